@@ -17,10 +17,10 @@
 """
 A composition system for creating backend objects.
 
-Backends implement install(), start() and stop() methods. A backend is composed
-of many mixins and each mixin will implement any/all of those methods and all
-will be called. Backends additionally provide for collecting property values
-from each mixin into a single final property on the backend.
+Backends implement install(), start(), reload() and stop() methods. A backend
+is composed of many mixins and each mixin will implement any/all of those
+methods and all will be called. Backends additionally provide for collecting
+property values from each mixin into a single final property on the backend.
 
 Mixins are not actually mixed in to the backend class using Python inheritance
 machinery. Instead, each mixin is instantiated and collected in the Backend
@@ -31,7 +31,9 @@ certain properties and methods are explicitly aggregated on the backend
 instance: see the call_methods function.
 
 There is also a feature for determining if configuration values have changed
-between old and new configurations so we can selectively take action.
+between old and new configurations so we can selectively take action. Mixins
+list in their "reloadable" attribute the configuration keys whose changes can
+be applied by their reload() method, without stopping the running services.
 
 The mixins appear in the code in the order they are instantiated by the
 backend. Keeping them that way is useful.
@@ -96,6 +98,11 @@ class GuiServerMixin(object):
     # server can use Tornado's curl_httpclient.
     debs = (
         'libcurl3', 'openssl', 'python-bzrlib', 'python-pip', 'python-pycurl')
+    # These options are stored in the builtin server options file, which is
+    # read again by the running server when it is reloaded.
+    reloadable = (
+        'bundleservice-url', 'charmstore-url', 'gisf-enabled', 'gtm-enabled',
+        'gzip-compression', 'interactive-login', 'juju-gui-debug', 'password')
 
     def install(self, backend):
         utils.install_builtin_server()
@@ -107,6 +114,16 @@ class GuiServerMixin(object):
                 config.get('ssl-key-contents'))
 
     def start(self, backend):
+        self._start_server(backend)
+
+    def reload(self, backend):
+        self._start_server(backend, reload=True)
+
+    def _start_server(self, backend, **kwargs):
+        """Start the builtin server, passing it the backend options.
+
+        Additional keyword arguments are passed to start_builtin_server.
+        """
         config = backend.config
         # In Juju < 2.0 the model UUID is present in the JUJU_ENV_UUID env var.
         env_uuid = os.getenv('JUJU_MODEL_UUID') or os.getenv('JUJU_ENV_UUID')
@@ -135,7 +152,8 @@ class GuiServerMixin(object):
             gzip=config['gzip-compression'],
             gtm_enabled=config['gtm-enabled'],
             gisf_enabled=config['gisf-enabled'],
-            charmstore_url=config['charmstore-url'])
+            charmstore_url=config['charmstore-url'],
+            **kwargs)
 
     def stop(self, backend):
         utils.stop_builtin_server()
@@ -192,6 +210,25 @@ class Backend(object):
             debs.update(getattr(mixin, 'debs', ()))
         return debs
 
+    def get_reloadable(self):
+        """Return a set of config keys that can be changed by reloading."""
+        keys = set()
+        for mixin in self.mixins:
+            keys.update(getattr(mixin, 'reloadable', ()))
+        return keys
+
+    def can_reload(self):
+        """Return whether the config changes can be applied by reloading.
+
+        This is True if a previous config is available and all the keys
+        changed since then are reloadable.
+        """
+        if not self.prev_config:
+            return False
+        keys = set(self.config).union(self.prev_config)
+        changed = set(key for key in keys if self.different(key))
+        return changed.issubset(self.get_reloadable())
+
     def install(self):
         """Execute the installation steps."""
         log('Installing dependencies.')
@@ -202,6 +239,13 @@ class Backend(object):
         """Execute the charm's "start" steps."""
         call_methods(self.mixins, 'start', self)
 
+    def reload(self):
+        """Apply the config changes without stopping the running services.
+
+        This can be used only when can_reload returns True.
+        """
+        call_methods(self.mixins, 'reload', self)
+
     def stop(self):
         """Execute the charm's "stop" steps.
 
@@ -18,11 +18,14 @@
 
 from contextlib import contextmanager
 from distutils.version import LooseVersion
+import hashlib
 import os
 import logging
+import platform
 import re
 import shutil
 from subprocess import CalledProcessError
+import sys
 import time
 import yaml
 
@@ -35,7 +38,11 @@ from charmhelpers.core.hookenv import (
     log,
     open_port,
 )
-from charmhelpers.core.host import service
+from charmhelpers.core.host import (
+    file_hash,
+    path_hash,
+    service,
+)
 from shelltoolbox import (
     apt_get_install,
     install_extra_repositories,
@@ -48,17 +55,24 @@ from shelltoolbox import (
 
 __all__ = [
     'CURRENT_DIR',
+    'DEPLOYMENTS_JOURNAL_PATH',
+    'GUISERVER_OPTIONS_PATH',
     'JUJU_GUI_DIR',
     'JUJU_PEM',
     'START',
     'STOP',
     'RELOAD',
     'RESTART',
+    'TOKENS_DB_PATH',
     'cmd_log',
     'find_missing_packages',
     'get_api_address',
+    'get_api_addresses',
     'get_port',
+    'get_python_deps_archive_path',
+    'get_python_deps_hash',
     'get_release_file_path',
+    'hash_paths',
     'install_missing_packages',
     'log_hook',
     'render_to_file',
@@ -67,17 +81,27 @@ __all__ = [
     'setup_ports',
     'start_builtin_server',
     'stop_builtin_server',
+    'unpack_python_deps',
 ]
 
 
 GUISERVER = 'guiserver'
+PYTHON_DEPS = 'python-deps'
 
 BASE_DIR = '/var/lib/juju-gui'
 CURRENT_DIR = os.getcwd()
 CONFIG_DIR = os.path.join(CURRENT_DIR, 'config')
 JUJU_GUI_DIR = os.path.join(BASE_DIR, 'juju-gui')
+DEPLOYMENTS_JOURNAL_PATH = os.path.join(BASE_DIR, 'deployments.journal')
+GUISERVER_OPTIONS_PATH = os.path.join(BASE_DIR, 'guiserver.options')
+INSTALL_HASHES_PATH = os.path.join(BASE_DIR, 'install-hashes.json')
 RELEASES_DIR = os.path.join(CURRENT_DIR, 'releases')
 SERVER_DIR = os.path.join(CURRENT_DIR, 'server')
+TOKENS_DB_PATH = os.path.join(BASE_DIR, 'tokens.db')
+# The location where pip installs Python packages system-wide.
+PYTHON_SITE_DIR = os.path.join(
+    os.path.sep, 'usr', 'local', 'lib',
+    'python{}.{}'.format(*sys.version_info[:2]), 'dist-packages')
 
 # Support both upstart via conf file in /etc/init
 # and systemd via service file in /lib/systemd/system
@@ -113,10 +137,18 @@ results_log = None
 def get_api_address(unit_dir=None):
     """Return the Juju API address.
 
+    """
+    return get_api_addresses(unit_dir)[0]
+
+
+def get_api_addresses(unit_dir=None):
+    """Return the list of Juju API addresses.
+
+    Multiple addresses are returned when the controller is highly available.
     """
     api_addresses = os.getenv('JUJU_API_ADDRESSES')
     if api_addresses is not None:
-        return api_addresses.split()[0]
+        return api_addresses.split()
     # The JUJU_API_ADDRESSES environment variable is not included in the hooks
     # context in older releases of juju-core.  Retrieve it from the machiner
     # agent file instead.
@@ -132,8 +164,7 @@ def get_api_address(unit_dir=None):
     else:
         raise IOError('Juju agent configuration file not found.')
     contents = yaml.load(open(agent_conf))
-    return contents['apiinfo']['addrs'][0]
-    return api_addresses.split()[0]
+    return contents['apiinfo']['addrs']
 
 
 @contextmanager
@@ -240,25 +271,160 @@ def get_port():
     return config.get('port', default_port) or default_port
 
 
+def hash_paths(*paths):
+    """Return a checksum of the files in the given paths.
+
+    Paths can include shell-style wildcards (see path_hash in
+    charmhelpers.core.host). Directories are walked recursively, ignoring
+    compiled Python files.
+    """
+    hashes = {}
+    for path in paths:
+        if not os.path.isdir(path):
+            hashes.update(path_hash(path))
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                if not filename.endswith('.pyc'):
+                    file_path = os.path.join(dirpath, filename)
+                    hashes[file_path] = file_hash(file_path)
+    checksum = hashlib.md5()
+    for file_path in sorted(hashes):
+        checksum.update('{} {}\n'.format(file_path, hashes[file_path]))
+    return checksum.hexdigest()
+
+
+def _is_installed(name, checksum):
+    """Return whether the named component is installed and up to date.
+
+    The component is up to date if it was installed from inputs with the given
+    checksum (see hash_paths).
+    """
+    installed = Serializer(INSTALL_HASHES_PATH).get()
+    return installed.get(name) == checksum
+
+
+def _set_installed(name, checksum):
+    """Record that the named component has been installed.
+
+    The given checksum identifies the inputs used for the installation.
+    """
+    install_hashes = Serializer(INSTALL_HASHES_PATH)
+    installed = dict(install_hashes.get())
+    installed[name] = checksum
+    install_hashes.set(installed)
+
+
+def get_python_deps_hash():
+    """Return a checksum of the packages included in the Python deps archive.
+
+    The checksum covers the server requirements file and the packages in the
+    deps and jujugui-deps directories. File names are relative to the charm
+    directory, so that the checksum computed when building the archive matches
+    the one computed on the units.
+    """
+    paths = [os.path.join(CURRENT_DIR, 'server-requirements.pip')]
+    for name in ('deps', 'jujugui-deps'):
+        directory = os.path.join(CURRENT_DIR, name)
+        if os.path.isdir(directory):
+            paths.extend(
+                os.path.join(directory, filename)
+                for filename in os.listdir(directory))
+    checksum = hashlib.md5()
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            checksum.update('{} {}\n'.format(
+                os.path.relpath(path, CURRENT_DIR), file_hash(path)))
+    return checksum.hexdigest()
+
+
+def get_python_deps_archive_path():
+    """Return the path of the pre-built Python dependencies archive.
+
+    The archive name includes the version of the last Juju GUI release, which
+    is packaged in the archive. It also includes the Python version, the
+    machine architecture and the Ubuntu series, as the C extensions in the
+    archive are only usable on the platform where they have been compiled (see
+    scripts/build_python_deps.py). Finally, it includes a short checksum of
+    the other packages in the archive (see get_python_deps_hash), so that an
+    archive built before the dependencies changed is not used.
+    """
+    release = os.path.basename(get_release_file_path())
+    version = release_expression.match(release).groups()[0]
+    tag = '-'.join([
+        'py{}{}'.format(*sys.version_info[:2]),
+        'ucs4' if sys.maxunicode > 0xffff else 'ucs2',
+        platform.machine(),
+        platform.linux_distribution()[2] or 'unknown',
+        get_python_deps_hash()[:12],
+    ])
+    filename = 'python-deps-{}-{}.tar.gz'.format(version, tag)
+    return os.path.join(RELEASES_DIR, filename)
+
+
+def unpack_python_deps():
+    """Install the Python dependencies from the pre-built archive.
+
+    Return True if the Juju GUI and the builtin server dependencies are
+    installed from the archive, False if the archive is missing, has been
+    built for another platform or from other dependencies, or cannot be
+    extracted. In the latter case the dependencies must be installed with pip.
+    """
+    archive_path = get_python_deps_archive_path()
+    if not os.path.exists(archive_path):
+        log('No up to date pre-built Python dependencies found for this '
+            'platform.')
+        return False
+    checksum = hash_paths(archive_path)
+    if _is_installed(PYTHON_DEPS, checksum):
+        return True
+    log('Unpacking the pre-built Python dependencies from {}.'.format(
+        archive_path))
+    with su('root'):
+        if not os.path.isdir(PYTHON_SITE_DIR):
+            os.makedirs(PYTHON_SITE_DIR)
+        try:
+            cmd_log(run('tar', '-xzf', archive_path, '-C', PYTHON_SITE_DIR))
+        except CalledProcessError as err:
+            log('Unable to unpack the Python dependencies: {}.'.format(err))
+            return False
+    _set_installed(PYTHON_DEPS, checksum)
+    return True
+
+
 def install_builtin_server():
-    """Install the builtin server code."""
-    log('Installing the builtin server dependencies.')
+    """Install the builtin server code.
+
+    Skip the installation if the dependencies and the server code did not
+    change since the last time the server was installed. The dependencies are
+    installed with pip only if the pre-built archive cannot be used.
+    """
     deps = os.path.join(CURRENT_DIR, 'deps')
     requirements = os.path.join(CURRENT_DIR, 'server-requirements.pip')
-    # Install the builtin server dependencies avoiding to download requirements
-    # from the network.
-    # XXX frankban: this pip installation here implicitly depends on juju-gui
-    # dependencies to be installed. In essence, this function does not fetch
-    # dependencies from the network only incidentally, because setup_gui() has
-    # been already called in the unit.
-    with su('root'):
-        cmd_log(run(
-            'pip2', 'install', '--no-index', '--no-dependencies',
-            '--find-links', 'file:///{}'.format(deps), '-r', requirements))
+    checksum = hash_paths(
+        os.path.join(deps, '*'), requirements,
+        os.path.join(SERVER_DIR, 'setup.py'),
+        os.path.join(SERVER_DIR, 'guiserver'))
+    if _is_installed(GUISERVER, checksum):
+        log('The builtin server is up to date.')
+        return
+    if not unpack_python_deps():
+        log('Installing the builtin server dependencies.')
+        # Install the builtin server dependencies avoiding to download
+        # requirements from the network.
+        # XXX frankban: this pip installation here implicitly depends on
+        # juju-gui dependencies to be installed. In essence, this function
+        # does not fetch dependencies from the network only incidentally,
+        # because setup_gui() has been already called in the unit.
+        with su('root'):
+            cmd_log(run(
+                'pip2', 'install', '--no-index', '--no-dependencies',
+                '--find-links', 'file:///{}'.format(deps), '-r', requirements))
     log('Installing the builtin server.')
     setup_cmd = os.path.join(SERVER_DIR, 'setup.py')
     with su('root'):
         cmd_log(run('/usr/bin/python', setup_cmd, 'install'))
+    _set_installed(GUISERVER, checksum)
 
 
 # TODO: add these config options -- some may no longer be necessary, some may
@@ -268,6 +434,16 @@ def install_builtin_server():
 # * read only (?)
 # * test serving (?)
 # * remove charmworld (?)
+def _option_literal(value):
+    """Return the given option value as a Python literal.
+
+    The resulting string can be included in the GUI server options file.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return repr(value)
+
+
 def write_builtin_server_startup(
         ssl_cert_path,
         serve_tests=False,
@@ -286,24 +462,39 @@ def write_builtin_server_startup(
         gtm_enabled=False,
         gisf_enabled=False,
         charmstore_url=None):
-    """Generate the builtin server Upstart file."""
+    """Generate the builtin server Upstart file and options file.
+
+    The options file includes the GUI server options which can be changed by
+    just reloading the server (see start_builtin_server).
+    """
+    log('Generating the builtin server options file.')
+    server_options = {
+        'bundleservice_url': bundleservice_url,
+        'charmstoreurl': charmstore_url,
+        'gisf': gisf_enabled,
+        'gtm': gtm_enabled,
+        'gzip': gzip,
+        'interactivelogin': interactive_login,
+        'jujuguidebug': debug,
+        'password': env_password,
+    }
+    options_context = dict(
+        (name, _option_literal(value))
+        for name, value in server_options.items())
+    render_to_file(
+        'guiserver.options.template', options_context, GUISERVER_OPTIONS_PATH)
+    # The options file may include the model password.
+    os.chmod(GUISERVER_OPTIONS_PATH, 0600)
     log('Generating the builtin server Upstart file.')
     context = {
         'builtin_server_logging': builtin_server_logging,
-        'charmstore_url': charmstore_url,
         'charmworld_url': charmworld_url,
-        'env_password': env_password,
         'env_uuid': env_uuid,
-        'gisf_enabled': gisf_enabled,
-        'gtm_enabled': gtm_enabled,
-        'gzip': gzip,
         'http_proxy': os.environ.get('http_proxy'),
         'https_proxy': os.environ.get('https_proxy'),
         'insecure': insecure,
-        'interactive_login': interactive_login,
-        'bundleservice_url': bundleservice_url,
-        'juju_gui_debug': debug,
         'juju_version': juju_version,
+        'options_path': GUISERVER_OPTIONS_PATH,
         'no_proxy': os.environ.get('no_proxy', os.environ.get('NO_PROXY')),
         'port': port,
         'sandbox': sandbox,
@@ -311,10 +502,14 @@ def write_builtin_server_startup(
         'ssl_cert_path': ssl_cert_path,
     }
     if not sandbox:
-        api_url = 'wss://{}'.format(get_api_address())
+        api_addresses = get_api_addresses()
+        api_url = 'wss://{}'.format(api_addresses[0])
         context.update({
+            'api_addresses': ','.join(api_addresses[1:]),
             'api_url': api_url,
             'api_version': 'go',
+            'deployments_journal': DEPLOYMENTS_JOURNAL_PATH,
+            'tokens_db': TOKENS_DB_PATH,
         })
     if serve_tests:
         context['tests_root'] = os.path.join(JUJU_GUI_DIR, 'test', '')
@@ -344,8 +539,14 @@ def start_builtin_server(
         gzip=True,
         gtm_enabled=False,
         gisf_enabled=False,
-        charmstore_url=None):
-    """Start the builtin server."""
+        charmstore_url=None,
+        reload=False):
+    """Start the builtin server.
+
+    If reload is True, the running server is asked to read its options file
+    again rather than being restarted, so that connections are preserved.
+    Only the options included in the options file can be changed this way.
+    """
     if (port is not None) and not port_in_range(port):
         # Do not use the user provided port if it is not valid.
         port = None
@@ -366,6 +567,11 @@ def start_builtin_server(
         gtm_enabled=gtm_enabled,
         gisf_enabled=gisf_enabled,
         charmstore_url=charmstore_url)
+    if reload:
+        log('Reloading the builtin server.')
+        with su('root'):
+            service(RELOAD, GUISERVER)
+        return
     log('Starting the builtin server.')
     with su('root'):
         service(RESTART, GUISERVER)
@@ -406,17 +612,29 @@ def get_release_file_path(version=None):
 
 
 def setup_gui():
-    """Set up Juju GUI."""
+    """Set up Juju GUI.
+
+    Skip the installation if the release and its dependencies did not change
+    since the last time the GUI was installed. The release is installed with
+    pip only if the pre-built archive cannot be used.
+    """
     # Install ensuring network access is not used.  All dependencies should
     # already be installed from the deps directory.
     jujugui_deps = os.path.join(CURRENT_DIR, 'jujugui-deps')
     release_tarball_path = get_release_file_path()
-    log('Installing Juju GUI from {}.'.format(release_tarball_path))
-    cmd = (
-        'pip2',  'install', '--no-index', '--find-links',
-        'file:///{}'.format(jujugui_deps), release_tarball_path)
-    with su('root'):
-        cmd_log(run(*cmd))
+    checksum = hash_paths(
+        os.path.join(jujugui_deps, '*'), release_tarball_path)
+    if _is_installed('jujugui', checksum):
+        log('Juju GUI is up to date.')
+        return
+    if not unpack_python_deps():
+        log('Installing Juju GUI from {}.'.format(release_tarball_path))
+        cmd = (
+            'pip2',  'install', '--no-index', '--find-links',
+            'file:///{}'.format(jujugui_deps), release_tarball_path)
+        with su('root'):
+            cmd_log(run(*cmd))
+    _set_installed('jujugui', checksum)
 
 
 def save_or_create_certificates(
@@ -424,13 +642,17 @@ def save_or_create_certificates(
     """Generate the SSL certificates.
 
     If both *ssl_cert_contents* and *ssl_key_contents* are provided, use them
-    as certificates; otherwise, generate them.
+    as certificates; otherwise, generate them. When generating certificates,
+    also generate an ECDSA certificate, used by the GUI server for clients
+    supporting it, as ECDSA handshakes are cheaper than RSA ones.
 
     Also create a pem file, suitable for use in the haproxy configuration,
     concatenating the key and the certificate files.
     """
     crt_path = os.path.join(ssl_cert_path, 'juju.crt')
     key_path = os.path.join(ssl_cert_path, 'juju.key')
+    ecdsa_crt_path = os.path.join(ssl_cert_path, 'juju-ecdsa.crt')
+    ecdsa_key_path = os.path.join(ssl_cert_path, 'juju-ecdsa.key')
     if not os.path.exists(ssl_cert_path):
         os.makedirs(ssl_cert_path)
     if ssl_cert_contents and ssl_key_contents:
@@ -439,16 +661,26 @@ def save_or_create_certificates(
             cert_file.write(ssl_cert_contents)
         with open(key_path, 'w') as key_file:
             key_file.write(ssl_key_contents)
+        # Do not serve a previously generated ECDSA certificate in place of
+        # the provided one.
+        for path in (ecdsa_crt_path, ecdsa_key_path):
+            if os.path.exists(path):
+                os.remove(path)
     else:
         # Generate certificates.
         # See http://superuser.com/questions/226192/openssl-without-prompt
         cn = 'your-jujugui-{0}.local'.format(int(time.time()))
+        # These are arbitrary test values for the certificate.
+        subj = '/C=GB/ST=Juju/L=GUI/O=Ubuntu/CN={0}'.format(cn)
         cmd_log(run(
             'openssl', 'req', '-new', '-newkey', 'rsa:4096',
-            '-days', '365', '-nodes', '-x509', '-subj',
-            # These are arbitrary test values for the certificate.
-            '/C=GB/ST=Juju/L=GUI/O=Ubuntu/CN={0}'.format(cn),
+            '-days', '365', '-nodes', '-x509', '-subj', subj,
             '-keyout', key_path, '-out', crt_path))
+        cmd_log(run(
+            'openssl', 'req', '-new', '-newkey', 'ec',
+            '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+            '-days', '365', '-nodes', '-x509', '-subj', subj,
+            '-keyout', ecdsa_key_path, '-out', ecdsa_crt_path))
     # Generate the pem file.
     pem_path = os.path.join(ssl_cert_path, JUJU_PEM)
     if os.path.exists(pem_path):
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Build the pre-built Python dependencies archive of the charm.
+
+The archive includes the last Juju GUI release and all the Juju GUI and
+builtin server dependencies, with their C extensions already compiled. The
+install hook unpacks it in the system site packages when it is compatible
+with the unit, falling back to installing each package with pip otherwise.
+The archive must be built again when the dependencies change: its name
+includes a checksum of the packages it has been built from.
+
+This script must be run from the charm root directory using a Python
+interpreter compatible with the one on the units ("make python-deps").
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+sys.path.insert(0, os.path.join(os.getcwd(), 'hooks'))
+import utils  # noqa
+
+
+def is_excluded(name):
+    """Return whether the given installed file must not be archived.
+
+    Console scripts are not used by the charm. The zope packages are installed
+    using apt by the install hook, so that the top level zope namespace
+    package includes both the deprecation and the interface subpackages.
+    """
+    return name == 'bin' or name.startswith('zope')
+
+
+def main():
+    archive_path = utils.get_python_deps_archive_path()
+    build_dir = tempfile.mkdtemp()
+    try:
+        # All the requirements are listed in the server requirements file.
+        subprocess.check_call([
+            sys.executable, '-m', 'pip', 'install', '--no-index',
+            '--no-dependencies', '--target', build_dir,
+            '--find-links', 'deps', '--find-links', 'jujugui-deps',
+            '-r', 'server-requirements.pip', utils.get_release_file_path()])
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            for name in sorted(os.listdir(build_dir)):
+                if not is_excluded(name):
+                    archive.add(os.path.join(build_dir, name), arcname=name)
+    finally:
+        shutil.rmtree(build_dir)
+    print('Python dependencies archived in {}.'.format(archive_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark bundle parsing, validation and change set generation.
+
+Time the steps performed by the GUI server when receiving bundles from
+clients, using synthetic v4 bundles including services, units placed on
+machines, containers and other units, and relations:
+  - yaml-python and yaml-libyaml: decoding the YAML contents, using the pure
+    Python and the libyaml based safe loaders (the latter only if available);
+  - validation: validating the bundle with jujubundlelib;
+  - constraints: parsing the service constraints;
+  - prepare: preparing the bundle for the deployer (see prepare_bundle);
+  - changeset: generating the bundle change set;
+  - import-params and validate-and-parse: the whole Import and
+    GetChangeSet request handling (see _validate_import_params and
+    _validate_and_parse_bundle in guiserver.bundles.views).
+
+Bundles are generated using a fixed seed, so that results are comparable
+across runs. Results are written as JSON, e.g.:
+
+    python -m benchmarks.bundles --sizes 1 10 100 1000 --output bundles.json
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import logging
+import platform
+import random
+import sys
+import time
+
+from charmworldlib.utils import parse_constraints
+from jujubundlelib import (
+    changeset,
+    validation,
+)
+import yaml
+
+import guiserver
+from guiserver.bundles.utils import prepare_bundle
+from guiserver.bundles.views import (
+    _validate_and_parse_bundle,
+    _validate_import_params,
+)
+
+
+# Define the relation names used by synthetic services.
+RELATIONS = ('db', 'cache', 'website', 'logging', 'monitoring')
+
+
+def make_bundle(size, seed):
+    """Return a synthetic v4 bundle with the given number of services.
+
+    Services have up to three units, constraints, options and annotations.
+    Units are placed on new machines, on bundle machines, in containers or
+    in containers on units of previously declared services. Each service is
+    related to up to three previously declared services. The same bundle is
+    returned for the same size and seed.
+    """
+    rand = random.Random(seed)
+    machines = {}
+    services = {}
+    relations = set()
+    for number in range(size):
+        name = 'service-{}'.format(number)
+        num_units = rand.randint(1, 3)
+        placements = []
+        for _ in range(rand.randint(0, num_units)):
+            kind = rand.choice(('machine', 'container', 'unit', 'new'))
+            if kind == 'unit' and number:
+                target = rand.choice(list(services))
+                placements.append('lxc:{}/0'.format(target))
+            elif kind in ('machine', 'container'):
+                machine = str(rand.randrange(max(size // 2, 1)))
+                machines[machine] = {
+                    'series': 'trusty',
+                    'constraints': 'mem={}G'.format(rand.choice((2, 4, 8))),
+                }
+                prefix = 'lxc:' if kind == 'container' else ''
+                placements.append(prefix + machine)
+            else:
+                placements.append('new')
+        service = {
+            'charm': 'cs:trusty/app{}-{}'.format(number, rand.randint(1, 99)),
+            'num_units': num_units,
+            'constraints': 'mem={}G cpu-cores={}'.format(
+                rand.choice((1, 2, 4)), rand.choice((1, 2))),
+            'options': dict(
+                ('option-{}'.format(i), rand.randint(0, 1000))
+                for i in range(rand.randint(0, 5))),
+            'annotations': {
+                'gui-x': str(rand.randint(0, 2000)),
+                'gui-y': str(rand.randint(0, 2000)),
+            },
+        }
+        if placements:
+            service['to'] = placements
+        if number:
+            for target in rand.sample(sorted(services), min(number, 3)):
+                relation = rand.choice(RELATIONS)
+                relations.add((
+                    '{}:{}'.format(name, relation),
+                    '{}:{}'.format(target, relation)))
+        services[name] = service
+    return {
+        'series': 'trusty',
+        'services': services,
+        'machines': machines,
+        'relations': sorted(list(relation) for relation in relations),
+    }
+
+
+def get_loaders():
+    """Return a list of (name, YAML safe loader class) tuples."""
+    loaders = [('yaml-python', yaml.SafeLoader)]
+    if getattr(yaml, '__with_libyaml__', False):
+        loaders.append(('yaml-libyaml', yaml.CSafeLoader))
+    return loaders
+
+
+def get_benchmarks(bundle):
+    """Return a list of (name, setup, function) tuples for the given bundle.
+
+    The setup function is called before each timed call, and returns the
+    arguments to be passed to the benchmarked function.
+    """
+    content = yaml.safe_dump(bundle)
+    constraints = [
+        service['constraints'] for service in bundle['services'].values()]
+    benchmarks = [
+        (name, lambda: (content,),
+         lambda content, loader=loader: yaml.load(content, Loader=loader))
+        for name, loader in get_loaders()
+    ]
+    benchmarks.extend([
+        ('validation', lambda: (bundle,), validation.validate),
+        ('constraints', lambda: (constraints,),
+         lambda constraints: [parse_constraints(i) for i in constraints]),
+        ('prepare', lambda: (copy.deepcopy(bundle),), prepare_bundle),
+        ('changeset', lambda: (bundle,),
+         lambda bundle: list(changeset.parse(bundle))),
+        ('import-params', lambda: ({'YAML': content, 'Version': 4},),
+         _validate_import_params),
+        ('validate-and-parse', lambda: (content,),
+         _validate_and_parse_bundle),
+    ])
+    return benchmarks
+
+
+def measure(setup, function, repeat):
+    """Return the sorted durations in seconds of repeat calls to function."""
+    durations = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.time()
+        function(*args)
+        durations.append(time.time() - start)
+    return sorted(durations)
+
+
+def run(sizes, seed, repeat):
+    """Run the benchmarks for the given bundle sizes.
+
+    Return a dict mapping bundle sizes to benchmark results. Each result maps
+    benchmark names to the best and the median durations in milliseconds.
+    """
+    results = {}
+    for size in sizes:
+        bundle = make_bundle(size, seed)
+        errors = validation.validate(bundle)
+        if errors:
+            raise ValueError('invalid synthetic bundle: {}'.format(errors))
+        size_results = results[str(size)] = {}
+        for name, setup, function in get_benchmarks(bundle):
+            durations = measure(setup, function, repeat)
+            size_results[name] = {
+                'Best': round(durations[0] * 1000, 3),
+                'Median': round(durations[len(durations) // 2] * 1000, 3),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[1, 10, 100, 1000],
+        help='the numbers of services in the benchmarked bundles')
+    parser.add_argument(
+        '--seed', type=int, default=42,
+        help='the seed used to generate bundles')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='the number of times each benchmark is repeated')
+    parser.add_argument(
+        '--output',
+        help='the path of the JSON results file (default: standard output)')
+    options = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    results = {
+        'Version': guiserver.get_version(),
+        'Python': platform.python_version(),
+        'Time': datetime.datetime.utcnow().isoformat(),
+        'Seed': options.seed,
+        'Repeat': options.repeat,
+        'Results': run(options.sizes, options.seed, options.repeat),
+    }
+    names = sorted(results['Results'][str(options.sizes[0])])
+    sys.stderr.write('{:>8} {}\n'.format(
+        'services', ' '.join('{:>18}'.format(name) for name in names)))
+    for size in options.sizes:
+        size_results = results['Results'][str(size)]
+        sys.stderr.write('{:>8} {}\n'.format(size, ' '.join(
+            '{:>15.3f} ms'.format(size_results[name]['Best'])
+            for name in names)))
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(encoded + '\n')
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Load test the Deployer with stubbed bundle validation and import.
+
+Run a Deployer whose worker processes validate and import bundles using stubs
+with configurable latencies, so that no Juju environment is required. Simulated
+clients then drive DeployMiddleware.process_request with Import, Watch, Next,
+Cancel and Status requests, as the GUI does:
+  - clients import bundles, all at the same time;
+  - watchers observe random deployments, calling Next until completion;
+  - random deployments are cancelled;
+  - clients poll the status of all deployments while they run.
+
+The results include the response latencies of each request type, the time
+from import requests to deployment completion, the IOLoop lag, the memory
+retained by the deployments Observer and the time spent notifying queue
+positions. Note that the Deployer submits a one second sleeping job after each
+import job, so that queued jobs can be cancelled: each deployment takes at
+least one second regardless of the import latency. Results are written as
+JSON, e.g.:
+
+    python -m benchmarks.deployer_load --imports 500 --watchers 1000
+"""
+
+import argparse
+import collections
+import datetime
+import itertools
+import json
+import logging
+import random
+import resource
+import sys
+import time
+
+from deployer import guiserver as blocking
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import guiserver
+from guiserver.auth import User
+from guiserver.bundles import (
+    utils,
+    workers,
+)
+from guiserver.bundles.base import (
+    Deployer,
+    DeployMiddleware,
+)
+
+
+# Define the interval in seconds between IOLoop lag samples.
+LAG_INTERVAL = 0.01
+# Define the interval in seconds between status requests.
+STATUS_INTERVAL = 0.1
+
+BUNDLE = 'services: {{wordpress-{}: {{charm: "cs:trusty/wordpress-42"}}}}'
+
+
+class _FakeEnvironment(object):
+    """An environment not connected to Juju."""
+
+    client = None
+
+    def close(self):
+        pass
+
+
+def install_stubs(validate_latency, import_latency):
+    """Replace the Juju dependent worker functions with stubs.
+
+    This must be called before the Deployer is created, so that worker
+    processes inherit the stubs. The stubs sleep for the given latencies,
+    and importing a bundle sends a progress event.
+    """
+    def validate(env, bundle):
+        time.sleep(validate_latency)
+
+    def import_bundle(
+            env, name, bundle, version, options, validate, deployment_id,
+            position=None):
+        if validate:
+            blocking._validate(env, bundle)
+        time.sleep(import_latency)
+        emit = workers._make_emitter(deployment_id, bundle=position)
+        emit('phase', 'deploy_services', import_latency)
+
+    workers.get_environment = lambda *args: _FakeEnvironment()
+    blocking._validate = validate
+    workers._import_bundle = import_bundle
+
+
+def percentiles(values):
+    """Return a dict of statistics in milliseconds for the given durations."""
+    values = sorted(values)
+    if not values:
+        return {'Count': 0}
+
+    def at(fraction):
+        index = int(round(fraction * (len(values) - 1)))
+        return round(values[index] * 1000, 3)
+
+    return {
+        'Count': len(values),
+        'P50': at(0.5),
+        'P99': at(0.99),
+        'Max': at(1),
+    }
+
+
+def deep_size(obj, seen=None):
+    """Return the approximate memory in bytes used by obj and its contents."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_size(key, seen) + deep_size(value, seen)
+            for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(vars(obj), seen)
+    for name in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, name):
+            size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+class Client(object):
+    """A simulated GUI client sending requests to the DeployMiddleware."""
+
+    def __init__(self, deployer, number, latencies, errors):
+        user = User(
+            username='user-{}'.format(number), password='secret',
+            is_authenticated=True)
+        self._middleware = DeployMiddleware(
+            user, deployer, self._write_response)
+        self._request_ids = itertools.count(1)
+        # Map request ids to (request type, start time, Future) tuples.
+        self._pending = {}
+        self._latencies = latencies
+        self._errors = errors
+
+    def call(self, request, **params):
+        """Send a Deployer request.
+
+        Return a Future whose result is the response.
+        """
+        request_id = next(self._request_ids)
+        future = gen.Future()
+        self._pending[request_id] = (request, time.time(), future)
+        self._middleware.process_request({
+            'RequestId': request_id,
+            'Type': 'Deployer',
+            'Request': request,
+            'Params': params,
+        })
+        return future
+
+    def close(self):
+        self._middleware.close()
+
+    def _write_response(self, response):
+        request, start, future = self._pending.pop(response['RequestId'])
+        self._latencies[request].append(time.time() - start)
+        if 'Error' in response:
+            self._errors[request] += 1
+        future.set_result(response)
+
+
+def _instrument(deployer, completions, notify_times):
+    """Record the deployment completion times and notify_position durations.
+
+    Completion times are stored in the given dict by deployment id, and
+    notify_position durations are appended to the given list.
+    """
+    import_callback = deployer._import_callback
+    notify_position = deployer._notify_position
+
+    def timed_import_callback(deployment_id, *args):
+        import_callback(deployment_id, *args)
+        completions[deployment_id] = time.time()
+
+    def timed_notify_position(deployment_id):
+        start = time.time()
+        notify_position(deployment_id)
+        notify_times.append(time.time() - start)
+
+    deployer._import_callback = timed_import_callback
+    deployer._notify_position = timed_notify_position
+
+
+def _watch_lag(io_loop, lags):
+    """Sample the IOLoop lag every LAG_INTERVAL seconds.
+
+    Return a function stopping the sampling.
+    """
+    state = {'expected': io_loop.time() + LAG_INTERVAL}
+
+    def sample():
+        now = io_loop.time()
+        lags.append(max(now - state['expected'], 0))
+        state['expected'] = now + LAG_INTERVAL
+        state['timeout'] = io_loop.add_timeout(state['expected'], sample)
+
+    state['timeout'] = io_loop.add_timeout(state['expected'], sample)
+    return lambda: io_loop.remove_timeout(state['timeout'])
+
+
+@gen.coroutine
+def watch(client, deployment_id):
+    """Watch the given deployment until it is completed or cancelled."""
+    response = yield client.call('Watch', DeploymentId=deployment_id)
+    if 'Error' in response:
+        return
+    watcher_id = response['Response']['WatcherId']
+    while True:
+        response = yield client.call('Next', WatcherId=watcher_id)
+        if 'Error' in response:
+            return
+        statuses = set(i['Status'] for i in response['Response']['Changes'])
+        if statuses & set([utils.COMPLETED, utils.CANCELLED]):
+            return
+
+
+@gen.coroutine
+def poll_status(client, deployer, io_loop):
+    """Request the deployments status until the deployer queue is empty."""
+    while True:
+        yield client.call('Status')
+        if not len(deployer._queue):
+            return
+        yield gen.Task(io_loop.add_timeout, io_loop.time() + STATUS_INTERVAL)
+
+
+@gen.coroutine
+def run(options, io_loop):
+    """Run the load test and return the results."""
+    rand = random.Random(options.seed)
+    deployer = Deployer('wss://juju.example.com:17070', 'go')
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    completions = {}
+    notify_times = []
+    lags = []
+    _instrument(deployer, completions, notify_times)
+    observer_size = deep_size(deployer._observer)
+    clients = [
+        Client(deployer, number, latencies, errors)
+        for number in range(options.clients)
+    ]
+    stop_lag = _watch_lag(io_loop, lags)
+    start = time.time()
+    # Import the bundles.
+    responses = yield [
+        clients[number % len(clients)].call(
+            'Import', YAML=BUNDLE.format(number), Version=4)
+        for number in range(options.imports)
+    ]
+    # Map deployment ids to the time their import was requested.
+    requested = {}
+    for response, delay in zip(responses, latencies['Import']):
+        if 'Error' not in response:
+            deployment_id = response['Response']['DeploymentId']
+            requested[deployment_id] = start + delay
+    deployment_ids = sorted(requested)
+    # Watch the deployments, cancel some of them and poll their status.
+    futures = [
+        watch(rand.choice(clients), rand.choice(deployment_ids))
+        for _ in range(options.watchers)
+    ]
+    futures.extend(
+        rand.choice(clients).call('Cancel', DeploymentId=deployment_id)
+        for deployment_id in rand.sample(
+            deployment_ids, min(options.cancels, len(deployment_ids))))
+    futures.append(poll_status(clients[0], deployer, io_loop))
+    yield futures
+    elapsed = time.time() - start
+    stop_lag()
+    for client in clients:
+        client.close()
+    deployer._validate_executor.shutdown()
+    deployer._run_executor.shutdown()
+    completed = [
+        completions[i] - requested[i] for i in deployment_ids
+        if i in completions]
+    raise gen.Return({
+        'Elapsed': round(elapsed, 3),
+        'Requests': dict(
+            (request, percentiles(values))
+            for request, values in latencies.items()),
+        'Errors': dict(errors),
+        'Deployments': percentiles(completed),
+        'IOLoopLag': percentiles(lags),
+        'NotifyPosition': dict(
+            percentiles(notify_times),
+            Total=round(sum(notify_times) * 1000, 3)),
+        'Observer': {
+            'SizeBefore': observer_size,
+            'SizeAfter': deep_size(deployer._observer),
+            'Deployments': len(deployer._observer.deployments),
+            'Watchers': len(deployer._observer.watchers),
+        },
+        'MaxRSS': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--imports', type=int, default=500,
+        help='the number of bundles imported')
+    parser.add_argument(
+        '--watchers', type=int, default=1000,
+        help='the number of deployment watchers')
+    parser.add_argument(
+        '--cancels', type=int, default=50,
+        help='the number of deployments cancelled')
+    parser.add_argument(
+        '--clients', type=int, default=50,
+        help='the number of simulated GUI clients')
+    parser.add_argument(
+        '--validate-latency', type=float, default=0.005,
+        help='the seconds spent validating each bundle')
+    parser.add_argument(
+        '--import-latency', type=float, default=0.01,
+        help='the seconds spent importing each bundle')
+    parser.add_argument(
+        '--seed', type=int, default=42,
+        help='the seed used to pick the watched and cancelled deployments')
+    parser.add_argument(
+        '--output',
+        help='the path of the JSON results file (default: standard output)')
+    options = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    install_stubs(options.validate_latency, options.import_latency)
+    io_loop = IOLoop.instance()
+    results = io_loop.run_sync(lambda: run(options, io_loop))
+    results.update({
+        'Version': guiserver.get_version(),
+        'Time': datetime.datetime.utcnow().isoformat(),
+        'Options': dict(
+            (key, value) for key, value in vars(options).items()
+            if key != 'output'),
+    })
+    sys.stderr.write(
+        '{Elapsed}s elapsed, deployment p50 {Deployments[P50]} ms, '
+        'IOLoop lag p99 {IOLoopLag[P99]} ms, notify_position total '
+        '{NotifyPosition[Total]} ms, observer {Observer[SizeAfter]} '
+        'bytes\n'.format(**results))
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(encoded + '\n')
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main()
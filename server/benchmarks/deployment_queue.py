@@ -0,0 +1,125 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the Deployer queue bookkeeping.
+
+Compare the time spent scheduling and completing deployments when using a
+plain list, re-notifying the positions of all the queued deployments on each
+completion, and when using the Deployer itself: deployments are completed
+through Deployer._import_callback, which only notifies the deployment started
+at the head of the queue, and clients poll the position of the last deployment
+through Deployer.next, which computes it from the queue ticket index.
+"""
+
+import argparse
+import logging
+import time
+
+from concurrent.futures import Future
+from tornado.ioloop import IOLoop
+
+from guiserver.bundles.base import Deployer
+from guiserver.bundles.utils import Observer
+
+
+def run_list(size, polls):
+    """Schedule and complete size deployments using a list as queue.
+
+    The positions of all the remaining deployments are notified each time a
+    deployment completes. The polls argument is ignored, as changes are
+    already pushed to the watchers. Return the elapsed time in seconds.
+    """
+    start = time.time()
+    observer = Observer()
+    queue = []
+    for _ in range(size):
+        deployment_id = observer.add_deployment()
+        observer.notify_position(deployment_id, len(queue))
+        queue.append(deployment_id)
+    while queue:
+        deployment_id = queue[0]
+        observer.notify_completed(deployment_id)
+        queue.remove(deployment_id)
+        for position, deploy_id in enumerate(queue):
+            observer.notify_position(deploy_id, position)
+    return time.time() - start
+
+
+def run_deployer(size, polls):
+    """Schedule and complete size deployments using a Deployer.
+
+    Deployments are queued as Deployer.import_bundle does, without submitting
+    jobs to the worker processes, and completed calling the Deployer import
+    callback. After each completion, polls clients ask for changes on the last
+    deployment in the queue. Return the elapsed time in seconds, excluding the
+    Deployer creation.
+    """
+    # Use an IO loop which is never started, so that worker processes are not
+    # spawned.
+    io_loop = IOLoop()
+    deployer = Deployer('wss://1.2.3.4:17070', 'go', io_loop=io_loop)
+    done = Future()
+    done.set_result(None)
+    try:
+        start = time.time()
+        last = None
+        for _ in range(size):
+            last = deployer._observer.add_deployment()
+            deployer._queue.append(last)
+            deployer._notify_position(last)
+            deployer._futures[last] = done
+        watcher_id = deployer.watch(last)
+        while len(deployer._queue):
+            deployer._import_callback(deployer._queue.first(), None, done)
+            for _ in range(polls):
+                deployer.next(watcher_id)
+        return time.time() - start
+    finally:
+        deployer.shutdown(wait=False)
+        io_loop.close(all_fds=True)
+
+
+def timeit(function, size, polls, repeat):
+    """Return the best time in seconds of repeat calls to function."""
+    return min(function(size, polls) for _ in range(repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[10, 100, 500, 1000],
+        help='the numbers of queued deployments to benchmark')
+    parser.add_argument(
+        '--polls', type=int, default=1,
+        help='position requests made by clients after each completion')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='the number of times each benchmark is repeated')
+    options = parser.parse_args()
+    # Avoid measuring the time spent logging changes.
+    logging.disable(logging.CRITICAL)
+    print('{:>8} {:>12} {:>12} {:>8}'.format(
+        'queued', 'list (s)', 'deployer (s)', 'speedup'))
+    for size in options.sizes:
+        list_time = timeit(run_list, size, options.polls, options.repeat)
+        deployer_time = timeit(
+            run_deployer, size, options.polls, options.repeat)
+        print('{:>8} {:>12.4f} {:>12.4f} {:>7.1f}x'.format(
+            size, list_time, deployer_time, list_time / deployer_time))
+
+
+if __name__ == '__main__':
+    main()
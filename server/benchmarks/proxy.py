@@ -0,0 +1,472 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the GUI server WebSocket proxy.
+
+Start the GUI server application (see guiserver.apps.server) and a fake Juju
+API server, each one in its own process, then connect simulated browser
+clients to the GUI server. Each client logs in, starts a megawatcher and
+repeatedly asks for the next deltas, which the fake Juju API replays from a
+recording. Report the frames per second, the round trip latency percentiles,
+and the CPU and memory used by the GUI server process, and write the results
+as JSON, so that they can be compared across releases, e.g.:
+
+    python -m benchmarks.proxy --clients 10 --duration 30 --output proxy.json
+
+A recording is a file including a JSON encoded list of megawatcher deltas per
+line, i.e. the Deltas field of AllWatcher.Next responses. If a recording is
+not provided, frames of synthetic deltas are generated using a fixed seed.
+When --direct is passed, clients connect to the fake Juju API directly, which
+provides a baseline for measuring the proxy overhead.
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from tornado import (
+    gen,
+    web,
+    websocket,
+)
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+import guiserver
+from guiserver.clients import websocket_connect
+
+
+# Define the model UUID used by the fake Juju API.
+MODEL_UUID = 'e4f1a55e-9d4c-4c6a-8a5e-6ab7e1c0b9f1'
+# Define the number of seconds to wait for the servers to start.
+STARTUP_TIMEOUT = 30
+
+
+def generate_frames(count, services, seed):
+    """Return a list of count frames of synthetic megawatcher deltas.
+
+    Deltas describe the given number of services, their units and machines.
+    The same frames are returned for the same seed.
+    """
+    rand = random.Random(seed)
+    frames = []
+    for _ in range(count):
+        deltas = []
+        for _ in range(rand.randint(1, 20)):
+            service = 'service-{}'.format(rand.randrange(services))
+            kind = rand.choice(('service', 'unit', 'unit', 'machine'))
+            if kind == 'service':
+                data = {
+                    'Name': service,
+                    'CharmURL': 'cs:trusty/{}-42'.format(service),
+                    'Exposed': rand.choice((True, False)),
+                    'Config': {'debug': rand.choice((True, False))},
+                }
+            elif kind == 'unit':
+                machine = str(rand.randrange(services * 3))
+                data = {
+                    'Name': '{}/{}'.format(service, rand.randrange(3)),
+                    'Service': service,
+                    'MachineId': machine,
+                    'Status': rand.choice(('pending', 'started', 'error')),
+                    'PublicAddress': '10.0.{}.{}'.format(
+                        rand.randrange(256), rand.randrange(256)),
+                }
+            else:
+                data = {
+                    'Id': str(rand.randrange(services * 3)),
+                    'InstanceId': 'i-{:08x}'.format(rand.getrandbits(32)),
+                    'Status': rand.choice(('pending', 'started')),
+                }
+            deltas.append([kind, 'change', data])
+        frames.append(deltas)
+    return frames
+
+
+def load_frames(path):
+    """Return the frames included in the recording at the given path."""
+    with open(path) as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+class FakeJujuHandler(websocket.WebSocketHandler):
+    """A fake Juju API WebSocket server replaying megawatcher frames.
+
+    Login and WatchAll requests always succeed, and each AllWatcher.Next
+    request receives the next recorded frame. Other requests receive an empty
+    response.
+    """
+
+    def initialize(self, frames):
+        self._frames = itertools.cycle(frames)
+
+    def on_message(self, message):
+        data = json.loads(message)
+        key = data.get('Type'), data.get('Request')
+        response = {}
+        if key == ('Client', 'WatchAll'):
+            response = {'AllWatcherId': '1'}
+        elif key == ('AllWatcher', 'Next'):
+            response = {'Deltas': next(self._frames)}
+        self.write_message(json.dumps(
+            {'RequestId': data.get('RequestId'), 'Response': response}))
+
+
+def get_usage():
+    """Return the CPU seconds and the peak RSS in MiB of this process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'CPU': usage.ru_utime + usage.ru_stime,
+        'MaxRSS': usage.ru_maxrss / 1024.0,
+    }
+
+
+def _serve_usage(connection, io_loop):
+    """Answer the usage requests made by the benchmark process.
+
+    Each request received through the given multiprocessing connection is
+    answered with the current resource usage.
+    """
+    def handle(fd, events):
+        connection.recv()
+        connection.send(get_usage())
+
+    io_loop.add_handler(connection.fileno(), handle, io_loop.READ)
+    io_loop.add_callback(connection.send, 'ready')
+
+
+def run_juju(connection, port, sslpath, frames):
+    """Run the fake Juju API server (in a separate process)."""
+    io_loop = IOLoop.instance()
+    app = web.Application([(r'.*', FakeJujuHandler, {'frames': frames})])
+    app.listen(port, address='localhost', ssl_options={
+        'certfile': os.path.join(sslpath, 'juju.crt'),
+        'keyfile': os.path.join(sslpath, 'juju.key'),
+    })
+    _serve_usage(connection, io_loop)
+    io_loop.start()
+
+
+def run_guiserver(connection, port, sslpath, juju_port, secure):
+    """Run the GUI server (in a separate process).
+
+    The server is set up and started by guiserver.manage, as in production.
+    """
+    from guiserver import manage
+    sys.argv = [
+        'guiserver',
+        '--apiurl=wss://localhost:{}/model/{}/api'.format(
+            juju_port, MODEL_UUID),
+        '--port={}'.format(port),
+        '--sslpath={}'.format(sslpath),
+        '--uuid={}'.format(MODEL_UUID),
+        '--jujuversion=2.0.0',
+        '--logging=warning',
+    ]
+    if not secure:
+        sys.argv.append('--insecure')
+    manage.setup()
+    _serve_usage(connection, IOLoop.instance())
+    manage.run()
+
+
+class Client(object):
+    """A simulated browser connected to the Juju API through a WebSocket."""
+
+    def __init__(self, io_loop, url):
+        self._io_loop = io_loop
+        self._url = url
+        self._request_ids = itertools.count(1)
+        # Map request ids to the Futures waiting for responses.
+        self._pending = {}
+        self._connection = None
+        self.received_bytes = 0
+
+    @gen.coroutine
+    def connect(self):
+        self._connection = yield websocket_connect(
+            self._io_loop, self._url, self._on_message)
+
+    def call(self, type_, request, params=None, **kwargs):
+        """Send an API request.
+
+        Return a Future whose result is the decoded response.
+        """
+        request_id = next(self._request_ids)
+        data = {
+            'RequestId': request_id,
+            'Type': type_,
+            'Request': request,
+            'Params': params or {},
+        }
+        data.update(kwargs)
+        future = self._pending[request_id] = Future()
+        self._connection.write_message(json.dumps(data))
+        return future
+
+    def close(self):
+        self._connection.close()
+
+    def _on_message(self, message):
+        if message is None:
+            # The connection has been closed.
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(IOError('connection closed'))
+            return
+        self.received_bytes += len(message)
+        data = json.loads(message)
+        future = self._pending.pop(data.get('RequestId'), None)
+        if future is not None:
+            future.set_result(data)
+
+
+@gen.coroutine
+def run_client(io_loop, url, start, deadline, latencies):
+    """Connect a client and ask for megawatcher frames until the deadline.
+
+    The round trip latencies of the frames received after start are appended
+    to the given list. Return the number of bytes received after start.
+    """
+    client = Client(io_loop, url)
+    yield client.connect()
+    yield client.call(
+        'Admin', 'Login', {'AuthTag': 'user-admin', 'Password': 'secret'})
+    response = yield client.call('Client', 'WatchAll')
+    watcher_id = response['Response']['AllWatcherId']
+    received_bytes = 0
+    while True:
+        before = time.time()
+        if before >= deadline:
+            break
+        if before < start:
+            received_bytes = client.received_bytes
+        yield client.call('AllWatcher', 'Next', Id=watcher_id)
+        if before >= start:
+            latencies.append(time.time() - before)
+    client.close()
+    raise gen.Return(client.received_bytes - received_bytes)
+
+
+def percentile(values, fraction):
+    """Return the given percentile (as a fraction) of the sorted values."""
+    if not values:
+        return 0
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def make_certificate(path):
+    """Generate a self-signed certificate in the given directory.
+
+    The juju.crt and juju.key file names are the ones used by the GUI server.
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-new', '-newkey', 'rsa:2048', '-days', '1',
+            '-nodes', '-x509', '-subj', '/CN=localhost',
+            '-keyout', os.path.join(path, 'juju.key'),
+            '-out', os.path.join(path, 'juju.crt'),
+        ], stdout=devnull, stderr=devnull)
+
+
+def get_unused_port():
+    """Return a TCP port number currently not in use on localhost."""
+    sock = socket.socket()
+    try:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def _run_in_group(target, *args):
+    """Call the given function in a new process group."""
+    os.setpgrp()
+    target(*args)
+
+
+def start_process(target, *args):
+    """Run the given server function in a separate process.
+
+    The process leads its own process group, so that it can be stopped
+    together with its children, e.g. the GUI server deployer workers.
+    Return a (process, connection) tuple, once the server is ready.
+    """
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_run_in_group, args=(target, child_connection) + args)
+    process.start()
+    if not connection.poll(STARTUP_TIMEOUT):
+        stop_process(process)
+        raise RuntimeError('{} did not start'.format(target.__name__))
+    connection.recv()
+    return process, connection
+
+
+def stop_process(process):
+    """Terminate the given process and its process group."""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    process.join()
+
+
+def benchmark(options, frames, sslpath):
+    """Run the benchmark with the given options and return the results."""
+    juju_port = get_unused_port()
+    juju, juju_connection = start_process(
+        run_juju, juju_port, sslpath, frames)
+    processes = [(juju, juju_connection)]
+    try:
+        if options.direct:
+            url = 'wss://localhost:{}/model/{}/api'.format(
+                juju_port, MODEL_UUID)
+            measured = juju_connection
+        else:
+            port = get_unused_port()
+            server, measured = start_process(
+                run_guiserver, port, sslpath, juju_port, options.secure)
+            processes.append((server, measured))
+            url = '{}://localhost:{}/ws/model-api/localhost/{}/{}'.format(
+                'wss' if options.secure else 'ws', port, juju_port,
+                MODEL_UUID)
+        io_loop = IOLoop.instance()
+        start = time.time() + options.warmup
+        deadline = start + options.duration
+        latencies = []
+        measured.send('usage')
+        usage_before = measured.recv()
+
+        @gen.coroutine
+        def run_clients():
+            results = yield [
+                run_client(io_loop, url, start, deadline, latencies)
+                for _ in range(options.clients)
+            ]
+            raise gen.Return(sum(results))
+
+        received_bytes = io_loop.run_sync(
+            run_clients,
+            timeout=options.warmup + options.duration + STARTUP_TIMEOUT)
+        measured.send('usage')
+        usage_after = measured.recv()
+    finally:
+        # Stop the GUI server before the fake Juju API.
+        for process, _ in reversed(processes):
+            stop_process(process)
+    latencies.sort()
+    cpu = usage_after['CPU'] - usage_before['CPU']
+    to_ms = lambda value: round(value * 1000, 3)
+    return {
+        'FramesPerSecond': round(len(latencies) / options.duration, 1),
+        'MegabytesPerSecond': round(
+            received_bytes / options.duration / 2 ** 20, 3),
+        'Frames': len(latencies),
+        'Latency': {
+            'Mean': to_ms(sum(latencies) / max(len(latencies), 1)),
+            'P50': to_ms(percentile(latencies, 0.5)),
+            'P99': to_ms(percentile(latencies, 0.99)),
+            'Max': to_ms(percentile(latencies, 1)),
+        },
+        'Server': {
+            'CPUSeconds': round(cpu, 3),
+            'CPUPercent': round(100 * cpu / options.duration, 1),
+            'MaxRSS': round(usage_after['MaxRSS'], 1),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--clients', type=int, default=10,
+        help='the number of simulated browser clients')
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='the number of seconds frames are measured')
+    parser.add_argument(
+        '--warmup', type=float, default=2,
+        help='the number of seconds before starting measuring')
+    parser.add_argument(
+        '--recording',
+        help='the megawatcher recording to replay (see above)')
+    parser.add_argument(
+        '--frames', type=int, default=100,
+        help='the number of synthetic frames when not using a recording')
+    parser.add_argument(
+        '--services', type=int, default=50,
+        help='the number of services described by synthetic frames')
+    parser.add_argument(
+        '--seed', type=int, default=42,
+        help='the seed used to generate synthetic frames')
+    parser.add_argument(
+        '--secure', action='store_true',
+        help='connect clients to the GUI server using TLS')
+    parser.add_argument(
+        '--direct', action='store_true',
+        help='connect clients directly to the fake Juju API')
+    parser.add_argument(
+        '--output',
+        help='the path of the JSON results file (default: standard output)')
+    options = parser.parse_args()
+    logging.disable(logging.WARNING)
+    if options.recording:
+        frames = load_frames(options.recording)
+    else:
+        frames = generate_frames(
+            options.frames, options.services, options.seed)
+    sslpath = tempfile.mkdtemp()
+    try:
+        make_certificate(sslpath)
+        results = benchmark(options, frames, sslpath)
+    finally:
+        shutil.rmtree(sslpath)
+    results.update({
+        'Version': guiserver.get_version(),
+        'Time': datetime.datetime.utcnow().isoformat(),
+        'Options': dict(
+            (key, value) for key, value in vars(options).items()
+            if key != 'output'),
+    })
+    sys.stderr.write(
+        '{FramesPerSecond} frames/s, p50 {Latency[P50]} ms, '
+        'p99 {Latency[P99]} ms, CPU {Server[CPUPercent]}%, '
+        'max RSS {Server[MaxRSS]} MiB\n'.format(**results))
+    encoded = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(encoded + '\n')
+    else:
+        print(encoded)
+
+
+if __name__ == '__main__':
+    main()
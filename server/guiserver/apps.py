@@ -17,20 +17,25 @@
 """Juju GUI server applications."""
 
 from distutils.version import LooseVersion
+import logging
+import threading
 import time
+import urlparse
 
-from pyramid.config import Configurator
+from concurrent.futures import ThreadPoolExecutor
 from tornado import web
+from tornado.ioloop import IOLoop
 from tornado.options import options
 from tornado.wsgi import WSGIContainer
 
 from guiserver import (
     auth,
+    clients,
     handlers,
+    tokenstores,
     utils,
 )
 from guiserver.bundles.base import Deployer
-from jujugui import make_application
 
 
 # Define the templates to use for building the WebSocket URLs.
@@ -39,17 +44,170 @@ WEBSOCKET_CONTROLLER_TARGET_TEMPLATE = 'wss://{server}:{port}/api'
 WEBSOCKET_MODEL_SOURCE_TEMPLATE = '/ws/model-api/$server/$port/$uuid'
 WEBSOCKET_MODEL_TARGET_TEMPLATE = 'wss://{server}:{port}/model/{uuid}/api'
 WEBSOCKET_TARGET_TEMPLATE_PRE2 = 'wss://{server}:{port}/environment/{uuid}/api'
+# Define the seconds clients are asked to wait before retrying when the Juju
+# GUI application cannot be loaded.
+LOADING_RETRY_AFTER = 10
 
 
-def server():
+def _write_unavailable(request, retry_after):
+    """Reply to the given request with a 503 Service Unavailable error.
+
+    Ask the client to retry after the given number of seconds.
+    """
+    body = 'The Juju GUI is not available, please retry later.\n'
+    request.write(
+        'HTTP/1.1 503 Service Unavailable\r\n'
+        'Content-Type: text/plain\r\n'
+        'Content-Length: {}\r\n'
+        'Retry-After: {}\r\n\r\n{}'.format(len(body), retry_after, body))
+    request.finish()
+
+
+class GuiApplication(object):
+    """The Juju GUI WSGI application, built the first time it is needed.
+
+    Importing and configuring the Pyramid application is the slowest part of
+    the server start up: deferring it allows the server to handle WebSocket
+    and server info requests as soon as it is listening. The application is
+    always built in a separate thread (see load_async), so that the IO loop is
+    never blocked: requests coming in while it is being built are handled as
+    soon as it is ready.
+    """
+
+    def __init__(self, settings):
+        """Initialize the application using the given GUI settings."""
+        self.settings = settings
+        self._container = None
+        # The application is built by a separate thread: the lock prevents
+        # concurrent builds, e.g. when load is called from other threads.
+        self._lock = threading.Lock()
+        # Store the future of the build in progress, if any.
+        self._loading = None
+
+    def load(self):
+        """Build the WSGI application if required, and return its container.
+
+        The returned container is a tornado.wsgi.WSGIContainer instance.
+        If the application is being built by another thread, wait for it.
+        This method blocks: do not call it from the IO loop thread.
+        """
+        with self._lock:
+            if self._container is None:
+                self._container = self._build()
+            return self._container
+
+    def load_async(self):
+        """Build the WSGI application in a separate thread.
+
+        Return a Future whose result is the WSGI container. If the application
+        is already being built, return the future of the build in progress.
+        If the last build failed, try again.
+        """
+        loading = self._loading
+        if loading is None or (
+                loading.done() and loading.exception() is not None):
+            executor = ThreadPoolExecutor(1)
+            self._loading = executor.submit(self.load)
+            executor.shutdown(wait=False)
+        return self._loading
+
+    def reload(self, settings):
+        """Replace the GUI settings with the given ones.
+
+        If the WSGI application is already loaded, it is rebuilt right away
+        using the new settings.
+        """
+        with self._lock:
+            loaded = self._container is not None
+            self.settings = settings
+            self._container = None
+            if loaded:
+                self._container = self._build()
+
+    def _build(self):
+        """Build and return the WSGI container."""
+        start_time = time.time()
+        from pyramid.config import Configurator
+        from jujugui import make_application
+        config = Configurator(settings=self.settings)
+        container = WSGIContainer(make_application(config))
+        logging.info('Juju GUI application loaded in {:.0f} ms'.format(
+            (time.time() - start_time) * 1000))
+        return container
+
+    def _loaded(self, request, future):
+        """Handle the given request queued while the application was loading.
+
+        If the application cannot be loaded, reply with a 503 error: the
+        application is loaded again when the next request comes in.
+        """
+        try:
+            container = future.result()
+        except Exception as err:
+            logging.error(
+                'cannot load the Juju GUI application: {}'.format(err))
+            _write_unavailable(request, LOADING_RETRY_AFTER)
+            return
+        container(request)
+
+    def __call__(self, request):
+        """Handle the given request, building the application if required.
+
+        This way the application can be used as a web.FallbackHandler
+        fallback. This method is called in the IO loop thread: if the
+        application is not loaded yet, the request is handled when it is.
+        """
+        container = self._container
+        if container is not None:
+            return container(request)
+        utils.add_future(
+            IOLoop.current(), self.load_async(), self._loaded, request)
+
+
+def get_gui_settings():
+    """Return the Juju GUI WSGI application settings.
+
+    The settings are built from the current server options.
+    """
+    settings = {
+        'jujugui.apiAddress': options.apiurl,
+        'jujugui.combine': not options.jujuguidebug,
+        'jujugui.gisf': options.gisf,
+        'jujugui.GTM_enabled': options.gtm,
+        'jujugui.gzip': options.gzip,
+        'jujugui.insecure': options.insecure,
+        'jujugui.interactive_login': options.interactivelogin,
+        'jujugui.bundleservice_url': options.bundleservice_url,
+        'jujugui.charmstore_url': options.charmstoreurl,
+        'jujugui.jujuCoreVersion': options.jujuversion,
+        'jujugui.raw': options.jujuguidebug,
+        'jujugui.sandbox': options.sandbox,
+        'jujugui.controllerSocketTemplate': (
+            WEBSOCKET_CONTROLLER_SOURCE_TEMPLATE),
+        'jujugui.socketTemplate': WEBSOCKET_MODEL_SOURCE_TEMPLATE,
+        'jujugui.uuid': options.uuid,
+    }
+    if options.password:
+        settings['jujugui.password'] = options.password
+    return settings
+
+
+def server(tls_stats=None):
     """Return the main server application.
 
     The server app is responsible for serving the WebSocket connection, the
     Juju GUI static files and the main index file for dynamic URLs.
+    If provided, the TLS handshake statistics are exposed by the info handler.
+    The Juju GUI application (see GuiApplication), the bundle deployer and the
+    set of connected WebSocket handlers are stored in the gui_application,
+    deployer and connections settings of the returned app.
     """
     # Set up the bundle deployer.
     deployer = Deployer(options.apiurl, options.apiversion,
-                        options.charmworldurl)
+                        options.charmworldurl, model_uuid=options.uuid,
+                        journal_path=options.deploymentsjournal)
+    # Keep track of the connected WebSocket handlers.
+    connections = set()
     # Set up handlers.
     server_handlers = []
     if options.sandbox:
@@ -59,7 +217,16 @@ def server():
     else:
         # Real environment.
         is_legacy_juju = LooseVersion(options.jujuversion) < LooseVersion('2')
-        tokens = auth.AuthenticationTokenHandler()
+        token_store = None
+        if options.tokensdb:
+            token_store = tokenstores.SQLiteTokenStore(options.tokensdb)
+        tokens = auth.AuthenticationTokenHandler(store=token_store)
+        endpoints = None
+        if options.apiaddresses:
+            # Spread connections across the controller API servers.
+            address = urlparse.urlsplit(options.apiurl).netloc
+            endpoints = clients.EndpointPool(
+                [address] + options.apiaddresses)
         auth_backend = auth.get_backend(options.apiversion)
         ws_model_target_template = WEBSOCKET_MODEL_TARGET_TEMPLATE
         if is_legacy_juju:
@@ -75,6 +242,10 @@ def server():
                 'deployer': deployer,
                 # The tokens collection for authentication token requests.
                 'tokens': tokens,
+                # The optional Juju API endpoints of an HA controller.
+                'endpoints': endpoints,
+                # The set of connected WebSocket handlers.
+                'connections': connections,
                 # The WebSocket URL template the browser uses for connecting.
                 'ws_source_template': WEBSOCKET_CONTROLLER_SOURCE_TEMPLATE,
                 # The WebSocket URL template used for connecting to Juju.
@@ -92,6 +263,10 @@ def server():
             'deployer': deployer,
             # The tokens collection for authentication token requests.
             'tokens': tokens,
+            # The optional Juju API endpoints of an HA controller.
+            'endpoints': endpoints,
+            # The set of connected WebSocket handlers.
+            'connections': connections,
             # The WebSocket URL template the browser uses for the connection.
             'ws_source_template': WEBSOCKET_MODEL_SOURCE_TEMPLATE,
             # The WebSocket URL template used for connecting to Juju.
@@ -122,35 +297,17 @@ def server():
         'deployer': deployer,
         'sandbox': options.sandbox,
         'start_time': int(time.time()),
+        'tls_stats': tls_stats,
     }
-    wsgi_settings = {
-        'jujugui.apiAddress': options.apiurl,
-        'jujugui.combine': not options.jujuguidebug,
-        'jujugui.gisf': options.gisf,
-        'jujugui.GTM_enabled': options.gtm,
-        'jujugui.gzip': options.gzip,
-        'jujugui.insecure': options.insecure,
-        'jujugui.interactive_login': options.interactivelogin,
-        'jujugui.bundleservice_url': options.bundleservice_url,
-        'jujugui.charmstore_url': options.charmstoreurl,
-        'jujugui.jujuCoreVersion': options.jujuversion,
-        'jujugui.raw': options.jujuguidebug,
-        'jujugui.sandbox': options.sandbox,
-        'jujugui.controllerSocketTemplate': (
-            WEBSOCKET_CONTROLLER_SOURCE_TEMPLATE),
-        'jujugui.socketTemplate': WEBSOCKET_MODEL_SOURCE_TEMPLATE,
-        'jujugui.uuid': options.uuid,
-    }
-    if options.password:
-        wsgi_settings['jujugui.password'] = options.password
-    config = Configurator(settings=wsgi_settings)
-    wsgi_app = WSGIContainer(make_application(config))
+    gui_application = GuiApplication(get_gui_settings())
     server_handlers.extend([
         # Handle GUI server info.
         (r'^/gui-server-info', handlers.InfoHandler, info_handler_options),
-        (r".*", web.FallbackHandler, dict(fallback=wsgi_app))
+        (r".*", web.FallbackHandler, dict(fallback=gui_application))
     ])
-    return web.Application(server_handlers, debug=options.debug)
+    return web.Application(
+        server_handlers, debug=options.debug, gui_application=gui_application,
+        deployer=deployer, connections=connections)
 
 
 def redirector():
@@ -41,16 +41,20 @@ This module includes the pieces required to process user authentication.
     - AuthenticationTokenHandler: This handles authentication token creation
       and usage requests.  It is used both by the AuthMiddleware and by
       handlers.WebSocketHandler in the ``on_message`` and ``on_juju_message``
-      methods.
+      methods.  Tokens are kept in a pluggable store (see
+      guiserver.tokenstores).
 """
 
 import copy
 import datetime
 import logging
+import time
 import uuid
 
 from tornado.ioloop import IOLoop
 
+from guiserver import tokenstores
+
 
 class User(object):
     """The current WebSocket user."""
@@ -153,6 +157,20 @@ class AuthMiddleware(object):
                         data, user)
         return data
 
+    def make_resume_request(self, request_id):
+        """Return a login request for the authenticated user.
+
+        The request is used to log in again when the connection to the Juju
+        API server is re-established.
+        """
+        user = self._user
+        return self._backend.make_request(
+            request_id, user.username, user.password)
+
+    def resume_succeeded(self, data):
+        """Return True if data represents a successful resume login."""
+        return self._backend.login_succeeded(data)
+
 
 class GoBackend(object):
     """Authentication backend for the Juju Go API implementation.
@@ -287,12 +305,17 @@ class AuthenticationTokenHandler(object):
         }
     """
 
-    def __init__(self, max_life=datetime.timedelta(minutes=2), io_loop=None):
+    def __init__(
+            self, max_life=datetime.timedelta(minutes=2), io_loop=None,
+            store=None):
         self._max_life = max_life
         if io_loop is None:
             io_loop = IOLoop.current()
         self._io_loop = io_loop
-        self._data = {}
+        if store is None:
+            store = tokenstores.MemoryTokenStore()
+        self._store = store
+        self._purge_handle = None
 
     def token_requested(self, data):
         """Does data represent a token creation request?  True or False."""
@@ -312,21 +335,17 @@ class AuthenticationTokenHandler(object):
                 Response={}))
             return
         token = uuid.uuid4().hex
-
-        def expire_token():
-            self._data.pop(token, None)
-            logging.info('auth: expired token {}'.format(token))
-        handle = self._io_loop.add_timeout(self._max_life, expire_token)
         now = datetime.datetime.utcnow()
+        expires = time.time() + self._max_life.total_seconds()
         # Stashing these is a security risk.  We currently deem this risk to
         # be acceptably small.  Even keeping an authenticated websocket in
         # memory seems to be of a similar risk profile, and we cannot operate
         # without that.
-        self._data[token] = dict(
-            username=user.username,
-            password=user.password,
-            handle=handle
-            )
+        self._store.put(token, user.username, user.password, expires)
+        # Expired tokens are rejected by the store: periodically remove them.
+        if self._purge_handle is None:
+            self._purge_handle = self._io_loop.add_timeout(
+                self._max_life, self._purge)
         write_message({
             'RequestId': data['RequestId'],
             'Response': {
@@ -336,6 +355,13 @@ class AuthenticationTokenHandler(object):
             }
         })
 
+    def _purge(self):
+        """Remove the expired tokens from the store."""
+        self._purge_handle = None
+        count = self._store.purge()
+        if count:
+            logging.info('auth: expired {} token(s)'.format(count))
+
     def authentication_requested(self, data):
         """Does data represent a token authentication request? True or False.
         """
@@ -350,11 +376,10 @@ class AuthenticationTokenHandler(object):
     def process_authentication_request(self, data, write_message):
         """Get the credentials for the token, or send an error."""
         token = data['Params']['Token']
-        credentials = self._data.pop(token, None)
+        credentials = self._store.pop(token)
         if credentials is not None:
             logging.info('auth: using token {}'.format(token))
-            self._io_loop.remove_timeout(credentials['handle'])
-            return credentials['username'], credentials['password']
+            return credentials
         else:
             write_message({
                 'RequestId': data['RequestId'],
@@ -23,6 +23,10 @@ base module:
     - base.Deployer: any object implementing the following interface:
         - validate(user, name, bundle) -> Future (str or None);
         - import_bundle(user, name, bundle) -> int (a deployment id);
+        - validate_batch(user, bundles) -> Future (list of str or None);
+        - import_batch(user, bundles) -> int (a deployment id);
+        - diff(bundle) -> (changes, total) or None;
+        - import_changes(user, name, bundle, changes) -> int (a deployment id);
         - watch(deployment_id) -> int or None (a watcher id);
         - next(watcher_id) -> Future (changes or None);
         - status() -> list (of changes).
@@ -43,6 +47,13 @@ base module:
       the WebSocket request/response aspects, or how incoming data is retrieved
       or generated.
 
+      When the WebSocket handlers proxy megawatcher deltas for the model where
+      bundles are deployed, the Deployer keeps a live snapshot of the model
+      services (see get_snapshot), and validates bundles against it without
+      querying the Juju API. Imported bundles are validated again by the
+      worker when their job leaves the queue, since deployments queued before
+      them may conflict with the bundle.
+
       The Deployer implementation in this package uses the juju-deployer
       library to import the provided bundle into the Juju environment. Since
       the mentioned operations are executed in a separate process, it is safe
@@ -145,6 +156,93 @@ If instead the request is valid, the response is like this:
 The deployment identifier can be used later to observe the progress and status
 of the deployment (see below).
 
+Importing multiple bundles.
+---------------------------
+
+Clients deploying several bundles at once can send a single batch request,
+including a list of Import parameters:
+
+    {
+        'RequestId': 2,
+        'Type': 'Deployer',
+        'Request': 'BatchImport',
+        'Params': {
+            'Bundles': [
+                {'Version': 4, 'YAML': 'bundle1', 'BundleID': 'id1'},
+                {'Version': 4, 'YAML': 'bundle2', 'BundleID': 'id2'},
+            ],
+        },
+    }
+
+The bundles are validated together against the same state of the environment,
+and each bundle is also validated against the ones preceding it in the list.
+If any bundle is not valid, nothing is deployed and the response includes a
+result for each bundle, in the same order as in the request:
+
+    {
+        'RequestId': 2,
+        'Response': {
+            'Results': [
+                {},
+                {'Error': 'service(s) already in the batch: mysql'},
+            ],
+        },
+        'Error': 'invalid request: invalid bundles in batch',
+    }
+
+Otherwise, the response includes a single DeploymentId, like Import responses.
+The bundles are imported one after the other in the same worker job, reusing
+the same Juju API connection. The batch deployment can be watched, subscribed
+to and cancelled as a whole. Progress changes include the position of the
+bundle being imported in the Bundle field of Progress, and the completed change
+includes the Results of each bundle import, e.g.:
+
+    {'DeploymentId': 43, 'Status': 'completed', 'Time': 1377080001,
+     'Error': '1 of 2 bundles failed',
+     'Results': [{}, {'Error': 'error details'}]}
+
+Importing only the missing changes.
+-----------------------------------
+
+Re-importing a bundle whose services are already deployed (e.g. after changing
+a service option) does not require redeploying the whole bundle. In that case,
+a v4 bundle can be imported using an ImportDelta request, with the same
+parameters as Import requests:
+
+    {
+        'RequestId': 3,
+        'Type': 'Deployer',
+        'Request': 'ImportDelta',
+        'Params': {'Version': 4, 'YAML': 'bundle', 'BundleID': 'id'},
+    }
+
+The GUI server computes the changes required to deploy the bundle (see
+guiserver.bundles.changes) and compares them with the live snapshot of the
+model: existing services are not deployed again (their changed options are
+set instead), units are only added to reach the number declared in the bundle,
+and existing relations are skipped. The remaining changes are applied directly
+using the Juju API. The response includes the number of changes to be applied
+(Delta) and the number of changes required to deploy the bundle from scratch
+(Total):
+
+    {
+        'RequestId': 3,
+        'Response': {'DeploymentId': 44, 'Delta': 2, 'Total': 250},
+    }
+
+The DeploymentId is not included if the model already reflects the bundle.
+An error is returned if the live snapshot of the model is not available, i.e.
+when no WebSocket connection is proxying the model megawatcher.
+
+Changes not depending on each other, e.g. adding the charms and machines of
+different services, are applied concurrently (see guiserver.bundles.dag). The
+Completed change of the deployment includes a Timing field, comparing the wall
+clock time spent applying the changes with the time required to apply them one
+after the other and with the duration of the longest chain of dependent
+changes:
+
+    {'Elapsed': 2.1, 'Total': 7.3, 'CriticalPath': 1.9}
+
 Watching a deployment progress.
 -------------------------------
 
@@ -213,6 +311,9 @@ The Queue values in the response indicates the position of the requested
 bundle deployment in the queue. The Deployer implementation processes one
 bundle at the time. A Queue value of zero means the deployment will be started
 as soon as possible.
+Changes notifying a new position in the queue are generated when the
+deployment is started, or when the client asks for changes (Next or Status
+requests) and the position changed since the last notification.
 
 The Status can be one of the following: 'scheduled', 'started', 'completed' and
 'cancelled. See the next section for an explanation of how to cancel a pending
@@ -221,6 +322,22 @@ The Status can be one of the following: 'scheduled', 'started', 'completed' and
 The Time field indicates the number of seconds since the epoch at the time of
 the change.
 
+While a deployment is started, changes are also sent each time a step of the
+import process is completed, e.g. a service is deployed or a relation is
+added. These changes include a Progress field, reporting the Action, the
+Entity (if any) and the Duration in seconds of the step:
+
+    {'DeploymentId': 42, 'Status': 'started', 'Time': 1377080001, 'Queue': 0,
+     'Progress': {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1.42}}
+
+The Action can be 'add_machine', 'deploy', 'add_units', 'add_relation' or
+'phase'. Phase changes are sent when a whole import phase is completed, and
+their Entity is the name of the phase (e.g. 'deploy_services').
+
+Only the last changes of each deployment are stored. If a client falls too far
+behind, the first change in the response is a gap change reporting how many
+changes have been missed, e.g. {'DeploymentId': 42, 'Gap': 3}.
+
 The Next request can be performed as many times as required by the API clients
 after receiving a response from a previous one. However, if the Status of the
 last deployment change is 'completed', no further changes will be notified, and
@@ -240,8 +357,42 @@ the watch request will always return only the last change:
         },
     }
 
-XXX frankban: a timeout to delete completed deployments history will be
-eventually implemented.
+Subscribing to a deployment progress.
+-------------------------------------
+
+As an alternative to the Watch/Next requests, clients can subscribe to the
+changes of a deployment, so that changes are pushed by the GUI server as soon
+as they happen, without the need of sending Next requests:
+
+    {
+        'RequestId': 5,
+        'Type': 'Deployer',
+        'Request': 'Subscribe',
+        'Params': {'DeploymentId': 42},
+    }
+
+The first response includes the watcher id assigned to the subscription, or
+an error if the deployment is not found:
+
+    {'RequestId': 5, 'Response': {'WatcherId': 48}}
+
+Then, changes are sent as further responses with the same request id, in the
+same format used for Next responses. Changes occurring in a short time window
+are sent together in a single response:
+
+    {
+        'RequestId': 5,
+        'Response': {
+            'Changes': [
+                {'DeploymentId': 42, 'Status': 'started', 'Time': 1377080000,
+                 'Queue': 0},
+            ],
+        },
+    }
+
+No more responses are sent after a change whose Status is 'completed' or
+'cancelled'. Subscriptions are terminated when the WebSocket connection is
+closed.
 
 Cancelling a deployment.
 ------------------------
@@ -319,6 +470,19 @@ In the second response above, the Error field in the first attempted deployment
 This means that bundle deployment has been completed but an error occurred
 during the process.
 
+Finished (completed or cancelled) deployments are not included in the status
+forever: only the most recent ones are kept, and deployments finished more
+than a day ago are expired. Watch requests for expired deployments fail. The
+number of expired deployments by status is reported by the GUI server info
+page (see guiserver.handlers.InfoHandler).
+
+When the GUI server is started with the --deploymentsjournal option, scheduled
+deployments and their results are persisted in the given journal file (see
+guiserver.bundles.journal), and restored when the server restarts. Since user
+passwords are never written to disk, deployments interrupted by a restart are
+reported as scheduled and suspended until the user who requested them sends
+an authenticated Deployer request: at that point they are imported again.
+
 Retrieving deployment change sets
 ---------------------------------
 
@@ -23,6 +23,10 @@ bundle views and the Deployer itself. See the bundles package docstring for
 a detailed explanation of how these objects are used.
 """
 
+import collections
+from functools import partial
+import logging
+import multiprocessing
 import time
 
 from concurrent.futures import (
@@ -35,8 +39,11 @@ from tornado.ioloop import IOLoop
 from tornado.util import ObjectDict
 
 from guiserver.bundles import (
+    changes,
+    journal,
     utils,
     views,
+    workers,
 )
 from guiserver.utils import add_future
 from guiserver.watchers import WatcherError
@@ -46,11 +53,33 @@ from guiserver.watchers import WatcherError
 # Set to zero to make Future.cancel() succeed more frequently (Futures in the
 # call queue cannot be cancelled).
 process.EXTRA_QUEUED_CALLS = 0
+# Define the number of seconds changes are collected before being pushed to
+# clients subscribed to deployments.
+PUSH_WINDOW = 0.1
 # Juju API versions supported by the GUI server Deployer.
 # Tests use the first API version in this list.
 SUPPORTED_API_VERSIONS = ['go']
 
 
+def _terminate(executor):
+    """Shut down the given process pool executor, killing its workers.
+
+    The jobs started or queued are abandoned: their futures are never
+    completed. The executor management thread is not waited for when the
+    interpreter exits, as it would wait for the results of the killed jobs.
+    """
+    processes = list(executor._processes or ())
+    thread = executor._queue_management_thread
+    if executor._call_queue is not None:
+        # Do not wait for queued jobs to be sent to the killed workers.
+        executor._call_queue.cancel_join_thread()
+    executor.shutdown(wait=False)
+    for worker in processes:
+        worker.terminate()
+    if thread is not None:
+        process._threads_queues.pop(thread, None)
+
+
 class Deployer(object):
     """Handle the bundle deployment process.
 
@@ -59,21 +88,30 @@ class Deployer(object):
     process.
 
     The validation and deployments steps are executed in separate processes.
-    It is possible to process only one bundle at the time.
+    It is possible to process only one bundle at the time. Worker processes
+    are spawned when the Deployer is created, and they keep their Juju API
+    connections open between jobs (see guiserver.bundles.workers).
 
     Note that the Deployer is not intended to store request related state: it
     is instantiated once when the application is bootstrapped and used as a
     singleton by all WebSocket requests.
     """
 
-    def __init__(self, apiurl, apiversion, charmworldurl=None, io_loop=None):
+    def __init__(
+            self, apiurl, apiversion, charmworldurl=None, io_loop=None,
+            model_uuid=None, journal_path=None):
         """Initialize the deployer.
 
         The apiurl argument is the URL of the juju-core WebSocket server.
         The apiversion argument is the Juju API version (e.g. "go").
+        The optional model_uuid argument is the UUID of the model where bundles
+        are deployed, used to look up the live environment snapshot.
+        The optional journal_path argument is the path of the journal used to
+        persist deployments across restarts (see guiserver.bundles.journal).
         """
         self._apiurl = apiurl
         self._apiversion = apiversion
+        self._model_uuid = model_uuid
         if charmworldurl is not None and not charmworldurl.endswith('/'):
             charmworldurl = charmworldurl + '/'
         self._charmworldurl = charmworldurl
@@ -81,45 +119,161 @@ class Deployer(object):
             io_loop = IOLoop.current()
         self._io_loop = io_loop
 
+        # Set up the pipe used by workers to send deployment progress events.
+        # The worker processes inherit the sending end when they are spawned.
+        self._progress_reader, progress_writer = multiprocessing.Pipe(
+            duplex=False)
+        workers.set_progress_connection(progress_writer)
+        io_loop.add_handler(
+            self._progress_reader.fileno(), self._progress_callback,
+            io_loop.READ)
+
         # Deployment validation and importing executors.
         self._validate_executor = ProcessPoolExecutor(1)
         self._run_executor = ProcessPoolExecutor(1)
+        # Spawn the worker processes as soon as the IO loop is running, so
+        # that the first jobs do not pay the process creation and warm up
+        # costs, without delaying the server start up.
+        io_loop.add_callback(self.warm_up)
 
         # An observer instance is used to watch the deployments progress.
         self._observer = utils.Observer()
         # Queue stores the deployment identifiers corresponding to the
         # currently started/queued jobs.
-        self._queue = []
+        self._queue = utils.DeploymentQueue()
         # The futures attribute maps deployment identifiers to Futures.
         self._futures = {}
+        # Map model UUIDs to environment snapshots fed by WebSocket handlers.
+        self._snapshots = {}
+        # Map deployment identifiers to the import records of deployments
+        # interrupted by a restart, waiting for their users to reconnect.
+        self._suspended = collections.OrderedDict()
+        # Map deployment identifiers to the import records of the started and
+        # queued deployments, used to compact the journal.
+        self._imports = {}
 
         # Options used by the juju-deployer.
         self.importer_options = blocking.get_default_guiserver_options()
 
+        # When draining, new deployments are rejected (see self.drain()).
+        self.draining = False
+        self._journal = None
+        if journal_path is not None:
+            self._journal = journal.Journal(journal_path, io_loop=io_loop)
+            self._restore()
+
+    def warm_up(self, fds=()):
+        """Spawn and warm up the worker processes.
+
+        This is done as soon as the IO loop runs. Call this method to spawn
+        the workers right away instead. In this case, the given file
+        descriptors (e.g. the server listening sockets) are closed by the
+        workers, so that they are only held by the server process.
+        """
+        for executor in (self._validate_executor, self._run_executor):
+            try:
+                executor.submit(workers.warm_up, tuple(fds))
+            except RuntimeError:
+                # The deployer has already been shut down.
+                return
+
+    def is_busy(self):
+        """Return True if bundle deployments are started or queued."""
+        return len(self._queue) > 0
+
+    def drain(self):
+        """Stop accepting new deployments, e.g. because the server is stopping.
+
+        Deployments already queued are still run. Suspended deployments are
+        no longer resumed: they are left to the next server process.
+        """
+        logging.info('deployer: not accepting new deployments')
+        self.draining = True
+
+    def shutdown(self, wait=True):
+        """Stop the worker processes and close the journal.
+
+        If wait is True, the jobs already submitted to the workers are
+        completed, and this method returns when the worker processes have
+        exited. Otherwise the worker processes are killed: the deployments
+        still started or queued are left in the journal, so that they are
+        suspended and resumed by the next server process (see self.resume()).
+        In any case, wait for the pending journal records to be written.
+        """
+        if wait:
+            self._validate_executor.shutdown(wait=True)
+            self._run_executor.shutdown(wait=True)
+        else:
+            for deployment_id in self._queue:
+                if self._journal is None:
+                    logging.warning(
+                        'deployment {} interrupted'.format(deployment_id))
+                else:
+                    logging.info(
+                        'deployment {} interrupted: it will be resumed after '
+                        'the restart'.format(deployment_id))
+            _terminate(self._validate_executor)
+            _terminate(self._run_executor)
+        if self._journal is not None:
+            self._journal.close()
+
     @gen.coroutine
     def validate(self, user, bundle):
         """Validate the deployment bundle.
 
-        The validation is executed in a separate process using the
+        The validation is executed in a worker process using the
         juju-deployer library.
 
         Three arguments are provided:
           - user: the current authenticated user;
           - bundle: a YAML decoded object representing the bundle contents.
 
+        If a live snapshot of the environment is available, the validation is
+        performed in this process without querying the Juju API.
+
         Return a Future whose result is a string representing an error or None
         if no error occurred.
         """
         apiversion = self._apiversion
         if apiversion not in SUPPORTED_API_VERSIONS:
             raise gen.Return('unsupported API version: {}'.format(apiversion))
+        snapshot = self._get_live_snapshot()
+        if snapshot is not None:
+            raise gen.Return(snapshot.validate(bundle))
         try:
             yield self._validate_executor.submit(
-                blocking.validate, self._apiurl, user.username, user.password,
+                workers.validate, self._apiurl, user.username, user.password,
                 bundle)
         except Exception as err:
             raise gen.Return(str(err))
 
+    @gen.coroutine
+    def validate_batch(self, user, bundles):
+        """Validate a batch of bundles to be deployed together.
+
+        The bundles are validated against a single state of the environment:
+        the live snapshot if available, otherwise the environment status
+        retrieved once in a worker process. Each bundle is also validated
+        against the ones preceding it in the batch.
+
+        Return a Future whose result is a list including an error string or
+        None for each bundle.
+        """
+        apiversion = self._apiversion
+        if apiversion not in SUPPORTED_API_VERSIONS:
+            error = 'unsupported API version: {}'.format(apiversion)
+            raise gen.Return([error] * len(bundles))
+        snapshot = self._get_live_snapshot()
+        if snapshot is not None:
+            raise gen.Return(utils.validate_batch(snapshot.services, bundles))
+        try:
+            errors = yield self._validate_executor.submit(
+                workers.validate_bundles, self._apiurl, user.username,
+                user.password, bundles)
+        except Exception as err:
+            errors = [str(err)] * len(bundles)
+        raise gen.Return(errors)
+
     def import_bundle(
             self, user, name, bundle, version, bundle_id, test_callback=None):
         """Schedule a deployment bundle import process.
@@ -141,20 +295,117 @@ class Deployer(object):
 
         Return the deployment identifier assigned to this deployment process.
         """
-        # Start observing this deployment, retrieve the next available
-        # deployment id and notify its position at the end of the queue.
+        # Start observing this deployment and retrieve the next available
+        # deployment id.
         deployment_id = self._observer.add_deployment()
-        self._observer.notify_position(deployment_id, len(self._queue))
-        # Add this deployment to the queue.
-        self._queue.append(deployment_id)
-        # Add the import bundle job to the run executor, and set up a callback
-        # to be called when the import process completes.
-        future = self._run_executor.submit(
-            blocking.import_bundle,
+        self._journal_import(
+            deployment_id, user, name, bundle, version, bundle_id)
+        # The bundle is validated again by the worker when the job leaves the
+        # queue: the live snapshot only reflects the model at request time,
+        # and the deployments queued before this one may conflict with it.
+        self._schedule(
+            deployment_id, user, name, bundle, version, bundle_id, True,
+            test_callback)
+        return deployment_id
+
+    def diff(self, bundle):
+        """Return the changes required to deploy the bundle in the model.
+
+        The changes are computed using the live snapshot of the model (see
+        guiserver.bundles.changes.diff). Return a (changes, total) tuple, where
+        total is the number of changes required to deploy the bundle in an
+        empty model, or None if a live snapshot is not available.
+        """
+        snapshot = self._get_live_snapshot()
+        if snapshot is not None:
+            return changes.diff(snapshot, bundle)
+
+    def import_changes(
+            self, user, name, bundle, version, bundle_id, delta,
+            test_callback=None):
+        """Schedule the application of the given bundle changes.
+
+        The delta argument is the list of changes returned by self.diff() for
+        the given bundle: only those changes are applied, directly using the
+        Juju API. See self.import_bundle() for a description of the other
+        arguments. If the GUI server is restarted before the changes are
+        applied, the whole bundle is imported when the deployment is resumed.
+
+        Return the deployment identifier assigned to this deployment process.
+        """
+        deployment_id = self._observer.add_deployment()
+        self._journal_import(
+            deployment_id, user, name, bundle, version, bundle_id)
+        self._submit(
+            deployment_id, self._import_callback, bundle_id, test_callback,
+            workers.apply_changes,
+            self._apiurl, user.username, user.password, delta, deployment_id)
+        return deployment_id
+
+    def import_batch(self, user, bundles, test_callback=None):
+        """Schedule the import of a batch of bundles in a single deployment.
+
+        The bundles argument is a list of (name, bundle, version, bundle_id)
+        tuples (see self.import_bundle() above). All the bundles are imported
+        in the same worker job, one after the other, reusing the same Juju API
+        connection. The completed change includes the result of each bundle
+        import (see guiserver.bundles.utils.create_results).
+
+        Return the deployment identifier assigned to the whole batch.
+        """
+        deployment_id = self._observer.add_deployment()
+        if self._journal is not None:
+            self._journal_scheduled({
+                'Op': 'import',
+                'DeploymentId': deployment_id,
+                'Batch': [
+                    {'Name': name, 'Bundle': bundle, 'Version': version,
+                     'BundleId': bundle_id}
+                    for name, bundle, version, bundle_id in bundles
+                ],
+                'Username': user.username,
+            })
+        # See self.import_bundle() for the reasons why the bundles are always
+        # validated again by the worker.
+        self._schedule_batch(deployment_id, user, bundles, True, test_callback)
+        return deployment_id
+
+    def _schedule(
+            self, deployment_id, user, name, bundle, version, bundle_id,
+            validate, test_callback=None):
+        """Add the given deployment to the queue and submit the import job."""
+        self._submit(
+            deployment_id, self._import_callback, bundle_id, test_callback,
+            workers.import_bundle,
             self._apiurl, user.username, user.password, name, bundle, version,
-            self.importer_options)
-        add_future(self._io_loop, future, self._import_callback,
-                   deployment_id, bundle_id)
+            self.importer_options, validate, deployment_id)
+
+    def _schedule_batch(
+            self, deployment_id, user, bundles, validate, test_callback=None):
+        """Add the given batch deployment to the queue and submit its job."""
+        jobs = [bundle[:3] for bundle in bundles]
+        bundle_ids = [bundle[3] for bundle in bundles]
+        self._submit(
+            deployment_id, self._batch_callback, bundle_ids, test_callback,
+            workers.import_bundles,
+            self._apiurl, user.username, user.password, jobs,
+            self.importer_options, validate, deployment_id)
+
+    def _submit(
+            self, deployment_id, callback, callback_arg, test_callback,
+            function, *args):
+        """Queue the given deployment and submit its job to the run executor.
+
+        The given callback is called with the deployment id, the callback_arg
+        and the job future when the job completes.
+        """
+        self._queue.append(deployment_id)
+        self._notify_position(deployment_id)
+        # Add the import job to the run executor, and set up a callback to be
+        # called when the import process completes.
+        future = self._run_executor.submit(function, *args)
+        add_future(
+            self._io_loop, future, callback, deployment_id, callback_arg)
         self._futures[deployment_id] = future
         # If a customized callback is provided, schedule it as well.
         if test_callback is not None:
@@ -163,7 +414,67 @@ class Deployer(object):
         # immediately put in the executor's call queue. This allows for
         # cancelling scheduled jobs, even if the job is the next to be started.
         self._run_executor.submit(time.sleep, 1)
-        return deployment_id
+
+    def _restore(self):
+        """Restore the deployments stored in the journal.
+
+        Deployments completed or cancelled before the restart are restored as
+        they were. Deployments still queued or started are suspended until
+        their users send a deployer request (see self.resume()). The journal
+        is then compacted in a separate thread, so that the server start up is
+        not delayed.
+        """
+        imports = collections.OrderedDict()
+        finished = collections.OrderedDict()
+        archive = {}
+        for record in self._journal.replay():
+            op = record.get('Op')
+            deployment_id = record.get('DeploymentId')
+            if op == 'import':
+                imports[deployment_id] = record
+            elif op == 'finish':
+                imports.pop(deployment_id, None)
+                finished[deployment_id] = record['Change']
+            elif op == 'archive':
+                archive = record['Archive']
+        self._observer.archive.update(archive)
+        for deployment_id, change in finished.items():
+            self._observer.restore_deployment(deployment_id, change)
+        for deployment_id, record in imports.items():
+            change = utils.create_change(deployment_id, utils.SCHEDULED)
+            self._observer.restore_deployment(deployment_id, change)
+            self._suspended[deployment_id] = record
+        # Compact the journal, only keeping the restored deployments.
+        self._journal.compact(self._journal_records())
+
+    def resume(self, user):
+        """Resume the suspended deployments started by the given user.
+
+        Suspended deployments are imported again without validation, as the
+        bundle could have been partially deployed before the restart. Nothing
+        is resumed while the deployer is draining.
+        """
+        if self.draining:
+            return
+        suspended = [
+            (deployment_id, record)
+            for deployment_id, record in self._suspended.items()
+            if record['Username'] == user.username
+        ]
+        for deployment_id, record in suspended:
+            del self._suspended[deployment_id]
+            self._imports[deployment_id] = record
+            logging.info('deployment {} resumed'.format(deployment_id))
+            if 'Batch' in record:
+                bundles = [
+                    (i['Name'], i['Bundle'], i['Version'], i['BundleId'])
+                    for i in record['Batch']
+                ]
+                self._schedule_batch(deployment_id, user, bundles, False)
+                continue
+            self._schedule(
+                deployment_id, user, record['Name'], record['Bundle'],
+                record['Version'], record['BundleId'], False)
 
     def _import_callback(self, deployment_id, bundle_id, future):
         """Callback called when a deployment process is completed.
@@ -172,31 +483,181 @@ class Deployer(object):
         deployment_id identifying one specific deployment job, and the fired
         future returned by the executor.
         """
+        # Notify progress events sent before the deployment completed.
+        self._read_progress()
         if future.cancelled():
             # Notify a deployment has been cancelled.
-            self._observer.notify_cancelled(deployment_id)
+            change = self._observer.notify_cancelled(deployment_id)
             success = False
         else:
-            error = None
+            error = timing = None
             success = True
             exception = future.exception()
             if exception is not None:
                 error = utils.message_from_error(exception)
                 success = False
+            else:
+                # Deployments applying bundle changes return a timing report.
+                timing = future.result()
+                if timing is not None:
+                    logging.info(
+                        'deployment {} changes applied in {Elapsed}s '
+                        '(sequential: {Total}s, critical path: '
+                        '{CriticalPath}s)'.format(deployment_id, **timing))
             # Notify a deployment completed.
-            self._observer.notify_completed(deployment_id, error=error)
-        # Remove the completed deployment job from the queue.
-        self._queue.remove(deployment_id)
-        del self._futures[deployment_id]
-        # Notify the new position of all remaining deployments in the queue.
-        for position, deploy_id in enumerate(self._queue):
-            self._observer.notify_position(deploy_id, position)
+            change = self._observer.notify_completed(
+                deployment_id, error=error, timing=timing)
+        self._journal_finish(deployment_id, change)
+        self._dequeue(deployment_id)
         # Increment the Charmworld deployment count upon successful
         # deployment.
         if success and bundle_id is not None:
             utils.increment_deployment_counter(
                 bundle_id, self._charmworldurl)
 
+    def _batch_callback(self, deployment_id, bundle_ids, future):
+        """Callback called when a batch deployment process is completed.
+
+        This callback, scheduled in self.import_batch(), receives the
+        deployment_id identifying the batch job, the list of bundle ids in the
+        batch and the fired future returned by the executor.
+        """
+        self._read_progress()
+        if future.cancelled():
+            change = self._observer.notify_cancelled(deployment_id)
+            errors = []
+        else:
+            exception = future.exception()
+            if exception is None:
+                errors = future.result()
+            else:
+                errors = [utils.message_from_error(exception)] * len(
+                    bundle_ids)
+            failed = len([error for error in errors if error is not None])
+            error = None
+            if failed:
+                error = '{} of {} bundles failed'.format(failed, len(errors))
+            change = self._observer.notify_completed(
+                deployment_id, error=error,
+                results=utils.create_results(errors))
+        self._journal_finish(deployment_id, change)
+        self._dequeue(deployment_id)
+        for bundle_id, error in zip(bundle_ids, errors):
+            if error is None and bundle_id is not None:
+                utils.increment_deployment_counter(
+                    bundle_id, self._charmworldurl)
+
+    def _dequeue(self, deployment_id):
+        """Remove the given finished deployment job from the queue.
+
+        Notify the deployment now at the head of the queue that it is started.
+        The positions of the other deployments are notified lazily, when
+        clients ask for changes (see self.next() and self.status()).
+        """
+        self._queue.remove(deployment_id)
+        del self._futures[deployment_id]
+        first = self._queue.first()
+        if first is not None:
+            self._notify_position(first)
+
+    def _journal_import(
+            self, deployment_id, user, name, bundle, version, bundle_id):
+        """Record a scheduled bundle import in the journal."""
+        if self._journal is not None:
+            self._journal_scheduled({
+                'Op': 'import',
+                'DeploymentId': deployment_id,
+                'Name': name,
+                'Bundle': bundle,
+                'Version': version,
+                'BundleId': bundle_id,
+                'Username': user.username,
+            })
+
+    def _journal_scheduled(self, record):
+        """Record the given scheduled deployment import in the journal."""
+        self._imports[record['DeploymentId']] = record
+        self._journal_append(record)
+
+    def _journal_finish(self, deployment_id, change):
+        """Record the last change of a finished deployment in the journal."""
+        if self._journal is not None:
+            self._imports.pop(deployment_id, None)
+            self._journal_append({
+                'Op': 'finish',
+                'DeploymentId': deployment_id,
+                'Change': change,
+            })
+
+    def _journal_append(self, record):
+        """Append the given record to the journal, compacting it if needed.
+        """
+        self._journal.append(record)
+        if self._journal.needs_compaction:
+            logging.info('deployer: compacting the journal')
+            self._journal.compact(self._journal_records())
+
+    def _journal_records(self):
+        """Return the journal records describing the current deployments.
+
+        The records include the archive, the last change of the finished
+        deployments still observed, and the import records of the started,
+        queued and suspended deployments.
+        """
+        records = [{'Op': 'archive', 'Archive': self._observer.archive}]
+        for deployment_id, watcher in self._observer.deployments.items():
+            if watcher.closed:
+                records.append({
+                    'Op': 'finish',
+                    'DeploymentId': deployment_id,
+                    'Change': watcher.getlast(),
+                })
+        imports = self._imports.values() + self._suspended.values()
+        records.extend(sorted(imports, key=lambda i: i['DeploymentId']))
+        return records
+
+    def _progress_callback(self, fd, events):
+        """Callback called when progress events are sent by workers."""
+        self._read_progress()
+
+    def _read_progress(self):
+        """Notify all the progress events available in the progress pipe."""
+        reader = self._progress_reader
+        if reader is None:
+            return
+        try:
+            while reader.poll():
+                deployment_id, progress = reader.recv()
+                self._observer.notify_progress(deployment_id, progress)
+        except (EOFError, IOError) as err:
+            logging.error('deployer: cannot read progress: {}'.format(err))
+            self._io_loop.remove_handler(reader.fileno())
+            self._progress_reader = None
+
+    def _notify_position(self, deployment_id):
+        """Notify the position of a queued deployment if it changed."""
+        position = self._queue.position_changed(deployment_id)
+        if position is not None:
+            self._observer.notify_position(deployment_id, position)
+
+    def get_snapshot(self, model_uuid):
+        """Return the environment snapshot for the given model UUID.
+
+        The snapshot is created if it does not exist. WebSocket handlers use
+        the returned snapshot to propagate megawatcher deltas.
+        """
+        snapshot = self._snapshots.get(model_uuid)
+        if snapshot is None:
+            snapshot = utils.EnvironmentSnapshot()
+            self._snapshots[model_uuid] = snapshot
+        return snapshot
+
+    def _get_live_snapshot(self):
+        """Return the live snapshot of the deployment model, or None."""
+        snapshot = self._snapshots.get(self._model_uuid)
+        if snapshot is not None and snapshot.is_live:
+            return snapshot
+
     def watch(self, deployment_id):
         """Start watching a deployment and return a watcher identifier.
 
@@ -220,18 +681,46 @@ class Deployer(object):
         deployment_id = self._observer.watchers.get(watcher_id)
         if deployment_id is None:
             return
+        self._notify_position(deployment_id)
         watcher = self._observer.deployments[deployment_id]
         try:
             return watcher.next(watcher_id)
         except WatcherError:
             return
 
+    def subscribe(self, watcher_id, callback):
+        """Call the given callback each time deployment changes are available.
+
+        The given watcher identifier refers to a specific deployment process
+        (see the self.watch() method above). The callback receives a list of
+        deployment changes. Return False if the watcher id is not valid.
+        """
+        deployment_id = self._observer.watchers.get(watcher_id)
+        if deployment_id is None:
+            return False
+        watcher = self._observer.deployments[deployment_id]
+        self._notify_position(deployment_id)
+        try:
+            watcher.subscribe(watcher_id, callback)
+        except WatcherError:
+            return False
+        return True
+
+    def unwatch(self, watcher_id):
+        """Stop watching a deployment, releasing the given watcher id."""
+        self._observer.remove_watcher(watcher_id)
+
     def cancel(self, deployment_id):
         """Attempt to cancel the deployment identified by deployment_id.
 
         Return None if the deployment has been correctly cancelled.
         Return an error string otherwise.
         """
+        if deployment_id in self._suspended:
+            del self._suspended[deployment_id]
+            change = self._observer.notify_cancelled(deployment_id)
+            self._journal_finish(deployment_id, change)
+            return
         future = self._futures.get(deployment_id)
         if future is None:
             return 'deployment not found or already completed'
@@ -241,9 +730,20 @@ class Deployer(object):
     def status(self):
         """Return a list containing the last known change for each deployment.
         """
+        self._observer.expire()
+        for deployment_id in self._queue:
+            self._notify_position(deployment_id)
         watchers = self._observer.deployments.values()
         return [i.getlast() for i in watchers]
 
+    def history(self):
+        """Return a dict mapping statuses to numbers of archived deployments.
+
+        Finished deployments are archived when they are no longer included in
+        the status (see guiserver.bundles.utils.Observer).
+        """
+        return dict(self._observer.archive)
+
 
 class DeployMiddleware(object):
     """Handle the bundles deployment request/response process.
@@ -265,16 +765,35 @@ class DeployMiddleware(object):
         deployment = DeployMiddleware(user, deployer, write_response)
         if deployment.requested(data):
             deployment.process_request(data)
+
+    When the client disconnects, release the watchers it requested:
+
+        deployment.close()
+
+    Changes of deployments the client subscribed to (using Subscribe requests)
+    are collected for PUSH_WINDOW seconds and then pushed to the client.
     """
 
-    def __init__(self, user, deployer, write_response):
+    def __init__(self, user, deployer, write_response, io_loop=None):
         """Initialize the deployment middleware."""
         self._user = user
         self._deployer = deployer
         self._write_response = write_response
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        # Store the watcher identifiers requested by the client.
+        self._watcher_ids = set()
+        # Map subscription request identifiers to the changes to be pushed.
+        self._pending = {}
+        # Map subscription request identifiers to scheduled push timeouts.
+        self._timeouts = {}
         self.routes = {
             'Import': views.import_bundle,
+            'BatchImport': views.batch_import,
+            'ImportDelta': views.import_delta,
             'Watch': views.watch,
+            'Subscribe': views.subscribe,
             'Next': views.next,
             'Cancel': views.cancel,
             'Status': views.status,
@@ -295,9 +814,51 @@ class DeployMiddleware(object):
         params = data.get('Params', {})
         view = self.routes[data['Request']]
         request = ObjectDict(params=params, user=self._user)
+        if self._user.is_authenticated:
+            # Resume the deployments of this user interrupted by a restart.
+            self._deployer.resume(self._user)
         response = yield view(request, self._deployer)
+        watcher_id = None
+        request_type = data['Request']
+        if request_type in ('Watch', 'Subscribe') and 'Error' not in response:
+            watcher_id = response['Response']['WatcherId']
+            self._watcher_ids.add(watcher_id)
         response['RequestId'] = request_id
         self._write_response(response)
+        if request_type == 'Subscribe' and watcher_id is not None:
+            self._deployer.subscribe(
+                watcher_id, partial(self._collect, request_id))
+
+    def _collect(self, request_id, changes):
+        """Collect changes to be pushed for the given subscription request.
+
+        Schedule the changes to be sent after PUSH_WINDOW seconds.
+        """
+        pending = self._pending.setdefault(request_id, [])
+        if not pending:
+            self._timeouts[request_id] = self._io_loop.add_timeout(
+                time.time() + PUSH_WINDOW, partial(self._push, request_id))
+        pending.extend(changes)
+
+    def _push(self, request_id):
+        """Send the changes collected for the given subscription request."""
+        del self._timeouts[request_id]
+        changes = self._pending.pop(request_id)
+        self._write_response(
+            {'RequestId': request_id, 'Response': {'Changes': changes}})
+
+    def close(self):
+        """Release the watchers requested by the client.
+
+        This must be called when the client connection is closed.
+        """
+        for watcher_id in self._watcher_ids:
+            self._deployer.unwatch(watcher_id)
+        self._watcher_ids.clear()
+        for timeout in self._timeouts.values():
+            self._io_loop.remove_timeout(timeout)
+        self._timeouts.clear()
+        self._pending.clear()
 
 
 class ChangeSetMiddleware(object):
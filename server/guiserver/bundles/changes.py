@@ -0,0 +1,270 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bundle change sets: incremental diffs and their application.
+
+The changes required to deploy a bundle are generated by jujubundlelib. Each
+change is a dict like the following:
+
+    {'id': 'addUnit-4', 'method': 'addUnit', 'args': ['$deploy-1', None],
+     'requires': ['deploy-1']}
+
+Arguments starting with "$" are placeholders, referring to the result of the
+change with the given id (e.g. the service name or the machine id), optionally
+followed by a ":relation" suffix.
+
+The diff function compares a bundle with a live environment snapshot (see
+guiserver.bundles.utils.EnvironmentSnapshot), and only returns the changes not
+already applied to the model. In addition to the jujubundlelib methods, diffs
+can include setConfig changes, updating the options of existing services:
+
+    {'id': 'setConfig-12', 'method': 'setConfig',
+     'args': ['mysql', {'dataset-size': '50%'}], 'requires': []}
+
+The apply function executes a single change using a Juju API client.
+"""
+
+import copy
+import itertools
+
+from charmworldlib.utils import parse_constraints
+from jujubundlelib import changeset
+
+
+def diff(snapshot, bundle):
+    """Return the changes required to deploy the given bundle in the model.
+
+    Changes already applied to the model described by the given snapshot are
+    skipped: existing services are not deployed again (only their changed
+    options are set), units are only added to reach the number of units
+    declared in the bundle, and existing relations and exposures are not
+    added again. Machines are only added when required by the new units.
+    References to skipped changes are replaced with the corresponding model
+    entities, e.g. "$deploy-1" becomes "mysql".
+
+    Note that annotations of existing services are not updated, and new units
+    placed on bundle machines always land on new machines, since bundle
+    machines are not mapped to model machines.
+
+    Return a (changes, total) tuple, where total is the number of changes
+    required to deploy the bundle in an empty model.
+    """
+    changes = list(changeset.parse(bundle))
+    records = dict((change['id'], change) for change in changes)
+    # Map skipped change ids to the corresponding model entities.
+    existing = {}
+    # Map services to the number of units already seen in the change set.
+    unit_counts = {}
+    counter = itertools.count(len(changes))
+    keep = set()
+    extra = []
+    for change in changes:
+        change_id, method = change['id'], change['method']
+        args = change['args']
+        if method == 'deploy':
+            service = args[1]
+            if service not in snapshot.services:
+                keep.add(change_id)
+                continue
+            existing[change_id] = service
+            options = _changed_options(snapshot.config.get(service), args[2])
+            if options:
+                extra.append({
+                    'id': 'setConfig-{}'.format(next(counter)),
+                    'method': 'setConfig',
+                    'args': [service, options],
+                    'requires': [],
+                })
+        elif method == 'addUnit':
+            service = _service(records, args[0])
+            position = unit_counts.get(service, 0)
+            unit_counts[service] = position + 1
+            units = snapshot.get_units(service)
+            if position < len(units):
+                existing[change_id] = units[position][1]
+                continue
+            keep.add(change_id)
+        elif method == 'expose':
+            service = _service(records, args[0])
+            if service not in snapshot.exposed:
+                keep.add(change_id)
+        elif method == 'addRelation':
+            endpoints = [_endpoint(records, arg) for arg in args]
+            if not snapshot.has_relation(*endpoints):
+                keep.add(change_id)
+    # Keep charms and machines only if required by the changes being kept.
+    # Changes are sorted so that requirements always precede their dependents.
+    required = set()
+    for change in reversed(changes):
+        change_id = change['id']
+        if change['method'] in ('addCharm', 'addMachines'):
+            if change_id in required:
+                keep.add(change_id)
+        if change_id in keep:
+            required.update(change['requires'])
+    # Keep annotations of new entities.
+    for change in changes:
+        if change['method'] == 'setAnnotations':
+            if change['requires'][0] in keep:
+                keep.add(change['id'])
+    delta = [
+        _substitute(change, existing, keep)
+        for change in changes if change['id'] in keep
+    ]
+    return delta + extra, len(changes)
+
+
+def _changed_options(config, options):
+    """Return the bundle options differing from the service config.
+
+    If the service config is not known, all the options are returned.
+    """
+    if config is None:
+        return dict(options)
+    return dict(
+        (key, value) for key, value in options.items()
+        if config.get(key) != value)
+
+
+def _reference(value):
+    """Split the given placeholder into a (change id, suffix) tuple.
+
+    Return (None, None) if the value is not a placeholder.
+    """
+    if not isinstance(value, basestring) or not value.startswith('$'):
+        return None, None
+    change_id, _, suffix = value[1:].partition(':')
+    return change_id, suffix or None
+
+
+def _service(records, value):
+    """Return the service name referred to by the given deploy placeholder."""
+    change_id, _ = _reference(value)
+    return records[change_id]['args'][1]
+
+
+def _endpoint(records, value):
+    """Return a (service, relation name) tuple for the given placeholder."""
+    change_id, relation = _reference(value)
+    return records[change_id]['args'][1], relation
+
+
+def _substitute(change, existing, keep):
+    """Return a copy of the given change referring to existing entities.
+
+    Placeholders of skipped changes are replaced with model entities, and the
+    skipped changes are removed from the requirements. Placements on units
+    whose machine is unknown are dropped.
+    """
+    def substitute(value):
+        if isinstance(value, dict):
+            return dict((k, substitute(v)) for k, v in value.items())
+        change_id, suffix = _reference(value)
+        if change_id is None or change_id not in existing:
+            return value
+        entity = existing[change_id]
+        if entity is not None and suffix is not None:
+            entity = '{}:{}'.format(entity, suffix)
+        return entity
+
+    change = copy.deepcopy(change)
+    change['args'] = [substitute(arg) for arg in change['args']]
+    change['requires'] = [i for i in change['requires'] if i in keep]
+    return change
+
+
+def resolve(value, results):
+    """Replace the placeholders in value with the given change results.
+
+    The results argument maps change ids to the values returned by apply.
+    """
+    if isinstance(value, dict):
+        return dict((k, resolve(v, results)) for k, v in value.items())
+    change_id, suffix = _reference(value)
+    if change_id is None:
+        return value
+    result = results[change_id]
+    if suffix is not None:
+        return '{}:{}'.format(result, suffix)
+    return result
+
+
+def apply(client, change, results):
+    """Apply the given change using the given Juju API client.
+
+    Placeholders are resolved using the results of the previous changes.
+    Return the change result, e.g. the service name or the machine id.
+    """
+    args = [resolve(arg, results) for arg in change['args']]
+    method = change['method']
+    if method == 'addCharm':
+        client.add_charm(args[0])
+        return args[0]
+    if method == 'deploy':
+        charm, service, options, constraints = args[:4]
+        client.deploy(
+            service, charm, num_units=0, config=options,
+            constraints=_constraints(constraints))
+        return service
+    if method == 'addMachines':
+        options = args[0]
+        result = client.add_machine(
+            series=options.get('series', ''),
+            constraints=_constraints(options.get('constraints')),
+            parent_id=_machine(client, options.get('parentId')) or '',
+            container_type=options.get('containerType', ''))
+        if result.get('Error'):
+            raise ValueError(result['Error'].get('Message', result['Error']))
+        return result['Machine']
+    if method == 'addUnit':
+        service, placement = args
+        result = client.add_unit(
+            service, machine_spec=_machine(client, placement))
+        return result['Units'][0]
+    if method == 'addRelation':
+        client.add_relation(*args)
+        return None
+    if method == 'expose':
+        client.expose(args[0])
+        return args[0]
+    if method == 'setAnnotations':
+        entity, entity_type, annotations = args
+        client.set_annotation(entity, entity_type, annotations)
+        return entity
+    if method == 'setConfig':
+        client.set_config(*args)
+        return args[0]
+    raise ValueError('unknown change method: {}'.format(method))
+
+
+def _constraints(constraints):
+    """Return the given constraints string as a dict, or None if empty."""
+    if not constraints:
+        return None
+    return parse_constraints(constraints)
+
+
+def _machine(client, placement):
+    """Return the machine id for the given placement.
+
+    Placements on units (e.g. "mysql/0") are converted to the machine where
+    the unit lives, since Juju only accepts machine placements.
+    """
+    if not placement or '/' not in placement:
+        return placement
+    service = placement.split('/')[0]
+    status = client.status()
+    return status['Services'][service]['Units'][placement]['Machine']
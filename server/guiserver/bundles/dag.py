@@ -0,0 +1,136 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Concurrent application of bundle change sets.
+
+Each change in a change set (see guiserver.bundles.changes) lists the ids of
+the changes it requires, so that changes form a directed acyclic graph. A
+change can be applied as soon as all its requirements are applied: independent
+changes, e.g. adding the charms and the machines of different services, are
+applied at the same time.
+
+The execute function returns a report like the following:
+
+    {'Elapsed': 2.1, 'Total': 7.3, 'CriticalPath': 1.9}
+
+where Elapsed is the wall clock time spent applying the changes, Total is the
+sum of the change durations, i.e. the time required to apply the changes one
+after the other, and CriticalPath is the duration of the longest chain of
+dependent changes, i.e. the minimum time required with unlimited concurrency.
+"""
+
+import collections
+import time
+
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+
+
+# Define the default maximum number of changes applied at the same time.
+MAX_WORKERS = 4
+
+
+def execute(changes, apply, max_workers=MAX_WORKERS, callback=None):
+    """Apply the given changes, running independent ones concurrently.
+
+    The apply function is called in a pool of max_workers threads, passing
+    each change and the results of the changes applied so far, as a dict
+    mapping change ids to the values returned by apply. Requirements not
+    included in the given changes are considered already applied. If provided,
+    callback is called in the calling thread each time a change is applied,
+    passing the change and its duration in seconds.
+
+    If a change fails, no further changes are started, and the exception is
+    raised as soon as the changes in progress are completed. A ValueError is
+    raised if the requirements cannot be satisfied, e.g. in case of cycles.
+
+    Return the execution report (see above).
+    """
+    ids = set(change['id'] for change in changes)
+    # Map change ids to the number of requirements not yet applied.
+    missing = {}
+    # Map change ids to the changes requiring them.
+    dependents = collections.defaultdict(list)
+    ready = collections.deque()
+    for change in changes:
+        requires = [i for i in change['requires'] if i in ids]
+        missing[change['id']] = len(requires)
+        for requirement in requires:
+            dependents[requirement].append(change)
+        if not requires:
+            ready.append(change)
+    results = {}
+    # Map change ids to the time elapsed from the start of the critical path
+    # to their completion.
+    finish = {}
+    total = 0
+    running = {}
+    failed = None
+    start = time.time()
+    executor = ThreadPoolExecutor(max_workers)
+    try:
+        while True:
+            while ready and failed is None:
+                change = ready.popleft()
+                future = executor.submit(_timed, apply, change, results)
+                running[future] = change
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                change = running.pop(future)
+                if future.exception() is not None:
+                    failed = failed or future
+                    continue
+                result, duration = future.result()
+                change_id = change['id']
+                results[change_id] = result
+                finish[change_id] = duration + max(
+                    [finish[i] for i in change['requires'] if i in finish] or
+                    [0])
+                total += duration
+                if callback is not None:
+                    callback(change, duration)
+                for dependent in dependents[change_id]:
+                    missing[dependent['id']] -= 1
+                    if not missing[dependent['id']]:
+                        ready.append(dependent)
+    finally:
+        executor.shutdown(wait=True)
+    if failed is not None:
+        failed.result()
+    if len(results) != len(changes):
+        unsatisfied = sorted(ids.difference(results))
+        raise ValueError('unsatisfiable change requirements: {}'.format(
+            ', '.join(unsatisfied)))
+    return {
+        'Elapsed': round(time.time() - start, 3),
+        'Total': round(total, 3),
+        'CriticalPath': round(max(finish.values() or [0]), 3),
+    }
+
+
+def _timed(function, change, results):
+    """Call function(change, results).
+
+    Return a (result, duration in seconds) tuple.
+    """
+    start = time.time()
+    result = function(change, results)
+    return result, time.time() - start
@@ -0,0 +1,180 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bundle deployments journal.
+
+The Deployer uses a journal to persist scheduled deployments and their results
+across GUI server restarts. The journal is an append-only file, including one
+JSON encoded record per line. Records are dicts with an Op key, e.g.:
+
+    {'Op': 'import', 'DeploymentId': 1, 'Name': 'bundle', 'Bundle': {...},
+     'Version': 4, 'BundleId': None, 'Username': 'user-admin'}
+    {'Op': 'finish', 'DeploymentId': 1, 'Change': {...}}
+
+Records are written in batches, from a separate thread, at most once every
+FLUSH_DELAY seconds, so that the IOLoop is not blocked by disk synchronization.
+When the GUI server starts, the journal is replayed and then compacted. It is
+compacted again whenever it grows past COMPACT_SIZE bytes, or twice its size
+after the last compaction if larger. Since records include bundle contents,
+the journal file is only readable by its owner.
+"""
+
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+
+
+# Define the number of seconds records are collected before being written.
+FLUSH_DELAY = 1
+# Define the minimum journal size in bytes triggering a compaction.
+COMPACT_SIZE = 4 * 1024 * 1024
+
+
+class Journal(object):
+    """An append-only journal of deployment records."""
+
+    def __init__(
+            self, path, io_loop=None, flush_delay=FLUSH_DELAY,
+            compact_size=COMPACT_SIZE):
+        self.path = path
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._flush_delay = flush_delay
+        self._compact_size = compact_size
+        # Store the encoded records not yet written.
+        self._pending = []
+        self._timeout = None
+        self._executor = ThreadPoolExecutor(1)
+        self._closed = False
+        # Track the journal size, including pending records.
+        try:
+            self._size = os.path.getsize(path)
+        except OSError:
+            self._size = 0
+        self._compacted_size = 0
+
+    @property
+    def needs_compaction(self):
+        """Return True if the journal grew enough to be compacted."""
+        threshold = max(self._compact_size, 2 * self._compacted_size)
+        return self._size > threshold
+
+    def replay(self):
+        """Return the list of records stored in the journal.
+
+        A truncated last record, e.g. as a result of a crash while writing,
+        is ignored.
+        """
+        records = []
+        try:
+            journal_file = open(self.path)
+        except IOError:
+            return records
+        with journal_file:
+            for number, line in enumerate(journal_file, 1):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logging.warning(
+                        'journal: ignoring invalid record at {}:{}'.format(
+                            self.path, number))
+        return records
+
+    def append(self, record):
+        """Schedule the given record to be written to the journal."""
+        if self._closed:
+            logging.error('journal: closed, record not written')
+            return
+        line = json.dumps(record) + '\n'
+        self._pending.append(line)
+        self._size += len(line)
+        if self._timeout is None:
+            self._timeout = self._io_loop.add_timeout(
+                self._io_loop.time() + self._flush_delay, self.flush)
+
+    def flush(self):
+        """Write pending records in a separate thread.
+
+        Return a Future whose result is None when records are written.
+        """
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        lines, self._pending = self._pending, []
+        return self._executor.submit(self._append, lines)
+
+    def compact(self, records):
+        """Replace the journal contents with the given records.
+
+        The records must describe the whole current state: records still
+        pending are discarded. The journal is rewritten in a separate thread,
+        after the records previously flushed.
+        Return a Future whose result is None when the journal is rewritten.
+        """
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        self._pending = []
+        lines = [json.dumps(record) + '\n' for record in records]
+        self._size = self._compacted_size = sum(len(line) for line in lines)
+        return self._executor.submit(self._rewrite, lines)
+
+    def close(self):
+        """Write the pending records and stop the writing thread.
+
+        Return when all the records are written.
+        """
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._executor.shutdown(wait=True)
+
+    def _append(self, lines):
+        """Append the given lines to the journal."""
+        if not lines:
+            return
+        try:
+            _write(self.path, lines, os.O_APPEND)
+        except (IOError, OSError) as err:
+            logging.error('journal: cannot write records: {}'.format(err))
+
+    def _rewrite(self, lines):
+        """Atomically replace the journal contents with the given lines."""
+        path = self.path + '.tmp'
+        try:
+            _write(path, lines, os.O_TRUNC)
+            os.rename(path, self.path)
+        except (IOError, OSError) as err:
+            logging.error('journal: cannot compact: {}'.format(err))
+
+
+def _write(path, lines, flag):
+    """Write the given lines to the file at path and sync it to disk.
+
+    The flag is either os.O_APPEND or os.O_TRUNC. The file is created if
+    needed, and made readable and writable only by its owner.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | flag, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, 'w') as journal_file:
+        journal_file.writelines(lines)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
@@ -16,6 +16,7 @@
 
 """Bundle deployment utility functions and objects."""
 
+import bisect
 import collections
 from functools import wraps
 import itertools
@@ -30,7 +31,7 @@ from tornado import (
 from tornado.httpclient import AsyncHTTPClient
 
 from charmworldlib.utils import parse_constraints
-from guiserver.watchers import AsyncWatcher
+from guiserver.watchers import RingBufferWatcher
 from jujuclient import EnvError
 
 # Change statuses.
@@ -38,9 +39,19 @@ SCHEDULED = 'scheduled'
 STARTED = 'started'
 CANCELLED = 'cancelled'
 COMPLETED = 'completed'
-
-
-def create_change(deployment_id, status, queue=None, error=None):
+# The key used to archive completed deployments that reported an error.
+FAILED = 'failed'
+# Define how many finished (completed or cancelled) deployments are kept, and
+# for how many seconds, before being archived.
+MAX_FINISHED_DEPLOYMENTS = 100
+MAX_FINISHED_AGE = 60 * 60 * 24
+# Define how many changes are stored for each deployment.
+MAX_DEPLOYMENT_CHANGES = 100
+
+
+def create_change(
+        deployment_id, status, queue=None, error=None, progress=None,
+        results=None, timing=None):
     """Return a dict representing a deployment change.
 
     The resulting dict contains at least the following fields:
@@ -50,7 +61,14 @@ def create_change(deployment_id, status, queue=None, error=None):
 
     These optional fields can also be present:
       - Queue: the deployment position in the queue at the time of this change;
-      - Error: a message describing an error occurred during the deployment.
+      - Error: a message describing an error occurred during the deployment;
+      - Progress: a dict describing a step completed by a started deployment,
+        including the Action, the Entity (if any) and the Duration in seconds;
+      - Results: a list including the outcome of each bundle imported by a
+        completed batch deployment (see create_results);
+      - Timing: a dict comparing the Elapsed time of a completed deployment
+        applying bundle changes with its Total and CriticalPath durations
+        (see guiserver.bundles.dag).
     """
     result = {
         'DeploymentId': deployment_id,
@@ -61,9 +79,25 @@ def create_change(deployment_id, status, queue=None, error=None):
         result['Queue'] = queue
     if error is not None:
         result['Error'] = error
+    if progress is not None:
+        result['Progress'] = progress
+    if results is not None:
+        result['Results'] = results
+    if timing is not None:
+        result['Timing'] = timing
     return result
 
 
+def create_results(errors):
+    """Return a list of per-bundle results given a list of errors.
+
+    Each error is either a string or None if the corresponding bundle has been
+    successfully validated or imported. In the resulting list, successes are
+    represented by empty dicts, failures by dicts including an Error field.
+    """
+    return [{} if error is None else {'Error': error} for error in errors]
+
+
 def message_from_error(exception):
     """Return a (possibly) human readable message from the given exception.
 
@@ -83,14 +117,131 @@ def message_from_error(exception):
     return message
 
 
-class Observer(object):
-    """Handle multiple deployment watchers."""
+class DeploymentQueue(object):
+    """An indexed queue of deployment identifiers.
+
+    Each queued deployment is assigned an increasing ticket number. The
+    position of a deployment is computed when requested, from its ticket, the
+    ticket of the first deployment in the queue and the tickets removed out of
+    order (e.g. cancelled deployments): this way adding or removing the first
+    deployment does not require updating the other positions.
+
+    The queue also records the last position reported for each deployment, so
+    that callers can notify a position only when it actually changed.
+    """
 
     def __init__(self):
+        # Map deployment identifiers to tickets and vice versa. Tickets are
+        # assigned in increasing order, so iterating over the ordered mapping
+        # yields deployments in queue order.
+        self._tickets = collections.OrderedDict()
+        self._deployments = {}
+        # The ticket of the first deployment in the queue, or the next ticket
+        # to be assigned if the queue is empty.
+        self._head = 0
+        # This counter is used to generate tickets.
+        self._ticket_counter = itertools.count()
+        # A sorted list of the tickets removed from the middle of the queue.
+        self._gaps = []
+        # Map deployment identifiers to the last reported positions.
+        self._reported = {}
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def __contains__(self, deployment_id):
+        return deployment_id in self._tickets
+
+    def __iter__(self):
+        return iter(self._tickets)
+
+    def append(self, deployment_id):
+        """Add the given deployment to the end of the queue.
+
+        Return the position of the deployment.
+        """
+        ticket = self._ticket_counter.next()
+        self._tickets[deployment_id] = ticket
+        self._deployments[ticket] = deployment_id
+        return self.position(deployment_id)
+
+    def remove(self, deployment_id):
+        """Remove the given deployment from the queue.
+
+        Raise a ValueError if the deployment is not in the queue.
+        """
+        ticket = self._tickets.pop(deployment_id, None)
+        if ticket is None:
+            raise ValueError(
+                'deployment {} not in queue'.format(deployment_id))
+        del self._deployments[ticket]
+        self._reported.pop(deployment_id, None)
+        if ticket != self._head:
+            bisect.insort(self._gaps, ticket)
+            return
+        # The first deployment has been removed: move the head forward,
+        # skipping the tickets already removed.
+        self._head += 1
+        gaps = self._gaps
+        index = 0
+        while index < len(gaps) and gaps[index] == self._head:
+            self._head += 1
+            index += 1
+        if index:
+            del gaps[:index]
+
+    def first(self):
+        """Return the first deployment in the queue, or None if empty."""
+        return self._deployments.get(self._head)
+
+    def position(self, deployment_id):
+        """Return the current position of the given deployment in the queue.
+
+        Raise a KeyError if the deployment is not in the queue.
+        """
+        ticket = self._tickets[deployment_id]
+        return ticket - self._head - bisect.bisect_left(self._gaps, ticket)
+
+    def position_changed(self, deployment_id):
+        """Return the position of the given deployment if it changed.
+
+        Return None if the position is the same as the one returned by the
+        last call to this method, or if the deployment is not in the queue.
+        """
+        if deployment_id not in self._tickets:
+            return None
+        position = self.position(deployment_id)
+        if self._reported.get(deployment_id) == position:
+            return None
+        self._reported[deployment_id] = position
+        return position
+
+
+class Observer(object):
+    """Handle multiple deployment watchers.
+
+    Finished deployments are expired, together with their watcher identifiers,
+    when more than max_finished deployments are finished or when they finished
+    more than max_age seconds ago. Expired deployments are only summarized in
+    the archive, a counter of finished deployments by status.
+    """
+
+    def __init__(
+            self, max_finished=MAX_FINISHED_DEPLOYMENTS,
+            max_age=MAX_FINISHED_AGE):
+        self._max_finished = max_finished
+        self._max_age = max_age
         # Map deployment identifiers to watchers.
         self.deployments = {}
         # Map watcher identifiers to deployment identifiers.
         self.watchers = {}
+        # Map deployment identifiers to sets of watcher identifiers.
+        self._deployment_watchers = {}
+        # Map finished deployment identifiers to their finish times, ordered
+        # from the oldest to the most recent.
+        self._finished = collections.OrderedDict()
+        # Count expired deployments by status.
+        self.archive = collections.Counter()
         # This counter is used to generate deployment identifiers.
         self._deployment_counter = itertools.count()
         # This counter is used to generate watcher identifiers.
@@ -103,10 +254,37 @@ class Observer(object):
         Return the generated deployment id.
         """
         deployment_id = self._deployment_counter.next()
-        self.deployments[deployment_id] = AsyncWatcher()
+        self._add_watcher(deployment_id)
         logging.info('deployment {} scheduled'.format(deployment_id))
         return deployment_id
 
+    def _add_watcher(self, deployment_id):
+        """Create and return the watcher for the given deployment id."""
+        watcher = self.deployments[deployment_id] = RingBufferWatcher(
+            MAX_DEPLOYMENT_CHANGES,
+            make_gap=lambda missed: {'DeploymentId': deployment_id,
+                                     'Gap': missed})
+        self._deployment_watchers[deployment_id] = set()
+        return watcher
+
+    def restore_deployment(self, deployment_id, change):
+        """Start observing a deployment restored after a server restart.
+
+        The given change is the last known change of the deployment. If it
+        represents a completed or cancelled deployment, the watcher is closed.
+        Subsequent deployment ids are generated starting from the given one.
+        """
+        watcher = self._add_watcher(deployment_id)
+        next_id = deployment_id + 1
+        self._deployment_counter = itertools.count(
+            max(next_id, self._deployment_counter.next()))
+        if change['Status'] in (COMPLETED, CANCELLED):
+            watcher.close(change)
+            self._finish(deployment_id)
+        else:
+            watcher.put(change)
+        logging.info('deployment {} restored'.format(deployment_id))
+
     def add_watcher(self, deployment_id):
         """Return a new watcher id for the given deployment id.
 
@@ -114,10 +292,24 @@ class Observer(object):
         """
         watcher_id = self._watcher_counter.next()
         self.watchers[watcher_id] = deployment_id
+        self._deployment_watchers[deployment_id].add(watcher_id)
         logging.debug('deployment {} observed by watcher {}'.format(
             deployment_id, watcher_id))
         return watcher_id
 
+    def remove_watcher(self, watcher_id):
+        """Stop the given watcher id from observing its deployment.
+
+        Do nothing if the watcher id is not valid or already expired.
+        """
+        deployment_id = self.watchers.pop(watcher_id, None)
+        if deployment_id is None:
+            return
+        self._deployment_watchers[deployment_id].discard(watcher_id)
+        self.deployments[deployment_id].remove(watcher_id)
+        logging.debug('deployment {} no longer observed by watcher {}'.format(
+            deployment_id, watcher_id))
+
     def notify_position(self, deployment_id, position):
         """Add a change to the deployment watcher notifying a new position.
 
@@ -131,19 +323,284 @@ class Observer(object):
         logging.debug('deployment {} now in position {}'.format(
             deployment_id, position))
 
+    def notify_progress(self, deployment_id, progress):
+        """Add a change to the deployment watcher notifying progress.
+
+        Ignore progress of unknown or already finished deployments.
+        """
+        watcher = self.deployments.get(deployment_id)
+        if watcher is None or watcher.closed:
+            return
+        change = create_change(
+            deployment_id, STARTED, queue=0, progress=progress)
+        watcher.put(change)
+        logging.debug('deployment {} progress: {}'.format(
+            deployment_id, progress))
+
     def notify_cancelled(self, deployment_id):
-        """Add a change to the deployment watcher notifying it is cancelled."""
+        """Add a change to the deployment watcher notifying it is cancelled.
+
+        Return the change.
+        """
         watcher = self.deployments[deployment_id]
         change = create_change(deployment_id, CANCELLED)
         watcher.close(change)
         logging.info('deployment {} cancelled'.format(deployment_id))
+        self._finish(deployment_id)
+        return change
+
+    def notify_completed(
+            self, deployment_id, error=None, results=None, timing=None):
+        """Add a change to the deployment watcher notifying it is completed.
 
-    def notify_completed(self, deployment_id, error=None):
-        """Add a change to the deployment watcher notifying it is completed."""
+        The optional results are included in the change for batch deployments,
+        the optional timing report for deployments applying bundle changes.
+        Return the change.
+        """
         watcher = self.deployments[deployment_id]
-        change = create_change(deployment_id, COMPLETED, error=error)
+        change = create_change(
+            deployment_id, COMPLETED, error=error, results=results,
+            timing=timing)
         watcher.close(change)
         logging.info('deployment {} completed'.format(deployment_id))
+        self._finish(deployment_id)
+        return change
+
+    def _finish(self, deployment_id):
+        """Mark the given deployment as finished and expire old deployments."""
+        self._finished[deployment_id] = time.time()
+        self.expire()
+
+    def expire(self):
+        """Archive the finished deployments exceeding the retention policy.
+
+        Remove their watchers and watcher identifiers.
+        """
+        finished = self._finished
+        oldest = time.time() - self._max_age
+        while finished:
+            deployment_id, finish_time = next(finished.iteritems())
+            if len(finished) <= self._max_finished and finish_time >= oldest:
+                break
+            del finished[deployment_id]
+            change = self.deployments.pop(deployment_id).getlast()
+            key = FAILED if 'Error' in change else change['Status']
+            self.archive[key] += 1
+            for watcher_id in self._deployment_watchers.pop(deployment_id):
+                del self.watchers[watcher_id]
+            logging.debug('deployment {} archived'.format(deployment_id))
+
+
+def get_deltas(data):
+    """Return the megawatcher deltas included in the given Juju API response.
+
+    Return None if data is not a response to an AllWatcher Next request.
+    Both the Juju 1 (capitalized) and Juju 2 (lowercase) formats are supported.
+    """
+    response = data.get('Response', data.get('response'))
+    if not isinstance(response, collections.Mapping):
+        return None
+    deltas = response.get('Deltas', response.get('deltas'))
+    if not isinstance(deltas, list):
+        return None
+    return deltas
+
+
+class EnvironmentSnapshot(object):
+    """A live snapshot of the services deployed in a Juju model.
+
+    The snapshot is fed with the megawatcher deltas proxied by the WebSocket
+    handlers connected to the model: handlers register themselves as feeders
+    when their megawatcher starts sending deltas, and unregister when the
+    watcher stops or the connection drops. The snapshot is live when at least
+    one feeder is registered and the initial megawatcher state has been
+    received. When the last feeder goes away the snapshot is reset, since
+    changes would no longer be tracked.
+
+    Besides the service names, the snapshot indexes the service options and
+    exposure, the units and their machines, and the relations in the model,
+    so that the changes required to deploy a bundle can be computed without
+    querying the Juju API (see guiserver.bundles.changes).
+    """
+
+    def __init__(self):
+        self.services = set()
+        # Map service names to their options, if reported by Juju.
+        self.config = {}
+        self.exposed = set()
+        # Map unit names to the identifiers of the machines they live on.
+        self.units = {}
+        # Map relation keys to sets of (service, relation name) endpoints.
+        self.relations = {}
+        self._feeders = 0
+        self._ready = False
+
+    @property
+    def is_live(self):
+        """Return True if the snapshot reflects the current model state."""
+        return self._ready and self._feeders > 0
+
+    def add_feeder(self):
+        """Register a new source of megawatcher deltas."""
+        self._feeders += 1
+
+    def remove_feeder(self):
+        """Unregister a source of megawatcher deltas."""
+        self._feeders -= 1
+        if self._feeders <= 0:
+            self._feeders = 0
+            self._ready = False
+            self.services.clear()
+            self.config.clear()
+            self.exposed.clear()
+            self.units.clear()
+            self.relations.clear()
+
+    def update(self, deltas):
+        """Update the snapshot with the given megawatcher deltas.
+
+        Each delta is a [entity type, change type, entity data] list. Both the
+        legacy (e.g. "Name") and the current (e.g. "name") keys are supported.
+        """
+        for delta in deltas:
+            try:
+                entity, change, data = delta
+            except (TypeError, ValueError):
+                continue
+            handler = self._handlers.get(entity)
+            if handler is not None and isinstance(data, dict):
+                handler(self, change == 'remove', data)
+        self._ready = True
+
+    def _update_service(self, removed, data):
+        name = _get(data, 'Name', 'name')
+        if removed:
+            self.services.discard(name)
+            self.config.pop(name, None)
+            self.exposed.discard(name)
+            return
+        self.services.add(name)
+        config = _get(data, 'Config', 'config')
+        if config is not None:
+            self.config[name] = config
+        if _get(data, 'Exposed', 'exposed'):
+            self.exposed.add(name)
+        else:
+            self.exposed.discard(name)
+
+    def _update_unit(self, removed, data):
+        name = _get(data, 'Name', 'name')
+        if removed:
+            self.units.pop(name, None)
+        else:
+            self.units[name] = _get(data, 'MachineId', 'machine-id')
+
+    def _update_relation(self, removed, data):
+        key = _get(data, 'Key', 'key')
+        if removed:
+            self.relations.pop(key, None)
+            return
+        endpoints = set()
+        for endpoint in _get(data, 'Endpoints', 'endpoints') or []:
+            service = _get(endpoint, 'ServiceName', 'application-name')
+            relation = _get(endpoint, 'Relation', 'relation') or {}
+            endpoints.add((service, _get(relation, 'Name', 'name')))
+        self.relations[key] = endpoints
+
+    _handlers = {
+        'service': _update_service,
+        'application': _update_service,
+        'unit': _update_unit,
+        'relation': _update_relation,
+    }
+
+    def get_units(self, service):
+        """Return the (unit name, machine id) pairs of the given service.
+
+        Units are sorted by unit number.
+        """
+        prefix = service + '/'
+        units = [
+            (int(name[len(prefix):]), name, machine)
+            for name, machine in self.units.items()
+            if name.startswith(prefix)
+        ]
+        return [(name, machine) for _, name, machine in sorted(units)]
+
+    def has_relation(self, endpoint_a, endpoint_b):
+        """Return True if the given endpoints are related in the model.
+
+        Endpoints are (service, relation name) pairs: the relation name can
+        be None if not specified, in which case any relation between the two
+        services is considered a match.
+        """
+        for endpoints in self.relations.values():
+            if len(endpoints) != 2:
+                continue
+            if (_endpoint_in(endpoint_a, endpoints) and
+                    _endpoint_in(endpoint_b, endpoints)):
+                return True
+        return False
+
+    def validate(self, bundle):
+        """Validate the given bundle against the snapshot.
+
+        Return an error string if the bundle includes services already
+        deployed in the model, None otherwise.
+        """
+        return validate_services(self.services, bundle)
+
+
+def _get(data, legacy_key, key):
+    """Return the value for the given legacy or current megawatcher key."""
+    if legacy_key in data:
+        return data[legacy_key]
+    return data.get(key)
+
+
+def _endpoint_in(endpoint, endpoints):
+    """Report whether the given (service, name) endpoint is in endpoints.
+
+    A None relation name matches any relation of the service.
+    """
+    service, name = endpoint
+    return any(
+        service == other_service and name in (None, other_name)
+        for other_service, other_name in endpoints)
+
+
+def validate_services(services, bundle):
+    """Validate the given bundle against the given deployed service names.
+
+    Return an error string if the bundle includes services already deployed,
+    None otherwise.
+    """
+    bundle_services = set(bundle.get('services', {}).keys())
+    overlapping = services.intersection(bundle_services)
+    if overlapping:
+        names = ', '.join(sorted(overlapping))
+        return 'service(s) already in the environment: {}'.format(names)
+
+
+def validate_batch(services, bundles):
+    """Validate the given bundles to be deployed together.
+
+    Each bundle is validated against the given deployed service names and the
+    services included in the bundles preceding it in the batch.
+    Return a list including an error string or None for each bundle.
+    """
+    batch_services = set()
+    errors = []
+    for bundle in bundles:
+        error = validate_services(services, bundle)
+        bundle_services = set(bundle.get('services', {}).keys())
+        overlapping = batch_services.intersection(bundle_services)
+        if error is None and overlapping:
+            names = ', '.join(sorted(overlapping))
+            error = 'service(s) already in the batch: {}'.format(names)
+        errors.append(error)
+        batch_services.update(bundle_services)
+    return errors
 
 
 def prepare_bundle(bundle):
@@ -62,6 +62,7 @@ using "yield", and they must return their results using "raise response(...)"
 
 import datetime
 import logging
+import time
 import uuid
 
 from jujubundlelib import (
@@ -73,12 +74,17 @@ from tornado.ioloop import IOLoop
 import yaml
 
 from guiserver.bundles.utils import (
+    create_results,
     prepare_bundle,
     require_authenticated_user,
     response,
 )
 
 
+# Define the error returned to import requests while the server is stopping.
+DRAINING_ERROR = 'the GUI server is restarting: please retry later'
+
+
 def _validate_import_params(params):
     """Parse the request data and return a (name, bundle, version, id) tuple.
 
@@ -139,6 +145,8 @@ def import_bundle(request, deployer):
         'BundleID': '~user/bundle-name',
     }.
     """
+    if deployer.draining:
+        raise response(error=DRAINING_ERROR)
     # Validate the request parameters.
     try:
         name, bundle, version, id_ = _validate_import_params(request.params)
@@ -163,6 +171,106 @@ def import_bundle(request, deployer):
     raise response({'DeploymentId': deployment_id})
 
 
+@gen.coroutine
+@require_authenticated_user
+def import_delta(request, deployer):
+    """Deploy only the changes required to bring the model up to a bundle.
+
+    The changes are computed by comparing the bundle with the live snapshot of
+    the model maintained by the Deployer: services, units, relations and
+    exposures already present are skipped, and options of existing services
+    are updated. Only v4 bundles are supported. If the request is valid, the
+    response contains the number of changes to be applied (Delta) and the
+    number of changes required to deploy the bundle from scratch (Total).
+    The DeploymentId is only included if there is something to deploy.
+
+    Request: 'ImportDelta'.
+    Parameters example: {
+        'YAML': 'bundle',
+        'Version': 4,
+        'BundleID': '~user/bundle-name',
+    }.
+    """
+    if deployer.draining:
+        raise response(error=DRAINING_ERROR)
+    try:
+        name, bundle, version, id_ = _validate_import_params(request.params)
+    except ValueError as err:
+        raise response(error='invalid request: {}'.format(err))
+    if version != 4:
+        raise response(error='invalid request: only v4 bundles are supported')
+    errors = validation.validate(bundle)
+    if errors:
+        error = 'invalid request: invalid bundle: {}'.format('; '.join(errors))
+        raise response(error=error)
+    start = time.time()
+    delta = deployer.diff(bundle)
+    if delta is None:
+        raise response(
+            error='invalid request: live model snapshot not available')
+    changes, total = delta
+    logging.info(
+        'import_delta: {} of {} changes required (diff computed in {:.3f} '
+        'seconds)'.format(len(changes), total, time.time() - start))
+    info = {'Delta': len(changes), 'Total': total}
+    if changes:
+        info['DeploymentId'] = deployer.import_changes(
+            request.user, name, bundle, version, id_, changes)
+    raise response(info)
+
+
+@gen.coroutine
+@require_authenticated_user
+def batch_import(request, deployer):
+    """Start or schedule the deployment of multiple bundles in a single job.
+
+    The bundles are validated together, against the same state of the Juju
+    environment. If any of them is not valid, no bundle is deployed and the
+    response contains the Results of the validation, one for each bundle, e.g.
+    [{}, {'Error': 'service(s) already in the environment: mysql'}].
+    Otherwise the response contains the DeploymentId assigned to the whole
+    batch: the results of each bundle import are included in the completed
+    deployment change.
+
+    Request: 'BatchImport'.
+    Parameters example: {
+        'Bundles': [
+            {'YAML': 'bundle', 'Version': 4, 'BundleID': '~user/bundle1'},
+            {'YAML': 'bundle', 'Version': 4, 'BundleID': '~user/bundle2'},
+        ],
+    }.
+    """
+    if deployer.draining:
+        raise response(error=DRAINING_ERROR)
+    params = request.params.get('Bundles')
+    if not isinstance(params, list) or not params:
+        raise response(error='invalid request: invalid data parameters')
+    # Validate the request parameters and prepare the bundles.
+    bundles = []
+    for position, bundle_params in enumerate(params):
+        if not isinstance(bundle_params, dict):
+            error = 'invalid request: bundle {}: invalid data parameters'
+            raise response(error=error.format(position))
+        try:
+            name, bundle, version, id_ = _validate_import_params(bundle_params)
+            prepare_bundle(bundle)
+        except ValueError as err:
+            error = 'invalid request: bundle {}: {}'.format(position, err)
+            raise response(error=error)
+        bundles.append((name, bundle, version, id_))
+    # Validate the bundles against the current state of the Juju environment.
+    errors = yield deployer.validate_batch(
+        request.user, [bundle for _, bundle, _, _ in bundles])
+    if any(errors):
+        raise response(
+            {'Results': create_results(errors)},
+            error='invalid request: invalid bundles in batch')
+    logging.info('batch_import: scheduling deployment of {} bundles'.format(
+        len(bundles)))
+    deployment_id = deployer.import_batch(request.user, bundles)
+    raise response({'DeploymentId': deployment_id})
+
+
 @gen.coroutine
 @require_authenticated_user
 def watch(request, deployer):
@@ -187,6 +295,30 @@ def watch(request, deployer):
     raise response({'WatcherId': watcher_id})
 
 
+@gen.coroutine
+@require_authenticated_user
+def subscribe(request, deployer):
+    """Handle requests for subscribing to a given deployment changes.
+
+    The deployment is identified in the request by the DeploymentId parameter.
+    If the request is valid, the response will contain the WatcherId assigned
+    to the subscription. Pushing the subsequent changes to the client is up to
+    the DeployMiddleware.
+
+    Request: 'Subscribe'.
+    Parameters example: {'DeploymentId': 42}.
+    """
+    deployment_id = request.params.get('DeploymentId')
+    if deployment_id is None:
+        raise response(error='invalid request: invalid data parameters')
+    watcher_id = deployer.watch(deployment_id)
+    if watcher_id is None:
+        raise response(error='invalid request: deployment not found')
+    logging.info('subscribe: deployment {} being observed by watcher {}'
+                 ''.format(deployment_id, watcher_id))
+    raise response({'WatcherId': watcher_id})
+
+
 @gen.coroutine
 @require_authenticated_user
 def next(request, deployer):
@@ -0,0 +1,443 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bundle deployment worker functions.
+
+The functions in this module are executed by the Deployer in its worker
+processes. The worker processes are spawned as soon as the Deployer IO loop
+runs and live as long as the GUI server: the heavy juju-deployer, jujuclient
+and websocket-client modules are imported before the processes are forked, and
+authenticated Juju API connections are kept open between jobs.
+
+Each worker process stores its own connections, keyed by (API URL, user name).
+A connection is health checked before being reused, and it is recycled when
+it gets too old or has been used for too many jobs.
+
+While importing a bundle, workers send progress events to the GUI server
+process using the connection set up by set_progress_connection. Each event is
+a (deployment id, progress) tuple, where progress is a dict like the following:
+
+    {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1.42}
+
+When importing a batch of bundles, progress events also include the Bundle
+field, reporting the position of the bundle being imported in the batch.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from deployer import guiserver as blocking
+from deployer.action.importer import Importer
+from deployer.env.gui import GUIEnvironment
+from deployer.utils import mkdir
+from websocket import WebSocketException
+
+from guiserver.bundles import dag
+from guiserver.bundles.changes import apply as apply_change
+from guiserver.bundles.utils import (
+    message_from_error,
+    validate_batch,
+)
+
+
+# Define the maximum number of seconds an API connection can be reused.
+MAX_CONNECTION_AGE = 60 * 30
+# Define the maximum number of jobs that can reuse an API connection.
+MAX_CONNECTION_USES = 100
+# Define the number of idle seconds after which a connection is pinged before
+# being reused.
+HEALTH_CHECK_INTERVAL = 30
+# Define the maximum number of bundle changes applied at the same time, each
+# one using its own API connection.
+MAX_CONCURRENT_CHANGES = 4
+
+# Map (API URL, user name) pairs to the connections open in this process.
+_connections = {}
+# The multiprocessing connection used to send progress events.
+_progress_connection = None
+
+
+class _Connection(object):
+    """An authenticated Juju API connection stored in a worker process."""
+
+    def __init__(self, env, password):
+        self.env = env
+        self.password = password
+        self.created = self.last_used = time.time()
+        self.uses = 0
+
+    def is_reusable(self, password):
+        """Return True if the connection can be used for a new job.
+
+        Also return False if the connection is too old, has been used for too
+        many jobs or does not answer a ping.
+        """
+        if password != self.password:
+            return False
+        now = time.time()
+        if now - self.created > MAX_CONNECTION_AGE:
+            return False
+        if self.uses >= MAX_CONNECTION_USES:
+            return False
+        client = self.env.client
+        if client is None or not client.conn.connected:
+            return False
+        if now - self.last_used > HEALTH_CHECK_INTERVAL:
+            try:
+                client.info()
+            except Exception as err:
+                logging.warning('worker: API connection ping failed: '
+                                '{}'.format(err))
+                return False
+        return True
+
+
+class _ProgressEnvironment(object):
+    """Wrap a GUIEnvironment reporting the time spent in each change."""
+
+    def __init__(self, env, emit):
+        self._env = env
+        self._emit = emit
+
+    def __getattr__(self, name):
+        return getattr(self._env, name)
+
+    def _timed(self, action, entity, method, *args, **kwargs):
+        """Call the given environment method and emit a progress event."""
+        start = time.time()
+        result = getattr(self._env, method)(*args, **kwargs)
+        self._emit(action, entity, time.time() - start)
+        return result
+
+    def add_machine(self, *args, **kwargs):
+        return self._timed(
+            'add_machine', None, 'add_machine', *args, **kwargs)
+
+    def deploy(self, name, *args, **kwargs):
+        return self._timed('deploy', name, 'deploy', name, *args, **kwargs)
+
+    def add_unit(self, name, *args, **kwargs):
+        return self._timed(
+            'add_units', name, 'add_unit', name, *args, **kwargs)
+
+    def add_units(self, name, *args, **kwargs):
+        return self._timed(
+            'add_units', name, 'add_units', name, *args, **kwargs)
+
+    def add_relation(self, endpoint_a, endpoint_b):
+        entity = '{} {}'.format(endpoint_a, endpoint_b)
+        return self._timed(
+            'add_relation', entity, 'add_relation', endpoint_a, endpoint_b)
+
+
+class _ClientPool(object):
+    """Lend Juju API clients to the threads applying bundle changes.
+
+    API clients cannot be shared between threads, so each thread borrows a
+    client while applying a change. The client of the given environment is
+    used first, additional connections are opened when required and closed
+    by self.close().
+    """
+
+    def __init__(self, env, apiurl, username, password):
+        self._credentials = (apiurl, username, password)
+        self._idle = [env.client]
+        self._envs = []
+        self._lock = threading.Lock()
+
+    def apply(self, change, results):
+        """Apply the given change using an idle client."""
+        client = self._acquire()
+        try:
+            return apply_change(client, change, results)
+        finally:
+            with self._lock:
+                self._idle.append(client)
+
+    def _acquire(self):
+        """Return an idle client, opening a new connection if required."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        env = GUIEnvironment(*self._credentials)
+        env.connect()
+        with self._lock:
+            self._envs.append(env)
+        return env.client
+
+    def close(self):
+        """Close the additional connections."""
+        for env in self._envs:
+            try:
+                env.close()
+            except Exception as err:
+                logging.warning('worker: error closing API connection: '
+                                '{}'.format(err))
+        self._envs = []
+
+
+def _phase(name):
+    """Wrap the given Importer method emitting a progress event when done."""
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        result = getattr(Importer, name)(self, *args, **kwargs)
+        self._emit('phase', name, time.time() - start)
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = getattr(Importer, name).__doc__
+    return wrapper
+
+
+class _ProgressImporter(Importer):
+    """A juju-deployer Importer reporting the time spent in each phase."""
+
+    def __init__(self, env, deployment, options, emit):
+        super(_ProgressImporter, self).__init__(
+            _ProgressEnvironment(env, emit), deployment, options)
+        self._emit = emit
+
+    get_charms = _phase('get_charms')
+    create_machines = _phase('create_machines')
+    deploy_services = _phase('deploy_services')
+    add_units = _phase('add_units')
+    wait_for_units = _phase('wait_for_units')
+    add_relations = _phase('add_relations')
+
+
+def set_progress_connection(connection):
+    """Set up the connection used to send progress events.
+
+    This must be called in the GUI server process before the worker processes
+    are spawned, so that workers inherit the connection.
+    """
+    global _progress_connection
+    _progress_connection = connection
+
+
+def _make_emitter(deployment_id, bundle=None):
+    """Return a function sending progress events for the given deployment.
+
+    If provided, the given bundle position in a batch is included in events.
+    Errors sending events are logged and otherwise ignored.
+    """
+    def emit(action, entity, duration):
+        connection = _progress_connection
+        if connection is None:
+            return
+        progress = {'Action': action, 'Duration': round(duration, 3)}
+        if entity is not None:
+            progress['Entity'] = entity
+        if bundle is not None:
+            progress['Bundle'] = bundle
+        try:
+            connection.send((deployment_id, progress))
+        except (IOError, OSError) as err:
+            logging.warning('worker: cannot send progress: {}'.format(err))
+    return emit
+
+
+def warm_up(fds=()):
+    """Prepare the current worker process to run deployer jobs.
+
+    This function is submitted to the executors when the Deployer is created,
+    so that worker processes are spawned before the first job arrives.
+    Close the given file descriptors inherited from the server process.
+    Return the worker process identifier.
+    """
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError as err:
+            logging.warning('worker: cannot close fd {}: {}'.format(fd, err))
+    return os.getpid()
+
+
+def get_environment(apiurl, username, password):
+    """Return a connected GUIEnvironment for the given credentials.
+
+    Reuse the connection stored in this process if it is still healthy,
+    otherwise open and store a new one.
+    """
+    key = (apiurl, username)
+    connection = _connections.get(key)
+    if connection is not None and not connection.is_reusable(password):
+        logging.debug('worker: recycling API connection for {}'.format(
+            username))
+        close_environment(apiurl, username)
+        connection = None
+    if connection is None:
+        env = GUIEnvironment(apiurl, username, password)
+        env.connect()
+        connection = _connections[key] = _Connection(env, password)
+    connection.uses += 1
+    connection.last_used = time.time()
+    return connection.env
+
+
+def close_environment(apiurl, username):
+    """Close and forget the connection for the given API URL and user name."""
+    connection = _connections.pop((apiurl, username), None)
+    if connection is not None:
+        try:
+            connection.env.close()
+        except Exception as err:
+            logging.warning('worker: error closing API connection: '
+                            '{}'.format(err))
+
+
+def _run(apiurl, username, password, function, *args):
+    """Call the given function passing an environment and the given args.
+
+    Discard the connection if it turns out to be broken while running.
+    """
+    env = get_environment(apiurl, username, password)
+    try:
+        return function(env, *args)
+    except (socket.error, WebSocketException):
+        close_environment(apiurl, username)
+        raise
+
+
+def _import_bundle(
+        env, name, bundle, version, options, validate, deployment_id,
+        position=None):
+    """Import a bundle in the given connected environment.
+
+    Skip the bundle validation if validate is False. Progress events are sent
+    for the given deployment id, including the bundle position if provided.
+    """
+    deployment = blocking.GUIDeployment(name, bundle, version=version)
+    emit = _make_emitter(deployment_id, bundle=position)
+    importer = _ProgressImporter(env, deployment, options, emit)
+    # The Importer retrieves the Juju home from the JUJU_HOME environment
+    # variable: create the directory if required and set up the variable.
+    mkdir(blocking.JUJU_HOME)
+    os.environ['JUJU_HOME'] = blocking.JUJU_HOME
+    if validate:
+        blocking._validate(env, bundle)
+    importer.run()
+
+
+def _validate_batch(env, bundles):
+    """Validate the given bundles against a single environment status."""
+    services = set(env.status()['services'].keys())
+    return validate_batch(services, bundles)
+
+
+def _import_bundles(env, bundles, options, validate, deployment_id):
+    """Import the given (name, bundle, version) tuples one after the other.
+
+    Return a list including an error string or None for each bundle. Errors
+    importing a bundle do not prevent the next ones from being imported,
+    except for connection errors, which are propagated.
+    """
+    errors = []
+    for position, (name, bundle, version) in enumerate(bundles):
+        try:
+            _import_bundle(
+                env, name, bundle, version, options, validate, deployment_id,
+                position=position)
+        except (socket.error, WebSocketException):
+            raise
+        except Exception as err:
+            errors.append(message_from_error(err))
+        else:
+            errors.append(None)
+    return errors
+
+
+def _apply_changes(env, changes, deployment_id, credentials):
+    """Apply the given bundle changes, independent ones concurrently.
+
+    The credentials argument is the (API URL, user name, password) tuple used
+    to open additional API connections. A progress event is sent for each
+    applied change. Return the execution report (see guiserver.bundles.dag).
+    """
+    emit = _make_emitter(deployment_id)
+    pool = _ClientPool(env, *credentials)
+    try:
+        return dag.execute(
+            changes, pool.apply, max_workers=MAX_CONCURRENT_CHANGES,
+            callback=lambda change, duration: emit(
+                change['method'], change['id'], duration))
+    finally:
+        pool.close()
+
+
+def validate(apiurl, username, password, bundle):
+    """Validate a bundle against the current state of the Juju environment.
+
+    See deployer.guiserver.validate.
+    """
+    _run(apiurl, username, password, blocking._validate, bundle)
+
+
+def import_bundle(
+        apiurl, username, password, name, bundle, version, options,
+        validate=True, deployment_id=None):
+    """Import a bundle.
+
+    See deployer.guiserver.import_bundle. The bundle is validated against the
+    current state of the environment unless validate is False, which is the
+    case when a suspended deployment is resumed, as the bundle could have been
+    partially deployed before the restart. The deployment id is included in
+    the progress events sent while the bundle is imported.
+    """
+    _run(apiurl, username, password, _import_bundle,
+         name, bundle, version, options, validate, deployment_id)
+
+
+def validate_bundles(apiurl, username, password, bundles):
+    """Validate a batch of bundles against the current environment status.
+
+    The environment status is retrieved once for all the bundles. Each bundle
+    is also validated against the ones preceding it in the batch.
+    Return a list including an error string or None for each bundle.
+    """
+    return _run(apiurl, username, password, _validate_batch, bundles)
+
+
+def import_bundles(
+        apiurl, username, password, bundles, options, validate=True,
+        deployment_id=None):
+    """Import a batch of bundles reusing the same API connection.
+
+    The bundles argument is a list of (name, bundle, version) tuples.
+    See import_bundle for a description of the other arguments.
+    Return a list including an error string or None for each bundle.
+    """
+    return _run(apiurl, username, password, _import_bundles,
+                bundles, options, validate, deployment_id)
+
+
+def apply_changes(apiurl, username, password, changes, deployment_id=None):
+    """Apply the given bundle changes (see guiserver.bundles.changes).
+
+    The changes are usually the result of a diff between a bundle and the
+    current state of the environment, so no further validation is performed.
+    Independent changes are applied concurrently, using up to
+    MAX_CONCURRENT_CHANGES API connections. The deployment id is included in
+    the progress events.
+
+    Return a report comparing the time spent applying the changes with the
+    critical path duration (see guiserver.bundles.dag).
+    """
+    return _run(
+        apiurl, username, password, _apply_changes, changes, deployment_id,
+        (apiurl, username, password))
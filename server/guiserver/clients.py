@@ -16,13 +16,40 @@
 
 """Juju GUI server websocket clients."""
 
+from collections import OrderedDict
+import functools
+import random
+import socket
+import time
+import urlparse
+
 from tornado import (
+    concurrent,
     httpclient,
     websocket,
 )
+from tornado.iostream import SSLIOStream
+
+from guiserver import tls
+
+
+# Define the number of seconds after which a connection attempt to the next
+# Juju API endpoint is started, if the previous attempts are still pending.
+RACE_DELAY = 0.25
+# Define for how many seconds an endpoint is tried last after a connection
+# failure.
+FAILURE_BACKOFF = 30
+# Define the weight of the last connection in the endpoint statistics, which
+# are exponentially weighted moving averages.
+STATS_WEIGHT = 0.3
 
+# The SSL context shared by the secure WebSocket connections, created when
+# first required.
+_ssl_context = None
 
-def websocket_connect(io_loop, url, on_message_callback, headers=None):
+
+def websocket_connect(
+        io_loop, url, on_message_callback, headers=None, endpoints=None):
     """WebSocket client connection factory.
 
     The client factory receives the following arguments:
@@ -31,16 +58,44 @@ def websocket_connect(io_loop, url, on_message_callback, headers=None):
         - on_message_callback: a callback that will be called each time
           a new message is received by the client;
         - headers (optional): a dict of additional headers to include in the
-          client handshake.
+          client handshake;
+        - endpoints (optional): the EndpointPool of a highly available Juju
+          controller. If the URL refers to one of its endpoints, the
+          connection is established with the best available endpoint (see
+          EndpointPool.candidates).
 
     Return a Future whose result is a WebSocketClientConnection.
     """
+    if endpoints is not None:
+        candidates = endpoints.candidates(url)
+        if candidates is not None:
+            race = _ConnectionRace(
+                io_loop, url, on_message_callback, headers, candidates)
+            return race.future
+    conn = WebSocketClientConnection(
+        io_loop, _make_request(url, headers), on_message_callback)
+    return conn.connect_future
+
+
+def get_ssl_context():
+    """Return the SSL context shared by the secure WebSocket connections.
+
+    Sharing the context avoids setting up SSL for each connection, which
+    includes loading the CA certificates bundle.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = tls.make_client_context()
+    return _ssl_context
+
+
+def _make_request(url, headers):
+    """Return the WebSocket handshake request for the given URL."""
     request = httpclient.HTTPRequest(
         url, validate_cert=False, request_timeout=100)
     if headers is not None:
         request.headers.update(headers)
-    conn = WebSocketClientConnection(io_loop, request, on_message_callback)
-    return conn.connect_future
+    return request
 
 
 class WebSocketClientConnection(websocket.WebSocketClientConnection):
@@ -59,6 +114,30 @@ class WebSocketClientConnection(websocket.WebSocketClientConnection):
         """
         super(WebSocketClientConnection, self).__init__(io_loop, request)
         self._on_message_callback = on_message_callback
+        # The endpoint this connection counts as a session for, if any.
+        self._endpoint = None
+
+    def _start_session(self, endpoint, on_message_callback):
+        """Count this connection as a session on the given endpoint.
+
+        Also set the callback called when a new message is received.
+        """
+        endpoint.sessions += 1
+        self._endpoint = endpoint
+        self._on_message_callback = on_message_callback
+
+    def _create_stream(self, addrinfo):
+        """Return the stream used to connect to the WebSocket server.
+
+        Secure connections use the shared SSL context.
+        """
+        if self.parsed.scheme != 'https' or self.request.validate_cert:
+            return super(WebSocketClientConnection, self)._create_stream(
+                addrinfo)
+        return SSLIOStream(
+            socket.socket(addrinfo[0][0]), io_loop=self.io_loop,
+            ssl_options=get_ssl_context(),
+            max_buffer_size=self.max_buffer_size)
 
     def on_message(self, message):
         """Hook called when a new message is received.
@@ -66,4 +145,162 @@ class WebSocketClientConnection(websocket.WebSocketClientConnection):
         The on_message_callback is called passing it the message.
         """
         super(WebSocketClientConnection, self).on_message(message)
+        if message is None and self._endpoint is not None:
+            # The connection has been closed.
+            self._endpoint.sessions -= 1
+            self._endpoint = None
         self._on_message_callback(message)
+
+
+class Endpoint(object):
+    """Connection statistics of a Juju API endpoint.
+
+    The latency is the time in seconds required to establish a WebSocket
+    connection, or None if the endpoint was never connected. The failure rate
+    is between 0 and 1. Both are moving averages giving more weight to recent
+    connections. The number of open connections to the endpoint is stored in
+    sessions.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.latency = None
+        self.failure_rate = 0
+        self.failed_at = None
+        self.sessions = 0
+
+    def __repr__(self):
+        return '<Endpoint: {}>'.format(self.address)
+
+    def get_url(self, url):
+        """Return the given URL pointing to this endpoint."""
+        parts = urlparse.urlsplit(url)
+        return urlparse.urlunsplit(parts._replace(netloc=self.address))
+
+    def connected(self, latency):
+        """Record a successful connection with the given latency."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += STATS_WEIGHT * (latency - self.latency)
+        self.failure_rate -= STATS_WEIGHT * self.failure_rate
+        self.failed_at = None
+
+    def failed(self):
+        """Record a connection failure."""
+        self.failure_rate += STATS_WEIGHT * (1 - self.failure_rate)
+        self.failed_at = time.time()
+
+    def is_healthy(self):
+        """Return True if the endpoint did not fail recently."""
+        failed_at = self.failed_at
+        return failed_at is None or time.time() - failed_at > FAILURE_BACKOFF
+
+    def get_cost(self):
+        """Return the expected cost of opening a new session.
+
+        The cost grows with the latency, the failure rate and the number of
+        open sessions, so that sessions are spread across endpoints. Endpoints
+        never connected have no cost, so that they are tried.
+        """
+        latency = self.latency or 0
+        return latency * (self.sessions + 1) / (1 - self.failure_rate * 0.9)
+
+
+class EndpointPool(object):
+    """The Juju API endpoints of a highly available controller.
+
+    The pool is initialized with the endpoint addresses, as "host:port"
+    strings. Statistics about the connections established by
+    websocket_connect are recorded in the corresponding endpoints.
+    """
+
+    def __init__(self, addresses):
+        self._endpoints = OrderedDict(
+            (address, Endpoint(address)) for address in addresses)
+
+    def __iter__(self):
+        return iter(self._endpoints.values())
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def candidates(self, url):
+        """Return the endpoints to try, in order, to connect to the given URL.
+
+        Healthy endpoints come first, ordered by cost; endpoints recently
+        failed are tried last. Ties are broken randomly.
+        Return None if the URL does not refer to an endpoint in the pool, in
+        which case the URL must be used as is.
+        """
+        if urlparse.urlsplit(url).netloc not in self._endpoints:
+            return None
+        return sorted(self, key=lambda endpoint: (
+            not endpoint.is_healthy(), endpoint.get_cost(), random.random()))
+
+
+class _ConnectionRace(object):
+    """Connect to the first endpoint responding among the given candidates.
+
+    Connection attempts are started in order, each one RACE_DELAY seconds
+    after the previous one or as soon as the previous one fails. The first
+    established connection is the result of the future attribute. The other
+    connections are closed as soon as they are established.
+    """
+
+    def __init__(self, io_loop, url, on_message_callback, headers, candidates):
+        self._io_loop = io_loop
+        self._url = url
+        self._on_message_callback = on_message_callback
+        self._headers = headers
+        self._candidates = list(candidates)
+        self._pending = 0
+        self._timeout = None
+        self.future = concurrent.Future()
+        self._attempt()
+
+    def _attempt(self):
+        """Start a connection attempt to the next candidate endpoint."""
+        self._timeout = None
+        endpoint = self._candidates.pop(0)
+        request = _make_request(endpoint.get_url(self._url), self._headers)
+        # The message callback is set if this connection wins the race.
+        conn = WebSocketClientConnection(
+            self._io_loop, request, lambda message: None)
+        self._pending += 1
+        callback = functools.partial(
+            self._on_connect, endpoint, conn, self._io_loop.time())
+        self._io_loop.add_future(conn.connect_future, callback)
+        if self._candidates:
+            self._timeout = self._io_loop.add_timeout(
+                self._io_loop.time() + RACE_DELAY, self._attempt)
+
+    def _cancel_timeout(self):
+        """Do not start the next connection attempt after a delay."""
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _on_connect(self, endpoint, conn, start, future):
+        """Handle the result of a connection attempt started at start."""
+        self._pending -= 1
+        try:
+            future.result()
+        except Exception as err:
+            endpoint.failed()
+            if self.future.done():
+                return
+            if self._candidates:
+                self._cancel_timeout()
+                self._attempt()
+            elif not self._pending:
+                self.future.set_exception(err)
+            return
+        endpoint.connected(self._io_loop.time() - start)
+        if self.future.done():
+            # Another endpoint won the race.
+            conn.close()
+            return
+        self._cancel_timeout()
+        conn._start_session(endpoint, self._on_message_callback)
+        self.future.set_result(conn)
@@ -17,12 +17,15 @@
 """Juju GUI server HTTP/HTTPS handlers."""
 
 from collections import deque
+import itertools
 import logging
 import os
+import random
 import time
 import urlparse
 
 from tornado import (
+    concurrent,
     escape,
     gen,
     httpclient,
@@ -40,11 +43,20 @@ from guiserver.bundles.base import (
     ChangeSetMiddleware,
     DeployMiddleware,
 )
-from guiserver.clients import websocket_connect
+from guiserver.bundles.utils import get_deltas
+from guiserver.clients import (
+    get_ssl_context,
+    websocket_connect,
+)
+from guiserver.sessions import (
+    ResumeMiddleware,
+    stops_watcher,
+)
 from guiserver.utils import (
     clone_request,
     get_headers,
     get_juju_api_url,
+    get_model_uuid,
     join_url,
     json_decode_dict,
     request_summary,
@@ -54,6 +66,16 @@ from guiserver.utils import (
 
 # Define the path to the fallback charm icon hosted by charmworld.
 DEFAULT_CHARM_ICON_PATH = '/static/img/charm_160.svg'
+# Define the number of seconds to wait before the first attempt to reconnect
+# to the Juju API server. The delay is doubled after each failed attempt, up
+# to the maximum delay, and randomized to spread reconnections.
+JUJU_RECONNECT_DELAY = 0.5
+JUJU_RECONNECT_MAX_DELAY = 8
+# Define the number of attempts to reconnect before disconnecting the client.
+JUJU_RECONNECT_ATTEMPTS = 6
+# Define the first identifier of the requests sent to Juju by the handler
+# itself: it is well above the identifiers used by the GUI.
+INTERNAL_REQUEST_ID = 2 ** 52
 
 
 class _WebSocketBaseHandler(websocket.WebSocketHandler):
@@ -79,6 +101,10 @@ class WebSocketHandler(_WebSocketBaseHandler):
     Juju API server. It also handles API authentication and requests for
     bundles deployment (using the juju-deployer deployment format).
 
+    If the Juju API server unexpectedly closes the connection, the handler
+    reconnects and resumes the session (see guiserver.sessions), queuing the
+    browser messages in the meanwhile.
+
     Relevant attributes:
 
       - connected: True if the current browser is connected, False otherwise;
@@ -100,12 +126,15 @@ class WebSocketHandler(_WebSocketBaseHandler):
     @gen.coroutine
     def initialize(
             self, apiurl, auth_backend, deployer, tokens, ws_source_template,
-            ws_target_template, io_loop=None):
+            ws_target_template, io_loop=None, endpoints=None,
+            connections=None):
         """Initialize the WebSocket server.
 
         Create a new WebSocket client and connect it to the Juju API.
         Set up the authentication system.
         Handle the queued messages.
+        If provided, the connections set includes the handler as long as the
+        browser is connected.
         """
         if io_loop is None:
             io_loop = IOLoop.current()
@@ -113,26 +142,51 @@ class WebSocketHandler(_WebSocketBaseHandler):
         self._summary = request_summary(self.request) + ' '
         logging.info(self._summary + 'client connected')
         self.connected = True
+        self._connections = connections
+        if connections is not None:
+            connections.add(self)
         self.juju_connected = False
-        self._juju_message_queue = queue = deque()
+        self.juju_connection = None
+        self._juju_message_queue = deque()
+        # Track the Juju API session so that it can be resumed, and the
+        # requests sent to Juju by the handler itself.
+        self.resume = ResumeMiddleware()
+        self._internal_ids = itertools.count(INTERNAL_REQUEST_ID)
+        self._internal_requests = {}
+        self._reconnecting = False
+        # Count the reconnection attempts since Juju last answered the client.
+        self._reconnect_attempts = 0
         # Set up the authentication infrastructure.
         self.tokens = tokens
         write_message = wrap_write_message(self)
         self.user = User()
+        apiurl = get_juju_api_url(
+            self.request.path, ws_source_template, ws_target_template, apiurl)
         self.auth = AuthMiddleware(
             self.user, auth_backend, tokens, write_message)
         # Set up the bundle deployment and change set infrastructure.
-        self.deployment = DeployMiddleware(self.user, deployer, write_message)
+        self.deployment = DeployMiddleware(
+            self.user, deployer, write_message, io_loop=io_loop)
         self.changeset = ChangeSetMiddleware(self.user, write_message)
-        apiurl = get_juju_api_url(
-            self.request.path, ws_source_template, ws_target_template, apiurl)
+        # Feed the environment snapshot of the model with the megawatcher
+        # deltas flowing through this connection, so that bundles can be
+        # validated without querying the Juju API. The handler is registered
+        # as a feeder only while the megawatcher is running.
+        self._snapshot = None
+        self._feeding = False
+        model_uuid = get_model_uuid(self.request.path, ws_source_template)
+        if model_uuid is not None:
+            self._snapshot = deployer.get_snapshot(model_uuid)
         # Juju requires the Origin header to be included in the WebSocket
         # client handshake request. Propagate the client origin if present;
         # use the Juju API server as origin otherwise.
         headers = get_headers(self.request, apiurl)
+        self._apiurl, self._headers = apiurl, headers
+        self._endpoints = endpoints
         # Connect the WebSocket client to the Juju API server.
         self._juju_connected_future = websocket_connect(
-            io_loop, apiurl, self.on_juju_message, headers=headers)
+            io_loop, apiurl, self.on_juju_message, headers=headers,
+            endpoints=endpoints)
         try:
             self.juju_connection = yield self._juju_connected_future
         except Exception as err:
@@ -142,11 +196,29 @@ class WebSocketHandler(_WebSocketBaseHandler):
             return
         # At this point the Juju API is successfully connected.
         self.juju_connected = True
-        logging.info(self._summary + 'Juju API connected: {}'.format(apiurl))
+        # With highly available controllers, the connection URL may refer to
+        # a different endpoint.
+        url = self.juju_connection.request.url
+        logging.info(self._summary + 'Juju API connected: {}'.format(url))
         # Send all the messages that have been enqueued before the connection
         # to the Juju API server was established.
+        self._flush_queue()
+
+    def _flush_queue(self):
+        """Send the queued messages to the Juju API server.
+
+        Messages queued while reconnecting are redirected to the resumed
+        megawatcher.
+        """
+        queue = self._juju_message_queue
         while self.connected and self.juju_connected and len(queue):
             message = queue.popleft()
+            if self.resume.watching:
+                data = json_decode_dict(message)
+                if data is not None:
+                    new_data = self.resume.redirect(data)
+                    if new_data is not data:
+                        message = escape.json_encode(new_data).decode('utf8')
             encoded = message.encode('utf-8')
             logging.debug(self._summary + 'queue -> juju: {}'.format(encoded))
             self.juju_connection.write_message(message)
@@ -182,6 +254,12 @@ class WebSocketHandler(_WebSocketBaseHandler):
             if self.tokens.token_requested(data):
                 return self.tokens.process_token_request(
                     data, self.user, wrap_write_message(self))
+            # Track the request so that the session can be resumed.
+            new_data = self.resume.process_request(data)
+            if self.juju_connected and new_data is not data:
+                # Queued messages are redirected when the queue is flushed.
+                encoded = escape.json_encode(new_data)
+                message = encoded.decode('utf8')
         # Propagate messages to the Juju API server.
         if encoded is None:
             encoded = message.encode('utf-8')
@@ -200,6 +278,15 @@ class WebSocketHandler(_WebSocketBaseHandler):
             # The Juju API closed the connection.
             return self.on_juju_close()
         data = json_decode_dict(message)
+        if data is not None:
+            future = self._internal_requests.pop(data.get('RequestId'), None)
+            if future is not None:
+                # This is the response to a request sent by the handler.
+                return future.set_result(data)
+            request = self.resume.process_response(data)
+            self._reconnect_attempts = 0
+            if self._snapshot is not None:
+                self._feed_snapshot(request, data)
         if (data is not None) and self.auth.in_progress():
             encoded = escape.json_encode(
                 self.auth.process_response(data))
@@ -213,26 +300,151 @@ class WebSocketHandler(_WebSocketBaseHandler):
         """Hook called when the WebSocket connection is terminated."""
         logging.info(self._summary + 'client connection closed')
         self.connected = False
+        if self._connections is not None:
+            self._connections.discard(self)
+        self.deployment.close()
+        self._stop_feeding()
+        self._snapshot = None
         # At this point the WebSocket client connection to the Juju API server
         # might not yet be established. For this reason the connection is
         # terminated adding a callback to the corresponding future.
-        callback = lambda _: self.juju_connection.close()
-        self._io_loop.add_future(self._juju_connected_future, callback)
+        self._io_loop.add_future(
+            self._juju_connected_future, self._close_juju_connection)
+
+    def _feed_snapshot(self, request, data):
+        """Update the environment snapshot with the given Juju response.
+
+        The handler starts feeding the snapshot when the first megawatcher
+        deltas are received, and stops when the watcher is stopped.
+        """
+        deltas = get_deltas(data)
+        if deltas is not None:
+            if not self._feeding:
+                self._snapshot.add_feeder()
+                self._feeding = True
+            self._snapshot.update(deltas)
+        elif stops_watcher(request, data):
+            self._stop_feeding()
+
+    def _stop_feeding(self):
+        """Stop feeding the environment snapshot, if currently feeding it."""
+        if self._feeding:
+            self._snapshot.remove_feeder()
+            self._feeding = False
+
+    def _close_juju_connection(self, future):
+        """Close the connection to the Juju API server, if established."""
+        if self.juju_connection is not None:
+            self.juju_connection.close()
 
     def on_juju_close(self):
         """Hook called when the WebSocket connection to Juju is terminated."""
         logging.info(self._summary + 'Juju API connection closed')
         self.juju_connected = False
         self.juju_connection = None
+        # The megawatcher is gone with the connection: changes occurring until
+        # the session is resumed are not tracked.
+        self._stop_feeding()
+        # Requests sent by the handler itself will never be answered.
+        requests, self._internal_requests = self._internal_requests, {}
+        for future in requests.values():
+            future.set_exception(websocket.WebSocketClosedError())
         # Usually the Juju API connection is terminated as a consequence of a
-        # browser disconnection. A server disconnection is unexpected and
-        # unlikely to happen. In the future Juju will support HA and we will
-        # need to react accordingly to server disconnections, but for the time
-        # being we just disconnect the browser and log an error.
+        # browser disconnection. A server disconnection is unexpected, e.g.
+        # the Juju API server restarted or a network failure occurred: in this
+        # case, reconnect and resume the session.
+        if self.connected and not self._reconnecting:
+            logging.warning(
+                self._summary + 'Juju API connection lost: reconnecting')
+            for response in self.resume.disconnected():
+                if self.auth.in_progress():
+                    response = self.auth.process_response(response)
+                self.write_message(escape.json_encode(response))
+            self._reconnect()
+
+    @gen.coroutine
+    def _reconnect(self):
+        """Reconnect to the Juju API server and resume the session.
+
+        Retry with exponential backoff. Disconnect the browser if the session
+        cannot be resumed, or if too many attempts are made without Juju
+        answering the browser requests, e.g. because Juju keeps dropping the
+        connection just after accepting it.
+        """
+        self._reconnecting = True
+        try:
+            while self._reconnect_attempts < JUJU_RECONNECT_ATTEMPTS:
+                delay = min(
+                    JUJU_RECONNECT_DELAY * 2 ** self._reconnect_attempts,
+                    JUJU_RECONNECT_MAX_DELAY)
+                self._reconnect_attempts += 1
+                deadline = self._io_loop.time() + random.uniform(
+                    delay / 2, delay)
+                yield gen.Task(self._io_loop.add_timeout, deadline)
+                if not self.connected:
+                    return
+                try:
+                    resumed = yield self._resume()
+                except Exception as err:
+                    logging.warning('{}unable to reconnect to the Juju API: '
+                                    '{!r}'.format(self._summary, err))
+                    continue
+                if resumed:
+                    return
+                break
+        finally:
+            self._reconnecting = False
         if self.connected:
             logging.error(self._summary + 'Juju API unexpectedly disconnected')
             self.close()
 
+    @gen.coroutine
+    def _resume(self):
+        """Connect to the Juju API server and resume the session.
+
+        Log in again the authenticated user and restart the megawatcher, then
+        send the pending and queued messages.
+        Return a Future whose result is False if Juju rejected the login or
+        the watcher, True otherwise.
+        """
+        self._juju_connected_future = websocket_connect(
+            self._io_loop, self._apiurl, self.on_juju_message,
+            headers=self._headers, endpoints=self._endpoints)
+        self.juju_connection = yield self._juju_connected_future
+        if not self.connected:
+            # The browser disconnected in the meanwhile.
+            self.juju_connection.close()
+            raise gen.Return(True)
+        if self.user.is_authenticated:
+            response = yield self._call(self.auth.make_resume_request)
+            if not self.auth.resume_succeeded(response):
+                logging.error(self._summary + 'unable to log in again')
+                raise gen.Return(False)
+        if self.resume.watching:
+            response = yield self._call(self.resume.make_watch_request)
+            if not self.resume.watcher_resumed(response):
+                logging.error(self._summary + 'unable to restart the watcher')
+                raise gen.Return(False)
+        self.juju_connected = True
+        logging.info(self._summary + 'Juju API session resumed')
+        for request in self.resume.pending_requests():
+            self.juju_connection.write_message(escape.json_encode(request))
+        self._flush_queue()
+        raise gen.Return(True)
+
+    def _call(self, make_request):
+        """Send a request to the Juju API server on behalf of the handler.
+
+        The request is created by calling make_request with a request id.
+        Return a Future whose result is the Juju response.
+        """
+        request_id = next(self._internal_ids)
+        future = concurrent.Future()
+        self._internal_requests[request_id] = future
+        self.juju_connection.write_message(
+            escape.json_encode(make_request(request_id)))
+        return future
+
 
 class SandboxHandler(_WebSocketBaseHandler):
     """Simulate WebSocket API in sandbox mode.
@@ -401,21 +613,30 @@ class JujuProxyHandler(ProxyHandler):
 class InfoHandler(web.RequestHandler):
     """Return information about the GUI server."""
 
-    def initialize(self, apiurl, apiversion, deployer, sandbox, start_time):
+    def initialize(
+            self, apiurl, apiversion, deployer, sandbox, start_time,
+            tls_stats=None):
         """Initialize the handler."""
         self.apiurl = apiurl
         self.apiversion = apiversion
         self.deployer = deployer
         self.sandbox = sandbox
         self.start_time = start_time
+        self.tls_stats = tls_stats
 
     def get_info(self, settings):
+        tls = None
+        if self.tls_stats is not None:
+            tls = self.tls_stats.to_dict()
         return {
             'apiurl': self.apiurl,
             'apiversion': self.apiversion,
             'debug': settings.get('debug', False),
             'deployer': self.deployer.status(),
+            'deployerhistory': self.deployer.history(),
             'sandbox': self.sandbox,
+            'tls': tls,
+            'tlsclient': get_ssl_context().stats.to_dict(),
             'uptime': int(time.time()) - self.start_time,
             'version': get_version(),
         }
@@ -17,30 +17,58 @@
 """Juju GUI server management."""
 
 import logging
-import os
-import ssl
+import random
+import signal
 import sys
+import time
 
+# Record when the server modules start to be imported, so that the start up
+# times can be reported.
+_start_time = time.time()
+
+from tornado import gen
 from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.options import (
     define,
     options,
     parse_command_line,
+    parse_config_file,
 )
 
 import guiserver
 from guiserver.apps import (
+    get_gui_settings,
     redirector,
     server,
 )
+from guiserver.tls import ServerTLS
 
+# The seconds spent importing the server modules.
+_import_time = time.time() - _start_time
 
-# Define ciphers supported by this server:
-# see <https://www-origin.openssl.org/docs/manmaster/apps/ciphers.html>.
-CIPHERS = 'HIGH:!RC4:!MD5:!aNULL:!eNULL:!EXP:!LOW:!MEDIUM'
 DEFAULT_API_VERSION = 'go'
 DEFAULT_SSL_PATH = '/etc/ssl/juju-gui'
+DEFAULT_DRAIN_TIMEOUT = 30
+# Define the number of seconds over which the connected GUIs are asked to
+# reconnect when the server is stopped, and how often the server checks for
+# running bundle deployments while draining.
+DRAIN_RECONNECT_SPREAD = 5
+DRAIN_POLL_INTERVAL = 0.5
+# Define the options that can be changed without restarting the server, by
+# updating the config file and sending a SIGHUP signal to the server process.
+RELOADABLE_OPTIONS = (
+    'bundleservice_url',
+    'charmstoreurl',
+    'gisf',
+    'gtm',
+    'gzip',
+    'interactivelogin',
+    'jujuguidebug',
+    'password',
+)
 
 
 def _add_debug(logger):
@@ -89,20 +117,6 @@ def _validate_range(option_name, min_value, max_value):
                  '{} and {}'.format(option_name, min_value, max_value))
 
 
-def _get_ssl_options():
-    """Return a Tornado SSL options dict.
-
-    The certificate and key file paths are generated using the base SSL path
-    included in the options.
-    """
-    return {
-        'certfile': os.path.join(options.sslpath, 'juju.crt'),
-        'keyfile': os.path.join(options.sslpath, 'juju.key'),
-        'ssl_version': ssl.PROTOCOL_SSLv23,
-        'ciphers': CIPHERS,
-    }
-
-
 def setup():
     """Set up options and logger. Configure the asynchronous HTTP client."""
     define(
@@ -110,6 +124,12 @@ def setup():
         help='The Juju WebSocket server address. This is usually the address '
              'of the bootstrap/state node as returned by "juju status".')
     # Optional parameters.
+    define(
+        'apiaddresses', type=str, multiple=True,
+        help='The comma separated addresses (as "host:port") of the other '
+             'Juju API servers of a highly available controller. If '
+             'provided, connections to the controller are spread across the '
+             'available servers, preferring the fastest ones.')
     define(
         'apiversion', type=str, default=DEFAULT_API_VERSION,
         help='the Juju API version/implementation. Currently the possible '
@@ -160,31 +180,163 @@ def setup():
         help='Enable gzip compression in the gui.')
     define('gtm', type=bool, default=False, help='Enable Google tag manager.')
     define('gisf', type=bool, default=False, help='Enable GUI in store front.')
+    define(
+        'deploymentsjournal', type=str,
+        help='The path of the journal used to persist bundle deployments '
+             'across restarts. If not provided, deployments are not '
+             'persisted.')
+    define(
+        'tokensdb', type=str,
+        help='The path of the SQLite database used to store authentication '
+             'tokens, so that they survive restarts and can be shared by '
+             'multiple server processes. If not provided, tokens are only '
+             'stored in memory.')
+    define(
+        'configfile', type=str,
+        help='The path of a file defining the options that can be changed '
+             'while the server is running ({}). The file is read again when '
+             'the server receives a SIGHUP signal. Options in the file '
+             'override the command line ones.'.format(
+                 ', '.join(RELOADABLE_OPTIONS)))
+    define(
+        'draintimeout', type=int, default=DEFAULT_DRAIN_TIMEOUT,
+        help='The maximum number of seconds the server waits for running '
+             'bundle deployments to complete when it is asked to stop with a '
+             'SIGTERM signal. Set to 0 to stop right away.')
     # In Tornado, parsing the options also sets up the default logger.
     parse_command_line()
+    if options.configfile:
+        parse_config_file(options.configfile, final=False)
     _validate_choices('apiversion', ('go', 'python'))
     _validate_range('port', 1, 65535)
+    _validate_range('draintimeout', 0, 3600)
     _add_debug(logging.getLogger())
     # Configure the asynchronous HTTP client used by proxy handlers.
     AsyncHTTPClient.configure(
         'tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=20)
 
 
+def _reload(app):
+    """Read the config file again and update the given server application.
+
+    The config file is expected to only define the options included in
+    RELOADABLE_OPTIONS. Existing connections are preserved.
+    """
+    logging.info('reloading options from {}'.format(options.configfile))
+    try:
+        parse_config_file(options.configfile, final=False)
+    except Exception as err:
+        logging.error('cannot reload options: {}'.format(err))
+        return
+    app.settings['gui_application'].reload(get_gui_settings())
+
+
+def _gui_application_loaded(future):
+    """Report errors occurred while loading the Juju GUI WSGI application.
+
+    The application is loaded again when the first request needing it comes
+    in, so that the error is also reported to the client.
+    """
+    error = future.exception()
+    if error is not None:
+        logging.error('cannot load the Juju GUI application: {}'.format(error))
+
+
+@gen.coroutine
+def _drain(app, http_server, timeout, io_loop=None):
+    """Gracefully stop the given server and its application.
+
+    Keep serving requests and accepting connections while waiting up to
+    timeout seconds for the running bundle deployments to complete: new bundle
+    imports are rejected in the meanwhile. The deployments still running after
+    the timeout are interrupted, and resumed by the next server process. Then
+    stop accepting connections and close the connected WebSocket handlers at
+    random times, so that the GUIs do not all reconnect at once, and finally
+    stop the IO loop.
+    """
+    if io_loop is None:
+        io_loop = IOLoop.current()
+    deployer = app.settings['deployer']
+    if deployer.draining:
+        # The server is already being drained.
+        return
+    logging.info('draining the server')
+    deployer.drain()
+    deadline = time.time() + timeout
+    while deployer.is_busy() and time.time() < deadline:
+        yield gen.Task(io_loop.add_timeout, time.time() + DRAIN_POLL_INTERVAL)
+    if deployer.is_busy():
+        logging.warning('stopping with bundle deployments in progress')
+    deployer.shutdown(wait=False)
+    http_server.stop()
+    handlers = list(app.settings['connections'])
+    if handlers:
+        now = time.time()
+        closed_at = now + min(DRAIN_RECONNECT_SPREAD, timeout)
+        for handler in handlers:
+            io_loop.add_timeout(random.uniform(now, closed_at), handler.close)
+        yield gen.Task(io_loop.add_timeout, closed_at)
+    logging.info('server stopped')
+    io_loop.stop()
+
+
 def run():
-    """Run the server"""
+    """Run the server.
+
+    The listening sockets are bound first, so that connections are queued
+    while the server application and the bundle deployer are set up. The
+    deployer worker processes, spawned right after, close their copies of the
+    listening sockets. The Juju GUI WSGI application is then loaded in a
+    separate thread, so that the server handles WebSocket and info requests
+    while it loads.
+    If a config file is provided, the options it defines are reloaded when
+    the server receives a SIGHUP signal. A SIGTERM signal drains the server
+    before stopping it.
+    """
     port = options.port
+    redirect = (port is None) and not options.insecure
+    if port is None:
+        port = 80 if options.insecure else 443
+    sockets = bind_sockets(port)
+    redirector_sockets = bind_sockets(80) if redirect else []
     if options.insecure:
         # Run the server over an insecure HTTP connection.
-        if port is None:
-            port = 80
-        server().listen(port)
+        server_tls = None
+        app = server()
     else:
         # Default configuration: run the server over a secure HTTPS connection.
-        if port is None:
-            port = 443
-            redirector().listen(80)
-        server().listen(port, ssl_options=_get_ssl_options())
+        server_tls = ServerTLS(options.sslpath)
+        app = server(tls_stats=server_tls.stats)
+    app.settings['deployer'].warm_up(
+        [i.fileno() for i in sockets + redirector_sockets])
+    if server_tls is None:
+        http_server = HTTPServer(app)
+        http_server.add_sockets(sockets)
+    else:
+        http_server = HTTPServer(app, ssl_options=server_tls.context)
+        http_server.add_sockets(sockets)
+        server_tls.add_server(http_server)
+        server_tls.start()
+    if redirector_sockets:
+        # Redirect HTTP requests to the HTTPS server.
+        HTTPServer(redirector()).add_sockets(redirector_sockets)
+    io_loop = IOLoop.instance()
+    io_loop.add_future(
+        app.settings['gui_application'].load_async(), _gui_application_loaded)
+    if options.configfile:
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: io_loop.add_callback_from_signal(
+                _reload, app))
+    drain_timeout = options.draintimeout
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: io_loop.add_callback_from_signal(
+            _drain, app, http_server, drain_timeout))
     version = guiserver.get_version()
     logging.info('starting Juju GUI server v{}'.format(version))
     logging.info('listening on port {}'.format(port))
-    IOLoop.instance().start()
+    logging.info(
+        'modules imported in {:.0f} ms, server ready in {:.0f} ms'.format(
+            _import_time * 1000, (time.time() - _start_time) * 1000))
+    io_loop.start()
@@ -0,0 +1,192 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server Juju API session resumption.
+
+When the connection to the Juju API server drops while the browser is still
+connected, the WebSocket handler reconnects to Juju, logs in again the
+authenticated user and resumes the session, so that the GUI does not need to
+reload (see guiserver.handlers.WebSocketHandler).
+
+The ResumeMiddleware tracks the session state required to do that:
+    - the requests sent to Juju and not yet answered: when the connection
+      drops Juju will never answer them, so the client receives an error
+      response for each one of them, except for the pending AllWatcher Next
+      requests, which are sent again once the session is resumed;
+    - the megawatcher started by the client: when resuming, a new watcher is
+      started, and client requests referring to the old watcher are
+      redirected to the new one.
+
+Note that the first Next call on the new watcher returns the whole model
+status again, as "change" deltas: entities removed while the connection was
+down are not reported to the client.
+"""
+
+import copy
+
+
+# Define the error sent to the client for requests lost when the connection
+# to the Juju API server drops.
+LOST_REQUEST_ERROR = 'connection to the Juju API server lost'
+
+
+class ResumeMiddleware(object):
+    """Track the Juju API session state required to resume it."""
+
+    def __init__(self):
+        # Map request ids to the client requests not yet answered by Juju.
+        self._in_flight = {}
+        # The last WatchAll request sent by the client.
+        self._watch_request = None
+        # The watcher id known by the client, and the one to use with Juju.
+        self._client_watcher_id = None
+        self._watcher_id = None
+        # The AllWatcher Next requests lost with the last disconnection.
+        self._lost = []
+
+    @property
+    def watching(self):
+        """Return True if the client started a megawatcher."""
+        return self._client_watcher_id is not None
+
+    def process_request(self, data):
+        """Track the given request sent by the client.
+
+        Return the request to be sent to Juju, possibly redirected to the
+        resumed watcher.
+        """
+        request_id = data.get('RequestId')
+        if request_id is None:
+            return data
+        self._in_flight[request_id] = data
+        if _is_watch_request(data):
+            self._watch_request = data
+        return self.redirect(data)
+
+    def process_response(self, data):
+        """Track the given response sent by Juju.
+
+        Return the client request answered by the response, or None if the
+        request is not known.
+        """
+        request_id = data.get('RequestId')
+        request = self._in_flight.pop(request_id, None)
+        if request is None or 'Error' in data:
+            return request
+        if request is self._watch_request:
+            watcher_id = _get_watcher_id(data)
+            self._client_watcher_id = self._watcher_id = watcher_id
+        return request
+
+    def disconnected(self):
+        """Handle the Juju API connection drop.
+
+        Return the error responses to be sent to the client for the requests
+        lost with the connection. Pending AllWatcher Next requests are kept,
+        so that they can be sent again when the session is resumed.
+        """
+        responses = []
+        self._lost = []
+        for request_id, request in self._in_flight.items():
+            if _is_next_request(request):
+                self._lost.append(request)
+                continue
+            del self._in_flight[request_id]
+            responses.append({
+                'RequestId': request_id,
+                'Error': LOST_REQUEST_ERROR,
+                'ErrorCode': '',
+                'Response': {},
+            })
+        return responses
+
+    def make_watch_request(self, request_id):
+        """Return the request starting a new watcher, with the given id.
+
+        Return None if the client did not start a watcher.
+        """
+        if not self.watching:
+            return None
+        request = copy.deepcopy(self._watch_request)
+        request['RequestId'] = request_id
+        return request
+
+    def watcher_resumed(self, data):
+        """Process the Juju response to the watch request used to resume.
+
+        Return True if the new watcher has been started, False otherwise.
+        """
+        if 'Error' in data:
+            return False
+        self._watcher_id = _get_watcher_id(data)
+        return self._watcher_id is not None
+
+    def pending_requests(self):
+        """Return the requests to be sent again once the session is resumed.
+
+        These are the AllWatcher Next requests pending when the connection
+        dropped, redirected to the resumed watcher.
+        """
+        requests, self._lost = self._lost, []
+        return [self.redirect(request) for request in requests]
+
+    def redirect(self, data):
+        """Return the given request referring to the current watcher."""
+        if (
+            self._watcher_id != self._client_watcher_id and
+            _is_next_request(data) and
+            data.get('Id') == self._client_watcher_id
+        ):
+            return dict(data, Id=self._watcher_id)
+        return data
+
+
+def stops_watcher(request, response):
+    """Return True if the given Juju response means the megawatcher stopped.
+
+    This is the case when the client stopped the watcher, or when a request
+    for the next deltas failed, e.g. because Juju stopped the watcher.
+    """
+    if request is None:
+        return False
+    if _is_stop_request(request):
+        return True
+    return _is_next_request(request) and 'Error' in response
+
+
+def _is_watch_request(data):
+    """Return True if data is a request starting the megawatcher."""
+    return data.get('Type') == 'Client' and data.get('Request') == 'WatchAll'
+
+
+def _is_next_request(data):
+    """Return True if data is a request for the next megawatcher deltas."""
+    return data.get('Type') == 'AllWatcher' and data.get('Request') == 'Next'
+
+
+def _is_stop_request(data):
+    """Return True if data is a request stopping the megawatcher."""
+    return data.get('Type') == 'AllWatcher' and data.get('Request') == 'Stop'
+
+
+def _get_watcher_id(data):
+    """Return the watcher id included in the given WatchAll response.
+
+    Both the Juju 1 (AllWatcherId) and Juju 2 (watcher-id) formats are
+    supported. Return None if the watcher id is not found.
+    """
+    response = data.get('Response') or {}
+    return response.get('AllWatcherId', response.get('watcher-id'))
@@ -16,12 +16,20 @@
 
 """Tests for the bundle deployment base objects."""
 
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from concurrent.futures import process
 from deployer import cli as deployer_cli
 import jujuclient
 import mock
 from tornado import gen
 from tornado.testing import(
     AsyncTestCase,
+    ExpectLog,
     gen_test,
     LogTrapTestCase,
 )
@@ -30,12 +38,15 @@ from guiserver import auth
 from guiserver.bundles import (
     base,
     utils,
+    workers,
 )
 from guiserver.tests import helpers
+from guiserver.watchers import AsyncWatcher
 
 
 def import_bundle_mock(
-        apiurl, username, password, name, bundle, version, options):
+        apiurl, username, password, name, bundle, version, options, validate,
+        deployment_id):
     """Used to test bundle deployment failures.
 
     This function is defined at module level so that it can be easily pickled
@@ -45,9 +56,10 @@ def import_bundle_mock(
 
 
 class FakeFuture(object):
-    def __init__(self, cancelled=False, exception=None):
+    def __init__(self, cancelled=False, exception=None, result=None):
         self._cancelled = cancelled
         self._exception = exception
+        self._result = result
 
     def cancelled(self):
         return self._cancelled
@@ -55,6 +67,9 @@ class FakeFuture(object):
     def exception(self):
         return self._exception
 
+    def result(self):
+        return self._result
+
 
 @mock.patch('time.time', mock.Mock(return_value=42))
 class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
@@ -110,6 +125,72 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
             self.apiurl, self.user.username, self.user.password, self.bundle)
         mock_validate.assert_called_in_a_separate_process()
 
+    def test_workers_warm_up(self):
+        # The worker processes are spawned when the IO loop runs.
+        with mock.patch('guiserver.bundles.base.ProcessPoolExecutor'):
+            deployer = self.make_deployer()
+            self.assertFalse(deployer._run_executor.submit.called)
+            self.io_loop.add_callback(self.stop)
+            self.wait()
+        deployer._run_executor.submit.assert_called_with(workers.warm_up, ())
+        self.assertEqual(2, deployer._run_executor.submit.call_count)
+
+    def test_workers_warm_up_close_fds(self):
+        # The given file descriptors are closed by the workers when they are
+        # spawned right away.
+        with mock.patch('guiserver.bundles.base.ProcessPoolExecutor'):
+            deployer = self.make_deployer()
+            deployer.warm_up([3, 4])
+        deployer._run_executor.submit.assert_called_with(
+            workers.warm_up, (3, 4))
+        self.assertEqual(2, deployer._run_executor.submit.call_count)
+
+    def test_workers_warm_up_after_shutdown(self):
+        # The worker processes are not spawned if the deployer is shut down
+        # before the IO loop runs.
+        deployer = self.make_deployer()
+        deployer.shutdown()
+        # No errors are raised.
+        deployer.warm_up()
+
+    def test_is_busy(self):
+        # The deployer is busy while deployments are started or queued.
+        deployer = self.make_deployer()
+        self.assertFalse(deployer.is_busy())
+        deployer._queue.append(42)
+        self.assertTrue(deployer.is_busy())
+
+    def test_shutdown(self):
+        # The worker processes are stopped when the deployer is shut down.
+        deployer = self.make_deployer()
+        deployer.shutdown()
+        with self.assertRaises(RuntimeError):
+            deployer._run_executor.submit(time.sleep, 0)
+        with self.assertRaises(RuntimeError):
+            deployer._validate_executor.submit(time.sleep, 0)
+
+    def test_shutdown_without_waiting(self):
+        # The worker processes are killed if the deployer is shut down without
+        # waiting for the running jobs.
+        deployer = self.make_deployer()
+        executor = deployer._run_executor
+        executor.submit(time.sleep, 0).result()
+        workers = list(executor._processes)
+        thread = executor._queue_management_thread
+        executor.submit(time.sleep, 60)
+        deployer.shutdown(wait=False)
+        workers[0].join(5)
+        self.assertFalse(workers[0].is_alive())
+        # The interpreter does not wait for the abandoned job at exit.
+        self.assertNotIn(thread, process._threads_queues)
+
+    def test_drain(self):
+        # The deployer can be asked to stop accepting new deployments.
+        deployer = self.make_deployer()
+        self.assertFalse(deployer.draining)
+        deployer.drain()
+        self.assertTrue(deployer.draining)
+
     @gen_test
     def test_unsupported_api_version(self):
         # An error message is returned the API version is not supported.
@@ -117,6 +198,45 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         result = yield deployer.validate(self.user, self.bundle)
         self.assertEqual('unsupported API version: not-supported', result)
 
+    @gen_test
+    def test_validation_live_snapshot(self):
+        # The bundle is validated without querying Juju if a live snapshot of
+        # the model is available.
+        deployer = base.Deployer(
+            self.apiurl, base.SUPPORTED_API_VERSIONS[0], model_uuid='uuid')
+        self.addCleanup(deployer.shutdown, wait=False)
+        snapshot = deployer.get_snapshot('uuid')
+        snapshot.add_feeder()
+        snapshot.update([['service', 'change', {'Name': 'foo'}]])
+        with self.patch_validate() as mock_validate:
+            result = yield deployer.validate(self.user, {'services': {'a': 1}})
+            self.assertIsNone(result)
+            result = yield deployer.validate(
+                self.user, {'services': {'foo': 1}})
+        self.assertEqual('service(s) already in the environment: foo', result)
+        self.assertEqual(0, mock_validate.call_count)
+
+    @gen_test
+    def test_validation_snapshot_not_live(self):
+        # The validation is executed in a separate process if the snapshot
+        # of the model is not live.
+        deployer = base.Deployer(
+            self.apiurl, base.SUPPORTED_API_VERSIONS[0], model_uuid='uuid')
+        self.addCleanup(deployer.shutdown, wait=False)
+        deployer.get_snapshot('uuid').add_feeder()
+        with self.patch_validate() as mock_validate:
+            yield deployer.validate(self.user, self.bundle)
+        mock_validate.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password, self.bundle)
+
+    def test_get_snapshot(self):
+        # The same snapshot is returned for the same model.
+        deployer = self.make_deployer()
+        snapshot = deployer.get_snapshot('uuid')
+        self.assertIsInstance(snapshot, utils.EnvironmentSnapshot)
+        self.assertIs(snapshot, deployer.get_snapshot('uuid'))
+        self.assertIsNot(snapshot, deployer.get_snapshot('another-uuid'))
+
     def test_import_bundle_scheduling(self):
         # A deployment id is returned if the bundle import process is
         # successfully scheduled.
@@ -133,16 +253,37 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         # The deployment is executed in a separate process.
         deployer = self.make_deployer()
         with self.patch_import_bundle() as mock_import_bundle:
-            deployer.import_bundle(
+            deployment_id = deployer.import_bundle(
                 self.user, 'bundle', self.bundle, self.version, bundle_id=None,
                 test_callback=self.stop)
         # Wait for the deployment to be completed.
         self.wait()
         mock_import_bundle.assert_called_once_with(
             self.apiurl, self.user.username, self.user.password, 'bundle',
-            self.bundle, self.version, deployer.importer_options)
+            self.bundle, self.version, deployer.importer_options, True,
+            deployment_id)
         mock_import_bundle.assert_called_in_a_separate_process()
 
+    def test_import_bundle_live_snapshot(self):
+        # The worker validates the bundle even if a live snapshot is available,
+        # as deployments queued before this one may conflict with it.
+        deployer = base.Deployer(
+            self.apiurl, base.SUPPORTED_API_VERSIONS[0], model_uuid='uuid')
+        self.addCleanup(deployer.shutdown, wait=False)
+        snapshot = deployer.get_snapshot('uuid')
+        snapshot.add_feeder()
+        snapshot.update([])
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployment_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, self.version, bundle_id=None,
+                test_callback=self.stop)
+        # Wait for the deployment to be completed.
+        self.wait()
+        mock_import_bundle.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password, 'bundle',
+            self.bundle, self.version, deployer.importer_options, True,
+            deployment_id)
+
     def test_options_are_fully_populated(self):
         # The options passed to the deployer match what it expects and are not
         # missing any entries.
@@ -170,6 +311,43 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         deployer = self.make_deployer()
         self.assertIsNone(deployer.watch(42))
 
+    def test_progress(self):
+        # Progress events sent by workers are notified to watchers.
+        deployer = self.make_deployer()
+        deployment_id = deployer._observer.add_deployment()
+        progress = {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1}
+        workers._progress_connection.send((deployment_id, progress))
+        deployer._read_progress()
+        change = deployer._observer.deployments[deployment_id].getlast()
+        self.assertEqual(progress, change['Progress'])
+
+    def test_subscribe(self):
+        # A callback can be subscribed to deployment changes.
+        deployer = self.make_deployer()
+        deployment_id = deployer._observer.add_deployment()
+        deployer._queue.append(deployment_id)
+        deployer._notify_position(deployment_id)
+        watcher_id = deployer.watch(deployment_id)
+        calls = []
+        self.assertTrue(deployer.subscribe(watcher_id, calls.append))
+        deployer._observer.notify_completed(deployment_id)
+        self.assertEqual(2, len(calls))
+        self.assert_change(calls[0], deployment_id, utils.STARTED, queue=0)
+        self.assert_change(calls[1], deployment_id, utils.COMPLETED)
+
+    def test_subscribe_invalid_watcher(self):
+        # False is returned if the watcher id is not valid.
+        deployer = self.make_deployer()
+        self.assertFalse(deployer.subscribe(42, None))
+
+    def test_unwatch(self):
+        # A watcher id can be released.
+        deployer = self.make_deployer()
+        deployment_id = deployer._observer.add_deployment()
+        watcher_id = deployer.watch(deployment_id)
+        deployer.unwatch(watcher_id)
+        self.assertIsNone(deployer.next(watcher_id))
+
     @gen_test
     def test_next(self):
         # A client can be asynchronously notified of deployment changes.
@@ -241,7 +419,7 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         # An EnvError is correctly propagated from the separate process to the
         # main thread.
         deployer = self.make_deployer()
-        import_bundle_path = 'guiserver.bundles.base.blocking.import_bundle'
+        import_bundle_path = 'guiserver.bundles.base.workers.import_bundle'
         with mock.patch(import_bundle_path, import_bundle_mock):
             deployer.import_bundle(
                 self.user, 'bundle', self.bundle, self.version, bundle_id=None,
@@ -353,6 +531,23 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         self.assertEqual(deployment1, change1['DeploymentId'])
         self.assertEqual(deployment2, change2['DeploymentId'])
 
+    def test_status_expired(self):
+        # Expired deployments are not included in the status.
+        deployer = self.make_deployer()
+        deployer._observer = utils.Observer(max_finished=1)
+        for _ in range(3):
+            deployment_id = deployer._observer.add_deployment()
+            deployer._observer.notify_completed(deployment_id)
+        change = deployer.status()[0]
+        self.assertEqual(deployment_id, change['DeploymentId'])
+
+    def test_history(self):
+        # The history summarizes the archived deployments.
+        deployer = self.make_deployer()
+        self.assertEqual({}, deployer.history())
+        deployer._observer.archive[utils.COMPLETED] = 2
+        self.assertEqual({utils.COMPLETED: 2}, deployer.history())
+
     def test_import_callback_cancelled(self):
         deployer = self.make_deployer()
         deployer_id = 123
@@ -378,7 +573,8 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
                 deployer._observer, 'notify_completed') as mock_notify:
             with mock.patch(mock_path) as mock_incrementer:
                 deployer._import_callback(deployer_id, None, future)
-        mock_notify.assert_called_with(deployer_id, error='aiiee')
+        mock_notify.assert_called_with(
+            deployer_id, error='aiiee', timing=None)
         self.assertFalse(mock_incrementer.called)
 
     def test_import_callback_no_bundleid(self):
@@ -392,7 +588,8 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
                 deployer._observer, 'notify_completed') as mock_notify:
             with mock.patch(mock_path) as mock_incrementer:
                 deployer._import_callback(deployer_id, None, future)
-        mock_notify.assert_called_with(deployer_id, error=None)
+        mock_notify.assert_called_with(
+            deployer_id, error=None, timing=None)
         self.assertFalse(mock_incrementer.called)
 
     def test_import_callback_success(self):
@@ -408,9 +605,442 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
                 deployer._observer, 'notify_completed') as mock_notify:
             with mock.patch(mock_path) as mock_incrementer:
                 deployer._import_callback(deployer_id, bundle_id, future)
-        mock_notify.assert_called_with(deployer_id, error=None)
+        mock_notify.assert_called_with(
+            deployer_id, error=None, timing=None)
         mock_incrementer.assert_called_with(bundle_id, deployer._charmworldurl)
 
+    def test_import_callback_timing(self):
+        # The timing report returned when applying changes is notified.
+        deployer = self.make_deployer()
+        deployer_id = 123
+        deployer._queue.append(deployer_id)
+        deployer._futures[deployer_id] = None
+        timing = {'Elapsed': 1.5, 'Total': 4.2, 'CriticalPath': 1.4}
+        future = FakeFuture(result=timing)
+        with mock.patch.object(
+                deployer._observer, 'notify_completed') as mock_notify:
+            deployer._import_callback(deployer_id, None, future)
+        mock_notify.assert_called_with(deployer_id, error=None, timing=timing)
+
+    def test_import_callback_positions(self):
+        # When a deployment completes, only the next one is notified. The
+        # positions of the others are notified when clients ask for changes.
+        deployer = self.make_deployer()
+        deployment_ids = []
+        for _ in range(3):
+            deployment_id = deployer._observer.add_deployment()
+            deployer._queue.append(deployment_id)
+            deployer._notify_position(deployment_id)
+            deployer._futures[deployment_id] = None
+            deployment_ids.append(deployment_id)
+        deployer._import_callback(deployment_ids[0], None, FakeFuture())
+        watchers = deployer._observer.deployments
+        self.assert_change(
+            [watchers[deployment_ids[1]].getlast()], deployment_ids[1],
+            utils.STARTED, queue=0)
+        self.assert_change(
+            [watchers[deployment_ids[2]].getlast()], deployment_ids[2],
+            utils.SCHEDULED, queue=2)
+        # The new position is notified when the client asks for changes.
+        watcher_id = deployer.watch(deployment_ids[2])
+        changes = deployer.next(watcher_id).result()
+        self.assert_change(
+            changes[-1:], deployment_ids[2], utils.SCHEDULED, queue=1)
+        # The position is not notified again if it did not change.
+        deployer.next(watcher_id)
+        changes = watchers[deployment_ids[2]].next('another').result()
+        self.assertEqual(2, len(changes))
+
+    def test_cancel_positions(self):
+        # When the first queued deployment is cancelled, the next one is
+        # started. The positions of the others are notified when clients ask.
+        deployer = self.make_deployer()
+        deployment_ids = []
+        for _ in range(4):
+            deployment_id = deployer._observer.add_deployment()
+            deployer._queue.append(deployment_id)
+            deployer._notify_position(deployment_id)
+            deployer._futures[deployment_id] = None
+            deployment_ids.append(deployment_id)
+        future = FakeFuture(cancelled=True)
+        deployer._import_callback(deployment_ids[1], None, future)
+        deployer._import_callback(deployment_ids[0], None, FakeFuture())
+        watchers = deployer._observer.deployments
+        self.assert_change(
+            [watchers[deployment_ids[2]].getlast()], deployment_ids[2],
+            utils.STARTED, queue=0)
+        self.assert_change(
+            [watchers[deployment_ids[3]].getlast()], deployment_ids[3],
+            utils.SCHEDULED, queue=3)
+        deployer.status()
+        self.assert_change(
+            [watchers[deployment_ids[3]].getlast()], deployment_ids[3],
+            utils.SCHEDULED, queue=1)
+
+    def test_status_positions(self):
+        # The status includes the current position of queued deployments.
+        deployer = self.make_deployer()
+        for deployment_id in (1, 2):
+            deployer._observer.deployments[deployment_id] = AsyncWatcher()
+            deployer._queue.append(deployment_id)
+            deployer._notify_position(deployment_id)
+            deployer._futures[deployment_id] = None
+        deployer._dequeue(1)
+        deployer._observer.deployments.pop(1)
+        change = deployer.status()[0]
+        self.assertEqual(utils.STARTED, change['Status'])
+        self.assertEqual(0, change['Queue'])
+
+
+class TestDeployerDelta(
+        helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    bundle = {'services': {'mysql': {'charm': 'cs:trusty/mysql-47'}}}
+    user = auth.User(
+        username='myuser', password='mypasswd', is_authenticated=True)
+
+    def make_live_deployer(self):
+        """Return a Deployer with a live snapshot of its model."""
+        deployer = base.Deployer(
+            self.apiurl, base.SUPPORTED_API_VERSIONS[0], model_uuid='uuid')
+        self.addCleanup(deployer.shutdown, wait=False)
+        snapshot = deployer.get_snapshot('uuid')
+        snapshot.add_feeder()
+        snapshot.update([])
+        return deployer
+
+    def test_diff(self):
+        # The changes are computed using the live snapshot.
+        deployer = self.make_live_deployer()
+        delta, total = deployer.diff(self.bundle)
+        self.assertEqual(2, total)
+        self.assertEqual(['addCharm', 'deploy'], [i['method'] for i in delta])
+
+    def test_diff_no_snapshot(self):
+        # None is returned if the live snapshot is not available.
+        deployer = self.make_deployer()
+        self.assertIsNone(deployer.diff(self.bundle))
+
+    def test_import_changes(self):
+        # The changes are applied in a separate process.
+        deployer = self.make_live_deployer()
+        delta, _ = deployer.diff(self.bundle)
+        with self.patch_apply_changes() as mock_apply_changes:
+            deployment_id = deployer.import_changes(
+                self.user, 'bundle-v4', self.bundle, 4, None, delta,
+                test_callback=self.stop)
+            self.wait()
+        mock_apply_changes.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password, delta,
+            deployment_id)
+        mock_apply_changes.assert_called_in_a_separate_process()
+        change = deployer._observer.deployments[deployment_id].getlast()
+        self.assertEqual(utils.COMPLETED, change['Status'])
+
+
+class TestDeployerBatch(
+        helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    bundles = [{'services': {'mysql': {}}}, {'services': {'django': {}}}]
+    user = auth.User(
+        username='myuser', password='mypasswd', is_authenticated=True)
+
+    def make_batch(self):
+        """Return the batch of (name, bundle, version, bundle_id) tuples."""
+        return [
+            ('bundle-v4', self.bundles[0], 4, '~user/bundle1'),
+            ('bundle-v4', self.bundles[1], 4, None),
+        ]
+
+    @gen_test
+    def test_validation(self):
+        # The bundles are validated together in a separate process.
+        deployer = self.make_deployer()
+        with self.patch_validate_bundles(side_effect=[None, 'bad wolf']) as m:
+            errors = yield deployer.validate_batch(self.user, self.bundles)
+        self.assertEqual([None, 'bad wolf'], errors)
+        m.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password, self.bundles)
+        m.assert_called_in_a_separate_process()
+
+    @gen_test
+    def test_validation_failure(self):
+        # The error is reported for all the bundles if the validation fails.
+        deployer = self.make_deployer()
+        error = ValueError('bad wolf')
+        with self.patch_validate_bundles(side_effect=error):
+            errors = yield deployer.validate_batch(self.user, self.bundles)
+        self.assertEqual(['bad wolf', 'bad wolf'], errors)
+
+    @gen_test
+    def test_validation_live_snapshot(self):
+        # The bundles are validated against the live snapshot if available.
+        deployer = base.Deployer(
+            self.apiurl, base.SUPPORTED_API_VERSIONS[0], model_uuid='uuid')
+        self.addCleanup(deployer.shutdown, wait=False)
+        snapshot = deployer.get_snapshot('uuid')
+        snapshot.add_feeder()
+        snapshot.update([['service', 'change', {'Name': 'django'}]])
+        with self.patch_validate_bundles() as mock_validate:
+            errors = yield deployer.validate_batch(self.user, self.bundles)
+        self.assertEqual(
+            [None, 'service(s) already in the environment: django'], errors)
+        self.assertEqual(0, mock_validate.call_count)
+
+    @gen_test
+    def test_unsupported_api_version(self):
+        deployer = self.make_deployer(apiversion='not-supported')
+        errors = yield deployer.validate_batch(self.user, self.bundles)
+        error = 'unsupported API version: not-supported'
+        self.assertEqual([error, error], errors)
+
+    def test_import(self):
+        # The bundles are imported in a single job and the completed change
+        # includes the per-bundle results.
+        deployer = self.make_deployer()
+        side_effect = [None, 'bad wolf']
+        with self.patch_import_bundles(side_effect=side_effect) as m:
+            deployment_id = deployer.import_batch(
+                self.user, self.make_batch(), test_callback=self.stop)
+            watcher_id = deployer.watch(deployment_id)
+            self.wait()
+        m.assert_called_once_with(
+            self.apiurl, self.user.username, self.user.password,
+            [('bundle-v4', self.bundles[0], 4),
+             ('bundle-v4', self.bundles[1], 4)],
+            deployer.importer_options, True, deployment_id)
+        m.assert_called_in_a_separate_process()
+        changes = deployer.next(watcher_id).result()
+        change = changes[-1]
+        self.assertEqual(utils.COMPLETED, change['Status'])
+        self.assertEqual('1 of 2 bundles failed', change['Error'])
+        self.assertEqual([{}, {'Error': 'bad wolf'}], change['Results'])
+
+    def test_batch_callback_error(self):
+        # Job errors are reported for all the bundles.
+        deployer = self.make_deployer()
+        deployment_id = deployer._observer.add_deployment()
+        deployer._queue.append(deployment_id)
+        deployer._futures[deployment_id] = None
+        future = FakeFuture(exception=ValueError('bad wolf'))
+        deployer._batch_callback(deployment_id, ['id1', None], future)
+        change = deployer._observer.deployments[deployment_id].getlast()
+        self.assertEqual('2 of 2 bundles failed', change['Error'])
+        self.assertEqual(
+            [{'Error': 'bad wolf'}, {'Error': 'bad wolf'}], change['Results'])
+        self.assertNotIn(deployment_id, deployer._queue)
+
+    def test_batch_callback_counter(self):
+        # The deployment counter is incremented for successful bundles.
+        deployer = self.make_deployer()
+        deployer._charmworldurl = 'http://cw.example.com'
+        deployment_id = deployer._observer.add_deployment()
+        deployer._queue.append(deployment_id)
+        deployer._futures[deployment_id] = None
+        future = FakeFuture(result=[None, 'bad wolf', None])
+        mock_path = 'guiserver.bundles.utils.increment_deployment_counter'
+        with mock.patch(mock_path) as mock_incrementer:
+            deployer._batch_callback(
+                deployment_id, ['id1', 'id2', None], future)
+        mock_incrementer.assert_called_once_with(
+            'id1', deployer._charmworldurl)
+
+    def test_batch_callback_cancelled(self):
+        # Cancelled batches do not include results.
+        deployer = self.make_deployer()
+        deployment_id = deployer._observer.add_deployment()
+        deployer._queue.append(deployment_id)
+        deployer._futures[deployment_id] = None
+        deployer._batch_callback(deployment_id, ['id1'], FakeFuture(True))
+        change = deployer._observer.deployments[deployment_id].getlast()
+        self.assertEqual(utils.CANCELLED, change['Status'])
+        self.assertNotIn('Results', change)
+
+
+class TestDeployerJournal(
+        helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    bundle = {'services': {}}
+    user = auth.User(
+        username='myuser', password='mypasswd', is_authenticated=True)
+
+    def setUp(self):
+        super(TestDeployerJournal, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'deployments.journal')
+
+    def write_journal(self, records):
+        """Write the given records to the journal file."""
+        with open(self.path, 'w') as journal_file:
+            for record in records:
+                journal_file.write(json.dumps(record) + '\n')
+
+    def make_import_record(self, deployment_id, username='myuser'):
+        """Return an import journal record."""
+        return {
+            'Op': 'import', 'DeploymentId': deployment_id, 'Name': 'bundle',
+            'Bundle': self.bundle, 'Version': 4, 'BundleId': None,
+            'Username': username,
+        }
+
+    def make_deployer(self):
+        deployer = base.Deployer(
+            self.apiurl, base.SUPPORTED_API_VERSIONS[0],
+            journal_path=self.path)
+        self.addCleanup(deployer.shutdown, wait=False)
+        return deployer
+
+    def test_restore(self):
+        # Deployments are restored from the journal, and the journal is
+        # compacted.
+        completed = utils.create_change(1, utils.COMPLETED)
+        self.write_journal([
+            {'Op': 'archive', 'Archive': {utils.COMPLETED: 5}},
+            self.make_import_record(1),
+            self.make_import_record(2),
+            {'Op': 'finish', 'DeploymentId': 1, 'Change': completed},
+        ])
+        deployer = self.make_deployer()
+        changes = sorted(deployer.status(), key=lambda c: c['DeploymentId'])
+        self.assertEqual(
+            [utils.COMPLETED, utils.SCHEDULED],
+            [change['Status'] for change in changes])
+        self.assertEqual([2], deployer._suspended.keys())
+        self.assertEqual({utils.COMPLETED: 5}, deployer.history())
+        # New deployments get new identifiers.
+        self.assertEqual(3, deployer._observer.add_deployment())
+        expected = [
+            {'Op': 'archive', 'Archive': {utils.COMPLETED: 5}},
+            {'Op': 'finish', 'DeploymentId': 1, 'Change': completed},
+            self.make_import_record(2),
+        ]
+        # Wait for the compaction to complete.
+        deployer._journal.flush().result()
+        self.assertEqual(expected, deployer._journal.replay())
+
+    def test_resume(self):
+        # Suspended deployments are resumed without validation when their
+        # users send deployer requests.
+        self.write_journal([
+            self.make_import_record(1, username='another-user'),
+            self.make_import_record(2),
+        ])
+        deployer = self.make_deployer()
+        with self.patch_import_bundle() as mock_import_bundle:
+            deployer.resume(self.user)
+        self.assertEqual([1], deployer._suspended.keys())
+        deployer._io_loop.add_future(
+            deployer._futures[2], lambda future: self.stop())
+        self.wait()
+        mock_import_bundle.assert_called_once_with(
+            self.apiurl, 'myuser', 'mypasswd', 'bundle', self.bundle, 4,
+            deployer.importer_options, False, 2)
+
+    def test_resume_draining(self):
+        # Suspended deployments are left to the next server process if the
+        # deployer is draining.
+        self.write_journal([self.make_import_record(1)])
+        deployer = self.make_deployer()
+        deployer.drain()
+        deployer.resume(self.user)
+        self.assertEqual([1], deployer._suspended.keys())
+        self.assertFalse(deployer.is_busy())
+
+    def test_shutdown_interrupted(self):
+        # Deployments interrupted by a shutdown are suspended when the
+        # deployer is restarted.
+        deployer = self.make_deployer()
+        deployment_id = deployer._observer.add_deployment()
+        deployer._journal_import(
+            deployment_id, self.user, 'bundle', self.bundle, 4, None)
+        deployer._queue.append(deployment_id)
+        expected_log = (
+            'deployment 0 interrupted: it will be resumed after the restart')
+        with ExpectLog('', expected_log, required=True):
+            deployer.shutdown(wait=False)
+        deployer = self.make_deployer()
+        self.assertEqual([deployment_id], deployer._suspended.keys())
+
+    def test_cancel_suspended(self):
+        # Suspended deployments can be cancelled.
+        self.write_journal([self.make_import_record(1)])
+        deployer = self.make_deployer()
+        self.assertIsNone(deployer.cancel(1))
+        self.assertEqual(utils.CANCELLED, deployer.status()[0]['Status'])
+        deployer._journal.flush().result()
+        record = deployer._journal.replay()[-1]
+        self.assertEqual('finish', record['Op'])
+        self.assertEqual(utils.CANCELLED, record['Change']['Status'])
+
+    def test_resume_batch(self):
+        # Suspended batch deployments are resumed as well.
+        record = {
+            'Op': 'import', 'DeploymentId': 1, 'Username': 'myuser',
+            'Batch': [{'Name': 'bundle', 'Bundle': self.bundle, 'Version': 4,
+                       'BundleId': None}],
+        }
+        self.write_journal([record])
+        deployer = self.make_deployer()
+        with self.patch_import_bundles(side_effect=[None]) as mock_import:
+            deployer.resume(self.user)
+        deployer._io_loop.add_future(
+            deployer._futures[1], lambda future: self.stop())
+        self.wait()
+        mock_import.assert_called_once_with(
+            self.apiurl, 'myuser', 'mypasswd', [('bundle', self.bundle, 4)],
+            deployer.importer_options, False, 1)
+
+    def test_import_journaled(self):
+        # Imports and their results are recorded in the journal.
+        deployer = self.make_deployer()
+        with self.patch_import_bundle():
+            deployment_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, 4, bundle_id=None,
+                test_callback=self.stop)
+        self.wait()
+        deployer._journal.flush().result()
+        records = deployer._journal.replay()
+        self.assertEqual(
+            self.make_import_record(deployment_id), records[-2])
+        self.assertEqual(
+            utils.COMPLETED, records[-1]['Change']['Status'])
+
+    def test_shutdown_flushes_journal(self):
+        # Pending journal records are written when the deployer is shut down.
+        deployer = self.make_deployer()
+        with self.patch_import_bundle():
+            deployment_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, 4, bundle_id=None,
+                test_callback=self.stop)
+        self.wait()
+        deployer.shutdown()
+        records = deployer._journal.replay()
+        self.assertEqual(
+            self.make_import_record(deployment_id), records[-2])
+        self.assertEqual('finish', records[-1]['Op'])
+
+    def test_journal_compaction(self):
+        # The journal is compacted when it grows too much, only keeping the
+        # current deployments.
+        deployer = self.make_deployer()
+        deployer._journal._compact_size = 1
+        with self.patch_import_bundle():
+            first_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, 4, bundle_id=None,
+                test_callback=self.stop)
+            self.wait()
+            second_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, 4, bundle_id=None)
+            # Shut down the deployer before the second deployment is notified
+            # as completed.
+            deployer.shutdown()
+        records = deployer._journal.replay()
+        self.assertEqual(
+            ['archive', 'finish', 'import'], [i['Op'] for i in records])
+        self.assertEqual(first_id, records[1]['DeploymentId'])
+        self.assertEqual(self.make_import_record(second_id), records[2])
+
 
 class TestDeployMiddleware(helpers.BundlesTestMixin, AsyncTestCase):
 
@@ -436,6 +1066,12 @@ class TestDeployMiddleware(helpers.BundlesTestMixin, AsyncTestCase):
             requested = self.deployment.requested(request)
             self.assertTrue(requested, request)
 
+    def test_batch_import_requested(self):
+        # Batch imports are deployment requests.
+        request = self.make_deployment_request(
+            'BatchImport', params={'Bundles': []})
+        self.assertTrue(self.deployment.requested(request))
+
     def test_deployment_requested_v4(self):
         # True is returned if the incoming data is a deployment request.
         requests = (
@@ -528,6 +1164,54 @@ class TestDeployMiddleware(helpers.BundlesTestMixin, AsyncTestCase):
             requested = self.deployment.requested(request)
             self.assertFalse(requested, request)
 
+    @gen_test
+    def test_close(self):
+        # Watchers requested by the client are released on close.
+        with mock.patch.object(self.deployer, 'watch', return_value=47):
+            yield self.deployment.process_request(
+                {'RequestId': 1, 'Type': 'Deployer', 'Request': 'Watch',
+                 'Params': {'DeploymentId': 42}})
+        with mock.patch.object(self.deployer, 'unwatch') as mock_unwatch:
+            self.deployment.close()
+            self.deployment.close()
+        mock_unwatch.assert_called_once_with(47)
+
+    @gen_test
+    def test_subscribe(self):
+        # Changes are pushed to subscribed clients in batches.
+        deployment_id = self.deployer._observer.add_deployment()
+        yield self.deployment.process_request(
+            {'RequestId': 1, 'Type': 'Deployer', 'Request': 'Subscribe',
+             'Params': {'DeploymentId': deployment_id}})
+        self.assertEqual(1, len(self.responses))
+        watcher_id = self.responses[0]['Response']['WatcherId']
+        self.deployer._observer.notify_position(deployment_id, 1)
+        self.deployer._observer.notify_position(deployment_id, 0)
+        # Changes are not sent immediately.
+        self.assertEqual(1, len(self.responses))
+        yield gen.Task(
+            self.io_loop.add_timeout, time.time() + base.PUSH_WINDOW * 2)
+        self.assertEqual(2, len(self.responses))
+        response = self.responses[1]
+        self.assertEqual(1, response['RequestId'])
+        changes = response['Response']['Changes']
+        self.assertEqual([1, 0], [change['Queue'] for change in changes])
+        self.assertIn(watcher_id, self.deployment._watcher_ids)
+
+    @gen_test
+    def test_subscribe_closed(self):
+        # Pending changes are discarded when the middleware is closed.
+        deployment_id = self.deployer._observer.add_deployment()
+        yield self.deployment.process_request(
+            {'RequestId': 1, 'Type': 'Deployer', 'Request': 'Subscribe',
+             'Params': {'DeploymentId': deployment_id}})
+        self.deployer._observer.notify_position(deployment_id, 1)
+        self.deployment.close()
+        self.deployer._observer.notify_position(deployment_id, 0)
+        yield gen.Task(
+            self.io_loop.add_timeout, time.time() + base.PUSH_WINDOW * 2)
+        self.assertEqual(1, len(self.responses))
+
     @gen_test
     def test_process_request_v3(self):
         # A deployment request is correctly processed.
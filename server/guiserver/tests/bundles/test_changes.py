@@ -0,0 +1,281 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bundle change sets."""
+
+import unittest
+
+import mock
+
+from guiserver.bundles import (
+    changes,
+    utils,
+)
+
+
+def make_bundle(django_units=2, mysql_to=None):
+    """Return a bundle including the django and mysql services."""
+    mysql = {'charm': 'cs:trusty/mysql-47', 'num_units': 1}
+    if mysql_to is not None:
+        mysql['to'] = mysql_to
+    return {
+        'services': {
+            'django': {
+                'charm': 'cs:trusty/django-42',
+                'num_units': django_units,
+                'options': {'debug': True},
+                'expose': True,
+            },
+            'mysql': mysql,
+        },
+        'relations': [['django:db', 'mysql:db']],
+    }
+
+
+class TestDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = utils.EnvironmentSnapshot()
+
+    def deploy_django(self, units=2, config=None):
+        """Add the django service to the snapshot."""
+        data = {'Name': 'django', 'Exposed': True}
+        if config is not None:
+            data['Config'] = config
+        deltas = [['service', 'change', data]]
+        for number in range(units):
+            deltas.append(['unit', 'change', {
+                'Name': 'django/{}'.format(number),
+                'MachineId': str(number + 5),
+            }])
+        self.snapshot.update(deltas)
+
+    def deploy_mysql(self):
+        """Add the mysql service related to django to the snapshot."""
+        self.snapshot.update([
+            ['service', 'change', {'Name': 'mysql', 'Config': {}}],
+            ['unit', 'change', {'Name': 'mysql/0', 'MachineId': '1'}],
+            ['relation', 'change', {
+                'Key': 'django:db mysql:db',
+                'Endpoints': [
+                    {'ServiceName': 'django', 'Relation': {'Name': 'db'}},
+                    {'ServiceName': 'mysql', 'Relation': {'Name': 'db'}},
+                ]}],
+        ])
+
+    def get_ids(self, delta):
+        """Return the ids of the given changes."""
+        return [change['id'] for change in delta]
+
+    def test_empty_model(self):
+        # All the changes are required if the model is empty.
+        delta, total = changes.diff(self.snapshot, make_bundle())
+        self.assertEqual(9, total)
+        self.assertEqual(9, len(delta))
+
+    def test_deployed(self):
+        # No changes are required if the bundle is already deployed.
+        self.deploy_django(config={'debug': True})
+        self.deploy_mysql()
+        delta, total = changes.diff(self.snapshot, make_bundle())
+        self.assertEqual([], delta)
+        self.assertEqual(9, total)
+
+    def test_changed_options(self):
+        # Changed options of existing services are set.
+        self.deploy_django(config={'debug': False, 'port': 8000})
+        self.deploy_mysql()
+        delta, _ = changes.diff(self.snapshot, make_bundle())
+        expected = [{
+            'id': 'setConfig-9',
+            'method': 'setConfig',
+            'args': ['django', {'debug': True}],
+            'requires': [],
+        }]
+        self.assertEqual(expected, delta)
+
+    def test_unknown_options(self):
+        # All the options are set if the service config is not known.
+        self.deploy_django()
+        self.deploy_mysql()
+        delta, _ = changes.diff(self.snapshot, make_bundle())
+        self.assertEqual(['setConfig-9'], self.get_ids(delta))
+        self.assertEqual(['django', {'debug': True}], delta[0]['args'])
+
+    def test_missing_units(self):
+        # Only the missing units are added.
+        self.deploy_django(units=1, config={'debug': True})
+        self.deploy_mysql()
+        delta, _ = changes.diff(self.snapshot, make_bundle(django_units=3))
+        self.assertEqual(['addUnit-7', 'addUnit-8'], self.get_ids(delta))
+        self.assertEqual(['django', None], delta[0]['args'])
+        self.assertEqual([], delta[0]['requires'])
+
+    def test_new_service(self):
+        # New services are deployed and related to existing ones.
+        self.deploy_django(config={'debug': True})
+        delta, _ = changes.diff(self.snapshot, make_bundle())
+        self.assertEqual(
+            ['addCharm-3', 'deploy-4', 'addRelation-5', 'addUnit-8'],
+            self.get_ids(delta))
+        relation = delta[2]
+        self.assertEqual(['django:db', '$deploy-4:db'], relation['args'])
+        self.assertEqual(['deploy-4'], relation['requires'])
+
+    def test_unexposed_service(self):
+        # Existing services are exposed if required.
+        self.deploy_django(config={'debug': True})
+        self.deploy_mysql()
+        self.snapshot.update([['service', 'change', {'Name': 'django'}]])
+        delta, _ = changes.diff(self.snapshot, make_bundle())
+        self.assertEqual(['expose-2'], self.get_ids(delta))
+        self.assertEqual(['django'], delta[0]['args'])
+
+    def test_unneeded_machines(self):
+        # Bundle machines are not added if no new units are placed there.
+        bundle = make_bundle(mysql_to=['0'])
+        bundle['machines'] = {'0': {}}
+        self.deploy_django(config={'debug': True})
+        self.deploy_mysql()
+        delta, _ = changes.diff(self.snapshot, bundle)
+        self.assertEqual([], delta)
+
+    def test_needed_machines(self):
+        # Bundle machines are added if new units are placed there.
+        bundle = make_bundle(mysql_to=['0'])
+        bundle['machines'] = {'0': {}}
+        self.deploy_django(config={'debug': True})
+        delta, _ = changes.diff(self.snapshot, bundle)
+        self.assertIn('addMachines-5', self.get_ids(delta))
+        unit = delta[-1]
+        self.assertEqual('addUnit', unit['method'])
+        self.assertEqual(['$deploy-4', '$addMachines-5'], unit['args'])
+
+    def test_placement_on_existing_unit(self):
+        # Units placed on existing units are placed on their machines.
+        self.deploy_django(config={'debug': True})
+        bundle = make_bundle(mysql_to=['django/1'])
+        bundle['machines'] = {}
+        delta, _ = changes.diff(self.snapshot, bundle)
+        unit = delta[-1]
+        self.assertEqual(['$deploy-4', '6'], unit['args'])
+        self.assertEqual(['deploy-4'], unit['requires'])
+
+
+class TestResolve(unittest.TestCase):
+
+    results = {'deploy-1': 'mysql', 'addMachines-2': '4'}
+
+    def test_placeholders(self):
+        self.assertEqual('mysql', changes.resolve('$deploy-1', self.results))
+        self.assertEqual(
+            'mysql:db', changes.resolve('$deploy-1:db', self.results))
+
+    def test_dict(self):
+        self.assertEqual(
+            {'parentId': '4', 'containerType': 'lxc'},
+            changes.resolve(
+                {'parentId': '$addMachines-2', 'containerType': 'lxc'},
+                self.results))
+
+    def test_values(self):
+        self.assertEqual('cs:mysql', changes.resolve('cs:mysql', {}))
+        self.assertIsNone(changes.resolve(None, {}))
+
+
+class TestApply(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.results = {
+            'addCharm-0': 'cs:trusty/mysql-47',
+            'deploy-1': 'mysql',
+            'deploy-2': 'django',
+            'addUnit-3': 'mysql/0',
+        }
+
+    def apply(self, method, *args):
+        change = {'id': 'id', 'method': method, 'args': list(args)}
+        return changes.apply(self.client, change, self.results)
+
+    def test_add_charm(self):
+        result = self.apply('addCharm', 'cs:trusty/mysql-47')
+        self.assertEqual('cs:trusty/mysql-47', result)
+        self.client.add_charm.assert_called_once_with('cs:trusty/mysql-47')
+
+    def test_deploy(self):
+        result = self.apply(
+            'deploy', '$addCharm-0', 'mysql', {'debug': True}, 'mem=4G', {})
+        self.assertEqual('mysql', result)
+        self.client.deploy.assert_called_once_with(
+            'mysql', 'cs:trusty/mysql-47', num_units=0,
+            config={'debug': True}, constraints={'mem': '4G'})
+
+    def test_add_machines(self):
+        self.client.add_machine.return_value = {'Machine': '4', 'Error': None}
+        result = self.apply('addMachines', {'series': 'trusty'})
+        self.assertEqual('4', result)
+        self.client.add_machine.assert_called_once_with(
+            series='trusty', constraints=None, parent_id='',
+            container_type='')
+
+    def test_add_container_on_unit(self):
+        # Containers placed on units are created on the unit machine.
+        self.client.add_machine.return_value = {'Machine': '2/lxc/0'}
+        self.client.status.return_value = {
+            'Services': {'mysql': {'Units': {'mysql/0': {'Machine': '2'}}}}}
+        self.apply(
+            'addMachines', {'containerType': 'lxc', 'parentId': '$addUnit-3'})
+        self.client.add_machine.assert_called_once_with(
+            series='', constraints=None, parent_id='2', container_type='lxc')
+
+    def test_add_machines_error(self):
+        self.client.add_machine.return_value = {
+            'Machine': '', 'Error': {'Message': 'bad wolf'}}
+        with self.assertRaises(ValueError) as context:
+            self.apply('addMachines', {})
+        self.assertEqual('bad wolf', str(context.exception))
+
+    def test_add_unit(self):
+        self.client.add_unit.return_value = {'Units': ['mysql/1']}
+        result = self.apply('addUnit', '$deploy-1', '4')
+        self.assertEqual('mysql/1', result)
+        self.client.add_unit.assert_called_once_with('mysql', machine_spec='4')
+
+    def test_add_relation(self):
+        self.apply('addRelation', '$deploy-1:db', '$deploy-2:db')
+        self.client.add_relation.assert_called_once_with(
+            'mysql:db', 'django:db')
+
+    def test_expose(self):
+        self.apply('expose', '$deploy-1')
+        self.client.expose.assert_called_once_with('mysql')
+
+    def test_set_annotations(self):
+        self.apply('setAnnotations', '$deploy-1', 'service', {'gui-x': '1'})
+        self.client.set_annotation.assert_called_once_with(
+            'mysql', 'service', {'gui-x': '1'})
+
+    def test_set_config(self):
+        self.apply('setConfig', 'mysql', {'debug': True})
+        self.client.set_config.assert_called_once_with(
+            'mysql', {'debug': True})
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError) as context:
+            self.apply('bad-wolf')
+        self.assertEqual(
+            'unknown change method: bad-wolf', str(context.exception))
@@ -0,0 +1,152 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the concurrent application of bundle change sets."""
+
+import threading
+import time
+import unittest
+
+from guiserver.bundles import dag
+
+
+def make_change(change_id, *requires):
+    """Return a change with the given id and requirements."""
+    return {
+        'id': change_id,
+        'method': change_id.split('-')[0],
+        'args': [],
+        'requires': list(requires),
+    }
+
+
+class TestExecute(unittest.TestCase):
+
+    changes = [
+        make_change('addCharm-0'),
+        make_change('deploy-1', 'addCharm-0'),
+        make_change('addCharm-2'),
+        make_change('deploy-3', 'addCharm-2'),
+        make_change('addRelation-4', 'deploy-1', 'deploy-3'),
+    ]
+
+    def test_requirements(self):
+        # Changes are applied after their requirements, and they receive the
+        # results of the changes applied so far.
+        applied = []
+        lock = threading.Lock()
+
+        def apply(change, results):
+            with lock:
+                for requirement in change['requires']:
+                    self.assertIn(requirement, results)
+                applied.append(change['id'])
+            return change['id'].upper()
+
+        dag.execute(self.changes, apply)
+        expected = sorted(change['id'] for change in self.changes)
+        self.assertEqual(expected, sorted(applied))
+        self.assertEqual('addRelation-4', applied[-1])
+
+    def test_concurrency(self):
+        # Independent changes are applied at the same time.
+        event = threading.Event()
+
+        def apply(change, results):
+            if change['id'] == 'addCharm-0':
+                # This only succeeds if addCharm-2 is applied concurrently.
+                self.assertTrue(event.wait(5))
+            elif change['id'] == 'addCharm-2':
+                event.set()
+
+        dag.execute(self.changes, apply)
+
+    def test_max_workers(self):
+        # No more than max_workers changes are applied at the same time.
+        changes = [make_change('addCharm-{}'.format(i)) for i in range(10)]
+        counters = {'running': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def apply(change, results):
+            with lock:
+                counters['running'] += 1
+                counters['max'] = max(counters['max'], counters['running'])
+            time.sleep(0.01)
+            with lock:
+                counters['running'] -= 1
+
+        dag.execute(changes, apply, max_workers=3)
+        self.assertLessEqual(counters['max'], 3)
+
+    def test_report(self):
+        # The report compares the elapsed time with the total and critical
+        # path durations.
+        def apply(change, results):
+            time.sleep(0.05 if change['method'] == 'addCharm' else 0.01)
+
+        report = dag.execute(self.changes, apply)
+        self.assertGreaterEqual(report['Total'], 0.13)
+        self.assertGreaterEqual(report['CriticalPath'], 0.07)
+        self.assertLess(report['CriticalPath'], report['Total'])
+        self.assertLess(report['Elapsed'], report['Total'])
+
+    def test_callback(self):
+        # The callback is called for each applied change.
+        calls = []
+        dag.execute(
+            self.changes, lambda change, results: None,
+            callback=lambda change, duration: calls.append(change['id']))
+        self.assertEqual(5, len(calls))
+        self.assertEqual('addRelation-4', calls[-1])
+
+    def test_error(self):
+        # Changes depending on a failed change are not applied, and the error
+        # is propagated.
+        applied = []
+
+        def apply(change, results):
+            if change['id'] == 'deploy-1':
+                raise ValueError('bad wolf')
+            applied.append(change['id'])
+
+        with self.assertRaises(ValueError) as context:
+            dag.execute(self.changes, apply, max_workers=1)
+        self.assertEqual('bad wolf', str(context.exception))
+        self.assertNotIn('addRelation-4', applied)
+
+    def test_external_requirements(self):
+        # Requirements not included in the changes are considered applied.
+        changes = [make_change('addUnit-5', 'deploy-1')]
+        report = dag.execute(changes, lambda change, results: None)
+        self.assertEqual(0, report['CriticalPath'])
+
+    def test_cycle(self):
+        # A ValueError is raised if requirements cannot be satisfied.
+        changes = [
+            make_change('addCharm-0'),
+            make_change('deploy-1', 'deploy-2'),
+            make_change('deploy-2', 'deploy-1'),
+        ]
+        with self.assertRaises(ValueError) as context:
+            dag.execute(changes, lambda change, results: None)
+        self.assertEqual(
+            'unsatisfiable change requirements: deploy-1, deploy-2',
+            str(context.exception))
+
+    def test_no_changes(self):
+        # An empty change set is valid.
+        report = dag.execute([], lambda change, results: None)
+        self.assertEqual(0, report['Total'])
@@ -0,0 +1,162 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bundle deployments journal."""
+
+import os
+import shutil
+import stat
+import tempfile
+
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    gen_test,
+    LogTrapTestCase,
+)
+
+from guiserver.bundles import journal
+
+
+class TestJournal(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestJournal, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'deployments.journal')
+        self.journal = journal.Journal(self.path, io_loop=self.io_loop)
+
+    def test_replay_no_journal(self):
+        # An empty list is returned if the journal does not exist.
+        self.assertEqual([], self.journal.replay())
+
+    @gen_test
+    def test_append_and_replay(self):
+        # Records are written when the journal is flushed.
+        self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        self.journal.append({'Op': 'finish', 'DeploymentId': 1})
+        self.assertEqual([], self.journal.replay())
+        yield self.journal.flush()
+        expected = [
+            {'Op': 'import', 'DeploymentId': 1},
+            {'Op': 'finish', 'DeploymentId': 1},
+        ]
+        self.assertEqual(expected, self.journal.replay())
+
+    def test_delayed_flush(self):
+        # Records are automatically flushed after a delay.
+        self.journal = journal.Journal(
+            self.path, io_loop=self.io_loop, flush_delay=0.01)
+        self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        self.io_loop.add_timeout(self.io_loop.time() + 0.2, self.stop)
+        self.wait()
+        self.assertEqual(
+            [{'Op': 'import', 'DeploymentId': 1}], self.journal.replay())
+
+    def test_truncated_record(self):
+        # Truncated records are ignored.
+        with open(self.path, 'w') as journal_file:
+            journal_file.write('{"Op": "import"}\n{"Op": "fin')
+        expected_log = 'journal: ignoring invalid record at .*:2'
+        with ExpectLog('', expected_log, required=True):
+            records = self.journal.replay()
+        self.assertEqual([{'Op': 'import'}], records)
+
+    @gen_test
+    def test_compact(self):
+        # The journal contents can be replaced.
+        self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        yield self.journal.flush()
+        self.journal.append({'Op': 'import', 'DeploymentId': 2})
+        yield self.journal.compact([{'Op': 'import', 'DeploymentId': 3}])
+        self.assertEqual(
+            [{'Op': 'import', 'DeploymentId': 3}], self.journal.replay())
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_compact_empty(self):
+        # The journal can be compacted to an empty file.
+        self.journal.compact([]).result()
+        self.assertEqual([], self.journal.replay())
+        self.assertTrue(os.path.exists(self.path))
+
+    def assert_private(self):
+        """Ensure the journal file is only accessible by its owner."""
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(0o600, mode)
+
+    def test_private_file(self):
+        # The journal file is only readable by its owner.
+        self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        self.journal.flush().result()
+        self.assert_private()
+        self.journal.compact([]).result()
+        self.assert_private()
+
+    def test_existing_file_made_private(self):
+        # The permissions of an existing journal are restricted.
+        open(self.path, 'w').close()
+        os.chmod(self.path, 0o644)
+        self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        self.journal.flush().result()
+        self.assert_private()
+
+    def test_needs_compaction(self):
+        # The journal needs compaction when it grows past the given size.
+        self.journal = journal.Journal(
+            self.path, io_loop=self.io_loop, compact_size=100)
+        self.assertFalse(self.journal.needs_compaction)
+        self.journal.append({'Op': 'import', 'Bundle': 'x' * 100})
+        self.assertTrue(self.journal.needs_compaction)
+        self.journal.compact([]).result()
+        self.assertFalse(self.journal.needs_compaction)
+
+    def test_needs_compaction_existing_file(self):
+        # The size of an existing journal is taken into account.
+        with open(self.path, 'w') as journal_file:
+            journal_file.write('{}\n' * 50)
+        self.journal = journal.Journal(
+            self.path, io_loop=self.io_loop, compact_size=100)
+        self.assertTrue(self.journal.needs_compaction)
+
+    def test_needs_compaction_relative_size(self):
+        # The journal is not compacted again until it doubles its size after
+        # the last compaction.
+        self.journal = journal.Journal(
+            self.path, io_loop=self.io_loop, compact_size=10)
+        self.journal.compact([{'Bundle': 'x' * 100}]).result()
+        self.assertFalse(self.journal.needs_compaction)
+        self.journal.append({'Bundle': 'x' * 100})
+        self.assertFalse(self.journal.needs_compaction)
+        self.journal.append({'Op': 'finish'})
+        self.assertTrue(self.journal.needs_compaction)
+
+    def test_close(self):
+        # Pending records are written when the journal is closed.
+        self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        self.journal.close()
+        self.assertEqual(
+            [{'Op': 'import', 'DeploymentId': 1}], self.journal.replay())
+        # Closing the journal again is a no-op.
+        self.journal.close()
+
+    def test_append_after_close(self):
+        # Records appended after the journal is closed are not written.
+        self.journal.close()
+        expected_log = 'journal: closed, record not written'
+        with ExpectLog('', expected_log, required=True):
+            self.journal.append({'Op': 'import', 'DeploymentId': 1})
+        self.assertEqual([], self.journal.replay())
@@ -68,6 +68,18 @@ class TestCreateChange(unittest.TestCase):
         obtained = utils.create_change(2, utils.COMPLETED, error='an error')
         self.assertEqual(expected, obtained)
 
+    def test_progress(self):
+        # The progress info can be included in the change.
+        progress = {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1}
+        expected = {
+            'DeploymentId': 0,
+            'Status': utils.STARTED,
+            'Time': 12345,
+            'Progress': progress,
+        }
+        obtained = utils.create_change(0, utils.STARTED, progress=progress)
+        self.assertEqual(expected, obtained)
+
     def test_all_params(self):
         # The change includes all the parameters.
         expected = {
@@ -81,6 +93,30 @@ class TestCreateChange(unittest.TestCase):
             3, utils.COMPLETED, queue=47, error='an error')
         self.assertEqual(expected, obtained)
 
+    def test_results(self):
+        # The per-bundle results of a batch can be included in the change.
+        results = [{}, {'Error': 'bad wolf'}]
+        expected = {
+            'DeploymentId': 0,
+            'Status': utils.COMPLETED,
+            'Time': 12345,
+            'Results': results,
+        }
+        obtained = utils.create_change(0, utils.COMPLETED, results=results)
+        self.assertEqual(expected, obtained)
+
+
+class TestCreateResults(unittest.TestCase):
+
+    def test_results(self):
+        # Errors are converted to per-bundle results.
+        self.assertEqual(
+            [{}, {'Error': 'bad wolf'}, {}],
+            utils.create_results([None, 'bad wolf', None]))
+
+    def test_empty(self):
+        self.assertEqual([], utils.create_results([]))
+
 
 class TestMessageFromError(LogTrapTestCase, unittest.TestCase):
 
@@ -114,6 +150,293 @@ class TestMessageFromError(LogTrapTestCase, unittest.TestCase):
         self.assertEqual('no further details can be provided', error)
 
 
+class TestGetDeltas(unittest.TestCase):
+
+    def test_legacy_deltas(self):
+        # Deltas are returned from Juju 1 megawatcher responses.
+        deltas = [['service', 'change', {'Name': 'django'}]]
+        data = {'RequestId': 1, 'Response': {'Deltas': deltas}}
+        self.assertEqual(deltas, utils.get_deltas(data))
+
+    def test_deltas(self):
+        # Deltas are returned from Juju 2 megawatcher responses.
+        deltas = [['application', 'change', {'name': 'django'}]]
+        data = {'request-id': 1, 'response': {'deltas': deltas}}
+        self.assertEqual(deltas, utils.get_deltas(data))
+
+    def test_no_deltas(self):
+        # None is returned if the response does not include deltas.
+        self.assertIsNone(utils.get_deltas({'RequestId': 1, 'Response': {}}))
+
+    def test_not_a_response(self):
+        # None is returned if the data is not a response.
+        self.assertIsNone(utils.get_deltas({'RequestId': 1, 'Type': 'Admin'}))
+
+
+class TestEnvironmentSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = utils.EnvironmentSnapshot()
+
+    def test_initial(self):
+        # The snapshot is initially empty and not live.
+        self.assertEqual(set(), self.snapshot.services)
+        self.assertFalse(self.snapshot.is_live)
+
+    def test_live(self):
+        # The snapshot is live when fed and the initial deltas are received.
+        self.snapshot.add_feeder()
+        self.assertFalse(self.snapshot.is_live)
+        self.snapshot.update([])
+        self.assertTrue(self.snapshot.is_live)
+
+    def test_not_live_without_feeders(self):
+        # The snapshot is reset when the last feeder goes away.
+        self.snapshot.add_feeder()
+        self.snapshot.add_feeder()
+        self.snapshot.update([['service', 'change', {'Name': 'django'}]])
+        self.snapshot.remove_feeder()
+        self.assertTrue(self.snapshot.is_live)
+        self.snapshot.remove_feeder()
+        self.assertFalse(self.snapshot.is_live)
+        self.assertEqual(set(), self.snapshot.services)
+
+    def test_update(self):
+        # Services are added and removed based on the deltas.
+        self.snapshot.update([
+            ['service', 'change', {'Name': 'django'}],
+            ['application', 'change', {'name': 'haproxy'}],
+            ['unit', 'change', {'Name': 'django/0'}],
+            ['service', 'change', {'Name': 'mysql'}],
+        ])
+        self.assertEqual(
+            set(['django', 'haproxy', 'mysql']), self.snapshot.services)
+        self.snapshot.update([['service', 'remove', {'Name': 'mysql'}]])
+        self.assertEqual(set(['django', 'haproxy']), self.snapshot.services)
+
+    def test_update_invalid_deltas(self):
+        # Invalid deltas are ignored.
+        self.snapshot.update([None, ['service'], 'bad wolf'])
+        self.assertEqual(set(), self.snapshot.services)
+
+    def test_validate(self):
+        # None is returned if the bundle services are not in the model.
+        self.snapshot.update([['service', 'change', {'Name': 'django'}]])
+        bundle = {'services': {'mysql': {}, 'haproxy': {}}}
+        self.assertIsNone(self.snapshot.validate(bundle))
+
+    def test_validate_overlapping(self):
+        # An error is returned if the bundle services are already deployed.
+        self.snapshot.update([
+            ['service', 'change', {'Name': 'django'}],
+            ['service', 'change', {'Name': 'mysql'}],
+        ])
+        bundle = {'services': {'mysql': {}, 'django': {}, 'haproxy': {}}}
+        self.assertEqual(
+            'service(s) already in the environment: django, mysql',
+            self.snapshot.validate(bundle))
+
+
+class TestEnvironmentSnapshotIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = utils.EnvironmentSnapshot()
+
+    def test_services(self):
+        # Service options and exposure are indexed.
+        self.snapshot.update([
+            ['service', 'change',
+             {'Name': 'mysql', 'Config': {'debug': True}, 'Exposed': True}],
+            ['application', 'change', {'name': 'django', 'exposed': False}],
+        ])
+        self.assertEqual({'mysql': {'debug': True}}, self.snapshot.config)
+        self.assertEqual(set(['mysql']), self.snapshot.exposed)
+        self.snapshot.update([
+            ['service', 'change', {'Name': 'mysql', 'Exposed': False}]])
+        self.assertEqual(set(), self.snapshot.exposed)
+        self.snapshot.update([['service', 'remove', {'Name': 'mysql'}]])
+        self.assertEqual({}, self.snapshot.config)
+
+    def test_units(self):
+        # Units and their machines are indexed.
+        self.snapshot.update([
+            ['unit', 'change', {'Name': 'mysql/10', 'MachineId': '3'}],
+            ['unit', 'change', {'name': 'mysql/2', 'machine-id': '1'}],
+            ['unit', 'change', {'Name': 'mysql-slave/0', 'MachineId': '4'}],
+        ])
+        self.assertEqual(
+            [('mysql/2', '1'), ('mysql/10', '3')],
+            self.snapshot.get_units('mysql'))
+        self.snapshot.update([['unit', 'remove', {'Name': 'mysql/2'}]])
+        self.assertEqual(
+            [('mysql/10', '3')], self.snapshot.get_units('mysql'))
+        self.assertEqual([], self.snapshot.get_units('django'))
+
+    def test_relations(self):
+        # Relations are indexed by endpoints.
+        self.snapshot.update([
+            ['relation', 'change', {
+                'Key': 'django:db mysql:db',
+                'Endpoints': [
+                    {'ServiceName': 'django', 'Relation': {'Name': 'db'}},
+                    {'ServiceName': 'mysql', 'Relation': {'Name': 'db'}},
+                ]}],
+            ['relation', 'change', {
+                'key': 'haproxy:peer',
+                'endpoints': [{
+                    'application-name': 'haproxy',
+                    'relation': {'name': 'peer'}}]}],
+        ])
+        self.assertTrue(
+            self.snapshot.has_relation(('mysql', 'db'), ('django', 'db')))
+        self.assertTrue(
+            self.snapshot.has_relation(('mysql', None), ('django', None)))
+        self.assertFalse(
+            self.snapshot.has_relation(('mysql', 'slave'), ('django', None)))
+        self.assertFalse(
+            self.snapshot.has_relation(('haproxy', None), ('haproxy', None)))
+        self.snapshot.update([
+            ['relation', 'remove', {'Key': 'django:db mysql:db'}]])
+        self.assertFalse(
+            self.snapshot.has_relation(('mysql', None), ('django', None)))
+
+    def test_reset(self):
+        # The index is cleared when the last feeder goes away.
+        self.snapshot.add_feeder()
+        self.snapshot.update([
+            ['service', 'change', {'Name': 'mysql', 'Exposed': True}],
+            ['unit', 'change', {'Name': 'mysql/0', 'MachineId': '0'}],
+        ])
+        self.snapshot.remove_feeder()
+        self.assertEqual(set(), self.snapshot.exposed)
+        self.assertEqual({}, self.snapshot.units)
+
+
+class TestValidateBatch(unittest.TestCase):
+
+    def test_valid(self):
+        # A list of None values is returned if all the bundles are valid.
+        bundles = [
+            {'services': {'mysql': {}}},
+            {'services': {'haproxy': {}}},
+            {},
+        ]
+        self.assertEqual(
+            [None, None, None], utils.validate_batch({'django'}, bundles))
+
+    def test_deployed_services(self):
+        # Bundles including deployed services are reported.
+        bundles = [
+            {'services': {'mysql': {}}},
+            {'services': {'django': {}, 'haproxy': {}}},
+        ]
+        self.assertEqual(
+            [None, 'service(s) already in the environment: django'],
+            utils.validate_batch({'django'}, bundles))
+
+    def test_batch_services(self):
+        # Bundles including services of previous bundles are reported.
+        bundles = [
+            {'services': {'mysql': {}, 'django': {}}},
+            {'services': {'haproxy': {}}},
+            {'services': {'mysql': {}, 'django': {}}},
+        ]
+        self.assertEqual(
+            [None, None, 'service(s) already in the batch: django, mysql'],
+            utils.validate_batch(set(), bundles))
+
+    def test_empty(self):
+        self.assertEqual([], utils.validate_batch({'django'}, []))
+
+
+class TestDeploymentQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = utils.DeploymentQueue()
+
+    def test_initial(self):
+        # A queue is initially empty.
+        self.assertEqual(0, len(self.queue))
+        self.assertIsNone(self.queue.first())
+        self.assertEqual([], list(self.queue))
+
+    def test_append(self):
+        # Appending a deployment returns its position in the queue.
+        self.assertEqual(0, self.queue.append(42))
+        self.assertEqual(1, self.queue.append(47))
+        self.assertEqual(2, len(self.queue))
+        self.assertIn(47, self.queue)
+        self.assertEqual(42, self.queue.first())
+
+    def test_remove_first(self):
+        # Removing the first deployment moves the others forward.
+        for deployment_id in range(3):
+            self.queue.append(deployment_id)
+        self.queue.remove(0)
+        self.assertNotIn(0, self.queue)
+        self.assertEqual(1, self.queue.first())
+        self.assertEqual(0, self.queue.position(1))
+        self.assertEqual(1, self.queue.position(2))
+
+    def test_remove_middle(self):
+        # Deployments can be removed from the middle of the queue.
+        for deployment_id in range(4):
+            self.queue.append(deployment_id)
+        self.queue.remove(2)
+        self.assertEqual(0, self.queue.first())
+        self.assertEqual(1, self.queue.position(1))
+        self.assertEqual(2, self.queue.position(3))
+        # The gap is skipped when the head moves forward.
+        self.queue.remove(0)
+        self.queue.remove(1)
+        self.assertEqual(3, self.queue.first())
+        self.assertEqual(0, self.queue.position(3))
+
+    def test_iteration_order(self):
+        # Iterating over the queue yields deployments in ticket order.
+        deployment_ids = [47, 3, 1000, 42, 8]
+        for deployment_id in deployment_ids:
+            self.queue.append(deployment_id)
+        self.queue.remove(1000)
+        self.assertEqual([47, 3, 42, 8], list(self.queue))
+
+    def test_remove_all(self):
+        # The queue can be emptied and reused.
+        self.queue.append(1)
+        self.queue.append(2)
+        self.queue.remove(2)
+        self.queue.remove(1)
+        self.assertEqual(0, len(self.queue))
+        self.assertIsNone(self.queue.first())
+        self.assertEqual(0, self.queue.append(3))
+
+    def test_remove_unknown(self):
+        # A ValueError is raised removing a deployment not in the queue.
+        with self.assertRaises(ValueError) as context_manager:
+            self.queue.remove(42)
+        self.assertEqual(
+            'deployment 42 not in queue', str(context_manager.exception))
+
+    def test_position_unknown(self):
+        # A KeyError is raised asking for the position of unknown deployments.
+        with self.assertRaises(KeyError):
+            self.queue.position(42)
+
+    def test_position_changed(self):
+        # The position is returned only if it changed since the last time.
+        self.queue.append(1)
+        self.queue.append(2)
+        self.assertEqual(1, self.queue.position_changed(2))
+        self.assertIsNone(self.queue.position_changed(2))
+        self.queue.remove(1)
+        self.assertEqual(0, self.queue.position_changed(2))
+        self.assertIsNone(self.queue.position_changed(2))
+
+    def test_position_changed_not_queued(self):
+        # None is returned for deployments not in the queue.
+        self.assertIsNone(self.queue.position_changed(42))
+
+
 class TestObserver(LogTrapTestCase, unittest.TestCase):
 
     def setUp(self):
@@ -181,6 +504,24 @@ class TestObserver(LogTrapTestCase, unittest.TestCase):
         self.assert_watcher(watcher1, deployment1)
         self.assert_watcher(watcher2, deployment2)
 
+    def test_remove_watcher(self):
+        # A watcher id can be removed from the observer.
+        deployment_id = self.observer.add_deployment()
+        watcher_id = self.observer.add_watcher(deployment_id)
+        self.observer.remove_watcher(watcher_id)
+        self.assertEqual({}, self.observer.watchers)
+        # Removing the watcher again is a no-op.
+        self.observer.remove_watcher(watcher_id)
+
+    def test_deployment_gap(self):
+        # Gap changes include the deployment id.
+        deployment_id = self.observer.add_deployment()
+        watcher = self.observer.deployments[deployment_id]
+        for position in range(utils.MAX_DEPLOYMENT_CHANGES + 1):
+            self.observer.notify_position(deployment_id, position)
+        changes = watcher.next('watcher1').result()
+        self.assertEqual({'DeploymentId': deployment_id, 'Gap': 1}, changes[0])
+
     @mock_time
     def test_notify_scheduled(self):
         # It is possible to notify a new queue position for a deployment.
@@ -211,6 +552,31 @@ class TestObserver(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(expected, watcher.getlast())
         self.assertFalse(watcher.closed)
 
+    @mock_time
+    def test_notify_progress(self):
+        # It is possible to notify the progress of a started deployment.
+        deployment_id = self.observer.add_deployment()
+        watcher = self.observer.deployments[deployment_id]
+        progress = {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1}
+        self.observer.notify_progress(deployment_id, progress)
+        expected = {
+            'DeploymentId': deployment_id,
+            'Status': utils.STARTED,
+            'Time': 12345,
+            'Queue': 0,
+            'Progress': progress,
+        }
+        self.assertEqual(expected, watcher.getlast())
+
+    def test_notify_progress_finished(self):
+        # Progress of finished or unknown deployments is ignored.
+        deployment_id = self.observer.add_deployment()
+        self.observer.notify_completed(deployment_id)
+        self.observer.notify_progress(deployment_id, {'Action': 'deploy'})
+        self.observer.notify_progress(42, {'Action': 'deploy'})
+        watcher = self.observer.deployments[deployment_id]
+        self.assertEqual(utils.COMPLETED, watcher.getlast()['Status'])
+
     @mock_time
     def test_notify_cancelled(self):
         # It is possible to notify that a deployment has been cancelled.
@@ -268,6 +634,112 @@ class TestObserver(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(expected, watcher.getlast())
         self.assertTrue(watcher.closed)
 
+    @mock_time
+    def test_notify_completed_timing(self):
+        # The timing report of a deployment is included in the change.
+        deployment_id = self.observer.add_deployment()
+        timing = {'Elapsed': 1.5, 'Total': 4.2, 'CriticalPath': 1.4}
+        change = self.observer.notify_completed(deployment_id, timing=timing)
+        self.assertEqual(timing, change['Timing'])
+
+    def test_notify_completed_results(self):
+        # The results of a batch deployment are included in the change.
+        deployment_id = self.observer.add_deployment()
+        results = [{}, {'Error': 'bad wolf'}]
+        change = self.observer.notify_completed(
+            deployment_id, error='1 of 2 bundles failed', results=results)
+        self.assertEqual(results, change['Results'])
+        watcher = self.observer.deployments[deployment_id]
+        self.assertEqual(change, watcher.getlast())
+
+
+class TestObserverRestore(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.observer = utils.Observer()
+
+    def test_restore_finished(self):
+        # Finished deployments are restored with a closed watcher.
+        change = utils.create_change(3, utils.COMPLETED)
+        self.observer.restore_deployment(3, change)
+        watcher = self.observer.deployments[3]
+        self.assertTrue(watcher.closed)
+        self.assertEqual(change, watcher.getlast())
+
+    def test_restore_pending(self):
+        # Pending deployments are restored with an open watcher.
+        change = utils.create_change(3, utils.SCHEDULED)
+        self.observer.restore_deployment(3, change)
+        watcher = self.observer.deployments[3]
+        self.assertFalse(watcher.closed)
+        self.assertEqual(change, watcher.getlast())
+
+    def test_deployment_ids(self):
+        # New deployment ids follow the restored ones.
+        self.observer.restore_deployment(
+            7, utils.create_change(7, utils.COMPLETED))
+        self.observer.restore_deployment(
+            3, utils.create_change(3, utils.COMPLETED))
+        self.assertEqual(8, self.observer.add_deployment())
+
+
+class TestObserverRetention(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.observer = utils.Observer(max_finished=2, max_age=60)
+
+    def test_initial(self):
+        # A newly created observer has an empty archive.
+        self.assertEqual({}, self.observer.archive)
+
+    def test_keep_max_finished(self):
+        # Only the most recent finished deployments are kept.
+        deployment_ids = [self.observer.add_deployment() for _ in range(4)]
+        for deployment_id in deployment_ids[:3]:
+            self.observer.notify_completed(deployment_id)
+        self.assertEqual(
+            set(deployment_ids[1:]), set(self.observer.deployments))
+        self.assertEqual({utils.COMPLETED: 1}, self.observer.archive)
+
+    def test_running_deployments_preserved(self):
+        # Deployments not yet finished are never expired.
+        deployment_id = self.observer.add_deployment()
+        for _ in range(3):
+            self.observer.notify_cancelled(self.observer.add_deployment())
+        self.assertIn(deployment_id, self.observer.deployments)
+        self.assertEqual(3, len(self.observer.deployments))
+
+    def test_watchers_removed(self):
+        # Watcher ids of expired deployments are removed.
+        deployment_ids = [self.observer.add_deployment() for _ in range(3)]
+        watcher_id = self.observer.add_watcher(deployment_ids[0])
+        self.observer.add_watcher(deployment_ids[1])
+        for deployment_id in deployment_ids:
+            self.observer.notify_completed(deployment_id)
+        self.assertNotIn(watcher_id, self.observer.watchers)
+        self.assertEqual(1, len(self.observer.watchers))
+
+    def test_max_age(self):
+        # Deployments finished too long ago are expired.
+        deployment_id = self.observer.add_deployment()
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            self.observer.notify_cancelled(deployment_id)
+        with mock.patch('time.time', mock.Mock(return_value=1060)):
+            self.observer.expire()
+        self.assertIn(deployment_id, self.observer.deployments)
+        with mock.patch('time.time', mock.Mock(return_value=1061)):
+            self.observer.expire()
+        self.assertNotIn(deployment_id, self.observer.deployments)
+        self.assertEqual({utils.CANCELLED: 1}, self.observer.archive)
+
+    def test_archive_failures(self):
+        # Completed deployments with errors are archived as failures.
+        for error in ('bad wolf', None, 'bad wolf', None, None):
+            deployment_id = self.observer.add_deployment()
+            self.observer.notify_completed(deployment_id, error=error)
+        expected = {utils.FAILED: 2, utils.COMPLETED: 1}
+        self.assertEqual(expected, self.observer.archive)
+
 
 class TestPrepareBundle(unittest.TestCase):
 
@@ -45,7 +45,7 @@ class ViewsTestMixin(object):
     def setUp(self):
         super(ViewsTestMixin, self).setUp()
         self.view = self.get_view()
-        self.deployer = mock.Mock()
+        self.deployer = mock.Mock(draining=False)
 
     def make_future(self, result):
         """Create and return a Future containing the given result."""
@@ -85,9 +85,24 @@ class ViewsTestMixin(object):
         self.assertEqual(0, len(self.deployer.mock_calls))
 
 
+class ImportViewsTestMixin(object):
+    """Common tests for the views scheduling bundle deployments."""
+
+    @gen_test
+    def test_draining(self):
+        # An error response is returned if the server is stopping.
+        self.deployer.draining = True
+        request = self.make_view_request(params={})
+        response = yield self.view(request, self.deployer)
+        expected_response = {'Response': {}, 'Error': views.DRAINING_ERROR}
+        self.assertEqual(expected_response, response)
+        # The Deployer methods have not been called.
+        self.assertEqual(0, len(self.deployer.mock_calls))
+
+
 class TestImportBundleV3(
-        ViewsTestMixin, helpers.BundlesTestMixin, LogTrapTestCase,
-        AsyncTestCase):
+        ViewsTestMixin, ImportViewsTestMixin, helpers.BundlesTestMixin,
+        LogTrapTestCase, AsyncTestCase):
 
     def get_view(self):
         return views.import_bundle
@@ -403,6 +418,149 @@ class TestImportBundleV4(
             '~jorge/wiki/3/smallwiki')
 
 
+class TestImportDelta(
+        ViewsTestMixin, ImportViewsTestMixin, helpers.BundlesTestMixin,
+        LogTrapTestCase, AsyncTestCase):
+
+    bundle = {'services': {'mysql': {'charm': 'cs:trusty/mysql-47'}}}
+
+    def get_view(self):
+        return views.import_delta
+
+    def make_request(self, version=4):
+        params = {'YAML': yaml.safe_dump(self.bundle), 'Version': version}
+        return self.make_view_request(params=params)
+
+    @gen_test
+    def test_v3_bundle(self):
+        # Only v4 bundles are supported.
+        params = {'YAML': 'bundle: {services: {}}'}
+        request = self.make_view_request(params=params)
+        response = yield self.view(request, self.deployer)
+        self.assertEqual(
+            'invalid request: only v4 bundles are supported',
+            response['Error'])
+
+    @gen_test
+    def test_invalid_bundle(self):
+        # An error response is returned if the bundle is not valid.
+        params = {'YAML': 'services: {mysql: {}}', 'Version': 4}
+        request = self.make_view_request(params=params)
+        response = yield self.view(request, self.deployer)
+        self.assertIn('invalid request: invalid bundle: ', response['Error'])
+        self.assertEqual(0, len(self.deployer.mock_calls))
+
+    @gen_test
+    def test_no_snapshot(self):
+        # An error response is returned if a live snapshot is not available.
+        self.deployer.diff.return_value = None
+        response = yield self.view(self.make_request(), self.deployer)
+        self.assertEqual(
+            'invalid request: live model snapshot not available',
+            response['Error'])
+
+    @gen_test
+    def test_no_changes(self):
+        # Nothing is deployed if the model already reflects the bundle.
+        self.deployer.diff.return_value = ([], 2)
+        response = yield self.view(self.make_request(), self.deployer)
+        self.assertEqual({'Response': {'Delta': 0, 'Total': 2}}, response)
+        self.assertFalse(self.deployer.import_changes.called)
+
+    @gen_test
+    def test_success(self):
+        # The response includes the deployment id and the diff size.
+        delta = [{'id': 'deploy-1'}]
+        self.deployer.diff.return_value = (delta, 2)
+        self.deployer.import_changes.return_value = 42
+        request = self.make_request()
+        response = yield self.view(request, self.deployer)
+        expected_response = {
+            'Response': {'DeploymentId': 42, 'Delta': 1, 'Total': 2}}
+        self.assertEqual(expected_response, response)
+        self.deployer.diff.assert_called_once_with(self.bundle)
+        self.deployer.import_changes.assert_called_once_with(
+            request.user, 'bundle-v4', self.bundle, 4, None, delta)
+
+
+class TestBatchImport(
+        ViewsTestMixin, ImportViewsTestMixin, helpers.BundlesTestMixin,
+        LogTrapTestCase, AsyncTestCase):
+
+    def get_view(self):
+        return views.batch_import
+
+    def make_params(self, *contents):
+        """Return the batch parameters for the given YAML contents."""
+        return {'Bundles': [
+            {'YAML': content, 'Version': 4, 'BundleID': 'id{}'.format(i)}
+            for i, content in enumerate(contents)
+        ]}
+
+    @gen_test
+    def test_empty_batch(self):
+        # An error response is returned if no bundles are provided.
+        request = self.make_view_request(params={'Bundles': []})
+        response = yield self.view(request, self.deployer)
+        self.assertEqual(
+            'invalid request: invalid data parameters', response['Error'])
+        self.assertEqual(0, len(self.deployer.mock_calls))
+
+    @gen_test
+    def test_invalid_bundle_params(self):
+        # An error response is returned if bundle parameters are not valid.
+        params = {'Bundles': [{'Version': 4}]}
+        request = self.make_view_request(params=params)
+        response = yield self.view(request, self.deployer)
+        self.assertEqual(
+            'invalid request: bundle 0: invalid data parameters',
+            response['Error'])
+        self.assertEqual(0, len(self.deployer.mock_calls))
+
+    @gen_test
+    def test_invalid_bundle(self):
+        # An error response is returned if a bundle is not well formed.
+        params = self.make_params('services: {}', 'not valid')
+        request = self.make_view_request(params=params)
+        response = yield self.view(request, self.deployer)
+        self.assertEqual(
+            'invalid request: bundle 1: the bundle data is not well formed',
+            response['Error'])
+        self.assertEqual(0, len(self.deployer.mock_calls))
+
+    @gen_test
+    def test_undeployable_bundles(self):
+        # Per-bundle results are returned if any bundle cannot be deployed.
+        params = self.make_params('services: {}', 'services: {}')
+        request = self.make_view_request(params=params)
+        self.deployer.validate_batch.return_value = self.make_future(
+            [None, 'bad wolf'])
+        response = yield self.view(request, self.deployer)
+        expected_response = {
+            'Response': {'Results': [{}, {'Error': 'bad wolf'}]},
+            'Error': 'invalid request: invalid bundles in batch',
+        }
+        self.assertEqual(expected_response, response)
+        self.deployer.validate_batch.assert_called_once_with(
+            request.user, [{'services': {}}, {'services': {}}])
+        self.assertFalse(self.deployer.import_batch.called)
+
+    @gen_test
+    def test_success(self):
+        # The response includes the deployment identifier of the batch.
+        params = self.make_params('services: {}', 'services: {}')
+        request = self.make_view_request(params=params)
+        self.deployer.validate_batch.return_value = self.make_future(
+            [None, None])
+        self.deployer.import_batch.return_value = 42
+        response = yield self.view(request, self.deployer)
+        self.assertEqual({'Response': {'DeploymentId': 42}}, response)
+        self.deployer.import_batch.assert_called_once_with(request.user, [
+            ('bundle-v4', {'services': {}}, 4, 'id0'),
+            ('bundle-v4', {'services': {}}, 4, 'id1'),
+        ])
+
+
 class TestWatch(
         ViewsTestMixin, helpers.BundlesTestMixin, LogTrapTestCase,
         AsyncTestCase):
@@ -452,6 +610,37 @@ class TestWatch(
             yield self.view(request, self.deployer)
 
 
+class TestSubscribe(
+        ViewsTestMixin, helpers.BundlesTestMixin, LogTrapTestCase,
+        AsyncTestCase):
+
+    def get_view(self):
+        return views.subscribe
+
+    @gen_test
+    def test_deployment_not_found(self):
+        # An error response is returned if the deployment identifier is not
+        # valid.
+        request = self.make_view_request(params={'DeploymentId': 42})
+        self.deployer.watch.return_value = None
+        response = yield self.view(request, self.deployer)
+        expected_response = {
+            'Response': {},
+            'Error': 'invalid request: deployment not found',
+        }
+        self.assertEqual(expected_response, response)
+        self.deployer.watch.assert_called_once_with(42)
+
+    @gen_test
+    def test_success(self):
+        # The response includes the watcher identifier.
+        request = self.make_view_request(params={'DeploymentId': 42})
+        self.deployer.watch.return_value = 47
+        response = yield self.view(request, self.deployer)
+        self.assertEqual({'Response': {'WatcherId': 47}}, response)
+        self.deployer.watch.assert_called_once_with(42)
+
+
 class TestNext(
         ViewsTestMixin, helpers.BundlesTestMixin, LogTrapTestCase,
         AsyncTestCase):
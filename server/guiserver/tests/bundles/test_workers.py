@@ -0,0 +1,365 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the bundle deployment worker functions."""
+
+import os
+import socket
+import unittest
+
+import mock
+from tornado.testing import LogTrapTestCase
+
+from guiserver.bundles import workers
+
+
+class TestWarmUp(unittest.TestCase):
+
+    def test_pid(self):
+        # The warm up function returns the current process id.
+        self.assertEqual(os.getpid(), workers.warm_up())
+
+    def test_close_fds(self):
+        # The given inherited file descriptors are closed.
+        reader, writer = os.pipe()
+        os.close(reader)
+        workers.warm_up([writer])
+        with self.assertRaises(OSError):
+            os.close(writer)
+
+
+class WorkersTestMixin(object):
+    """Set up a fake GUIEnvironment and clean up stored connections."""
+
+    apiurl = 'wss://api.example.com:17070'
+
+    def setUp(self):
+        patcher = mock.patch('guiserver.bundles.workers.GUIEnvironment')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(workers._connections.clear)
+
+
+class TestGetEnvironment(WorkersTestMixin, unittest.TestCase):
+
+    def test_new_connection(self):
+        # A new connection is opened the first time an environment is
+        # requested.
+        env = workers.get_environment(self.apiurl, 'user', 'passwd')
+        mock_env = workers.GUIEnvironment
+        mock_env.assert_called_once_with(self.apiurl, 'user', 'passwd')
+        self.assertEqual(mock_env(), env)
+        env.connect.assert_called_once_with()
+
+    def test_reused_connection(self):
+        # The same connection is returned for the same API URL and user.
+        env1 = workers.get_environment(self.apiurl, 'user', 'passwd')
+        env2 = workers.get_environment(self.apiurl, 'user', 'passwd')
+        self.assertIs(env1, env2)
+        self.assertEqual(1, workers.GUIEnvironment.call_count)
+        self.assertEqual(2, workers._connections[self.apiurl, 'user'].uses)
+
+    def test_different_users(self):
+        # Different users do not share connections.
+        workers.get_environment(self.apiurl, 'user1', 'passwd')
+        workers.get_environment(self.apiurl, 'user2', 'passwd')
+        self.assertEqual(2, workers.GUIEnvironment.call_count)
+
+    def test_password_changed(self):
+        # The connection is recycled if the password changes.
+        env = workers.get_environment(self.apiurl, 'user', 'passwd1')
+        workers.get_environment(self.apiurl, 'user', 'passwd2')
+        env.close.assert_called_once_with()
+        self.assertEqual(2, workers.GUIEnvironment.call_count)
+
+    def test_disconnected(self):
+        # The connection is recycled if it is no longer connected.
+        env = workers.get_environment(self.apiurl, 'user', 'passwd')
+        env.client.conn.connected = False
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        self.assertEqual(2, workers.GUIEnvironment.call_count)
+
+    def test_too_many_uses(self):
+        # The connection is recycled after too many jobs.
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        connection = workers._connections[self.apiurl, 'user']
+        connection.uses = workers.MAX_CONNECTION_USES
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        self.assertEqual(2, workers.GUIEnvironment.call_count)
+
+    def test_too_old(self):
+        # The connection is recycled when it is too old.
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        connection = workers._connections[self.apiurl, 'user']
+        connection.created -= workers.MAX_CONNECTION_AGE + 1
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        self.assertEqual(2, workers.GUIEnvironment.call_count)
+
+    def test_health_check(self):
+        # Idle connections are pinged before being reused.
+        env = workers.get_environment(self.apiurl, 'user', 'passwd')
+        connection = workers._connections[self.apiurl, 'user']
+        connection.last_used -= workers.HEALTH_CHECK_INTERVAL + 1
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        env.client.info.assert_called_once_with()
+        self.assertEqual(1, workers.GUIEnvironment.call_count)
+
+    def test_health_check_failure(self):
+        # The connection is recycled if the ping fails.
+        env = workers.get_environment(self.apiurl, 'user', 'passwd')
+        env.client.info.side_effect = ValueError('bad wolf')
+        connection = workers._connections[self.apiurl, 'user']
+        connection.last_used -= workers.HEALTH_CHECK_INTERVAL + 1
+        workers.get_environment(self.apiurl, 'user', 'passwd')
+        self.assertEqual(2, workers.GUIEnvironment.call_count)
+
+
+class TestValidate(WorkersTestMixin, unittest.TestCase):
+
+    bundle = {'services': {}}
+
+    def test_validation(self):
+        # The bundle is validated using a stored connection.
+        path = 'guiserver.bundles.workers.blocking._validate'
+        with mock.patch(path) as mock_validate:
+            workers.validate(self.apiurl, 'user', 'passwd', self.bundle)
+            workers.validate(self.apiurl, 'user', 'passwd', self.bundle)
+        env = workers.GUIEnvironment()
+        mock_validate.assert_called_with(env, self.bundle)
+        self.assertEqual(2, mock_validate.call_count)
+        self.assertEqual(1, env.connect.call_count)
+
+    def test_validation_error(self):
+        # Validation errors are propagated and the connection is preserved.
+        path = 'guiserver.bundles.workers.blocking._validate'
+        with mock.patch(path, side_effect=ValueError('bad wolf')):
+            with self.assertRaises(ValueError):
+                workers.validate(self.apiurl, 'user', 'passwd', self.bundle)
+        self.assertIn((self.apiurl, 'user'), workers._connections)
+
+    def test_connection_error(self):
+        # Broken connections are discarded.
+        path = 'guiserver.bundles.workers.blocking._validate'
+        with mock.patch(path, side_effect=socket.error('bad wolf')):
+            with self.assertRaises(socket.error):
+                workers.validate(self.apiurl, 'user', 'passwd', self.bundle)
+        self.assertNotIn((self.apiurl, 'user'), workers._connections)
+
+
+class TestBatch(WorkersTestMixin, LogTrapTestCase, unittest.TestCase):
+
+    bundles = [
+        ('bundle-v4', {'services': {'mysql': {}}}, 4),
+        ('bundle-v4', {'services': {'django': {}}}, 4),
+    ]
+
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        patcher = mock.patch('guiserver.bundles.workers._import_bundle')
+        self.mock_import_bundle = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_validate(self):
+        # The bundles are validated against the same environment status.
+        env = workers.GUIEnvironment()
+        env.status.return_value = {'services': {'django': {}}}
+        errors = workers.validate_bundles(
+            self.apiurl, 'user', 'passwd', [b for _, b, _ in self.bundles])
+        self.assertEqual(
+            [None, 'service(s) already in the environment: django'], errors)
+        env.status.assert_called_once_with()
+
+    def test_import(self):
+        # The bundles are imported using the same connection.
+        errors = workers.import_bundles(
+            self.apiurl, 'user', 'passwd', self.bundles, 'options',
+            validate=False, deployment_id=42)
+        self.assertEqual([None, None], errors)
+        env = workers.GUIEnvironment()
+        self.assertEqual(
+            [mock.call(env, 'bundle-v4', {'services': {'mysql': {}}}, 4,
+                       'options', False, 42, position=0),
+             mock.call(env, 'bundle-v4', {'services': {'django': {}}}, 4,
+                       'options', False, 42, position=1)],
+            self.mock_import_bundle.call_args_list)
+        self.assertEqual(1, env.connect.call_count)
+
+    def test_import_error(self):
+        # Errors importing a bundle do not prevent importing the next ones.
+        self.mock_import_bundle.side_effect = [ValueError('bad wolf'), None]
+        errors = workers.import_bundles(
+            self.apiurl, 'user', 'passwd', self.bundles, 'options')
+        self.assertEqual(['bad wolf', None], errors)
+        self.assertEqual(2, self.mock_import_bundle.call_count)
+
+    def test_import_connection_error(self):
+        # Connection errors stop the batch and discard the connection.
+        self.mock_import_bundle.side_effect = socket.error('bad wolf')
+        with self.assertRaises(socket.error):
+            workers.import_bundles(
+                self.apiurl, 'user', 'passwd', self.bundles, 'options')
+        self.assertEqual(1, self.mock_import_bundle.call_count)
+        self.assertNotIn((self.apiurl, 'user'), workers._connections)
+
+
+class TestApplyChanges(WorkersTestMixin, unittest.TestCase):
+
+    changes = [
+        {'id': 'addCharm-0', 'method': 'addCharm',
+         'args': ['cs:trusty/mysql-47'], 'requires': []},
+        {'id': 'deploy-1', 'method': 'deploy',
+         'args': ['$addCharm-0', 'mysql', {}, '', {}],
+         'requires': ['addCharm-0']},
+        {'id': 'expose-2', 'method': 'expose', 'args': ['$deploy-1'],
+         'requires': ['deploy-1']},
+    ]
+
+    def setUp(self):
+        super(TestApplyChanges, self).setUp()
+        self.addCleanup(workers.set_progress_connection, None)
+
+    def test_apply(self):
+        # The changes are applied in order using the API client, and a
+        # progress event is sent for each change.
+        connection = mock.Mock()
+        workers.set_progress_connection(connection)
+        report = workers.apply_changes(
+            self.apiurl, 'user', 'passwd', self.changes, deployment_id=42)
+        self.assertEqual(
+            ['CriticalPath', 'Elapsed', 'Total'], sorted(report.keys()))
+        client = workers.GUIEnvironment().client
+        client.add_charm.assert_called_once_with('cs:trusty/mysql-47')
+        client.deploy.assert_called_once_with(
+            'mysql', 'cs:trusty/mysql-47', num_units=0, config={},
+            constraints=None)
+        client.expose.assert_called_once_with('mysql')
+        events = [args[0][0] for args in connection.send.call_args_list]
+        self.assertEqual(
+            [(42, 'addCharm', 'addCharm-0'), (42, 'deploy', 'deploy-1'),
+             (42, 'expose', 'expose-2')],
+            [(i, p['Action'], p['Entity']) for i, p in events])
+
+    def test_error(self):
+        # Errors applying a change stop the process.
+        client = workers.GUIEnvironment().client
+        client.deploy.side_effect = ValueError('bad wolf')
+        with self.assertRaises(ValueError):
+            workers.apply_changes(self.apiurl, 'user', 'passwd', self.changes)
+        self.assertFalse(client.expose.called)
+
+
+class TestClientPool(WorkersTestMixin, unittest.TestCase):
+
+    change = {'id': 'expose-1', 'method': 'expose', 'args': ['mysql']}
+
+    def test_reuse(self):
+        # The environment client is used while idle.
+        env = mock.Mock()
+        pool = workers._ClientPool(env, self.apiurl, 'user', 'passwd')
+        pool.apply(self.change, {})
+        pool.apply(self.change, {})
+        self.assertEqual(2, env.client.expose.call_count)
+        self.assertFalse(workers.GUIEnvironment.called)
+
+    def test_additional_connections(self):
+        # Additional connections are opened if no clients are idle, and they
+        # are closed when the pool is closed.
+        env = mock.Mock()
+        pool = workers._ClientPool(env, self.apiurl, 'user', 'passwd')
+        clients = [pool._acquire(), pool._acquire()]
+        self.assertEqual(env.client, clients[0])
+        workers.GUIEnvironment.assert_called_once_with(
+            self.apiurl, 'user', 'passwd')
+        new_env = workers.GUIEnvironment()
+        new_env.connect.assert_called_once_with()
+        self.assertEqual(new_env.client, clients[1])
+        pool.close()
+        new_env.close.assert_called_once_with()
+        self.assertFalse(env.close.called)
+
+
+class TestProgress(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.addCleanup(workers.set_progress_connection, None)
+
+    def emit(self, action, entity, duration):
+        self.events.append((action, entity))
+
+    def test_emitter(self):
+        # Progress events are sent using the progress connection.
+        connection = mock.Mock()
+        workers.set_progress_connection(connection)
+        emit = workers._make_emitter(42)
+        emit('deploy', 'mysql', 1.23456)
+        connection.send.assert_called_once_with(
+            (42, {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1.235}))
+
+    def test_emitter_no_entity(self):
+        # The entity is omitted if not available.
+        connection = mock.Mock()
+        workers.set_progress_connection(connection)
+        workers._make_emitter(42)('add_machine', None, 1)
+        connection.send.assert_called_once_with(
+            (42, {'Action': 'add_machine', 'Duration': 1}))
+
+    def test_emitter_bundle(self):
+        # The bundle position in a batch is included if provided.
+        connection = mock.Mock()
+        workers.set_progress_connection(connection)
+        workers._make_emitter(42, bundle=1)('deploy', 'mysql', 1)
+        connection.send.assert_called_once_with(
+            (42, {'Action': 'deploy', 'Entity': 'mysql', 'Duration': 1,
+                  'Bundle': 1}))
+
+    def test_emitter_no_connection(self):
+        # Progress events are discarded if no connection is set up.
+        workers._make_emitter(42)('deploy', 'mysql', 1)
+
+    def test_emitter_error(self):
+        # Errors sending progress events are ignored.
+        connection = mock.Mock()
+        connection.send.side_effect = IOError('bad wolf')
+        workers.set_progress_connection(connection)
+        workers._make_emitter(42)('deploy', 'mysql', 1)
+
+    def test_environment(self):
+        # The progress environment emits events for changes.
+        env = mock.Mock()
+        progress_env = workers._ProgressEnvironment(env, self.emit)
+        progress_env.deploy('mysql', 'cs:trusty/mysql-42')
+        progress_env.add_units('mysql', 2)
+        progress_env.add_relation('mysql:db', 'wordpress:db')
+        progress_env.status()
+        env.deploy.assert_called_once_with('mysql', 'cs:trusty/mysql-42')
+        env.add_units.assert_called_once_with('mysql', 2)
+        env.status.assert_called_once_with()
+        expected = [
+            ('deploy', 'mysql'),
+            ('add_units', 'mysql'),
+            ('add_relation', 'mysql:db wordpress:db'),
+        ]
+        self.assertEqual(expected, self.events)
+
+    def test_importer_phases(self):
+        # The importer emits events when phases are completed.
+        importer = workers._ProgressImporter(
+            mock.Mock(), mock.Mock(), mock.Mock(), self.emit)
+        with mock.patch.object(workers.Importer, 'add_relations') as mock_add:
+            importer.add_relations()
+        mock_add.assert_called_once_with(importer)
+        self.assertEqual([('phase', 'add_relations')], self.events)
@@ -23,6 +23,7 @@ import multiprocessing
 import os
 import signal
 import StringIO as io
+import time
 import unittest
 
 import mock
@@ -119,8 +120,7 @@ class GoAPITestMixin(object):
                                  token='DEFACED', username=None,
                                  password=None):
         if username is not None and password is not None:
-            tokens._data[token] = dict(
-                username=username, password=password, handle="handle")
+            tokens._store.put(token, username, password, time.time() + 60)
         return dict(
             RequestId=request_id, Type='GUIToken', Request='Login',
             Params={'Token': token})
@@ -132,8 +132,13 @@ class BundlesTestMixin(object):
     apiurl = 'wss://api.example.com:17070'
 
     def make_deployer(self, apiversion=base.SUPPORTED_API_VERSIONS[0]):
-        """Create and return a Deployer instance."""
-        return base.Deployer(self.apiurl, apiversion)
+        """Create and return a Deployer instance.
+
+        The deployer worker processes are stopped when the test completes.
+        """
+        deployer = base.Deployer(self.apiurl, apiversion)
+        self.addCleanup(deployer.shutdown, wait=False)
+        return deployer
 
     def make_view_request(self, params=None, is_authenticated=True):
         """Create and return a mock request to be passed to bundle views.
@@ -192,17 +197,35 @@ class BundlesTestMixin(object):
         return json.dumps(data) if encoded else data
 
     def patch_validate(self, side_effect=None):
-        """Mock the blocking validate function."""
+        """Mock the worker validate function."""
         mock_validate = MultiProcessMock(side_effect=side_effect)
-        validate_path = 'guiserver.bundles.base.blocking.validate'
+        validate_path = 'guiserver.bundles.base.workers.validate'
         return mock.patch(validate_path, mock_validate)
 
     def patch_import_bundle(self, side_effect=None):
-        """Mock the blocking import_bundle function."""
+        """Mock the worker import_bundle function."""
         mock_import_bundle = MultiProcessMock(side_effect=side_effect)
-        import_bundle_path = 'guiserver.bundles.base.blocking.import_bundle'
+        import_bundle_path = 'guiserver.bundles.base.workers.import_bundle'
         return mock.patch(import_bundle_path, mock_import_bundle)
 
+    def patch_apply_changes(self, side_effect=None):
+        """Mock the worker apply_changes function."""
+        mock_apply_changes = MultiProcessMock(side_effect=side_effect)
+        apply_path = 'guiserver.bundles.base.workers.apply_changes'
+        return mock.patch(apply_path, mock_apply_changes)
+
+    def patch_validate_bundles(self, side_effect=None):
+        """Mock the worker validate_bundles function."""
+        mock_validate = MultiProcessMock(side_effect=side_effect)
+        validate_path = 'guiserver.bundles.base.workers.validate_bundles'
+        return mock.patch(validate_path, mock_validate)
+
+    def patch_import_bundles(self, side_effect=None):
+        """Mock the worker import_bundles function."""
+        mock_import_bundles = MultiProcessMock(side_effect=side_effect)
+        import_path = 'guiserver.bundles.base.workers.import_bundles'
+        return mock.patch(import_path, mock_import_bundles)
+
 
 class WSSTestMixin(object):
     """Add some helper methods for testing secure WebSocket handlers."""
@@ -16,15 +16,27 @@
 
 """Tests for the Juju GUI server applications."""
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import mock
+from tornado import wsgi
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    LogTrapTestCase,
+)
 
 from guiserver import (
     apps,
     auth,
+    clients,
     handlers,
     manage,
+    tokenstores,
 )
 from guiserver.bundles import base
 
@@ -85,6 +97,9 @@ class TestServer(AppsTestMixin, unittest.TestCase):
             'sandbox': False,
             'charmstoreurl': 'https://api.jujucharms.com/charmstore/',
             'bundleservice_url': '',
+            'deploymentsjournal': None,
+            'tokensdb': None,
+            'apiaddresses': [],
         }
         options_dict.update(kwargs)
         options = mock.Mock(**options_dict)
@@ -94,7 +109,8 @@ class TestServer(AppsTestMixin, unittest.TestCase):
     def get_gui_config(self, app):
         """Return the GUI config as a dictionary, given an app object."""
         spec = self.get_url_spec(app, r'.*$')
-        application = spec.kwargs['fallback'].wsgi_application.application
+        container = spec.kwargs['fallback'].load()
+        application = container.wsgi_application.application
         return application.registry.settings
 
     def test_auth_backend(self):
@@ -118,6 +134,17 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         deployer = self.assert_in_spec(spec, 'deployer')
         self.assertIsInstance(deployer, base.Deployer)
 
+    def test_deployer_and_connections_settings(self):
+        # The deployer and the connected handlers are stored in the settings.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws/model-api(?:/.*)?$')
+        self.assertIs(spec.kwargs['deployer'], app.settings['deployer'])
+        connections = self.assert_in_spec(spec, 'connections')
+        self.assertEqual(set(), connections)
+        self.assertIs(connections, app.settings['connections'])
+        spec = self.get_url_spec(app, r'^/ws/controller-api(?:/.*)?$')
+        self.assertIs(connections, spec.kwargs['connections'])
+
     def test_ws_templates_controller(self):
         # The WebSocket templates are properly passed to the WebSocket handler
         # managing connections to the controller.
@@ -158,6 +185,35 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         spec = self.get_url_spec(app, r'^/ws/model-api(?:/.*)?$')
         tokens = self.assert_in_spec(spec, 'tokens')
         self.assertIsInstance(tokens, auth.AuthenticationTokenHandler)
+        self.assertIsInstance(tokens._store, tokenstores.MemoryTokenStore)
+
+    def test_tokens_database(self):
+        # Tokens are stored in a database if its path is provided.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'tokens.db')
+        app = self.get_app(tokensdb=path)
+        spec = self.get_url_spec(app, r'^/ws/model-api(?:/.*)?$')
+        tokens = self.assert_in_spec(spec, 'tokens')
+        self.assertIsInstance(tokens._store, tokenstores.SQLiteTokenStore)
+        self.assertEqual(path, tokens._store.path)
+
+    def test_endpoints(self):
+        # The WebSocket handlers share the pool of controller API endpoints.
+        app = self.get_app(apiaddresses=['1.2.3.4:17070', 'example.com:17070'])
+        spec = self.get_url_spec(app, r'^/ws/controller-api(?:/.*)?$')
+        endpoints = self.assert_in_spec(spec, 'endpoints')
+        self.assertIsInstance(endpoints, clients.EndpointPool)
+        addresses = [endpoint.address for endpoint in endpoints]
+        self.assertEqual(['example.com:17070', '1.2.3.4:17070'], addresses)
+        spec = self.get_url_spec(app, r'^/ws/model-api(?:/.*)?$')
+        self.assertIs(endpoints, self.assert_in_spec(spec, 'endpoints'))
+
+    def test_endpoints_disabled(self):
+        # The endpoints pool is not used if no other addresses are provided.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws/model-api(?:/.*)?$')
+        self.assertIsNone(self.assert_in_spec(spec, 'endpoints'))
 
     def test_websocket_in_sandbox_mode(self):
         # The sandbox WebSocket handler is used if sandbox mode is enabled.
@@ -229,6 +285,151 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         config = self.get_gui_config(app)
         self.assertTrue(config['jujugui.raw'])
 
+    def test_gui_application(self):
+        # The lazy GUI application is used as fallback and stored in settings.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'.*$')
+        gui_application = self.assert_in_spec(spec, 'fallback')
+        self.assertIsInstance(gui_application, apps.GuiApplication)
+        self.assertIs(gui_application, app.settings['gui_application'])
+
+
+class TestGuiApplication(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        # Set up a GUI application.
+        self.settings = {'jujugui.sandbox': True}
+        self.gui_application = apps.GuiApplication(self.settings)
+
+    def test_not_loaded(self):
+        # The WSGI application is not built when the GUI app is created.
+        with mock.patch('jujugui.make_application') as mock_make:
+            apps.GuiApplication(self.settings)
+        self.assertFalse(mock_make.called)
+
+    def test_load(self):
+        # The WSGI application is built using the GUI settings.
+        container = self.gui_application.load()
+        self.assertIsInstance(container, wsgi.WSGIContainer)
+        settings = container.wsgi_application.application.registry.settings
+        self.assertTrue(settings['jujugui.sandbox'])
+
+    def test_load_once(self):
+        # The WSGI application is only built the first time it is required.
+        container = self.gui_application.load()
+        with mock.patch('jujugui.make_application') as mock_make:
+            self.assertIs(container, self.gui_application.load())
+        self.assertFalse(mock_make.called)
+
+    def test_load_async(self):
+        # The WSGI application can be built in a separate thread.
+        threads = []
+
+        def make_container(application):
+            threads.append(threading.current_thread())
+            return wsgi.WSGIContainer(application)
+        with mock.patch(
+                'guiserver.apps.WSGIContainer', side_effect=make_container):
+            container = self.gui_application.load_async().result()
+        self.assertIsInstance(container, wsgi.WSGIContainer)
+        self.assertIs(container, self.gui_application.load())
+        self.assertEqual(1, len(threads))
+        self.assertIsNot(threading.current_thread(), threads[0])
+
+    def test_reload(self):
+        # The WSGI application is rebuilt using the new settings.
+        self.gui_application.load()
+        self.gui_application.reload({'jujugui.sandbox': False})
+        container = self.gui_application.load()
+        settings = container.wsgi_application.application.registry.settings
+        self.assertFalse(settings['jujugui.sandbox'])
+
+    def test_reload_not_loaded(self):
+        # The WSGI application is not built when reloading if it was not
+        # loaded already.
+        with mock.patch('jujugui.make_application') as mock_make:
+            self.gui_application.reload({'jujugui.sandbox': False})
+        self.assertFalse(mock_make.called)
+        self.assertEqual(
+            {'jujugui.sandbox': False}, self.gui_application.settings)
+
+
+class TestGuiApplicationCall(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestGuiApplicationCall, self).setUp()
+        # Set up a GUI application whose WSGI container is a mock.
+        self.gui_application = apps.GuiApplication({})
+        self.container = mock.Mock(side_effect=lambda request: self.stop())
+
+    def patch_build(self, **kwargs):
+        """Patch the application build, so that the WSGI app is not loaded."""
+        kwargs.setdefault('return_value', self.container)
+        return mock.patch.object(self.gui_application, '_build', **kwargs)
+
+    def test_call(self):
+        # Requests are handled by the WSGI container.
+        request = object()
+        with self.patch_build():
+            self.gui_application.load()
+        self.gui_application(request)
+        self.container.assert_called_once_with(request)
+
+    def test_call_while_loading(self):
+        # Requests coming in while the application is being built are handled
+        # as soon as it is ready, without blocking the IO loop.
+        built = threading.Event()
+
+        def build():
+            built.wait()
+            return self.container
+        request = object()
+        with self.patch_build(side_effect=build):
+            self.gui_application(request)
+            self.assertFalse(self.container.called)
+            built.set()
+            self.wait()
+        self.container.assert_called_once_with(request)
+
+    def test_call_error(self):
+        # If the application cannot be built, queued requests are replied
+        # with a 503 error, asking clients to retry later.
+        request = mock.Mock()
+        request.finish.side_effect = self.stop
+        expected_log = 'cannot load the Juju GUI application: bad wolf'
+        with ExpectLog('', expected_log, required=True):
+            with self.patch_build(side_effect=ValueError('bad wolf')):
+                self.gui_application(request)
+                self.wait()
+        response = request.write.call_args[0][0]
+        self.assertTrue(
+            response.startswith('HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertIn('\r\nRetry-After: 10\r\n', response)
+
+    def test_load_async_in_progress(self):
+        # The future of the build in progress is returned if the application
+        # is already being built.
+        built = threading.Event()
+
+        def build():
+            built.wait()
+            return self.container
+        with self.patch_build(side_effect=build) as mock_build:
+            future = self.gui_application.load_async()
+            self.assertIs(future, self.gui_application.load_async())
+            built.set()
+            self.assertIs(self.container, future.result())
+        mock_build.assert_called_once_with()
+
+    def test_load_async_retry(self):
+        # The application is built again if the last build failed.
+        with self.patch_build(side_effect=ValueError('bad wolf')):
+            future = self.gui_application.load_async()
+            self.assertIsInstance(future.exception(), ValueError)
+        with self.patch_build():
+            container = self.gui_application.load_async().result()
+        self.assertIs(self.container, container)
+
 
 class TestRedirector(AppsTestMixin, unittest.TestCase):
 
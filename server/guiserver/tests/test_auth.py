@@ -17,12 +17,16 @@
 """Tests for the Juju GUI server authentication management."""
 
 import datetime
+import time
 import unittest
 
 import mock
 from tornado.testing import LogTrapTestCase
 
-from guiserver import auth
+from guiserver import (
+    auth,
+    tokenstores,
+)
 from guiserver.tests import helpers
 
 
@@ -143,6 +147,22 @@ class AuthMiddlewareTestMixin(object):
         self.auth.process_request(request)
         self.assertTrue(self.auth.in_progress())
 
+    def test_make_resume_request(self):
+        # The resume request logs in again the authenticated user.
+        self.auth.process_request(self.make_login_request())
+        self.auth.process_response(self.make_login_response())
+        request = self.auth.make_resume_request(47)
+        expected = self.make_login_request(request_id=47)
+        self.assertEqual(expected, request)
+        self.assertFalse(self.auth.in_progress())
+
+    def test_resume_succeeded(self):
+        # The result of the resume login is correctly reported.
+        response = self.make_login_response(request_id=47)
+        self.assertTrue(self.auth.resume_succeeded(response))
+        response = self.make_login_response(request_id=47, successful=False)
+        self.assertFalse(self.auth.resume_succeeded(response))
+
 
 class TestGoAuthMiddleware(
         helpers.GoAPITestMixin, AuthMiddlewareTestMixin,
@@ -288,14 +308,15 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         super(TestAuthenticationTokenHandler, self).setUp()
         self.io_loop = mock.Mock()
         self.max_life = datetime.timedelta(minutes=1)
+        self.store = tokenstores.MemoryTokenStore()
         self.tokens = auth.AuthenticationTokenHandler(
-            self.max_life, self.io_loop)
+            self.max_life, self.io_loop, store=self.store)
 
     def test_explicit_initialization(self):
         # The class accepted the explicit initialization.
         self.assertEqual(self.max_life, self.tokens._max_life)
         self.assertEqual(self.io_loop, self.tokens._io_loop)
-        self.assertEqual({}, self.tokens._data)
+        self.assertEqual(self.store, self.tokens._store)
 
     @mock.patch('tornado.ioloop.IOLoop.current',
                 mock.Mock(return_value='mockloop'))
@@ -305,6 +326,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             datetime.timedelta(minutes=2), tokens._max_life)
         self.assertEqual('mockloop', tokens._io_loop)
+        self.assertIsInstance(tokens._store, tokenstores.MemoryTokenStore)
 
     def test_token_requested(self):
         # It recognizes a token request.
@@ -342,20 +364,31 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
                 Expires='2013-11-21T21:01:00Z'
             )
         ))
-        self.assertTrue('DEFACED' in self.tokens._data)
-        self.assertEqual(
-            {'username', 'password', 'handle'},
-            set(self.tokens._data['DEFACED'].keys()))
         self.assertEqual(
-            user.username, self.tokens._data['DEFACED']['username'])
-        self.assertEqual(
-            user.password, self.tokens._data['DEFACED']['password'])
-        self.assertEqual(
-            self.max_life, self.io_loop.add_timeout.call_args[0][0])
-        self.assertTrue('DEFACED' in self.tokens._data)
-        expire_token = self.io_loop.add_timeout.call_args[0][1]
-        expire_token()
-        self.assertFalse('DEFACED' in self.tokens._data)
+            (user.username, user.password), self.store.pop('DEFACED'))
+        # A purge of the expired tokens is scheduled.
+        self.io_loop.add_timeout.assert_called_once_with(
+            self.max_life, self.tokens._purge)
+
+    def test_purge_scheduling(self):
+        # Only one purge at a time is scheduled.
+        user = auth.User('user-admin', 'ADMINSECRET', True)
+        data = dict(RequestId=42, Type='GUIToken', Request='Create')
+        self.tokens.process_token_request(data, user, mock.Mock())
+        self.tokens.process_token_request(data, user, mock.Mock())
+        self.assertEqual(1, self.io_loop.add_timeout.call_count)
+        # Once the purge is done, the next token schedules another one.
+        self.tokens._purge()
+        self.tokens.process_token_request(data, user, mock.Mock())
+        self.assertEqual(2, self.io_loop.add_timeout.call_count)
+
+    def test_purge(self):
+        # Expired tokens are removed from the store.
+        self.store.put('DEFACED', 'user-admin', 'ADMINSECRET', time.time())
+        self.store.put('BEEFED', 'user-admin', 'ADMINSECRET', time.time() + 60)
+        self.tokens._purge()
+        self.assertEqual(1, len(self.store))
+        self.assertIsNotNone(self.store.pop('BEEFED'))
 
     def test_unauthenticated_process_token_request(self):
         # Unauthenticated token requests get an informative error.
@@ -369,7 +402,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             ErrorCode='unauthorized access',
             Response={}
         ))
-        self.assertEqual({}, self.tokens._data)
+        self.assertEqual(0, len(self.store))
         self.assertFalse(self.io_loop.add_timeout.called)
 
     def test_authentication_requested(self):
@@ -397,8 +430,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         # It correctly responds to authentication requests with known tokens.
         username = 'user-admin'
         password = 'ADMINSECRET'
-        self.tokens._data['DEFACED'] = dict(
-            handle='handle marker', username=username, password=password)
+        self.store.put('DEFACED', username, password, time.time() + 60)
         request = dict(
             RequestId=42, Type='GUIToken', Request='Login',
             Params={'Token': 'DEFACED'})
@@ -406,9 +438,8 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             (username, password),
             self.tokens.process_authentication_request(request, write_message))
-        self.io_loop.remove_timeout.assert_called_once_with('handle marker')
         self.assertFalse(write_message.called)
-        self.assertFalse('DEFACED' in self.tokens._data)
+        self.assertEqual(0, len(self.store))
 
     def test_unknown_authentication_request(self):
         # It correctly rejects authentication requests with unknown tokens.
@@ -419,13 +450,25 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             None,
             self.tokens.process_authentication_request(request, write_message))
-        self.assertFalse(self.io_loop.remove_timeout.called)
         write_message.assert_called_once_with(dict(
             RequestId=42,
             Error='unknown, fulfilled, or expired token',
             ErrorCode='unauthorized access',
             Response={}))
 
+    def test_expired_authentication_request(self):
+        # It correctly rejects authentication requests with expired tokens.
+        self.store.put('DEFACED', 'user-admin', 'ADMINSECRET', time.time())
+        request = dict(
+            RequestId=42, Type='GUIToken', Request='Login',
+            Params={'Token': 'DEFACED'})
+        write_message = mock.Mock()
+        self.assertIsNone(
+            self.tokens.process_authentication_request(request, write_message))
+        self.assertEqual(
+            'unknown, fulfilled, or expired token',
+            write_message.call_args[0][0]['Error'])
+
     @mock.patch('uuid.uuid4', mock.Mock(return_value=mock.Mock(hex='DEFACED')))
     @helpers.patch_time
     def test_token_request_and_authentication_collaborate(self):
@@ -16,6 +16,10 @@
 
 """Tests for the Juju GUI server clients."""
 
+import socket
+import unittest
+
+import mock
 from tornado import (
     concurrent,
     web,
@@ -23,6 +27,7 @@ from tornado import (
 from tornado.testing import (
     AsyncHTTPSTestCase,
     gen_test,
+    LogTrapTestCase,
 )
 
 from guiserver import clients
@@ -84,6 +89,18 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         self.assertIn('Origin', headers)
         self.assertEqual(origin, headers['Origin'])
 
+    @gen_test
+    def test_shared_ssl_context(self):
+        # Secure connections share the same SSL context.
+        ssl_context = clients.get_ssl_context()
+        self.assertIs(ssl_context, clients.get_ssl_context())
+        handshakes = ssl_context.stats.full + ssl_context.stats.resumed
+        client = yield self.connect()
+        self.assertIs(ssl_context, client.stream.socket.context)
+        # The client handshake is recorded.
+        stats = ssl_context.stats
+        self.assertEqual(handshakes + 1, stats.full + stats.resumed)
+
     @gen_test
     def test_connection_close(self):
         # The client connection is correctly terminated.
@@ -92,3 +109,200 @@ class TestWebSocketClientConnection(AsyncHTTPSTestCase, helpers.WSSTestMixin):
         message = yield client.read_message()
         self.assertIsNone(message)
         yield self.server_closed_future
+
+
+def get_closed_address():
+    """Return a local address refusing connections."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return '127.0.0.1:{}'.format(port)
+
+
+class TestWebSocketConnectEndpoints(
+        LogTrapTestCase, AsyncHTTPSTestCase, helpers.WSSTestMixin):
+
+    def get_app(self):
+        # In this test case the WebSocket client is connected to a WebSocket
+        # echo server returning received messages.
+        self.received = []
+        options = {
+            'close_future': concurrent.Future(),
+            'io_loop': self.io_loop,
+        }
+        return web.Application([(r'/', helpers.EchoWebSocketHandler, options)])
+
+    def connect(self, endpoints, address):
+        """Return a future whose result is a connected client.
+
+        The connection URL refers to the given address.
+        """
+        url = 'wss://{}/'.format(address)
+        return clients.websocket_connect(
+            self.io_loop, url, self.received.append, endpoints=endpoints)
+
+    @gen_test
+    def test_connection(self):
+        # Connection statistics are recorded in the endpoint.
+        address = 'localhost:{}'.format(self.get_http_port())
+        endpoints = clients.EndpointPool([address])
+        client = yield self.connect(endpoints, address)
+        endpoint = list(endpoints)[0]
+        self.assertEqual(1, endpoint.sessions)
+        self.assertIsNotNone(endpoint.latency)
+        # The given callback is called when messages are received.
+        client.write_message('hello')
+        yield client.read_message()
+        self.assertEqual(['hello'], self.received)
+        # The session ends when the connection is closed.
+        client.close()
+        yield client.read_message()
+        self.assertEqual(0, endpoint.sessions)
+
+    @gen_test
+    def test_failure(self):
+        # The next endpoint is tried as soon as a connection attempt fails.
+        closed = get_closed_address()
+        address = 'localhost:{}'.format(self.get_http_port())
+        endpoints = clients.EndpointPool([closed, address])
+        failing, working = endpoints
+        # Make sure the failing endpoint is tried first.
+        working.latency = 1
+        with mock.patch('guiserver.clients.RACE_DELAY', 60):
+            client = yield self.connect(endpoints, address)
+        self.assertEqual('https://{}/'.format(address), client.request.url)
+        self.assertFalse(failing.is_healthy())
+        self.assertEqual(0, failing.sessions)
+        self.assertEqual(1, working.sessions)
+
+    @gen_test
+    def test_race(self):
+        # Only one of the racing connections is kept.
+        port = self.get_http_port()
+        addresses = ['localhost:{}'.format(port), '127.0.0.1:{}'.format(port)]
+        endpoints = clients.EndpointPool(addresses)
+        with mock.patch('guiserver.clients.RACE_DELAY', 0):
+            yield self.connect(endpoints, addresses[0])
+        self.assertEqual(1, sum(endpoint.sessions for endpoint in endpoints))
+
+    @gen_test
+    def test_all_endpoints_failing(self):
+        # The connection fails if all the endpoints fail.
+        addresses = [get_closed_address(), get_closed_address()]
+        endpoints = clients.EndpointPool(addresses)
+        with self.assertRaises(Exception):
+            yield self.connect(endpoints, addresses[0])
+        for endpoint in endpoints:
+            self.assertFalse(endpoint.is_healthy())
+
+    @gen_test
+    def test_url_not_in_pool(self):
+        # URLs not referring to an endpoint in the pool are used as they are.
+        address = 'localhost:{}'.format(self.get_http_port())
+        endpoints = clients.EndpointPool(['example.com:17070'])
+        client = yield self.connect(endpoints, address)
+        self.assertEqual('https://{}/'.format(address), client.request.url)
+        self.assertEqual(0, list(endpoints)[0].sessions)
+
+
+class TestEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoint = clients.Endpoint('1.2.3.4:17070')
+
+    def test_repr(self):
+        # The endpoint is correctly represented.
+        self.assertEqual('<Endpoint: 1.2.3.4:17070>', repr(self.endpoint))
+
+    def test_get_url(self):
+        # The given URL is modified to point to the endpoint.
+        url = self.endpoint.get_url('wss://example.com:17070/model/42/api')
+        self.assertEqual('wss://1.2.3.4:17070/model/42/api', url)
+
+    def test_latency(self):
+        # The latency is a moving average of the connection latencies.
+        self.assertIsNone(self.endpoint.latency)
+        self.endpoint.connected(1)
+        self.assertEqual(1, self.endpoint.latency)
+        self.endpoint.connected(2)
+        self.assertAlmostEqual(1 + clients.STATS_WEIGHT, self.endpoint.latency)
+
+    def test_failure_rate(self):
+        # The failure rate is a moving average of the connection results.
+        self.assertEqual(0, self.endpoint.failure_rate)
+        self.endpoint.failed()
+        self.assertAlmostEqual(
+            clients.STATS_WEIGHT, self.endpoint.failure_rate)
+        self.endpoint.connected(1)
+        expected = clients.STATS_WEIGHT * (1 - clients.STATS_WEIGHT)
+        self.assertAlmostEqual(expected, self.endpoint.failure_rate)
+
+    def test_is_healthy(self):
+        # Endpoints are not healthy for a while after a failure.
+        self.assertTrue(self.endpoint.is_healthy())
+        with mock.patch('time.time', return_value=1000):
+            self.endpoint.failed()
+            self.assertFalse(self.endpoint.is_healthy())
+        later = 1001 + clients.FAILURE_BACKOFF
+        with mock.patch('time.time', return_value=later):
+            self.assertTrue(self.endpoint.is_healthy())
+
+    def test_healthy_after_connection(self):
+        # Endpoints are healthy again after a successful connection.
+        self.endpoint.failed()
+        self.endpoint.connected(1)
+        self.assertTrue(self.endpoint.is_healthy())
+
+    def test_get_cost(self):
+        # The cost depends on the latency, failures and sessions.
+        self.assertEqual(0, self.endpoint.get_cost())
+        self.endpoint.connected(1)
+        self.assertEqual(1, self.endpoint.get_cost())
+        self.endpoint.sessions = 2
+        self.assertEqual(3, self.endpoint.get_cost())
+        self.endpoint.failed()
+        self.assertGreater(self.endpoint.get_cost(), 3)
+
+
+class TestEndpointPool(unittest.TestCase):
+
+    def setUp(self):
+        self.endpoints = clients.EndpointPool(
+            ['1.2.3.4:17070', '1.2.3.5:17070', '1.2.3.6:17070'])
+        self.first, self.second, self.third = self.endpoints
+
+    def test_endpoints(self):
+        # Duplicate addresses are ignored.
+        endpoints = clients.EndpointPool(['1.2.3.4:17070', '1.2.3.4:17070'])
+        self.assertEqual(1, len(endpoints))
+
+    def test_candidates(self):
+        # Endpoints are sorted by cost.
+        self.first.connected(3)
+        self.second.connected(1)
+        self.third.connected(2)
+        candidates = self.endpoints.candidates('wss://1.2.3.4:17070/api')
+        self.assertEqual([self.second, self.third, self.first], candidates)
+
+    def test_candidates_sessions(self):
+        # Sessions are spread across endpoints.
+        for endpoint in self.endpoints:
+            endpoint.connected(1)
+        self.first.sessions = 2
+        self.second.sessions = 1
+        candidates = self.endpoints.candidates('wss://1.2.3.4:17070/api')
+        self.assertEqual([self.third, self.second, self.first], candidates)
+
+    def test_candidates_unhealthy(self):
+        # Endpoints recently failed are tried last.
+        self.first.connected(1)
+        self.second.failed()
+        self.third.connected(2)
+        candidates = self.endpoints.candidates('wss://1.2.3.4:17070/api')
+        self.assertEqual([self.first, self.third, self.second], candidates)
+
+    def test_candidates_unknown_url(self):
+        # None is returned if the URL does not refer to a pool endpoint.
+        candidates = self.endpoints.candidates('wss://1.2.3.7:17070/api')
+        self.assertIsNone(candidates)
@@ -46,6 +46,7 @@ from guiserver import (
     get_version,
     handlers,
     manage,
+    tls,
 )
 from guiserver.bundles import base
 from guiserver.tests import helpers
@@ -70,6 +71,7 @@ class WebSocketHandlerTestMixin(object):
         self.api_close_future = concurrent.Future()
         self.deployer = base.Deployer(
             self.apiurl, manage.DEFAULT_API_VERSION, io_loop=self.io_loop)
+        self.addCleanup(self.deployer.shutdown, wait=False)
         self.tokens = auth.AuthenticationTokenHandler(io_loop=self.io_loop)
         echo_options = {
             'close_future': self.api_close_future,
@@ -217,6 +219,24 @@ class TestWebSocketHandlerConnection(
         self.assertIn('Origin', headers)
         self.assertEqual(self.get_url('/echo'), headers['Origin'])
 
+    @gen_test
+    def test_juju_connection_endpoints(self):
+        # The Juju API endpoints pool is used when connecting to Juju.
+        address = 'localhost:{}'.format(self.get_http_port())
+        endpoints = clients.EndpointPool([address])
+        handler = self.make_handler()
+        yield handler.initialize(
+            self.apiurl,
+            self.auth_backend,
+            self.deployer,
+            self.tokens,
+            apps.WEBSOCKET_MODEL_SOURCE_TEMPLATE,
+            apps.WEBSOCKET_MODEL_TARGET_TEMPLATE,
+            io_loop=self.io_loop,
+            endpoints=endpoints)
+        self.assertTrue(handler.juju_connected)
+        self.assertEqual(1, list(endpoints)[0].sessions)
+
     @gen_test
     def test_client_callback(self):
         # The WebSocket client is created passing the proper callback.
@@ -226,6 +246,64 @@ class TestWebSocketHandlerConnection(
         self.assertIn(
             handler.on_juju_message, mock_websocket_connect.call_args[0])
 
+    @gen_test
+    def test_environment_snapshot(self):
+        # Megawatcher deltas sent by Juju update the snapshot of the model.
+        with self.mock_websocket_connect():
+            handler = yield self.make_initialized_handler(
+                mock_protocol=True,
+                path='/ws/model-api/1.2.3.4/17070/my-uuid')
+        snapshot = self.deployer.get_snapshot('my-uuid')
+        deltas = [['application', 'change', {'name': 'django'}]]
+        handler.on_juju_message(json.dumps({'response': {'deltas': deltas}}))
+        self.assertTrue(snapshot.is_live)
+        self.assertEqual(set(['django']), snapshot.services)
+        # The snapshot is no longer live when the connection is closed.
+        handler.on_close()
+        self.assertFalse(snapshot.is_live)
+
+    @gen_test
+    def test_environment_snapshot_without_watcher(self):
+        # The handler does not feed the snapshot until the megawatcher starts.
+        with self.mock_websocket_connect():
+            yield self.make_initialized_handler(
+                mock_protocol=True,
+                path='/ws/model-api/1.2.3.4/17070/my-uuid')
+        snapshot = self.deployer.get_snapshot('my-uuid')
+        snapshot.update([])
+        self.assertFalse(snapshot.is_live)
+
+    @gen_test
+    def test_environment_snapshot_watcher_stopped(self):
+        # The snapshot is no longer live when the megawatcher is stopped.
+        with self.mock_websocket_connect():
+            handler = yield self.make_initialized_handler(
+                mock_protocol=True,
+                path='/ws/model-api/1.2.3.4/17070/my-uuid')
+        snapshot = self.deployer.get_snapshot('my-uuid')
+        handler.on_juju_message(json.dumps({'response': {'deltas': []}}))
+        self.assertTrue(snapshot.is_live)
+        handler.on_message(json.dumps(
+            {'RequestId': 42, 'Type': 'AllWatcher', 'Request': 'Stop'}))
+        handler.on_juju_message(json.dumps({'RequestId': 42, 'Response': {}}))
+        self.assertFalse(snapshot.is_live)
+        # The snapshot is live again when a new watcher sends deltas.
+        handler.on_juju_message(json.dumps({'response': {'deltas': []}}))
+        self.assertTrue(snapshot.is_live)
+
+    @gen_test
+    def test_environment_snapshot_juju_disconnected(self):
+        # The snapshot is no longer live when the Juju connection drops.
+        with self.mock_websocket_connect():
+            handler = yield self.make_initialized_handler(
+                mock_protocol=True,
+                path='/ws/model-api/1.2.3.4/17070/my-uuid')
+        snapshot = self.deployer.get_snapshot('my-uuid')
+        handler.on_juju_message(json.dumps({'response': {'deltas': []}}))
+        with mock.patch.object(handler, '_reconnect'):
+            handler.on_juju_message(None)
+        self.assertFalse(snapshot.is_live)
+
     @gen_test
     def test_connection_closed_by_client(self):
         # The proxy connection is terminated when the client disconnects.
@@ -233,13 +311,31 @@ class TestWebSocketHandlerConnection(
         client.close()
         yield self.api_close_future
 
+    @gen_test
+    def test_connections_tracked(self):
+        # The handler is included in the connections set while the browser
+        # is connected.
+        connections = set()
+        handler = self.make_handler()
+        yield handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, self.tokens,
+            apps.WEBSOCKET_MODEL_SOURCE_TEMPLATE,
+            apps.WEBSOCKET_MODEL_TARGET_TEMPLATE, self.io_loop,
+            connections=connections)
+        self.assertEqual(set([handler]), connections)
+        handler.on_close()
+        self.assertEqual(set(), connections)
+
     @gen_test
     def test_connection_closed_by_server(self):
-        # The proxy connection is terminated when the server disconnects.
+        # The proxy connection is terminated when the server disconnects and
+        # the session cannot be resumed, in this case because the server
+        # keeps closing the connection.
         client = yield self.make_client()
         # A server disconnection is logged as an error.
         expected_log = '.*Juju API unexpectedly disconnected'
-        with ExpectLog('', expected_log, required=True):
+        patch_delay = mock.patch('guiserver.handlers.JUJU_RECONNECT_DELAY', 0)
+        with patch_delay, ExpectLog('', expected_log, required=True):
             # Fire the Future in order to force an echo server disconnection.
             self.api_close_future.set_result(None)
             message = yield client.read_message()
@@ -435,10 +531,7 @@ class TestWebSocketHandlerAuthentication(
         # It supports authenticating with a token.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
         self.assertEqual(
             self.make_login_request(
                 request_id=42, username='user', password='passwd'),
@@ -455,10 +548,7 @@ class TestWebSocketHandlerAuthentication(
         # It correctly handles a token that will not authenticate.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
         self.send_login_response(False)
         message = self.handler.ws_connection.write_message.call_args[0][0]
         self.assertEqual(
@@ -477,6 +567,194 @@ class TestWebSocketHandlerAuthentication(
         self.assertEqual(0, len(self.handler._juju_message_queue))
 
 
+class TestWebSocketHandlerReconnection(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    watch_request = {
+        'RequestId': 2, 'Type': 'Client', 'Request': 'WatchAll', 'Params': {}}
+    next_request = {
+        'RequestId': 3, 'Type': 'AllWatcher', 'Request': 'Next', 'Id': '1'}
+    status_request = {
+        'RequestId': 4, 'Type': 'Client', 'Request': 'FullStatus'}
+
+    def make_juju_connection(self, handler, login_successful=True):
+        """Return a mock Juju API connection answering login and WatchAll.
+
+        All the requests are recorded in the returned requests list.
+        """
+        requests = []
+
+        def write_message(message):
+            data = json.loads(message)
+            requests.append(data)
+            request_id = data['RequestId']
+            if data['Type'] == 'Admin':
+                response = self.make_login_response(
+                    request_id=request_id, successful=login_successful)
+            elif data['Request'] == 'WatchAll':
+                response = {
+                    'RequestId': request_id,
+                    'Response': {'AllWatcherId': '2'},
+                }
+            else:
+                return
+            self.io_loop.add_callback(
+                handler.on_juju_message, json.dumps(response))
+
+        connection = mock.Mock()
+        connection.write_message.side_effect = write_message
+        return connection, requests
+
+    def patch_websocket_connect(self, connection):
+        """Patch the handler websocket_connect to return the connection."""
+        future = concurrent.Future()
+        future.set_result(connection)
+        return mock.patch(
+            'guiserver.handlers.websocket_connect',
+            mock.Mock(return_value=future))
+
+    def get_sent_messages(self, handler):
+        """Return the decoded messages sent by the handler to the browser."""
+        mock_write_message = handler.ws_connection.write_message
+        return [json.loads(call[0][0])
+                for call in mock_write_message.call_args_list]
+
+    @gen.coroutine
+    def make_session(self):
+        """Return a handler with an authenticated user watching the model.
+
+        The handler is connected to a mock Juju API connection, and a Next
+        request and a status request are waiting for a Juju response.
+        """
+        handler = self.make_handler(mock_protocol=True)
+        with self.patch_websocket_connect(mock.Mock()):
+            yield handler.initialize(
+                self.apiurl,
+                self.auth_backend,
+                self.deployer,
+                self.tokens,
+                apps.WEBSOCKET_MODEL_SOURCE_TEMPLATE,
+                apps.WEBSOCKET_MODEL_TARGET_TEMPLATE,
+                io_loop=self.io_loop)
+        handler.on_message(self.make_login_request(encoded=True))
+        handler.on_juju_message(self.make_login_response(encoded=True))
+        handler.on_message(json.dumps(self.watch_request))
+        handler.on_juju_message(
+            json.dumps({'RequestId': 2, 'Response': {'AllWatcherId': '1'}}))
+        handler.on_message(json.dumps(self.next_request))
+        handler.on_message(json.dumps(self.status_request))
+        handler.ws_connection.write_message.reset_mock()
+        raise gen.Return(handler)
+
+    @gen.coroutine
+    def disconnect(self, handler, connection):
+        """Drop the Juju API connection and wait for the session resume.
+
+        The connection is used when reconnecting to Juju.
+        """
+        with self.patch_websocket_connect(connection):
+            with mock.patch('guiserver.handlers.JUJU_RECONNECT_DELAY', 0):
+                handler.on_juju_message(None)
+                self.assertFalse(handler.juju_connected)
+                while handler._reconnecting:
+                    yield gen.Task(self.io_loop.add_callback)
+
+    @gen_test
+    def test_session_resumed(self):
+        # The user is logged in again and the megawatcher is restarted.
+        handler = yield self.make_session()
+        connection, requests = self.make_juju_connection(handler)
+        yield self.disconnect(handler, connection)
+        self.assertTrue(handler.connected)
+        self.assertTrue(handler.juju_connected)
+        self.assertEqual(connection, handler.juju_connection)
+        self.assertEqual(3, len(requests))
+        login, watch, next_request = requests
+        self.assertEqual('Login', login['Request'])
+        self.assertEqual(
+            {'AuthTag': 'user', 'Password': 'passwd'}, login['Params'])
+        self.assertEqual('WatchAll', watch['Request'])
+        # The pending Next request is sent again to the new watcher.
+        self.assertEqual(dict(self.next_request, Id='2'), next_request)
+
+    @gen_test
+    def test_internal_responses_not_forwarded(self):
+        # The browser only receives errors for the requests lost with the
+        # connection, and not the responses to the resume requests.
+        handler = yield self.make_session()
+        connection, _ = self.make_juju_connection(handler)
+        yield self.disconnect(handler, connection)
+        messages = self.get_sent_messages(handler)
+        self.assertEqual(1, len(messages))
+        self.assertEqual(4, messages[0]['RequestId'])
+        self.assertIn('Error', messages[0])
+
+    @gen_test
+    def test_requests_redirected(self):
+        # Requests sent after the session is resumed refer to the new watcher.
+        handler = yield self.make_session()
+        connection, requests = self.make_juju_connection(handler)
+        yield self.disconnect(handler, connection)
+        request = dict(self.next_request, RequestId=5)
+        handler.on_message(json.dumps(request))
+        self.assertEqual(dict(request, Id='2'), requests[-1])
+
+    @gen_test
+    def test_queued_messages(self):
+        # Messages sent while reconnecting are sent to the new connection.
+        handler = yield self.make_session()
+        connection, requests = self.make_juju_connection(handler)
+        request = dict(self.next_request, RequestId=5)
+        with self.patch_websocket_connect(connection):
+            with mock.patch('guiserver.handlers.JUJU_RECONNECT_DELAY', 0):
+                handler.on_juju_message(None)
+                handler.on_message(json.dumps(request))
+                self.assertEqual(1, len(handler._juju_message_queue))
+                while handler._reconnecting:
+                    yield gen.Task(self.io_loop.add_callback)
+        self.assertEqual(0, len(handler._juju_message_queue))
+        self.assertEqual(dict(request, Id='2'), requests[-1])
+
+    @gen_test
+    def test_login_failure(self):
+        # The browser is disconnected if the user cannot log in again.
+        handler = yield self.make_session()
+        connection, requests = self.make_juju_connection(
+            handler, login_successful=False)
+        ws_connection = handler.ws_connection
+        expected_log = '.*unable to log in again'
+        with ExpectLog('', expected_log, required=True):
+            yield self.disconnect(handler, connection)
+        self.assertEqual(1, len(requests))
+        self.assertFalse(handler.juju_connected)
+        ws_connection.close.assert_called_once_with()
+
+    @gen_test
+    def test_login_in_progress(self):
+        # A login request lost with the connection does not leave the
+        # authentication in progress.
+        handler = self.make_handler(mock_protocol=True)
+        with self.patch_websocket_connect(mock.Mock()):
+            yield handler.initialize(
+                self.apiurl,
+                self.auth_backend,
+                self.deployer,
+                self.tokens,
+                apps.WEBSOCKET_MODEL_SOURCE_TEMPLATE,
+                apps.WEBSOCKET_MODEL_TARGET_TEMPLATE,
+                io_loop=self.io_loop)
+        handler.on_message(self.make_login_request(encoded=True))
+        self.assertTrue(handler.auth.in_progress())
+        connection, _ = self.make_juju_connection(handler)
+        yield self.disconnect(handler, connection)
+        self.assertFalse(handler.auth.in_progress())
+        self.assertFalse(handler.user.is_authenticated)
+        message = self.get_sent_messages(handler)[0]
+        self.assertEqual(42, message['RequestId'])
+        self.assertIn('Error', message)
+
+
 class TestWebSocketHandlerBundles(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin,
         helpers.BundlesTestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
@@ -864,6 +1142,7 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
     def get_app(self):
         mock_deployer = mock.Mock()
         mock_deployer.status.return_value = 'deployments status'
+        mock_deployer.history.return_value = {'completed': 47}
         options = {
             'apiurl': 'wss://api.example.com:17070',
             'apiversion': 'clojure',
@@ -871,6 +1150,7 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
             'sandbox': False,
             'start_time': 10,
         }
+        self.info_options = options
         return web.Application([(r'^/info', handlers.InfoHandler, options)])
 
     @mock.patch('time.time', mock.Mock(return_value=52))
@@ -881,7 +1161,10 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
             'apiversion': 'clojure',
             'debug': False,
             'deployer': 'deployments status',
+            'deployerhistory': {'completed': 47},
             'sandbox': False,
+            'tls': None,
+            'tlsclient': clients.get_ssl_context().stats.to_dict(),
             'uptime': 42,
             'version': get_version(),
         }
@@ -893,6 +1176,15 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
         info = escape.json_decode(response.body)
         self.assertEqual(expected, info)
 
+    def test_tls_stats(self):
+        # TLS handshake statistics are included if provided.
+        stats = tls.HandshakeStats()
+        stats.add(False, 0.1)
+        self.info_options['tls_stats'] = stats
+        response = self.fetch('/info')
+        info = escape.json_decode(response.body)
+        self.assertEqual(stats.to_dict(), info['tls'])
+
 
 class TestHttpsRedirectHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
@@ -18,11 +18,17 @@
 
 from contextlib import contextmanager
 import logging
-import ssl
+import signal
 import unittest
 
+from concurrent.futures import Future
 import mock
-from tornado.testing import LogTrapTestCase
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    gen_test,
+    LogTrapTestCase,
+)
 
 from guiserver import manage
 
@@ -152,31 +158,8 @@ class TestValidateRange(ValidatorTestMixin, unittest.TestCase):
             manage._validate_range('arg1', *self.value_range)
 
 
-class TestGetSslOptions(unittest.TestCase):
-
-    mock_options = mock.Mock(sslpath='/my/path')
-
-    def test_options(self):
-        # The SSL options are correctly returned.
-        expected = {
-            'certfile': '/my/path/juju.crt',
-            'keyfile': '/my/path/juju.key',
-            'ssl_version': ssl.PROTOCOL_SSLv23,
-            'ciphers': manage.CIPHERS,
-        }
-        with mock.patch('guiserver.manage.options', self.mock_options):
-            self.assertEqual(expected, manage._get_ssl_options())
-
-
 class TestRun(LogTrapTestCase, unittest.TestCase):
 
-    expected_ssl_options = {
-        'certfile': '/my/sslpath/juju.crt',
-        'keyfile': '/my/sslpath/juju.key',
-        'ssl_version': ssl.PROTOCOL_SSLv23,
-        'ciphers': manage.CIPHERS,
-    }
-
     def mock_and_run(self, **kwargs):
         """Run the application after mocking the IO loop and the options/apps.
 
@@ -184,49 +167,343 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         """
         options = {
             'apiversion': 'go',
+            'configfile': None,
             'port': None,
             'sslpath': '/my/sslpath',
         }
         options.update(kwargs)
+        self.sockets = {}
         with \
                 mock.patch('guiserver.manage.IOLoop') as ioloop, \
                 mock.patch('guiserver.manage.options', mock.Mock(**options)), \
                 mock.patch('guiserver.manage.redirector') as redirector, \
-                mock.patch('guiserver.manage.server') as server:
+                mock.patch('guiserver.manage.server') as server, \
+                mock.patch('guiserver.manage.bind_sockets') as bind_sockets, \
+                mock.patch('guiserver.manage.HTTPServer') as http_server, \
+                mock.patch('guiserver.manage.ServerTLS') as server_tls, \
+                mock.patch('guiserver.manage.signal.signal') as mock_signal:
+            bind_sockets.side_effect = self.make_sockets
             manage.run()
-        return ioloop.instance().start, redirector().listen, server().listen
+        self.ioloop, self.server = ioloop.instance(), server
+        self.signal = mock_signal
+        self.bind_sockets, self.http_server = bind_sockets, http_server
+        self.server_tls = server_tls
+        return redirector
+
+    def make_sockets(self, port):
+        """Return a list including a mock socket bound to the given port."""
+        sock = mock.Mock()
+        sock.fileno.return_value = port
+        return self.sockets.setdefault(port, [sock])
+
+    def assert_http_server(self, port):
+        """Ensure the HTTP server has been started on the given port."""
+        self.server.assert_called_once_with()
+        self.http_server.assert_called_once_with(self.server())
+        self.assert_listening(port)
+        self.assertFalse(self.server_tls.called)
+
+    def assert_https_server(self, port):
+        """Ensure the HTTPS server has been started on the given port."""
+        self.server_tls.assert_called_once_with('/my/sslpath')
+        server_tls = self.server_tls()
+        self.server.assert_called_once_with(tls_stats=server_tls.stats)
+        self.http_server.assert_any_call(
+            self.server(), ssl_options=server_tls.context)
+        self.assert_listening(port)
+        https_server = self.http_server()
+        server_tls.add_server.assert_called_once_with(https_server)
+        server_tls.start.assert_called_once_with()
+
+    def assert_listening(self, port):
+        """Ensure the server listens on sockets bound to the given port."""
+        self.bind_sockets.assert_any_call(port)
+        self.http_server().add_sockets.assert_any_call(self.sockets[port])
+
+    def assert_redirecting(self, redirector):
+        """Ensure HTTP requests on port 80 are redirected to HTTPS."""
+        self.http_server.assert_any_call(redirector())
+        self.assert_listening(80)
 
     def test_secure_mode(self):
         # The application is correctly run in secure mode.
-        _, redirector_listen, server_listen = self.mock_and_run(insecure=False)
-        redirector_listen.assert_called_once_with(80)
-        server_listen.assert_called_once_with(
-            443, ssl_options=self.expected_ssl_options)
+        redirector = self.mock_and_run(insecure=False)
+        self.assert_redirecting(redirector)
+        self.assert_https_server(443)
 
     def test_insecure_mode(self):
         # The application is correctly run in insecure mode.
-        _, redirector_listen, server_listen = self.mock_and_run(insecure=True)
-        self.assertFalse(redirector_listen.called)
-        server_listen.assert_called_once_with(80)
+        redirector = self.mock_and_run(insecure=True)
+        self.assertFalse(redirector.called)
+        self.assert_http_server(80)
 
     def test_customized_port_secure_mode(self):
         # If the user provided a port, the server starts listening on that port
         # and the redirector is not used.
-        _, redirector_listen, server_listen = self.mock_and_run(
-            insecure=False, port=8080)
-        self.assertFalse(redirector_listen.called)
-        server_listen.assert_called_once_with(
-            8080, ssl_options=self.expected_ssl_options)
+        redirector = self.mock_and_run(insecure=False, port=8080)
+        self.assertFalse(redirector.called)
+        self.assertEqual([8080], self.sockets.keys())
+        self.assert_https_server(8080)
 
     def test_customized_port_insecure_mode(self):
         # The application is correctly run in insecure mode with a user
         # provided port.
-        _, redirector_listen, server_listen = self.mock_and_run(
-            insecure=True, port=12345)
-        self.assertFalse(redirector_listen.called)
-        server_listen.assert_called_once_with(12345)
+        redirector = self.mock_and_run(insecure=True, port=12345)
+        self.assertFalse(redirector.called)
+        self.assert_http_server(12345)
+
+    def test_sockets_bound_first(self):
+        # The listening sockets are bound before the server application is
+        # set up, so that connections are queued in the meanwhile.
+        manager = mock.MagicMock()
+        self.sockets = {}
+        manager.bind_sockets.side_effect = self.make_sockets
+        with \
+                mock.patch('guiserver.manage.IOLoop'), \
+                mock.patch('guiserver.manage.options',
+                           mock.Mock(port=80, configfile=None)), \
+                mock.patch('guiserver.manage.server', manager.server), \
+                mock.patch('guiserver.manage.bind_sockets',
+                           manager.bind_sockets), \
+                mock.patch('guiserver.manage.HTTPServer'), \
+                mock.patch('guiserver.manage.ServerTLS'), \
+                mock.patch('guiserver.manage.signal.signal'):
+            manage.run()
+        calls = [call[0] for call in manager.mock_calls]
+        self.assertLess(calls.index('bind_sockets'), calls.index('server'))
+
+    def test_workers_close_sockets(self):
+        # The deployer worker processes are spawned right away, and they
+        # close the listening sockets they inherit.
+        self.mock_and_run(insecure=False)
+        deployer = self.server().settings['deployer']
+        deployer.warm_up.assert_called_once_with([443, 80])
+
+    def test_gui_application_loaded(self):
+        # The GUI application is loaded in a separate thread, and loading
+        # errors are reported in the IO loop.
+        self.mock_and_run()
+        gui_application = self.server().settings['gui_application']
+        gui_application.load_async.assert_called_once_with()
+        self.ioloop.add_future.assert_called_once_with(
+            gui_application.load_async(), manage._gui_application_loaded)
 
     def test_ioloop_started(self):
         # The IO loop instance is started when the application is run.
-        ioloop_start, _, _ = self.mock_and_run()
-        ioloop_start.assert_called_once_with()
+        self.mock_and_run()
+        self.ioloop.start.assert_called_once_with()
+
+    def get_signal_handler(self, signum):
+        """Return the handler registered for the given signal.
+
+        Return None if the signal is not handled.
+        """
+        for call in self.signal.call_args_list:
+            if call[0][0] == signum:
+                return call[0][1]
+        return None
+
+    def test_reload_on_sighup(self):
+        # If a config file is provided, options are reloaded on SIGHUP.
+        self.mock_and_run(configfile='/my/config')
+        handler = self.get_signal_handler(signal.SIGHUP)
+        # The reload is scheduled in the IO loop.
+        handler(signal.SIGHUP, None)
+        self.ioloop.add_callback_from_signal.assert_called_once_with(
+            manage._reload, self.server())
+
+    def test_no_reload_without_config_file(self):
+        # The SIGHUP signal is not handled if a config file is not provided.
+        self.mock_and_run()
+        self.assertIsNone(self.get_signal_handler(signal.SIGHUP))
+
+    def test_drain_on_sigterm(self):
+        # The server is drained when a SIGTERM signal is received.
+        self.mock_and_run(draintimeout=42)
+        handler = self.get_signal_handler(signal.SIGTERM)
+        # The drain is scheduled in the IO loop.
+        handler(signal.SIGTERM, None)
+        self.ioloop.add_callback_from_signal.assert_called_once_with(
+            manage._drain, self.server(), self.http_server(), 42)
+
+
+class TestGuiApplicationLoaded(LogTrapTestCase, unittest.TestCase):
+
+    def test_loaded(self):
+        # No errors are logged if the GUI application is loaded.
+        future = Future()
+        future.set_result('container')
+        with mock.patch('guiserver.manage.logging.error') as mock_error:
+            manage._gui_application_loaded(future)
+        self.assertFalse(mock_error.called)
+
+    def test_error(self):
+        # Errors occurred while loading the GUI application are logged.
+        future = Future()
+        future.set_exception(ImportError('bad wolf'))
+        expected_log = 'cannot load the Juju GUI application: bad wolf'
+        with ExpectLog('', expected_log, required=True):
+            manage._gui_application_loaded(future)
+
+
+class TestDrain(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestDrain, self).setUp()
+        # Set up a mock server and application.
+        self.http_server = mock.Mock()
+        self.deployer = mock.Mock(draining=False)
+        self.deployer.is_busy.return_value = False
+        self.handlers = [mock.Mock(), mock.Mock()]
+        self.app = mock.Mock(settings={
+            'connections': set(self.handlers),
+            'deployer': self.deployer,
+        })
+        # Do not wait for real while draining.
+        self.patch('guiserver.manage.DRAIN_RECONNECT_SPREAD', 0.05)
+        self.patch('guiserver.manage.DRAIN_POLL_INTERVAL', 0.01)
+        # Stopping the IO loop is only simulated.
+        self.mock_io_loop = mock.Mock(add_timeout=self.io_loop.add_timeout)
+
+    def patch(self, target, value):
+        """Patch the given target with the given value for the test."""
+        patcher = mock.patch(target, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @gen_test
+    def test_drain(self):
+        # The server stops accepting connections, handlers are closed and
+        # the IO loop is stopped.
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        self.http_server.stop.assert_called_once_with()
+        for handler in self.handlers:
+            handler.close.assert_called_once_with()
+        self.deployer.shutdown.assert_called_once_with(wait=False)
+        self.mock_io_loop.stop.assert_called_once_with()
+
+    @gen_test
+    def test_deployer_drained(self):
+        # The deployer stops accepting new deployments before the server
+        # waits for the running ones.
+        def is_busy():
+            self.deployer.drain.assert_called_once_with()
+            return False
+        self.deployer.is_busy.side_effect = is_busy
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        self.assertTrue(self.deployer.is_busy.called)
+
+    @gen_test
+    def test_already_draining(self):
+        # Nothing happens if the server is already being drained, e.g. when
+        # more than one SIGTERM signal is received.
+        self.deployer.draining = True
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        self.assertFalse(self.deployer.drain.called)
+        self.assertFalse(self.http_server.stop.called)
+        self.assertFalse(self.mock_io_loop.stop.called)
+
+    @gen_test
+    def test_wait_for_deployments(self):
+        # The server waits for the running deployments to complete.
+        self.deployer.is_busy.side_effect = [True, True, False, False]
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        self.assertEqual(4, self.deployer.is_busy.call_count)
+        self.mock_io_loop.stop.assert_called_once_with()
+
+    @gen_test
+    def test_serve_while_waiting_for_deployments(self):
+        # Connections are accepted and handlers are left open while the
+        # running deployments complete.
+        def is_busy():
+            self.assertFalse(self.http_server.stop.called)
+            for handler in self.handlers:
+                self.assertFalse(handler.close.called)
+            return self.deployer.is_busy.call_count < 3
+        self.deployer.is_busy.side_effect = is_busy
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        self.http_server.stop.assert_called_once_with()
+        for handler in self.handlers:
+            handler.close.assert_called_once_with()
+
+    @gen_test
+    def test_handlers_connected_while_draining(self):
+        # Handlers connected while waiting for the deployments are closed.
+        handler = mock.Mock()
+
+        def is_busy():
+            self.app.settings['connections'].add(handler)
+            return self.deployer.is_busy.call_count < 2
+        self.deployer.is_busy.side_effect = is_busy
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        handler.close.assert_called_once_with()
+
+    @gen_test
+    def test_timeout(self):
+        # The server is stopped when the timeout expires even if deployments
+        # are still running.
+        self.deployer.is_busy.return_value = True
+        yield manage._drain(
+            self.app, self.http_server, 0.1, io_loop=self.mock_io_loop)
+        for handler in self.handlers:
+            handler.close.assert_called_once_with()
+        self.deployer.shutdown.assert_called_once_with(wait=False)
+        self.mock_io_loop.stop.assert_called_once_with()
+
+    @gen_test
+    def test_no_connections(self):
+        # The server is stopped right away if no handlers are connected and
+        # no deployments are running.
+        self.app.settings['connections'] = set()
+        self.patch('guiserver.manage.DRAIN_RECONNECT_SPREAD', 10)
+        yield manage._drain(
+            self.app, self.http_server, 10, io_loop=self.mock_io_loop)
+        self.mock_io_loop.stop.assert_called_once_with()
+
+    @gen_test
+    def test_no_timeout(self):
+        # The server is stopped right away if the timeout is 0.
+        self.deployer.is_busy.return_value = True
+        yield manage._drain(
+            self.app, self.http_server, 0, io_loop=self.mock_io_loop)
+        self.http_server.stop.assert_called_once_with()
+        self.mock_io_loop.stop.assert_called_once_with()
+
+
+class TestReload(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        # Set up a mock server application.
+        self.app = mock.Mock(settings={'gui_application': mock.Mock()})
+
+    def reload(self, side_effect=None):
+        """Reload the options and return the mock config file parser."""
+        options = mock.Mock(configfile='/my/config')
+        with \
+                mock.patch('guiserver.manage.options', options), \
+                mock.patch('guiserver.manage.parse_config_file',
+                           side_effect=side_effect) as mock_parse, \
+                mock.patch('guiserver.manage.get_gui_settings',
+                           return_value={'jujugui.gtm': True}):
+            manage._reload(self.app)
+        return mock_parse
+
+    def test_reload(self):
+        # The GUI application is reloaded using the new options.
+        mock_parse = self.reload()
+        mock_parse.assert_called_once_with('/my/config', final=False)
+        gui_application = self.app.settings['gui_application']
+        gui_application.reload.assert_called_once_with({'jujugui.gtm': True})
+
+    def test_error(self):
+        # The GUI application is left untouched if the config file is not
+        # valid.
+        self.reload(side_effect=SyntaxError('bad wolf'))
+        gui_application = self.app.settings['gui_application']
+        self.assertFalse(gui_application.reload.called)
@@ -0,0 +1,220 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for the Juju GUI server Juju API session resumption."""
+
+import unittest
+
+from guiserver import sessions
+
+
+def make_watch_request(request_id=1):
+    """Return a request starting the megawatcher."""
+    return {
+        'RequestId': request_id,
+        'Type': 'Client',
+        'Request': 'WatchAll',
+        'Params': {},
+    }
+
+
+def make_watch_response(request_id=1, watcher_id='1'):
+    """Return a WatchAll response including the given watcher id."""
+    return {'RequestId': request_id, 'Response': {'AllWatcherId': watcher_id}}
+
+
+def make_next_request(request_id=2, watcher_id='1'):
+    """Return a request for the next megawatcher deltas."""
+    return {
+        'RequestId': request_id,
+        'Type': 'AllWatcher',
+        'Request': 'Next',
+        'Id': watcher_id,
+        'Params': {},
+    }
+
+
+def make_status_request(request_id=3):
+    """Return a request which is not related to the megawatcher."""
+    return {'RequestId': request_id, 'Type': 'Client', 'Request': 'Status'}
+
+
+class TestResumeMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.resume = sessions.ResumeMiddleware()
+
+    def watch(self, watcher_id='1'):
+        """Start the megawatcher with the given id."""
+        self.resume.process_request(make_watch_request())
+        self.resume.process_response(make_watch_response(
+            watcher_id=watcher_id))
+
+    def resume_watcher(self, watcher_id='2'):
+        """Simulate a disconnection and restart the megawatcher."""
+        responses = self.resume.disconnected()
+        request = self.resume.make_watch_request(100)
+        self.assertTrue(self.resume.watcher_resumed(make_watch_response(
+            request_id=request['RequestId'], watcher_id=watcher_id)))
+        return responses
+
+    def test_not_watching(self):
+        # The megawatcher is not started by default.
+        self.assertFalse(self.resume.watching)
+        self.assertIsNone(self.resume.make_watch_request(100))
+
+    def test_watching(self):
+        # The megawatcher is tracked when Juju responds to WatchAll.
+        self.resume.process_request(make_watch_request())
+        self.assertFalse(self.resume.watching)
+        self.resume.process_response(make_watch_response())
+        self.assertTrue(self.resume.watching)
+
+    def test_watch_failure(self):
+        # The megawatcher is not tracked if Juju returns an error.
+        self.resume.process_request(make_watch_request())
+        response = make_watch_response()
+        response['Error'] = 'bad wolf'
+        self.resume.process_response(response)
+        self.assertFalse(self.resume.watching)
+
+    def test_watcher_id_juju2(self):
+        # The Juju 2 watcher id format is supported.
+        self.resume.process_request(make_watch_request())
+        self.resume.process_response(
+            {'RequestId': 1, 'Response': {'watcher-id': '1'}})
+        self.assertTrue(self.resume.watching)
+
+    def test_requests_not_modified(self):
+        # Requests are returned untouched while the session is not resumed.
+        self.watch()
+        for request in (make_next_request(), make_status_request()):
+            self.assertIs(request, self.resume.process_request(request))
+
+    def test_requests_without_id(self):
+        # Requests without a request id are not tracked.
+        request = {'Type': 'Client', 'Request': 'Status'}
+        self.assertIs(request, self.resume.process_request(request))
+        self.assertEqual([], self.resume.disconnected())
+
+    def test_disconnected(self):
+        # Error responses are returned for the requests lost with the
+        # connection, except for the pending Next requests.
+        self.watch()
+        self.resume.process_request(make_next_request())
+        self.resume.process_request(make_status_request())
+        responses = self.resume.disconnected()
+        self.assertEqual([{
+            'RequestId': 3,
+            'Error': sessions.LOST_REQUEST_ERROR,
+            'ErrorCode': '',
+            'Response': {},
+        }], responses)
+
+    def test_answered_requests(self):
+        # Requests already answered by Juju are not reported as lost.
+        self.resume.process_request(make_status_request())
+        self.resume.process_response({'RequestId': 3, 'Response': {}})
+        self.assertEqual([], self.resume.disconnected())
+
+    def test_answered_request_returned(self):
+        # The request answered by a response is returned.
+        request = make_status_request()
+        self.resume.process_request(request)
+        response = {'RequestId': 3, 'Error': 'bad wolf'}
+        self.assertIs(request, self.resume.process_response(response))
+        self.assertIsNone(self.resume.process_response(response))
+
+    def test_make_watch_request(self):
+        # The request starting the new watcher has the given request id.
+        self.watch()
+        request = self.resume.make_watch_request(100)
+        self.assertEqual(make_watch_request(request_id=100), request)
+
+    def test_watcher_resume_failure(self):
+        # Failures in restarting the megawatcher are reported.
+        self.watch()
+        response = make_watch_response(request_id=100)
+        response['Error'] = 'bad wolf'
+        self.assertFalse(self.resume.watcher_resumed(response))
+
+    def test_pending_requests(self):
+        # The pending Next requests are redirected to the resumed watcher.
+        self.watch()
+        self.resume.process_request(make_next_request())
+        self.resume.process_request(make_status_request())
+        self.resume_watcher()
+        requests = self.resume.pending_requests()
+        self.assertEqual([make_next_request(watcher_id='2')], requests)
+        # Pending requests are only returned once.
+        self.assertEqual([], self.resume.pending_requests())
+
+    def test_pending_requests_after_disconnection(self):
+        # Requests sent while reconnecting are not returned as pending.
+        self.watch()
+        self.resume.disconnected()
+        self.resume.process_request(make_next_request())
+        self.assertEqual([], self.resume.pending_requests())
+
+    def test_redirect(self):
+        # Next requests are redirected to the resumed watcher.
+        self.watch()
+        self.resume_watcher()
+        request = self.resume.process_request(make_next_request())
+        self.assertEqual(make_next_request(watcher_id='2'), request)
+
+    def test_redirect_other_requests(self):
+        # Requests not referring to the client watcher are not redirected.
+        self.watch()
+        self.resume_watcher()
+        for request in (make_status_request(), make_next_request(
+                watcher_id='47')):
+            self.assertIs(request, self.resume.process_request(request))
+
+    def test_multiple_resumes(self):
+        # Requests are always redirected to the last resumed watcher.
+        self.watch()
+        self.resume_watcher()
+        self.resume_watcher(watcher_id='3')
+        request = self.resume.process_request(make_next_request())
+        self.assertEqual(make_next_request(watcher_id='3'), request)
+
+
+class TestStopsWatcher(unittest.TestCase):
+
+    def test_stop_request(self):
+        # The watcher is stopped by the client.
+        request = {'RequestId': 4, 'Type': 'AllWatcher', 'Request': 'Stop'}
+        response = {'RequestId': 4, 'Response': {}}
+        self.assertTrue(sessions.stops_watcher(request, response))
+
+    def test_next_error(self):
+        # The watcher is stopped if a Next request fails.
+        response = {'RequestId': 2, 'Error': 'watcher was stopped'}
+        self.assertTrue(sessions.stops_watcher(make_next_request(), response))
+
+    def test_next_success(self):
+        # The watcher is still running if a Next request succeeds.
+        response = {'RequestId': 2, 'Response': {'Deltas': []}}
+        self.assertFalse(sessions.stops_watcher(make_next_request(), response))
+
+    def test_other_requests(self):
+        # Other requests do not affect the watcher.
+        response = {'RequestId': 3, 'Error': 'bad wolf'}
+        self.assertFalse(
+            sessions.stops_watcher(make_status_request(), response))
+        self.assertFalse(sessions.stops_watcher(None, response))
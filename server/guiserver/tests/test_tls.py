@@ -0,0 +1,234 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests for the Juju GUI server TLS support."""
+
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+import unittest
+
+import mock
+import tornado
+from tornado import (
+    iostream,
+    web,
+)
+from tornado.testing import (
+    AsyncHTTPSTestCase,
+    LogTrapTestCase,
+)
+
+from guiserver import tls
+
+
+def make_ssl_path(test_case):
+    """Create and return an SSL path including a certificate and its key.
+
+    The directory is removed when the given test case completes.
+    """
+    path = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, path)
+    tornado_tests = os.path.join(os.path.dirname(tornado.__file__), 'test')
+    shutil.copy(
+        os.path.join(tornado_tests, 'test.crt'),
+        os.path.join(path, tls.CERTFILE))
+    shutil.copy(
+        os.path.join(tornado_tests, 'test.key'),
+        os.path.join(path, tls.KEYFILE))
+    return path
+
+
+class TestMakeServerContext(unittest.TestCase):
+
+    load_cert_chain = 'guiserver.tls.StatsContext.load_cert_chain'
+
+    def setUp(self):
+        self.ssl_path = make_ssl_path(self)
+
+    def test_context(self):
+        # The context is correctly set up.
+        context = tls.make_server_context(self.ssl_path)
+        self.assertIsInstance(context, tls.StatsContext)
+        self.assertEqual(ssl.PROTOCOL_SSLv23, context.protocol)
+        self.assertTrue(context.options & ssl.OP_NO_SSLv3)
+        self.assertTrue(context.options & ssl.OP_NO_COMPRESSION)
+        self.assertTrue(context.options & ssl.OP_CIPHER_SERVER_PREFERENCE)
+
+    def test_certificates(self):
+        # The RSA certificate is loaded.
+        with mock.patch(self.load_cert_chain) as mock_load:
+            tls.make_server_context(self.ssl_path)
+        mock_load.assert_called_once_with(
+            os.path.join(self.ssl_path, tls.CERTFILE),
+            os.path.join(self.ssl_path, tls.KEYFILE))
+
+    def test_ecdsa_certificates(self):
+        # The ECDSA certificate is also loaded if present.
+        certfile = os.path.join(self.ssl_path, tls.ECDSA_CERTFILE)
+        open(certfile, 'w').close()
+        with mock.patch(self.load_cert_chain) as mock_load:
+            tls.make_server_context(self.ssl_path)
+        self.assertEqual(2, mock_load.call_count)
+        mock_load.assert_called_with(
+            certfile, os.path.join(self.ssl_path, tls.ECDSA_KEYFILE))
+
+
+class TestMakeClientContext(unittest.TestCase):
+
+    def test_context(self):
+        # The context is correctly set up.
+        context = tls.make_client_context()
+        self.assertIsInstance(context, tls.StatsContext)
+        self.assertIsInstance(context.stats, tls.HandshakeStats)
+        self.assertEqual(ssl.CERT_NONE, context.verify_mode)
+        self.assertTrue(context.options & ssl.OP_NO_SSLv3)
+        self.assertTrue(context.options & ssl.OP_NO_COMPRESSION)
+
+
+class TestHandshakeStats(unittest.TestCase):
+
+    def test_no_handshakes(self):
+        # Statistics are empty if no handshakes were recorded.
+        expected = {
+            'full': 0,
+            'full_avg_ms': 0,
+            'resumed': 0,
+            'resumed_avg_ms': 0,
+        }
+        self.assertEqual(expected, tls.HandshakeStats().to_dict())
+
+    def test_handshakes(self):
+        # Full and resumed handshakes are recorded separately.
+        stats = tls.HandshakeStats()
+        stats.add(False, 0.1)
+        stats.add(False, 0.2)
+        stats.add(True, 0.01)
+        expected = {
+            'full': 2,
+            'full_avg_ms': 150,
+            'resumed': 1,
+            'resumed_avg_ms': 10,
+        }
+        self.assertEqual(expected, stats.to_dict())
+
+
+class TestStatsContext(unittest.TestCase):
+
+    def setUp(self):
+        self.context = tls.StatsContext(ssl.PROTOCOL_SSLv23)
+        self.context.stats = tls.HandshakeStats()
+
+    def handshake_done(self, hits):
+        """Record a handshake, given the resulting context session hits."""
+        with mock.patch('guiserver.tls.StatsContext.session_stats') as stats:
+            stats.return_value = {'hits': hits}
+            self.context.handshake_done(0.1)
+
+    def test_full_handshakes(self):
+        # Handshakes not increasing the session hits are full handshakes.
+        self.handshake_done(0)
+        self.handshake_done(0)
+        self.assertEqual(2, self.context.stats.full)
+        self.assertEqual(0, self.context.stats.resumed)
+
+    def test_resumed_handshakes(self):
+        # Handshakes increasing the session hits resumed a session.
+        self.handshake_done(0)
+        self.handshake_done(1)
+        self.handshake_done(3)
+        self.assertEqual(1, self.context.stats.full)
+        self.assertEqual(2, self.context.stats.resumed)
+
+    def test_no_stats(self):
+        # Handshakes are ignored if no statistics are collected.
+        self.context.stats = None
+        self.handshake_done(1)
+
+
+class TestServerTLS(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = mock.Mock()
+        self.server_tls = tls.ServerTLS(
+            make_ssl_path(self), io_loop=self.io_loop)
+
+    def test_context(self):
+        # The server context records handshakes in the stats.
+        context = self.server_tls.context
+        self.assertIsInstance(context, tls.StatsContext)
+        self.assertIs(self.server_tls.stats, context.stats)
+
+    def test_rotate(self):
+        # The servers context is replaced when ticket keys are rotated.
+        server = mock.Mock()
+        self.server_tls.add_server(server)
+        context = self.server_tls.context
+        self.server_tls.rotate()
+        self.assertIsNot(context, self.server_tls.context)
+        self.assertIs(self.server_tls.context, server.ssl_options)
+        self.assertIs(self.server_tls.stats, self.server_tls.context.stats)
+
+    @mock.patch('guiserver.tls.PeriodicCallback')
+    def test_start(self, mock_periodic_callback):
+        # Ticket keys are periodically rotated.
+        self.server_tls.start()
+        mock_periodic_callback.assert_called_once_with(
+            self.server_tls.rotate, tls.TICKET_KEYS_LIFETIME * 1000,
+            io_loop=self.io_loop)
+        mock_periodic_callback().start.assert_called_once_with()
+
+
+class TestHandshakes(LogTrapTestCase, AsyncHTTPSTestCase):
+
+    def get_app(self):
+        return web.Application([(r'/', HelloHandler)])
+
+    def get_ssl_options(self):
+        self.server_tls = tls.ServerTLS(make_ssl_path(self))
+        return self.server_tls.context
+
+    def request(self):
+        """Send a request to the server on a new TLS connection.
+
+        Return when the response headers are received.
+        """
+        stream = iostream.SSLIOStream(
+            socket.socket(), io_loop=self.io_loop,
+            ssl_options={'cert_reqs': ssl.CERT_NONE})
+        self.addCleanup(stream.close)
+        stream.connect(('localhost', self.get_http_port()), self.stop)
+        self.wait()
+        stream.write(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        stream.read_until(b'\r\n\r\n', self.stop)
+        return self.wait()
+
+    def test_handshakes_recorded(self):
+        # Handshakes performed by the server are recorded.
+        self.assertIn(b'200 OK', self.request())
+        self.assertIn(b'200 OK', self.request())
+        stats = self.server_tls.stats
+        self.assertEqual(2, stats.full + stats.resumed)
+
+
+class HelloHandler(web.RequestHandler):
+    """A handler greeting the world."""
+
+    def get(self):
+        self.write('Hello, world!')
@@ -0,0 +1,171 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server authentication token stores."""
+
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import time
+import unittest
+
+from tornado.testing import (
+    AsyncTestCase,
+    ExpectLog,
+    LogTrapTestCase,
+)
+
+from guiserver import tokenstores
+
+
+class TestMemoryTokenStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = tokenstores.MemoryTokenStore()
+
+    def test_put_and_pop(self):
+        # Tokens can only be used once.
+        self.store.put('DEFACED', 'user-admin', 'ADMINSECRET', time.time() + 9)
+        self.assertEqual(1, len(self.store))
+        self.assertEqual(
+            ('user-admin', 'ADMINSECRET'), self.store.pop('DEFACED'))
+        self.assertIsNone(self.store.pop('DEFACED'))
+
+    def test_unknown(self):
+        # None is returned if the token is unknown.
+        self.assertIsNone(self.store.pop('DEFACED'))
+
+    def test_expired(self):
+        # None is returned if the token is expired.
+        self.store.put('DEFACED', 'user-admin', 'ADMINSECRET', time.time())
+        self.assertIsNone(self.store.pop('DEFACED'))
+        self.assertEqual(0, len(self.store))
+
+    def test_purge(self):
+        # Expired tokens are removed.
+        self.store.put('DEFACED', 'user-admin', 'ADMINSECRET', time.time())
+        self.store.put('BEEFED', 'user-admin', 'ADMINSECRET', time.time() + 60)
+        self.assertEqual(1, self.store.purge())
+        self.assertEqual(1, len(self.store))
+        self.assertIsNotNone(self.store.pop('BEEFED'))
+
+    def test_close(self):
+        # Tokens are forgotten when the store is closed.
+        self.store.put('DEFACED', 'user-admin', 'ADMINSECRET', time.time() + 9)
+        self.store.close()
+        self.assertEqual(0, len(self.store))
+
+
+class TestSQLiteTokenStore(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestSQLiteTokenStore, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'tokens.db')
+        self.store = self.make_store()
+
+    def make_store(self, **kwargs):
+        """Create and return a store using the test database."""
+        store = tokenstores.SQLiteTokenStore(
+            self.path, io_loop=self.io_loop, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def put(self, store, token='DEFACED', life=60):
+        """Store a token for the admin user expiring in life seconds."""
+        store.put(token, 'user-admin', 'ADMINSECRET', time.time() + life)
+
+    def test_database(self):
+        # The database uses write-ahead logging and it is private.
+        connection = sqlite3.connect(self.path)
+        self.addCleanup(connection.close)
+        mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual('wal', mode)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.path).st_mode))
+
+    def test_pending(self):
+        # Tokens not yet written can be used by the same store.
+        self.put(self.store)
+        self.assertEqual(
+            ('user-admin', 'ADMINSECRET'), self.store.pop('DEFACED'))
+        self.assertIsNone(self.store.pop('DEFACED'))
+        self.store.flush()
+        self.assertIsNone(self.make_store().pop('DEFACED'))
+
+    def test_shared(self):
+        # Written tokens can be used, only once, by other stores.
+        self.put(self.store)
+        self.store.flush()
+        other = self.make_store()
+        self.assertEqual(('user-admin', 'ADMINSECRET'), other.pop('DEFACED'))
+        self.assertIsNone(self.store.pop('DEFACED'))
+        self.assertIsNone(other.pop('DEFACED'))
+
+    def test_persistence(self):
+        # Tokens survive closing the store.
+        self.put(self.store)
+        self.store.close()
+        self.assertEqual(
+            ('user-admin', 'ADMINSECRET'), self.make_store().pop('DEFACED'))
+
+    def test_concurrent_delete(self):
+        # A token deleted by another process in the meanwhile is not returned.
+        self.put(self.store)
+        self.store.flush()
+        # Simulate the concurrent deletion by ignoring the delete statement.
+        with self.store._connection as connection:
+            connection.execute(
+                'CREATE TEMP TRIGGER ignore_delete BEFORE DELETE ON tokens '
+                'BEGIN SELECT RAISE(IGNORE); END')
+        self.assertIsNone(self.store.pop('DEFACED'))
+
+    def test_expired(self):
+        # None is returned if the token is expired.
+        self.put(self.store, life=0)
+        self.assertIsNone(self.store.pop('DEFACED'))
+        self.put(self.store, life=0)
+        self.store.flush()
+        self.assertIsNone(self.store.pop('DEFACED'))
+
+    def test_purge(self):
+        # Expired tokens are removed, both pending and written.
+        self.put(self.store, token='DEFACED', life=0)
+        self.put(self.store, token='BEEFED', life=60)
+        self.store.flush()
+        self.put(self.store, token='FACADE', life=0)
+        self.assertEqual(2, self.store.purge())
+        self.assertIsNotNone(self.make_store().pop('BEEFED'))
+
+    def test_delayed_flush(self):
+        # Tokens are automatically written in batches after a delay.
+        store = self.make_store(flush_delay=0.01)
+        self.put(store, token='DEFACED')
+        self.put(store, token='BEEFED')
+        self.io_loop.add_timeout(self.io_loop.time() + 0.2, self.stop)
+        self.wait()
+        other = self.make_store()
+        self.assertIsNotNone(other.pop('DEFACED'))
+        self.assertIsNotNone(other.pop('BEEFED'))
+
+    def test_database_error(self):
+        # Database errors are logged and the token is rejected.
+        self.store._connection.close()
+        expected_log = 'tokens: cannot retrieve token: .*'
+        with ExpectLog('', expected_log, required=True):
+            self.assertIsNone(self.store.pop('DEFACED'))
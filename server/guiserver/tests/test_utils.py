@@ -154,6 +154,26 @@ class TestGetJujuApiUrl(unittest.TestCase):
         self.assertEqual('wss://1.2.3.4:47/model/uuid/exterminate', url)
 
 
+class TestGetModelUuid(unittest.TestCase):
+
+    source_template = '/api/$server/$port/$uuid'
+
+    def test_no_match(self):
+        # None is returned if the path does not match the template.
+        self.assertIsNone(utils.get_model_uuid('/ws', self.source_template))
+
+    def test_match(self):
+        # The model UUID is returned if the path matches the template.
+        uuid = utils.get_model_uuid(
+            '/api/1.2.3.4/4242/my-uuid', self.source_template)
+        self.assertEqual('my-uuid', uuid)
+
+    def test_no_uuid(self):
+        # None is returned if the template does not include the UUID.
+        uuid = utils.get_model_uuid('/api/1.2.3.4/4242', '/api/$server/$port')
+        self.assertIsNone(uuid)
+
+
 class TestJoinUrl(unittest.TestCase):
 
     def test_url_parts(self):
@@ -191,3 +191,112 @@ class TestAsyncWatcher(unittest.TestCase):
         # The first listener is not affected by the error.
         self.watcher.put('change1')
         self.assert_results(future, ['change1'])
+
+    def test_remove(self):
+        # Removed listeners start again from the first change.
+        self.watcher.put('change1')
+        self.watcher.next('watcher1')
+        self.watcher.remove('watcher1')
+        self.assert_results(self.watcher.next('watcher1'), ['change1'])
+
+    def test_remove_pending(self):
+        # Pending futures of removed listeners are not fired.
+        future = self.watcher.next('watcher1')
+        self.watcher.remove('watcher1')
+        self.watcher.put('change1')
+        self.assertFalse(future.done())
+
+    def test_remove_unknown(self):
+        # Removing an unknown listener is a no-op.
+        self.watcher.remove('no-such-watcher')
+
+    def test_subscribe(self):
+        # Subscribed callbacks receive unseen changes and new changes.
+        calls = []
+        self.watcher.put('change1')
+        self.watcher.subscribe('watcher1', calls.append)
+        self.watcher.put('change2')
+        self.watcher.close('final change')
+        self.assertEqual(
+            [['change1'], ['change2'], ['final change']], calls)
+
+    def test_subscribe_position(self):
+        # Changes passed to subscribed callbacks are marked as seen.
+        self.watcher.subscribe('watcher1', lambda changes: None)
+        self.watcher.put('change1')
+        future = self.watcher.next('watcher1')
+        self.assertFalse(future.done())
+        self.watcher.put('change2')
+        self.assert_results(future, ['change2'])
+
+    def test_subscribe_no_changes(self):
+        # The callback is not called if there are no unseen changes.
+        calls = []
+        self.watcher.subscribe('watcher1', calls.append)
+        self.assertEqual([], calls)
+
+    def test_subscribe_closed(self):
+        # Callbacks subscribed to closed watchers receive the closing change.
+        calls = []
+        self.watcher.close('final change')
+        self.watcher.subscribe('watcher1', calls.append)
+        self.assertEqual([['final change']], calls)
+
+    def test_subscribe_twice(self):
+        # An error is raised if the same watcher id subscribes twice.
+        self.watcher.subscribe('w1', lambda changes: None)
+        with self.assert_error('watcher w1 is already waiting for changes'):
+            self.watcher.subscribe('w1', lambda changes: None)
+
+    def test_remove_subscribed(self):
+        # Callbacks of removed listeners are no longer called.
+        calls = []
+        self.watcher.subscribe('watcher1', calls.append)
+        self.watcher.remove('watcher1')
+        self.watcher.put('change1')
+        self.assertEqual([], calls)
+
+
+class TestRingBufferWatcher(TestAsyncWatcher):
+
+    def setUp(self):
+        # Set up a ring buffer watcher large enough to pass the AsyncWatcher
+        # tests.
+        self.watcher = watchers.RingBufferWatcher(10)
+
+    def test_invalid_capacity(self):
+        # The capacity must be a positive number.
+        with self.assertRaises(ValueError) as context_manager:
+            watchers.RingBufferWatcher(0)
+        self.assertEqual('invalid capacity: 0', str(context_manager.exception))
+
+    def test_bounded_history(self):
+        # Only the last changes are stored, and a gap change is sent to
+        # listeners that missed changes.
+        watcher = watchers.RingBufferWatcher(3)
+        for number in range(5):
+            watcher.put(number)
+        self.assert_results(watcher.next('watcher1'), [{'Gap': 2}, 2, 3, 4])
+        self.assertEqual(4, watcher.getlast())
+
+    def test_falling_behind(self):
+        # Listeners falling behind are notified of the changes they missed.
+        watcher = watchers.RingBufferWatcher(2)
+        watcher.put('change1')
+        self.assert_results(watcher.next('watcher1'), ['change1'])
+        for change in ('change2', 'change3', 'change4', 'change5'):
+            watcher.put(change)
+        self.assert_results(
+            watcher.next('watcher1'), [{'Gap': 2}, 'change4', 'change5'])
+        # Listeners keeping up do not receive gap changes.
+        watcher.put('change6')
+        self.assert_results(watcher.next('watcher1'), ['change6'])
+
+    def test_make_gap(self):
+        # The gap change can be customized.
+        watcher = watchers.RingBufferWatcher(
+            1, make_gap=lambda missed: 'missed {}'.format(missed))
+        watcher.put('change1')
+        watcher.put('change2')
+        self.assert_results(
+            watcher.next('watcher1'), ['missed 1', 'change2'])
@@ -0,0 +1,248 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Juju GUI server TLS support.
+
+The HTTPS listener uses a single SSL context, so that the TLS session cache
+and session tickets let returning browsers resume their sessions with an
+abbreviated handshake, instead of paying a full handshake (including an
+expensive RSA private key operation) for each new connection.
+
+Python 2 does not expose the session ticket keys, which are generated by
+OpenSSL when an SSL context is created: the keys are rotated by replacing the
+listener context every TICKET_KEYS_LIFETIME seconds, which also empties the
+session cache.
+
+Similarly, the secure WebSocket connections to the Juju API servers share a
+single client SSL context (see guiserver.clients).
+"""
+
+import logging
+import os
+import ssl
+import time
+
+from tornado.ioloop import (
+    IOLoop,
+    PeriodicCallback,
+)
+
+
+# Define ciphers supported by this server, preferring forward secret ECDHE
+# key exchanges and AEAD ciphers:
+# see <https://www-origin.openssl.org/docs/manmaster/apps/ciphers.html>.
+CIPHERS = ':'.join([
+    'ECDHE+AESGCM',
+    'ECDHE+CHACHA20',
+    'ECDHE+AES',
+    'DHE+AESGCM',
+    'HIGH',
+    '!RC4',
+    '!MD5',
+    '!aNULL',
+    '!eNULL',
+    '!EXP',
+    '!LOW',
+    '!MEDIUM',
+])
+# Define the elliptic curve used for ECDHE key exchanges.
+ECDH_CURVE = 'prime256v1'
+# Define the certificate and key file names, relative to the SSL path. The
+# ECDSA certificate is optional: if present, it is served to clients
+# supporting it, as ECDSA handshakes are much cheaper than RSA ones.
+CERTFILE = 'juju.crt'
+KEYFILE = 'juju.key'
+ECDSA_CERTFILE = 'juju-ecdsa.crt'
+ECDSA_KEYFILE = 'juju-ecdsa.key'
+# Define how often, in seconds, session ticket keys are rotated.
+TICKET_KEYS_LIFETIME = 12 * 60 * 60
+
+
+def make_server_context(sslpath):
+    """Return an SSL context suitable for the GUI server HTTPS listener.
+
+    The certificates are loaded from the given SSL path.
+    """
+    context = StatsContext(ssl.PROTOCOL_SSLv23)
+    context.options |= (
+        ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION |
+        ssl.OP_CIPHER_SERVER_PREFERENCE | ssl.OP_SINGLE_ECDH_USE)
+    context.set_ciphers(CIPHERS)
+    context.set_ecdh_curve(ECDH_CURVE)
+    context.load_cert_chain(
+        os.path.join(sslpath, CERTFILE), os.path.join(sslpath, KEYFILE))
+    ecdsa_certfile = os.path.join(sslpath, ECDSA_CERTFILE)
+    if os.path.exists(ecdsa_certfile):
+        context.load_cert_chain(
+            ecdsa_certfile, os.path.join(sslpath, ECDSA_KEYFILE))
+    return context
+
+
+class HandshakeStats(object):
+    """Count and time TLS handshakes.
+
+    Handshakes are split between full handshakes and abbreviated ones, in
+    which a previous TLS session is resumed.
+    """
+
+    def __init__(self):
+        self.full = 0
+        self.resumed = 0
+        self._full_time = 0.0
+        self._resumed_time = 0.0
+
+    def add(self, resumed, duration):
+        """Record a handshake which took the given number of seconds."""
+        if resumed:
+            self.resumed += 1
+            self._resumed_time += duration
+        else:
+            self.full += 1
+            self._full_time += duration
+
+    def to_dict(self):
+        """Return the handshake statistics as a dict.
+
+        Durations are average times in milliseconds, including the network
+        round trips required by the handshakes.
+        """
+        return {
+            'full': self.full,
+            'full_avg_ms': _average_ms(self._full_time, self.full),
+            'resumed': self.resumed,
+            'resumed_avg_ms': _average_ms(self._resumed_time, self.resumed),
+        }
+
+
+def _average_ms(total, count):
+    """Return the average in milliseconds of count durations in seconds."""
+    if not count:
+        return 0
+    return round(total * 1000 / count, 3)
+
+
+def make_client_context():
+    """Return an SSL context suitable for connecting to the Juju API servers.
+
+    Certificates are not validated, as Juju uses self-signed certificates.
+    Handshake statistics are recorded in the context stats attribute.
+
+    Note that Python 2 does not allow clients to resume TLS sessions, so
+    the context saves the cost of setting up SSL for each connection, but
+    client handshakes are always full handshakes.
+    """
+    context = StatsContext(ssl.PROTOCOL_SSLv23)
+    context.options |= (
+        ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_COMPRESSION)
+    context.set_ciphers(CIPHERS)
+    context.stats = HandshakeStats()
+    return context
+
+
+class StatsContext(ssl.SSLContext):
+    """An SSL context recording statistics about the handshakes.
+
+    Statistics are recorded in the stats attribute, if set.
+    """
+
+    stats = None
+
+    def __init__(self, protocol):
+        super(StatsContext, self).__init__(protocol)
+        # The number of sessions resumed so far by this context.
+        self._session_hits = 0
+
+    def wrap_socket(
+            self, sock, server_side=False, do_handshake_on_connect=True,
+            suppress_ragged_eofs=True, server_hostname=None):
+        """Return an SSL socket recording its handshake."""
+        return _HandshakeTimingSocket(
+            sock=sock, server_side=server_side,
+            do_handshake_on_connect=do_handshake_on_connect,
+            suppress_ragged_eofs=suppress_ragged_eofs,
+            server_hostname=server_hostname, _context=self)
+
+    def handshake_done(self, duration):
+        """Record a handshake which took the given number of seconds."""
+        # Handshakes complete one at a time in the IO loop thread: the
+        # session has been resumed if the context hits counter increased.
+        hits = self.session_stats()['hits']
+        resumed = hits > self._session_hits
+        self._session_hits = hits
+        if self.stats is not None:
+            self.stats.add(resumed, duration)
+
+
+class _HandshakeTimingSocket(ssl.SSLSocket):
+    """An SSL socket measuring the duration of its handshake.
+
+    With non-blocking sockets, the handshake duration goes from the first
+    do_handshake call to the successful one.
+    """
+
+    _handshake_started = None
+
+    def do_handshake(self, block=False):
+        if self._handshake_started is None:
+            self._handshake_started = time.time()
+        super(_HandshakeTimingSocket, self).do_handshake(block)
+        self.context.handshake_done(time.time() - self._handshake_started)
+
+
+class ServerTLS(object):
+    """The TLS setup of the GUI server HTTPS listener.
+
+    Use the context attribute as the listener SSL options, and register the
+    resulting HTTP servers with add_server, so that the session ticket keys
+    are rotated once start is called. Handshake statistics are collected in
+    the stats attribute.
+    """
+
+    def __init__(self, sslpath, io_loop=None):
+        self._sslpath = sslpath
+        self._io_loop = io_loop or IOLoop.current()
+        self._servers = []
+        self.stats = HandshakeStats()
+        self.context = self._make_context()
+
+    def _make_context(self):
+        """Create and return a new server SSL context."""
+        context = make_server_context(self._sslpath)
+        context.stats = self.stats
+        return context
+
+    def add_server(self, server):
+        """Register the given Tornado HTTP server."""
+        self._servers.append(server)
+
+    def rotate(self):
+        """Replace the SSL context of the registered servers.
+
+        The new context uses new session ticket keys, and starts with an
+        empty session cache. Connections already established are not
+        affected.
+        """
+        self.context = self._make_context()
+        for server in self._servers:
+            server.ssl_options = self.context
+        logging.info('tls: session ticket keys rotated')
+
+    def start(self):
+        """Periodically rotate the session ticket keys."""
+        PeriodicCallback(
+            self.rotate, TICKET_KEYS_LIFETIME * 1000,
+            io_loop=self._io_loop).start()
@@ -0,0 +1,209 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2016 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server authentication token stores.
+
+Authentication tokens (see guiserver.auth.AuthenticationTokenHandler) are
+single-use credentials with a limited life. Tokens are kept in a store, which
+must implement the following interface:
+    - put(token, username, password, expires): store the credentials for the
+      given token, valid until the given expiration time (in seconds since
+      the epoch);
+    - pop(token) -> (username, password) or None: remove the given token and
+      return its credentials, or None if the token is unknown, already used
+      or expired;
+    - purge() -> int: remove the expired tokens, returning how many of them
+      have been removed; and
+    - close(): release the resources used by the store.
+
+The MemoryTokenStore keeps tokens in a dict, and it is suitable when a single
+GUI server process is running. The SQLiteTokenStore persists tokens in a SQLite
+database using write-ahead logging, so that tokens survive server restarts and
+can be shared by multiple GUI server processes: a token created by one process
+can be used, only once, in another one. New tokens are written in batches, at
+most FLUSH_DELAY seconds after their creation: in the meanwhile they are only
+available to the process which created them.
+
+Note that stores include user credentials: the SQLite database is only
+readable by its owner.
+"""
+
+import logging
+import os
+import sqlite3
+import time
+
+from tornado.ioloop import IOLoop
+
+
+# Define the number of seconds new tokens are collected before being written.
+FLUSH_DELAY = 0.1
+# Define the number of seconds to wait for a locked database.
+LOCK_TIMEOUT = 5
+
+
+class MemoryTokenStore(object):
+    """Store authentication tokens in memory."""
+
+    def __init__(self):
+        # Map tokens to (username, password, expires) tuples.
+        self._data = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def put(self, token, username, password, expires):
+        """Store the credentials for the given token."""
+        self._data[token] = (username, password, expires)
+
+    def pop(self, token):
+        """Remove the given token and return its credentials.
+
+        Return None if the token is unknown or expired.
+        """
+        record = self._data.pop(token, None)
+        if record is None or record[2] <= time.time():
+            return None
+        return record[:2]
+
+    def purge(self):
+        """Remove the expired tokens and return their number."""
+        now = time.time()
+        expired = [
+            token for token, record in self._data.items() if record[2] <= now]
+        for token in expired:
+            del self._data[token]
+        return len(expired)
+
+    def close(self):
+        """Forget all the stored tokens."""
+        self._data.clear()
+
+
+class SQLiteTokenStore(object):
+    """Store authentication tokens in a SQLite database."""
+
+    def __init__(self, path, io_loop=None, flush_delay=FLUSH_DELAY):
+        self.path = path
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._flush_delay = flush_delay
+        # Store the tokens not yet written, as (username, password, expires)
+        # tuples, so that they can be used without querying the database.
+        self._pending = {}
+        self._timeout = None
+        # Create the database file readable and writable only by its owner.
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        self._connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        # In WAL mode the database is still consistent after a crash, but the
+        # last transactions may be lost: this is acceptable for tokens.
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                'token TEXT PRIMARY KEY, username TEXT NOT NULL, '
+                'password TEXT NOT NULL, expires REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS tokens_expires '
+                'ON tokens (expires)')
+
+    def put(self, token, username, password, expires):
+        """Schedule the credentials for the given token to be written."""
+        self._pending[token] = (username, password, expires)
+        if self._timeout is None:
+            self._timeout = self._io_loop.add_timeout(
+                self._io_loop.time() + self._flush_delay, self.flush)
+
+    def pop(self, token):
+        """Remove the given token and return its credentials.
+
+        Return None if the token is unknown, expired, or if it has been
+        already used, possibly by another process sharing the database.
+        """
+        record = self._pending.pop(token, None)
+        if record is None:
+            record = self._delete(token)
+        if record is None or record[2] <= time.time():
+            return None
+        return record[:2]
+
+    def _delete(self, token):
+        """Delete the given token from the database and return its record.
+
+        Return None if the token is not in the database.
+        """
+        connection = self._connection
+        try:
+            with connection:
+                record = connection.execute(
+                    'SELECT username, password, expires FROM tokens '
+                    'WHERE token = ?', (token,)).fetchone()
+                if record is None:
+                    return None
+                cursor = connection.execute(
+                    'DELETE FROM tokens WHERE token = ?', (token,))
+        except sqlite3.Error as err:
+            logging.error('tokens: cannot retrieve token: {}'.format(err))
+            return None
+        # Another process could have deleted the token in the meanwhile.
+        if cursor.rowcount != 1:
+            return None
+        return record
+
+    def flush(self):
+        """Write pending tokens to the database in a single transaction."""
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._pending:
+            return
+        rows = [
+            (token,) + record for token, record in self._pending.items()]
+        try:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO tokens '
+                    '(token, username, password, expires) '
+                    'VALUES (?, ?, ?, ?)', rows)
+        except sqlite3.Error as err:
+            # Pending tokens are still available to the current process.
+            logging.error('tokens: cannot write tokens: {}'.format(err))
+            return
+        self._pending.clear()
+
+    def purge(self):
+        """Remove the expired tokens and return their number."""
+        now = time.time()
+        expired = [
+            token for token, record in self._pending.items()
+            if record[2] <= now]
+        for token in expired:
+            del self._pending[token]
+        try:
+            with self._connection:
+                cursor = self._connection.execute(
+                    'DELETE FROM tokens WHERE expires <= ?', (now,))
+        except sqlite3.Error as err:
+            logging.error('tokens: cannot purge tokens: {}'.format(err))
+            return len(expired)
+        return len(expired) + cursor.rowcount
+
+    def close(self):
+        """Write pending tokens and close the database."""
+        self.flush()
+        self._connection.close()
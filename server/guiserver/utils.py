@@ -73,17 +73,37 @@ def get_juju_api_url(path, source_template, target_template, default):
     parsed values to the real Juju WebSocket URL.
     If a URL cannot be inferred as described, return the given default.
     """
-    pattern = source_template.replace(
-        '$server', '(?P<server>.*)').replace(
-        '$port', '(?P<port>\d+)').replace(
-        '$uuid', '(?P<uuid>.*)')
-    match = re.search(pattern, path)
+    match = _match_source_template(path, source_template)
     if match is None:
         # The path is empty: probably an old Juju version is being used.
         return default
     return target_template.format(**match.groupdict())
 
 
+def get_model_uuid(path, source_template):
+    """Return the model UUID included in the given WebSocket handler path.
+
+    See get_juju_api_url for a description of the path and source template.
+    Return None if the UUID cannot be found.
+    """
+    match = _match_source_template(path, source_template)
+    if match is None:
+        return None
+    return match.groupdict().get('uuid')
+
+
+def _match_source_template(path, source_template):
+    """Match the given path against the given WebSocket source template.
+
+    Return the resulting match object, or None if the path does not match.
+    """
+    pattern = source_template.replace(
+        '$server', '(?P<server>.*)').replace(
+        '$port', '(?P<port>\d+)').replace(
+        '$uuid', '(?P<uuid>.*)')
+    return re.search(pattern, path)
+
+
 def join_url(base_url, path, query):
     """Create and return an URL string joining the given parts.
 
@@ -19,6 +19,14 @@
 from concurrent.futures import Future
 
 
+def make_gap(missed):
+    """Return a change notifying a listener that changes have been missed.
+
+    The missed argument is the number of changes the listener did not receive.
+    """
+    return {'Gap': missed}
+
+
 class WatcherError(Exception):
     """Errors in the execution of the watcher methods."""
 
@@ -53,6 +61,12 @@ class AsyncWatcher(object):
     A watcher can be closed with a final change by invoking its close() method.
     When a watcher is closed, it is no longer possible to put new changes in
     it, and subsequent listeners will receive only the closing change.
+
+    Listeners can also subscribe a callback, which is called with the list of
+    unseen changes right away (if any), and then each time a change is put
+    into the watcher or the watcher is closed:
+
+        watcher.subscribe(42, callback)
     """
 
     def __init__(self):
@@ -64,6 +78,29 @@ class AsyncWatcher(object):
         # The _positions attribute maps watcher identifiers to the
         # corresponding position in the changes list.
         self._positions = {}
+        # The _callbacks attribute maps watcher identifiers to the callbacks
+        # of subscribed listeners.
+        self._callbacks = {}
+
+    def _pop_unseen(self, watcher_id):
+        """Return the changes not yet seen by the given listener.
+
+        Also mark those changes as seen.
+        """
+        watcher_position = self._positions.get(watcher_id, 0)
+        position = len(self._changes)
+        self._positions[watcher_id] = position
+        return self._changes[watcher_position:]
+
+    def _fire_callbacks(self, changes):
+        """Call the callbacks of all the subscribed listeners.
+
+        Update the position for all involved listeners.
+        """
+        position = len(self._changes)
+        for watcher_id, callback in self._callbacks.items():
+            self._positions[watcher_id] = position
+            callback(changes)
 
     def _fire_futures(self, changes):
         """Set a result to all pending Futures.
@@ -121,6 +158,7 @@ class AsyncWatcher(object):
             raise WatcherError('unable to put changes in a closed watcher')
         self._changes.append(change)
         self._fire_futures([change])
+        self._fire_callbacks([change])
 
     def close(self, change):
         """Close the watcher with the given closing message."""
@@ -129,4 +167,172 @@ class AsyncWatcher(object):
         self.closed = True
         self._changes = [change]
         self._fire_futures([change])
+        self._fire_callbacks([change])
+        self._positions = {}
+        self._callbacks = {}
+
+    def subscribe(self, watcher_id, callback):
+        """Call the given callback passing changes as soon as they are put.
+
+        Unseen changes are immediately passed to the callback. If the watcher
+        is closed, the callback is only called with the closing change.
+        """
+        if watcher_id in self._futures or watcher_id in self._callbacks:
+            raise WatcherError(
+                'watcher {} is already waiting for changes'.format(watcher_id))
+        if self.closed:
+            callback([self.getlast()])
+            return
+        changes = self._pop_unseen(watcher_id)
+        self._callbacks[watcher_id] = callback
+        if changes:
+            callback(changes)
+
+    def remove(self, watcher_id):
+        """Forget the listener identified by the given watcher id.
+
+        This is usually called when the listener goes away. A pending Future
+        or a subscribed callback for the listener, if any, is discarded
+        without being fired.
+        """
+        self._futures.pop(watcher_id, None)
+        self._callbacks.pop(watcher_id, None)
+        self._positions.pop(watcher_id, None)
+
+
+class RingBufferWatcher(AsyncWatcher):
+    """An asynchronous watcher storing a bounded number of changes.
+
+    This watcher works like the AsyncWatcher, but only the last capacity
+    changes are stored, in a ring buffer. Each change is assigned an increasing
+    sequence number, and the position of each listener is the sequence number
+    of the next change to send. Listeners falling behind by more than capacity
+    changes receive a gap change before the stored ones, e.g.:
+
+        watcher = RingBufferWatcher(2)
+        for change in ('a', 'b', 'c'):
+            watcher.put(change)
+        watcher.next(42).result()  # [{'Gap': 1}, 'b', 'c']
+
+    The gap change is created by calling the given make_gap callable passing
+    the number of missed changes.
+    """
+
+    def __init__(self, capacity, make_gap=make_gap):
+        if capacity < 1:
+            raise ValueError('invalid capacity: {}'.format(capacity))
+        super(RingBufferWatcher, self).__init__()
+        self._capacity = capacity
+        self._make_gap = make_gap
+        self._buffer = [None] * capacity
+        # The sequence number to be assigned to the next change.
+        self._sequence = 0
+        # The change used to close the watcher.
+        self._closing_change = None
+
+    def _fire_futures(self, changes):
+        """Set a result to all pending Futures.
+
+        Update the position for all involved listeners.
+        """
+        for watcher_id, future in self._futures.items():
+            self._positions[watcher_id] = self._sequence
+            future.set_result(changes)
+        self._futures = {}
+
+    def _fire_callbacks(self, changes):
+        """Call the callbacks of all the subscribed listeners.
+
+        Update the position for all involved listeners.
+        """
+        for watcher_id, callback in self._callbacks.items():
+            self._positions[watcher_id] = self._sequence
+            callback(changes)
+
+    def _pop_unseen(self, watcher_id):
+        """Return the changes not yet seen by the given listener.
+
+        Also mark those changes as seen.
+        """
+        watcher_position = self._positions.get(watcher_id, 0)
+        self._positions[watcher_id] = self._sequence
+        if watcher_position < self._sequence:
+            return self._get_changes(watcher_position)
+        return []
+
+    def _get_changes(self, position):
+        """Return the changes starting from the given sequence number.
+
+        Prepend a gap change if some of the changes are no longer stored.
+        """
+        first = max(0, self._sequence - self._capacity)
+        changes = []
+        if position < first:
+            changes.append(self._make_gap(first - position))
+            position = first
+        capacity = self._capacity
+        buf = self._buffer
+        changes.extend(
+            buf[sequence % capacity]
+            for sequence in xrange(position, self._sequence))
+        return changes
+
+    @property
+    def empty(self):
+        """Return True if the watcher is empty, False otherwise."""
+        return not (self._sequence or self.closed)
+
+    def next(self, watcher_id):
+        """Subscribe the given watcher id to the watcher, requesting changes.
+
+        Return a Future whose result is a list of unseen changes.
+        """
+        if watcher_id in self._futures:
+            raise WatcherError(
+                'watcher {} is already waiting for changes'.format(watcher_id))
+        future = Future()
+        if self.closed:
+            future.set_result([self._closing_change])
+            return future
+        watcher_position = self._positions.get(watcher_id, 0)
+        if watcher_position < self._sequence:
+            # There are already unseen changes to send.
+            future.set_result(self._get_changes(watcher_position))
+            self._positions[watcher_id] = self._sequence
+        else:
+            # There are not unseen changes, the returned future will be
+            # probably fired later.
+            self._futures[watcher_id] = future
+        return future
+
+    def getlast(self):
+        """Return the last notified change.
+
+        Raise an error if the watcher is empty.
+        """
+        if self.closed:
+            return self._closing_change
+        if self._sequence:
+            return self._buffer[(self._sequence - 1) % self._capacity]
+        raise WatcherError('the watcher is empty')
+
+    def put(self, change):
+        """Put a change into the watcher."""
+        if self.closed:
+            raise WatcherError('unable to put changes in a closed watcher')
+        self._buffer[self._sequence % self._capacity] = change
+        self._sequence += 1
+        self._fire_futures([change])
+        self._fire_callbacks([change])
+
+    def close(self, change):
+        """Close the watcher with the given closing message."""
+        if self.closed:
+            raise WatcherError('the watcher is already closed')
+        self.closed = True
+        self._closing_change = change
+        self._buffer = []
+        self._fire_futures([change])
+        self._fire_callbacks([change])
         self._positions = {}
+        self._callbacks = {}
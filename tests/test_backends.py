@@ -37,6 +37,10 @@ EXPECTED_DEBS = (
     'curl', 'libcurl3', 'openssl', 'python-bzrlib', 'python-pip',
     'python-pycurl')
 
+EXPECTED_RELOADABLE = (
+    'bundleservice-url', 'charmstore-url', 'gisf-enabled', 'gtm-enabled',
+    'gzip-compression', 'interactive-login', 'juju-gui-debug', 'password')
+
 JUJU_VERSION = run('jujud', '--version').strip()
 
 
@@ -62,6 +66,12 @@ class TestBackendProperties(unittest.TestCase):
         test_backend = backend.Backend(config={})
         self.assertEqual(set(EXPECTED_DEBS), test_backend.get_dependencies())
 
+    def test_reloadable(self):
+        # Ensure the backend includes the expected reloadable config keys.
+        test_backend = backend.Backend(config={})
+        self.assertEqual(
+            set(EXPECTED_RELOADABLE), test_backend.get_reloadable())
+
 
 class TestBackendCommands(unittest.TestCase):
 
@@ -318,6 +328,38 @@ class TestBackendCommands(unittest.TestCase):
             not config['secure'],
             config['charmworld-url'], port=8080)
 
+    def test_reload(self):
+        # Reload the GUI server.
+        config = self.make_config({'gtm-enabled': True})
+        test_backend = backend.Backend(
+            config=config, prev_config=self.make_config())
+        with self.mock_all() as mocks:
+            with patch_environ(JUJU_MODEL_UUID='model-uuid'):
+                test_backend.reload()
+        mocks.start_builtin_server.assert_called_once_with(
+            self.ssl_cert_path,
+            config['serve-tests'],
+            config['sandbox'],
+            config['builtin-server-logging'],
+            False,                        # insecure
+            config['charmworld-url'],
+            charmstore_url='http://charmstore.example.com/',
+            bundleservice_url='',
+            env_uuid='model-uuid',
+            interactive_login=False,
+            juju_version=JUJU_VERSION,
+            debug=False,
+            gtm_enabled=True,
+            gisf_enabled=False,
+            gzip=True,
+            port=None,
+            env_password=None,
+            reload=True)
+        # The GUI is not installed again and ports are left untouched.
+        self.assertFalse(mocks.setup_gui.called)
+        self.assertFalse(mocks.setup_ports.called)
+        self.assertFalse(mocks.stop_builtin_server.called)
+
     def test_stop(self):
         # Stop the GUI server.
         test_backend = backend.Backend(config=self.make_config())
@@ -344,6 +386,27 @@ class TestBackendUtils(unittest.TestCase):
         self.assertTrue(test_backend.different('sandbox'))
         self.assertFalse(test_backend.different('secure'))
 
+    def test_can_reload(self):
+        # Changes to reloadable keys can be applied by reloading.
+        test_backend = backend.Backend(
+            config={'gtm-enabled': True, 'password': 'new', 'secure': False},
+            prev_config={'gtm-enabled': False, 'secure': False},
+        )
+        self.assertTrue(test_backend.can_reload())
+
+    def test_cannot_reload(self):
+        # Changes to other keys require restarting the services.
+        test_backend = backend.Backend(
+            config={'gtm-enabled': True, 'secure': True},
+            prev_config={'gtm-enabled': False, 'secure': False},
+        )
+        self.assertFalse(test_backend.can_reload())
+
+    def test_cannot_reload_without_previous_config(self):
+        # A reload is not possible if the services have never been started.
+        test_backend = backend.Backend(config={'gtm-enabled': True})
+        self.assertFalse(test_backend.can_reload())
+
 
 class TestCallMethods(unittest.TestCase):
 
@@ -29,23 +29,33 @@ from shelltoolbox import environ
 import tempita
 
 from utils import (
+    DEPLOYMENTS_JOURNAL_PATH,
+    GUISERVER_OPTIONS_PATH,
     JUJU_GUI_DIR,
     JUJU_PEM,
+    RELOAD,
     RESTART,
     STOP,
+    TOKENS_DB_PATH,
     cmd_log,
     get_api_address,
+    get_api_addresses,
     get_port,
+    get_python_deps_archive_path,
+    get_python_deps_hash,
     get_release_file_path,
+    hash_paths,
     install_builtin_server,
     install_missing_packages,
     log_hook,
     port_in_range,
     render_to_file,
     save_or_create_certificates,
+    setup_gui,
     setup_ports,
     start_builtin_server,
     stop_builtin_server,
+    unpack_python_deps,
     write_builtin_server_startup,
 )
 # Import the whole utils package for monkey patching.
@@ -119,6 +129,19 @@ class TestGetApiAddress(unittest.TestCase):
         with self.agent_file() as (unit_dir, _):
             self.assertRaises(IOError, get_api_address, unit_dir)
 
+    def test_all_addresses_in_env(self):
+        # All the API addresses listed in the environment are returned.
+        addresses = '{} foo.example.com:42'.format(self.env_address)
+        with environ(JUJU_API_ADDRESSES=addresses):
+            self.assertEqual(
+                [self.env_address, 'foo.example.com:42'], get_api_addresses())
+
+    def test_all_addresses_in_agent_file(self):
+        # All the API addresses listed in the agent file are returned.
+        addresses = [self.agent_address, 'foo.example.com:42']
+        with self.agent_file(addresses) as (unit_dir, _):
+            self.assertEqual(addresses, get_api_addresses(unit_dir))
+
 
 class TestGetReleaseFilePath(unittest.TestCase):
 
@@ -330,6 +353,8 @@ class TestSaveOrCreateCertificates(unittest.TestCase):
         self.cert_path = os.path.join(base_dir, 'certificates')
         self.cert_file = os.path.join(self.cert_path, 'juju.crt')
         self.key_file = os.path.join(self.cert_path, 'juju.key')
+        self.ecdsa_cert_file = os.path.join(self.cert_path, 'juju-ecdsa.crt')
+        self.ecdsa_key_file = os.path.join(self.cert_path, 'juju-ecdsa.key')
 
     def test_generation(self):
         # Ensure certificates are correctly generated.
@@ -338,6 +363,20 @@ class TestSaveOrCreateCertificates(unittest.TestCase):
         self.assertIn('CERTIFICATE', open(self.cert_file).read())
         self.assertIn('PRIVATE KEY', open(self.key_file).read())
 
+    def test_ecdsa_generation(self):
+        # Ensure ECDSA certificates are generated as well.
+        save_or_create_certificates(self.cert_path, None, None)
+        self.assertIn('CERTIFICATE', open(self.ecdsa_cert_file).read())
+        self.assertIn('PRIVATE KEY', open(self.ecdsa_key_file).read())
+
+    def test_provided_certificates_ecdsa_removed(self):
+        # Ensure generated ECDSA certificates are removed if certificates are
+        # provided.
+        save_or_create_certificates(self.cert_path, None, None)
+        save_or_create_certificates(self.cert_path, 'mycert', 'mykey')
+        self.assertFalse(os.path.exists(self.ecdsa_cert_file))
+        self.assertFalse(os.path.exists(self.ecdsa_key_file))
+
     def test_provided_certificates(self):
         # Ensure files are correctly saved if their contents are provided.
         save_or_create_certificates(self.cert_path, 'mycert', 'mykey')
@@ -417,7 +456,9 @@ class TestStartGui(unittest.TestCase):
             su=(utils.su, su),
             run=(utils.run, run),
             render_to_file=(utils.render_to_file, render_to_file),
-            get_api_address=(utils.get_api_address, noop),
+            get_api_addresses=(
+                utils.get_api_addresses,
+                lambda: ['1.2.3.4:17070', '1.2.3.5:17070']),
         )
         # Apply the patches.
         for fn, fcns in self.utils_names.items():
@@ -427,6 +468,17 @@ class TestStartGui(unittest.TestCase):
         shutil.copy = noop
         self.os_chmod = os.chmod
         os.chmod = noop
+        self.hashes_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.hashes_dir)
+        hashes_path = os.path.join(self.hashes_dir, 'install-hashes.json')
+        patchers = (
+            mock.patch('utils.INSTALL_HASHES_PATH', hashes_path),
+            # The pre-built Python dependencies archive is not available.
+            mock.patch('utils.unpack_python_deps', return_value=False),
+        )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def tearDown(self):
         # Undo all of the monkey patching.
@@ -448,9 +500,14 @@ class TestStartGui(unittest.TestCase):
         guiserver_conf = self.files['runserver.sh']
         self.assertIn('description "GUIServer"', guiserver_conf)
         self.assertIn('--logging="info"', guiserver_conf)
-        # The get_api_address is noop'd in these tests so the addr is None.
-        self.assertIn('--apiurl="wss://None"', guiserver_conf)
+        self.assertIn('--apiurl="wss://1.2.3.4:17070"', guiserver_conf)
+        self.assertIn('--apiaddresses="1.2.3.5:17070"', guiserver_conf)
         self.assertIn('--apiversion="go"', guiserver_conf)
+        self.assertIn(
+            '--deploymentsjournal="{}"'.format(DEPLOYMENTS_JOURNAL_PATH),
+            guiserver_conf)
+        self.assertIn(
+            '--tokensdb="{}"'.format(TOKENS_DB_PATH), guiserver_conf)
         self.assertIn(
             '--testsroot="{}/test/"'.format(JUJU_GUI_DIR), guiserver_conf)
         self.assertIn('--insecure', guiserver_conf)
@@ -479,19 +536,49 @@ class TestStartGui(unittest.TestCase):
         self.assertIn('--logging="debug"', guiserver_conf)
         self.assertIn('--sandbox', guiserver_conf)
         self.assertNotIn('--apiurl', guiserver_conf)
+        self.assertNotIn('--apiaddresses', guiserver_conf)
         self.assertNotIn('--apiversion', guiserver_conf)
+        self.assertNotIn('--deploymentsjournal', guiserver_conf)
+        self.assertNotIn('--tokensdb', guiserver_conf)
 
     def test_write_builtin_server_startup_with_bundleservice(self):
-        # The builtin server Upstart file is properly generated with
+        # The builtin server options file is properly generated with
         # bundleservice.
         write_builtin_server_startup(
             self.ssl_cert_path,
-            bundleservice_url='https://1.2.3.4/bundleservice',
+            bundleservice_url=u'https://1.2.3.4/bundleservice',
             interactive_login=True)
+        options = self.files['guiserver.options']
+        self.assertIn(
+            "bundleservice_url = 'https://1.2.3.4/bundleservice'", options)
+        self.assertIn('interactivelogin = True', options)
+
+    def test_write_builtin_server_options(self):
+        # The reloadable options are stored in the builtin server options
+        # file, which is passed to the server.
+        write_builtin_server_startup(
+            self.ssl_cert_path, charmstore_url=self.charmstore_url,
+            env_password='secret', debug=True, gtm_enabled=True)
+        options = {}
+        exec self.files['guiserver.options'] in options
+        del options['__builtins__']
+        expected = {
+            'bundleservice_url': None,
+            'charmstoreurl': self.charmstore_url,
+            'gisf': False,
+            'gtm': True,
+            'gzip': True,
+            'interactivelogin': False,
+            'jujuguidebug': True,
+            'password': 'secret',
+        }
+        self.assertEqual(expected, options)
         guiserver_conf = self.files['runserver.sh']
-        self.assertIn('--bundleservice_url="https://1.2.3.4/bundleservice"',
-                      guiserver_conf)
-        self.assertIn('--interactivelogin="True"', guiserver_conf)
+        self.assertIn(
+            '--configfile="{}"'.format(GUISERVER_OPTIONS_PATH),
+            guiserver_conf)
+        self.assertNotIn('--password', guiserver_conf)
+        self.assertNotIn('--gtm', guiserver_conf)
 
     def test_start_builtin_server(self):
         start_builtin_server(
@@ -502,6 +589,16 @@ class TestStartGui(unittest.TestCase):
         self.assertEqual(self.service_names, ['guiserver'])
         self.assertEqual(self.actions, [RESTART])
 
+    def test_reload_builtin_server(self):
+        start_builtin_server(
+            self.ssl_cert_path, serve_tests=False, sandbox=False,
+            builtin_server_logging='info', insecure=False,
+            charmworld_url='http://charmworld.example.com/', port=443,
+            reload=True)
+        self.assertEqual(self.svc_ctl_call_count, 1)
+        self.assertEqual(self.service_names, ['guiserver'])
+        self.assertEqual(self.actions, [RELOAD])
+
     def test_stop_builtin_server(self):
         stop_builtin_server()
         self.assertEqual(self.svc_ctl_call_count, 1)
@@ -659,11 +756,228 @@ class TestGetPort(unittest.TestCase):
             self.assertEqual(4747, get_port())
 
 
+class TestHashPaths(unittest.TestCase):
+
+    def setUp(self):
+        # Set up a directory with some files.
+        self.playground = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.playground)
+        self.subdir = os.path.join(self.playground, 'subdir')
+        os.mkdir(self.subdir)
+        self.write('file1.txt', 'contents1')
+        self.write('file2.txt', 'contents2')
+        self.write('subdir/module.py', 'code')
+
+    def write(self, path, contents):
+        """Write the given contents to the given file in the playground."""
+        with open(os.path.join(self.playground, path), 'w') as stream:
+            stream.write(contents)
+
+    def test_stable(self):
+        # The same checksum is returned if files do not change.
+        pattern = os.path.join(self.playground, '*.txt')
+        self.assertEqual(hash_paths(pattern), hash_paths(pattern))
+
+    def test_file_changed(self):
+        # The checksum changes if a file changes.
+        pattern = os.path.join(self.playground, '*.txt')
+        checksum = hash_paths(pattern)
+        self.write('file2.txt', 'changed')
+        self.assertNotEqual(checksum, hash_paths(pattern))
+
+    def test_file_added(self):
+        # The checksum changes if a file is added.
+        pattern = os.path.join(self.playground, '*.txt')
+        checksum = hash_paths(pattern)
+        self.write('file3.txt', 'contents3')
+        self.assertNotEqual(checksum, hash_paths(pattern))
+
+    def test_directory(self):
+        # Directories are walked recursively.
+        checksum = hash_paths(self.playground)
+        self.write('subdir/module.py', 'changed')
+        self.assertNotEqual(checksum, hash_paths(self.playground))
+
+    def test_compiled_files_ignored(self):
+        # Compiled Python files are not included in the checksum.
+        checksum = hash_paths(self.playground)
+        self.write('subdir/module.pyc', 'compiled')
+        self.assertEqual(checksum, hash_paths(self.playground))
+
+    def test_multiple_paths(self):
+        # The checksum includes all the given paths.
+        file1 = os.path.join(self.playground, 'file1.txt')
+        checksum = hash_paths(file1, self.subdir)
+        self.assertNotEqual(checksum, hash_paths(file1))
+        self.assertNotEqual(checksum, hash_paths(self.subdir))
+
+
+class InstallTestMixin(object):
+    """Set up the install hashes file for installation tests.
+
+    Also set up the paths of the pre-built Python dependencies archive, which
+    does not exist unless created by the test (see make_archive).
+    """
+
+    def setUp(self):
+        playground = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, playground)
+        self.hashes_path = os.path.join(playground, 'install-hashes.json')
+        self.archive_path = os.path.join(playground, 'python-deps.tar.gz')
+        self.site_dir = os.path.join(playground, 'dist-packages')
+        patchers = (
+            mock.patch('utils.INSTALL_HASHES_PATH', self.hashes_path),
+            mock.patch(
+                'utils.get_python_deps_archive_path',
+                return_value=self.archive_path),
+            mock.patch('utils.PYTHON_SITE_DIR', self.site_dir),
+        )
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_archive(self, contents='archive'):
+        """Create the pre-built Python dependencies archive."""
+        with open(self.archive_path, 'w') as stream:
+            stream.write(contents)
+
+    def tar_call(self):
+        """Return the expected call used to unpack the archive."""
+        return mock.call(
+            'tar', '-xzf', self.archive_path, '-C', self.site_dir)
+
+
+class TestGetPythonDepsArchivePath(unittest.TestCase):
+
+    def setUp(self):
+        self.playground = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.playground)
+        open(os.path.join(self.playground, 'juju-gui-2.0.1.tgz'), 'w').close()
+        patcher = mock.patch('utils.RELEASES_DIR', self.playground)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('platform.machine', mock.Mock(return_value='x86_64'))
+    @mock.patch(
+        'platform.linux_distribution',
+        mock.Mock(return_value=('Ubuntu', '16.04', 'xenial')))
+    @mock.patch('utils.get_python_deps_hash', mock.Mock(return_value='a' * 32))
+    def test_path(self):
+        # The archive name includes the release version, the platform and the
+        # checksum of the dependencies.
+        path = get_python_deps_archive_path()
+        self.assertEqual(self.playground, os.path.dirname(path))
+        filename = os.path.basename(path)
+        self.assertTrue(filename.startswith('python-deps-2.0.1-py27-'))
+        self.assertTrue(
+            filename.endswith('-x86_64-xenial-aaaaaaaaaaaa.tar.gz'))
+
+    def test_not_a_release(self):
+        # The archive is not mistaken for a Juju GUI release.
+        open(get_python_deps_archive_path(), 'w').close()
+        self.assertEqual(
+            os.path.join(self.playground, 'juju-gui-2.0.1.tgz'),
+            get_release_file_path())
+
+
+class TestGetPythonDepsHash(unittest.TestCase):
+
+    def setUp(self):
+        self.playground = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.playground)
+        for path in ('deps', 'jujugui-deps'):
+            os.mkdir(os.path.join(self.playground, path))
+        self.write('server-requirements.pip', 'tornado==3.2.2\n')
+        self.write('deps/tornado-3.2.2.tar.gz', 'tornado')
+        self.write('jujugui-deps/pyramid-1.5.tar.gz', 'pyramid')
+        patcher = mock.patch('utils.CURRENT_DIR', self.playground)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, path, contents):
+        """Write the given contents to the path in the charm directory."""
+        with open(os.path.join(self.playground, path), 'w') as stream:
+            stream.write(contents)
+
+    def test_changed_requirements(self):
+        # The hash changes if the requirements file changes.
+        checksum = get_python_deps_hash()
+        self.write('server-requirements.pip', 'tornado==4.0\n')
+        self.assertNotEqual(checksum, get_python_deps_hash())
+
+    def test_changed_dependencies(self):
+        # The hash changes if packages are added or updated.
+        checksum = get_python_deps_hash()
+        self.write('deps/tornado-3.2.2.tar.gz', 'tornado patched')
+        updated = get_python_deps_hash()
+        self.assertNotEqual(checksum, updated)
+        self.write('jujugui-deps/webob-1.4.tar.gz', 'webob')
+        self.assertNotEqual(updated, get_python_deps_hash())
+
+    def test_charm_directory(self):
+        # The hash does not depend on the location of the charm directory.
+        checksum = get_python_deps_hash()
+        path = os.path.join(self.playground, 'charm')
+        shutil.copytree(self.playground, path)
+        with mock.patch('utils.CURRENT_DIR', path):
+            self.assertEqual(checksum, get_python_deps_hash())
+
+
+@mock.patch('utils.run')
+@mock.patch('utils.log')
+@mock.patch('utils.cmd_log', mock.Mock())
+@mock.patch('utils.su', mock.MagicMock())
+class TestUnpackPythonDeps(InstallTestMixin, unittest.TestCase):
+
+    def test_missing(self, mock_log, mock_run):
+        # False is returned if the archive is not found.
+        self.assertFalse(unpack_python_deps())
+        self.assertFalse(mock_run.called)
+        mock_log.assert_called_once_with(
+            'No up to date pre-built Python dependencies found for this '
+            'platform.')
+
+    def test_unpack(self, mock_log, mock_run):
+        # The archive is unpacked in the system site packages.
+        self.make_archive()
+        self.assertTrue(unpack_python_deps())
+        mock_run.assert_called_once_with(*self.tar_call()[1])
+        self.assertTrue(os.path.isdir(self.site_dir))
+
+    def test_up_to_date(self, mock_log, mock_run):
+        # The archive is not unpacked again if it did not change.
+        self.make_archive()
+        unpack_python_deps()
+        self.assertTrue(unpack_python_deps())
+        self.assertEqual(1, mock_run.call_count)
+
+    def test_changed(self, mock_log, mock_run):
+        # The archive is unpacked again if it changed.
+        self.make_archive()
+        unpack_python_deps()
+        self.make_archive(contents='new archive')
+        self.assertTrue(unpack_python_deps())
+        self.assertEqual(2, mock_run.call_count)
+
+    def test_failure(self, mock_log, mock_run):
+        # False is returned if the archive cannot be extracted.
+        self.make_archive()
+        mock_run.side_effect = CalledProcessError(2, 'tar')
+        self.assertFalse(unpack_python_deps())
+        mock_log.assert_called_with(
+            'Unable to unpack the Python dependencies: '
+            "Command 'tar' returned non-zero exit status 2.")
+        # The extraction is retried the next time.
+        mock_run.side_effect = None
+        self.assertTrue(unpack_python_deps())
+        self.assertEqual(2, mock_run.call_count)
+
+
 @mock.patch('utils.run')
 @mock.patch('utils.log')
 @mock.patch('utils.cmd_log', mock.Mock())
 @mock.patch('utils.su', mock.MagicMock())
-class TestInstallBuiltinServer(unittest.TestCase):
+class TestInstallBuiltinServer(InstallTestMixin, unittest.TestCase):
 
     def test_call(self, mock_log, mock_run):
         # The builtin server its correctly installed.
@@ -684,6 +998,92 @@ class TestInstallBuiltinServer(unittest.TestCase):
                 os.path.join(charm_dir, 'server', 'setup.py'), 'install')
         ])
 
+    def test_up_to_date(self, mock_log, mock_run):
+        # The builtin server is not installed again if nothing changed.
+        install_builtin_server()
+        mock_run.reset_mock()
+        install_builtin_server()
+        self.assertFalse(mock_run.called)
+        mock_log.assert_called_with('The builtin server is up to date.')
+
+    def test_changed(self, mock_log, mock_run):
+        # The builtin server is installed again if its inputs changed.
+        install_builtin_server()
+        mock_run.reset_mock()
+        with mock.patch('utils.hash_paths', return_value='new-checksum'):
+            install_builtin_server()
+        self.assertEqual(2, mock_run.call_count)
+
+    def test_failure(self, mock_log, mock_run):
+        # The installation is retried if it previously failed.
+        mock_run.side_effect = CalledProcessError(1, 'pip2')
+        with self.assertRaises(CalledProcessError):
+            install_builtin_server()
+        mock_run.side_effect = None
+        install_builtin_server()
+        self.assertEqual(3, mock_run.call_count)
+
+    def test_python_deps_archive(self, mock_log, mock_run):
+        # The dependencies are unpacked from the archive if available.
+        self.make_archive()
+        install_builtin_server()
+        charm_dir = os.path.abspath(
+            os.path.join(os.path.dirname(__file__), '..'))
+        self.assertEqual([
+            self.tar_call(),
+            mock.call(
+                '/usr/bin/python',
+                os.path.join(charm_dir, 'server', 'setup.py'), 'install')
+        ], mock_run.call_args_list)
+
+
+@mock.patch('utils.run')
+@mock.patch('utils.log')
+@mock.patch('utils.cmd_log', mock.Mock())
+@mock.patch('utils.su', mock.MagicMock())
+class TestSetupGui(InstallTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSetupGui, self).setUp()
+        # Set up a release file.
+        fd, self.release_path = tempfile.mkstemp(suffix='.tar.bz2')
+        os.close(fd)
+        self.addCleanup(os.remove, self.release_path)
+        patcher = mock.patch(
+            'utils.get_release_file_path', return_value=self.release_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_call(self, mock_log, mock_run):
+        # The Juju GUI is correctly installed.
+        setup_gui()
+        charm_dir = os.path.abspath(
+            os.path.join(os.path.dirname(__file__), '..'))
+        mock_run.assert_called_once_with(
+            'pip2', 'install', '--no-index', '--find-links',
+            'file:///{}/jujugui-deps'.format(charm_dir), self.release_path)
+
+    def test_up_to_date(self, mock_log, mock_run):
+        # The Juju GUI is not installed again if nothing changed.
+        setup_gui()
+        setup_gui()
+        self.assertEqual(1, mock_run.call_count)
+        mock_log.assert_called_with('Juju GUI is up to date.')
+
+    def test_release_changed(self, mock_log, mock_run):
+        # The Juju GUI is installed again if the release file changed.
+        setup_gui()
+        with open(self.release_path, 'w') as stream:
+            stream.write('new release')
+        setup_gui()
+        self.assertEqual(2, mock_run.call_count)
+
+    def test_python_deps_archive(self, mock_log, mock_run):
+        # The Juju GUI is unpacked from the archive if available.
+        self.make_archive()
+        setup_gui()
+        mock_run.assert_called_once_with(*self.tar_call()[1])
+
 
 @mock.patch('utils.find_missing_packages')
 @mock.patch('utils.install_extra_repositories')